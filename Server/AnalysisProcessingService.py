@@ -30,18 +30,16 @@ import numpy as np
 import pytz
 from cryptography.fernet import Fernet
 
-import websocket
 from BRAVO import asgi
 
 from Backend import models
 from modules.Percept import Sessions
-from modules import Database, AnalysisBuilder
+from modules import Database, AnalysisBuilder, Notification
 from decoder import Percept
 
 DATABASE_PATH = os.environ.get('DATASERVER_PATH')
 
 def processAnalysis():
-    ws = websocket.WebSocket()
     if models.ProcessingQueue.objects.filter(type="ProcessAnalysis", state="InProgress").exists():
         print(datetime.datetime.now())
         BatchQueues = models.ProcessingQueue.objects.filter(type="ProcessAnalysis", state="InProgress").order_by("datetime").all()
@@ -63,19 +61,13 @@ def processAnalysis():
             queue.state="Complete"
             queue.save()
 
-            try:
-                ws.connect("ws://localhost:3001/socket/notification")
-                ws.send(json.dumps({
-                    "NotificationType": "AnalysisProcessing",
-                    "TaskUser": str(user.unique_user_id),
-                    "TaskID": queue.descriptor["analysisId"],
-                    "Authorization": os.environ["ENCRYPTION_KEY"],
-                    "State": "EndProcessing",
-                    "Message": Results,
-                }))
-                ws.close()
-            except Exception as e:
-                print(e)
+            Notification.publishNotification({
+                "NotificationType": "AnalysisProcessing",
+                "TaskUser": str(user.unique_user_id),
+                "TaskID": queue.descriptor["analysisId"],
+                "State": "EndProcessing",
+                "Message": Results,
+            })
                 
 
 
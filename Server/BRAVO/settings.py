@@ -175,6 +175,7 @@ if BRAVODatabase:
             'HOST': os.environ.get('BRAVO_DATABASE_HOST'),
             'PORT': os.environ.get('BRAVO_DATABASE_PORT'),
             'PROTOCOL': "tcp",
+            'CONN_MAX_AGE': int(os.environ.get('DATABASE_CONN_MAX_AGE', 0)),
             'OPTIONS': {
                 'init_command': "SET sql_mode='STRICT_TRANS_TABLES'"
             },
@@ -184,6 +185,7 @@ else:
     DATABASES = {
         'default': {
             'ENGINE': 'django.db.backends.mysql',
+            'CONN_MAX_AGE': int(os.environ.get('DATABASE_CONN_MAX_AGE', 0)),
             'OPTIONS': {
                 'read_default_file': os.path.join(BASE_DIR, 'mysql.config'),
                 'init_command': "SET sql_mode='STRICT_TRANS_TABLES'"
@@ -226,25 +228,57 @@ USE_TZ = True
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 # Django DB Automatic Reconnect
+# Idle connections are pinged before reuse instead of issuing a query before every cursor. 
+# Read-only queries that fail because the server dropped the connection are retried once on a new connection.
 import importlib
+import time
 
 from django.conf import settings
 from django.db.backends.utils import CursorWrapper
+from django.db.utils import OperationalError
+
+DATABASE_PING_INTERVAL = float(os.environ.get('DATABASE_PING_INTERVAL', 60))
+DATABASE_RECONNECT_COUNT = {"Ping": 0, "Retry": 0}
+
+# MySQL client errors: server has gone away, lost connection during query, lost connection to server
+CONNECTION_LOST_ERRORS = (2006, 2013, 2055)
 
 for name, config in settings.DATABASES.items():
     module = importlib.import_module(config["ENGINE"] + ".base")
 
     def ensure_connection(self):
-        if self.connection is not None:
-            try:
-                with CursorWrapper(self.create_cursor(), self) as cursor:
-                    cursor.execute("SELECT 1")
-                return
-            except Exception:
-                pass
-
-        with self.wrap_database_errors:
-            self.connect()
+        if self.connection is not None and not self.in_atomic_block:
+            if time.monotonic() - getattr(self, "bravo_last_activity", 0) > DATABASE_PING_INTERVAL and not self.is_usable():
+                DATABASE_RECONNECT_COUNT["Ping"] += 1
+                print(f"Database connection lost after idle, reconnecting ({DATABASE_RECONNECT_COUNT['Ping']})")
+                try:
+                    self.close()
+                except Exception:
+                    self.connection = None
+
+        if self.connection is None:
+            with self.wrap_database_errors:
+                self.connect()
+        self.bravo_last_activity = time.monotonic()
 
     module.DatabaseWrapper.ensure_connection = ensure_connection
-    
\ No newline at end of file
+
+CursorWrapperExecute = CursorWrapper.execute
+def execute(self, sql, params=None):
+    try:
+        return CursorWrapperExecute(self, sql, params)
+    except OperationalError as e:
+        if self.db.in_atomic_block or not e.args or not e.args[0] in CONNECTION_LOST_ERRORS or not sql.lstrip().upper().startswith("SELECT"):
+            raise
+
+        DATABASE_RECONNECT_COUNT["Retry"] += 1
+        print(f"Database connection lost during query, retrying ({DATABASE_RECONNECT_COUNT['Retry']})")
+        try:
+            self.db.close()
+        except Exception:
+            self.db.connection = None
+        self.db.ensure_connection()
+        self.cursor = self.db.create_cursor()
+        return CursorWrapperExecute(self, sql, params)
+
+CursorWrapper.execute = execute
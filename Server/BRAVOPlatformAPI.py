@@ -22,22 +22,39 @@ Python Package to Access BRAVO REST APIs
 """
 
 import pandas as pd
+import numpy as np
 import requests
 from datetime import datetime
 import json
+import msgpack
+
+# MessagePack extension type used by the server for NumPy arrays (see Backend.APIs.Renderers)
+NDARRAY_EXTENSION = 1
+
+def decodeArray(code, data):
+    if code == NDARRAY_EXTENSION:
+        dtype, shape, buffer = msgpack.unpackb(data, raw=False)
+        return np.frombuffer(buffer, dtype=np.dtype(dtype)).reshape(shape)
+    return msgpack.ExtType(code, data)
+
+def decodeResponse(response):
+    if response.headers.get("Content-Type", "").startswith("application/x-msgpack"):
+        return msgpack.unpackb(response.content, ext_hook=decodeArray, raw=False, strict_map_key=False)
+    return response.json()
 
 class BRAVOPlatformRequest:
-    def __init__(self, username, password, server="http://localhost:3001"):
+    def __init__(self, username, password, server="http://localhost:3001", binary=False):
         self.__Username = username
         self.__Password = password
         self.__Server = server
         self.__RefreshCode = ""
+        self.__Accept = "application/x-msgpack" if binary else "application/json"
         
         form = {"Email": username, "Password": password, "Persistent": True}
         headers = {"Content-Type": "application/json"}
         response = requests.post(self.__Server + "/api/authenticate", json.dumps(form), headers=headers)
         if response.status_code == 200:
-            payload = response.json()
+            payload = decodeResponse(response)
             self.__RefreshCode = payload["refresh"]
             self.__Headers = {"Content-Type": "application/json", "Authorization": f"Bearer {payload['access']}"} 
         else:
@@ -49,7 +66,7 @@ class BRAVOPlatformRequest:
         headers = {"Content-Type": "application/json"}
         response = requests.post(self.__Server + "/api/authRefresh", json.dumps(form), headers=headers)
         if response.status_code == 200:
-            payload = response.json()
+            payload = decodeResponse(response)
             self.__Headers = {"Content-Type": "application/json", "Authorization": f"Bearer {payload['access']}"} 
         else:
             print(response.content)
@@ -58,11 +75,11 @@ class BRAVOPlatformRequest:
     def RequestPatientList(self):
         response = requests.post(self.__Server + "/api/queryPatients", headers=self.__Headers)
         if response.status_code == 200:
-            payload = response.json()
+            payload = decodeResponse(response)
             return payload
         else:
             if response.status_code == 400:
-                raise Exception(f"Network Error: {response.json()}")
+                raise Exception(f"Network Error: {decodeResponse(response)}")
             elif response.status_code == 401:
                 self.refreshAuthToken()
                 return self.RequestPatientList()
@@ -73,11 +90,11 @@ class BRAVOPlatformRequest:
         form = {"id": PatientID}
         response = requests.post(self.__Server + "/api/queryPatientInfo", json.dumps(form), headers=self.__Headers)
         if response.status_code == 200:
-            payload = response.json()
+            payload = decodeResponse(response)
             return payload
         else:
             if response.status_code == 400:
-                raise Exception(f"Network Error: {response.json()}")
+                raise Exception(f"Network Error: {decodeResponse(response)}")
             elif response.status_code == 401:
                 self.refreshAuthToken()
                 return self.RequestPatientInfo(PatientID)
@@ -96,7 +113,7 @@ class BRAVOPlatformRequest:
             return True
         else:
             if response.status_code == 400:
-                raise Exception(f"Network Error: {response.json()}")
+                raise Exception(f"Network Error: {decodeResponse(response)}")
             elif response.status_code == 401:
                 self.refreshAuthToken()
                 return self.RequestPatientTagUpdate(PatientID, PatientObj)
@@ -109,13 +126,13 @@ class BRAVOPlatformRequest:
             
     def RequestAverageNeuralActivity(self, PatientID):
         form = {"id": PatientID}
-        response = requests.post(self.__Server + "/api/queryAverageNeuralActivity", json.dumps(form), headers=self.__Headers)
+        response = requests.post(self.__Server + "/api/queryAverageNeuralActivity", json.dumps(form), headers=dict(self.__Headers, Accept=self.__Accept))
         if response.status_code == 200:
-            payload = response.json()
+            payload = decodeResponse(response)
             return payload
         else:
             if response.status_code == 400:
-                raise Exception(f"Network Error: {response.json()}")
+                raise Exception(f"Network Error: {decodeResponse(response)}")
             elif response.status_code == 401:
                 self.refreshAuthToken()
                 return self.RequestAverageNeuralActivity(PatientID)
@@ -124,13 +141,13 @@ class BRAVOPlatformRequest:
         
     def RequestAverageNeuralActivitiesRaw(self, PatientID):
         form = {"id": PatientID, "requestRaw": True}
-        response = requests.post(self.__Server + "/api/requestAverageNeuralActivity", json.dumps(form), headers=self.__Headers)
+        response = requests.post(self.__Server + "/api/requestAverageNeuralActivity", json.dumps(form), headers=dict(self.__Headers, Accept=self.__Accept))
         if response.status_code == 200:
-            payload = response.json()
+            payload = decodeResponse(response)
             return payload
         else:
             if response.status_code == 400:
-                raise Exception(f"Network Error: {response.json()}")
+                raise Exception(f"Network Error: {decodeResponse(response)}")
             elif response.status_code == 401:
                 self.refreshAuthToken()
                 return self.RequestAverageNeuralActivitiesRaw(PatientID)
@@ -139,13 +156,13 @@ class BRAVOPlatformRequest:
         
     def RequestNeuralActivityStreaming(self, PatientID):
         form = {"id": PatientID, "requestOverview": True}
-        response = requests.post(self.__Server + "/api/queryNeuralActivityStreaming", json.dumps(form), headers=self.__Headers)
+        response = requests.post(self.__Server + "/api/queryNeuralActivityStreaming", json.dumps(form), headers=dict(self.__Headers, Accept=self.__Accept))
         if response.status_code == 200:
-            payload = response.json()
+            payload = decodeResponse(response)
             return payload
         else:
             if response.status_code == 400:
-                raise Exception(f"Network Error: {response.json()}")
+                raise Exception(f"Network Error: {decodeResponse(response)}")
             elif response.status_code == 401:
                 self.refreshAuthToken()
                 return self.RequestNeuralActivityStreaming(PatientID)
@@ -154,9 +171,9 @@ class BRAVOPlatformRequest:
         
     def RequestNeuralActivityStream(self, PatientID, RecordingID):
         form = {"id": PatientID, "recordingId": RecordingID, "requestData": True}
-        response = requests.post(self.__Server + "/api/queryNeuralActivityStreaming", json.dumps(form), headers=self.__Headers)
+        response = requests.post(self.__Server + "/api/queryNeuralActivityStreaming", json.dumps(form), headers=dict(self.__Headers, Accept=self.__Accept))
         if response.status_code == 200:
-            payload = response.json()
+            payload = decodeResponse(response)
             return payload
         elif response.status_code == 401:
             self.refreshAuthToken()
@@ -166,9 +183,9 @@ class BRAVOPlatformRequest:
         
     def RequestMultiChannelStreamList(self, PatientID):
         form = {"id": PatientID, "requestOverview": True}
-        response = requests.post(self.__Server + "/api/queryMultiChannelStreaming", json.dumps(form), headers=self.__Headers)
+        response = requests.post(self.__Server + "/api/queryMultiChannelStreaming", json.dumps(form), headers=dict(self.__Headers, Accept=self.__Accept))
         if response.status_code == 200:
-            payload = response.json()
+            payload = decodeResponse(response)
             return payload
         elif response.status_code == 401:
             self.refreshAuthToken()
@@ -178,9 +195,9 @@ class BRAVOPlatformRequest:
         
     def RequestMultiChannelStream(self, PatientID, Timestamps, Devices):
         form = {"id": PatientID, "timestamps": Timestamps, "devices": Devices, "requestData": True}
-        response = requests.post(self.__Server + "/api/queryMultiChannelStreaming", json.dumps(form), headers=self.__Headers)
+        response = requests.post(self.__Server + "/api/queryMultiChannelStreaming", json.dumps(form), headers=dict(self.__Headers, Accept=self.__Accept))
         if response.status_code == 200:
-            payload = response.json()
+            payload = decodeResponse(response)
             return payload
         elif response.status_code == 401:
             self.refreshAuthToken()
@@ -196,7 +213,7 @@ class BRAVOPlatformRequest:
         form = {"id": PatientID}
         response = requests.post(self.__Server + "/api/queryTherapyHistory", json.dumps(form), headers=self.__Headers)
         if response.status_code == 200:
-            payload = response.json()
+            payload = decodeResponse(response)
             return payload
         elif response.status_code == 401:
             self.refreshAuthToken()
@@ -206,13 +223,13 @@ class BRAVOPlatformRequest:
     
     def RequestChronicLFP(self, PatientID):
         form = {"id": PatientID, "requestData": True, "timezoneOffset": 3600*5, "normalizeCircadianRhythm": False}
-        response = requests.post(self.__Server + "/api/queryChronicNeuralActivity", json.dumps(form), headers=self.__Headers)
+        response = requests.post(self.__Server + "/api/queryChronicNeuralActivity", json.dumps(form), headers=dict(self.__Headers, Accept=self.__Accept))
         if response.status_code == 200:
-            payload = response.json()
+            payload = decodeResponse(response)
             return payload
         else:
             if response.status_code == 400:
-                raise Exception(f"Network Error: {response.json()}")
+                raise Exception(f"Network Error: {decodeResponse(response)}")
             elif response.status_code == 401:
                 self.refreshAuthToken()
                 return self.RequestChronicLFP(PatientID)
@@ -223,11 +240,11 @@ class BRAVOPlatformRequest:
         form = {"id": PatientID}
         response = requests.post(self.__Server + "/api/queryPatientEvents", json.dumps(form), headers=self.__Headers)
         if response.status_code == 200:
-            payload = response.json()
+            payload = decodeResponse(response)
             return payload
         else:
             if response.status_code == 400:
-                raise Exception(f"Network Error: {response.json()}")
+                raise Exception(f"Network Error: {decodeResponse(response)}")
             elif response.status_code == 401:
                 self.refreshAuthToken()
                 return self.RequestPatientEvents(PatientID)
@@ -238,11 +255,11 @@ class BRAVOPlatformRequest:
         form = {"id": PatientID, "requestOverview": True}
         response = requests.post(self.__Server + "/api/queryPredictionModel", json.dumps(form), headers=self.__Headers)
         if response.status_code == 200:
-            payload = response.json()
+            payload = decodeResponse(response)
             return payload
         else:
             if response.status_code == 400:
-                raise Exception(f"Network Error: {response.json()}")
+                raise Exception(f"Network Error: {decodeResponse(response)}")
             elif response.status_code == 401:
                 self.refreshAuthToken()
                 return self.RequestPatientEvents(PatientID)
@@ -253,11 +270,11 @@ class BRAVOPlatformRequest:
         form = {"id": PatientID, "recordingId": RecordingID, "updatePredictionModels": True}
         response = requests.post(self.__Server + "/api/queryPredictionModel", json.dumps(form), headers=self.__Headers)
         if response.status_code == 200:
-            payload = response.json()
+            payload = decodeResponse(response)
             return payload
         else:
             if response.status_code == 400:
-                raise Exception(f"Network Error: {response.json()}")
+                raise Exception(f"Network Error: {decodeResponse(response)}")
             elif response.status_code == 401:
                 self.refreshAuthToken()
                 return self.RequestPatientEvents(PatientID)
@@ -25,8 +25,9 @@ from rest_framework.response import Response
 from django.http import HttpResponse
 
 from Backend import models, tasks
+from Backend.APIs import Renderers
 
-from modules import Database, ImageDatabase, AnalysisBuilder, WearableRecordingsDatabase, Therapy, RealtimeStream
+from modules import Database, ImageDatabase, AnalysisBuilder, WearableRecordingsDatabase, Therapy, RealtimeStream, LevelOfDetail
 from modules.Percept import Sessions, BrainSenseSurvey, BrainSenseEvent, BrainSenseStream, IndefiniteStream, ChronicBrainSense, TherapeuticPrediction, AdaptiveStimulation
 from modules.Summit import ChronicLogs, StreamingData
 from utility.PythonUtility import uniqueList
@@ -232,6 +233,7 @@ class QueryAverageNeuralActivity(RestViews.APIView):
     """
 
     parser_classes = [RestParsers.JSONParser]
+    renderer_classes = RestViews.APIView.renderer_classes + [Renderers.MessagePackRenderer]
     permission_classes = [IsAuthenticated]
     def post(self, request):
         if "id" in request.data:
@@ -276,6 +278,9 @@ class QueryNeuralActivityStreaming(RestViews.APIView):
     **Request specific Neural Activity Streaming Recording based on recording ID**
     
     ``requestFrequency`` is optional if user want to request power value from different frequency instead of the automated algorithm
+
+    ``viewport`` is optional. If provided, time-domain data is decimated to what is needed to render ``width`` pixels 
+    between ``start`` and ``end`` (seconds relative to recording start) instead of transmitted at full resolution.
       
     .. code-block:: json
 
@@ -283,7 +288,19 @@ class QueryNeuralActivityStreaming(RestViews.APIView):
         "requestData": true,
         "id": "(uuid)",
         "recordingId": "(uuid)",
-        "[requestFrequency]": "(int)"
+        "[requestFrequency]": "(int)",
+        "[viewport]": {"start": "(float)", "end": "(float)", "width": "(int)"}
+      }
+
+    **Request time-domain data for a new viewport (zoom or pan) without reprocessing power spectrum**
+
+    .. code-block:: json
+
+      {
+        "requestViewport": true,
+        "id": "(uuid)",
+        "recordingId": "(uuid)",
+        "viewport": {"start": "(float)", "end": "(float)", "width": "(int)"}
       }
 
     **Request update on power spectrum data for rendering**
@@ -322,6 +339,7 @@ class QueryNeuralActivityStreaming(RestViews.APIView):
     """
 
     parser_classes = [RestParsers.JSONParser]
+    renderer_classes = RestViews.APIView.renderer_classes + [Renderers.MessagePackRenderer]
     permission_classes = [IsAuthenticated]
     def post(self, request):
         request.user.configuration["ProcessingSettings"], changed = Database.retrieveProcessingSettings(request.user.configuration)
@@ -374,7 +392,7 @@ class QueryNeuralActivityStreaming(RestViews.APIView):
                     "Duration": item.event_duration
                 } for item in annotations]
 
-                data = RealtimeStream.processRealtimeStreamRenderingData(BrainSenseData, request.user.configuration["ProcessingSettings"]["RealtimeStream"], centerFrequencies=centerFrequencies)
+                data = RealtimeStream.processRealtimeStreamRenderingData(BrainSenseData, request.user.configuration["ProcessingSettings"]["RealtimeStream"], centerFrequencies=centerFrequencies, viewport=LevelOfDetail.parseViewport(request.data))
                 data = RealtimeStream.processAnnotationAnalysis(data)
                 return Response(status=200, data=data)
 
@@ -396,10 +414,36 @@ class QueryNeuralActivityStreaming(RestViews.APIView):
                     "Duration": item.event_duration
                 } for item in annotations]
 
-                data = RealtimeStream.processRealtimeStreamRenderingData(BrainSenseData, request.user.configuration["ProcessingSettings"]["RealtimeStream"], centerFrequencies=centerFrequencies)
+                data = RealtimeStream.processRealtimeStreamRenderingData(BrainSenseData, request.user.configuration["ProcessingSettings"]["RealtimeStream"], centerFrequencies=centerFrequencies, viewport=LevelOfDetail.parseViewport(request.data))
                 data = RealtimeStream.processAnnotationAnalysis(data)
                 return Response(status=200, data=data)
 
+        elif "requestViewport" in request.data:
+            Authority = {}
+            Authority["Level"] = Database.verifyAccess(request.user, request.data["id"])
+            if Authority["Level"] == 0:
+                return Response(status=400, data={"code": ERROR_CODE["PERMISSION_DENIED"]})
+
+            viewport = LevelOfDetail.parseViewport(request.data)
+            if not viewport:
+                return Response(status=400, data={"code": ERROR_CODE["MALFORMATED_REQUEST"]})
+
+            if Authority["Level"] == 1:
+                Authority["Permission"] = Database.verifyPermission(request.user, request.data["id"], Authority, "BrainSenseStream")
+            elif Authority["Level"] == 2:
+                PatientInfo = Database.extractAccess(request.user, request.data["id"])
+                Authority["Permission"] = Database.verifyPermission(request.user, PatientInfo.authorized_patient_id, Authority, "BrainSenseStream")
+
+            BrainSenseData, _ = RealtimeStream.queryRealtimeStreamRecording(request.user, request.data["recordingId"], Authority, 
+                                                                            refresh=False, cardiacFilter=request.user.configuration["ProcessingSettings"]["RealtimeStream"]["CardiacFilter"]["value"] == "true")
+            if BrainSenseData == None:
+                return Response(status=400, data={"code": ERROR_CODE["DATA_NOT_FOUND"]})
+
+            return Response(status=200, data={
+                "Viewport": viewport,
+                "Stream": RealtimeStream.processRealtimeStreamViewport(BrainSenseData, viewport)
+            })
+
         elif "updateStimulationPSD" in request.data:
             Authority = {}
             Authority["Level"] = Database.verifyAccess(request.user, request.data["id"])
@@ -455,7 +499,7 @@ class QueryNeuralActivityStreaming(RestViews.APIView):
             request.user.save()
 
             BrainSenseData, _ = RealtimeStream.queryRealtimeStreamRecording(request.user, request.data["recordingId"], Authority, 
-                                                                            refresh=True, cardiacFilter=request.data["updateCardiacFilter"])
+                                                                            refresh=False, cardiacFilter=request.data["updateCardiacFilter"])
             if BrainSenseData == None:
                 return Response(status=400, data={"code": ERROR_CODE["DATA_NOT_FOUND"]})
             
@@ -518,6 +562,9 @@ class QueryMultiChannelStreaming(RestViews.APIView):
       }
 
     **Request specific Indefinite Streaming Recording based on list of provided devices and timestamps**
+
+    ``viewport`` is optional. If provided, time-domain data is decimated to what is needed to render ``width`` pixels 
+    between ``start`` and ``end`` (seconds relative to recording start) and returned with ``StreamTime``.
     
     .. code-block:: json
 
@@ -525,7 +572,8 @@ class QueryMultiChannelStreaming(RestViews.APIView):
         "requestData": true,
         "id": "(uuid)",
         "timestamps": ["(int)"],
-        "devices": ["(uuid)"]
+        "devices": ["(uuid)"],
+        "[viewport]": {"start": "(float)", "end": "(float)", "width": "(int)"}
       }
 
     Returns:
@@ -534,6 +582,7 @@ class QueryMultiChannelStreaming(RestViews.APIView):
     """
 
     parser_classes = [RestParsers.JSONParser]
+    renderer_classes = RestViews.APIView.renderer_classes + [Renderers.MessagePackRenderer]
     permission_classes = [IsAuthenticated]
     def post(self, request):
         request.user.configuration["ProcessingSettings"], changed = Database.retrieveProcessingSettings(request.user.configuration)
@@ -584,7 +633,7 @@ class QueryMultiChannelStreaming(RestViews.APIView):
                 PatientID = PatientInfo.authorized_patient_id
 
             Authority["Permission"] = Database.verifyPermission(request.user, PatientID, Authority, "IndefiniteStream")
-            data = IndefiniteStream.queryMontageData(request.user, devices, timestamps, Authority)
+            data = IndefiniteStream.queryMontageData(request.user, devices, timestamps, Authority, viewport=LevelOfDetail.parseViewport(request.data))
 
             for i in range(len(data)):
                 annotations = models.CustomAnnotations.objects.filter(patient_deidentified_id=PatientID, 
@@ -667,6 +716,7 @@ class QueryChronicNeuralActivity(RestViews.APIView):
     """
 
     parser_classes = [RestParsers.JSONParser]
+    renderer_classes = RestViews.APIView.renderer_classes + [Renderers.MessagePackRenderer]
     permission_classes = [IsAuthenticated]
     def post(self, request):
         if "requestData" in request.data and "timezoneOffset" in request.data:
@@ -827,13 +877,18 @@ class QueryPredictionModel(RestViews.APIView):
                 return Response(status=400, data={"code": ERROR_CODE["DATA_NOT_FOUND"]})
             BrainSenseData["PowerDomain"]["Stimulation"] = RealtimeStream.processRealtimeStreamStimulationAmplitude(BrainSenseData["PowerDomain"])
 
+            # Prediction models precomputed by the processing queue are used if they match the cardiac filter setting and model version.
+            CardiacFilter = request.user.configuration["ProcessingSettings"]["RealtimeStream"]["CardiacFilter"]["value"] == "true"
+            PredictionModels = {item.recording_channel: item.model_details for item in models.PredictionModel.objects.filter(recording_id=request.data["recordingId"]).all()}
+
             data = list()
             for stimulationSide in BrainSenseData["PowerDomain"]["Stimulation"]:
                 if len(np.unique(stimulationSide["Amplitude"])) > 3:
-                    Features = TherapeuticPrediction.extractPredictionFeatures(BrainSenseData, stimulationSide["Hemisphere"])
+                    if stimulationSide["Name"] in PredictionModels.keys() and TherapeuticPrediction.isPredictionModelCurrent(PredictionModels[stimulationSide["Name"]], CardiacFilter):
+                        Features = PredictionModels[stimulationSide["Name"]]
+                    else:
+                        Features = TherapeuticPrediction.extractPredictionFeatures(BrainSenseData, stimulationSide["Hemisphere"], recordingId=request.data["recordingId"])
                     #Features = TherapeuticPrediction.extractFullPredictionFeatures(BrainSenseData, stimulationSide["Hemisphere"])
-                    #PredictionModel = models.PredictionModel(recording_id=request.data["recordingId"], recording_channel=stimulationSide["Name"], model_details=Features)
-                    #PredictionModel.save()
                     data.append(Features)
                 else:
                     data.append({"NoPrediction": True})
@@ -864,7 +919,7 @@ class QueryPredictionModel(RestViews.APIView):
             for stimulationSide in BrainSenseData["PowerDomain"]["Stimulation"]:
                 if len(np.unique(stimulationSide["Amplitude"])) > 3:
                     #Features = TherapeuticPrediction.extractPredictionFeatures(BrainSenseData, stimulationSide["Hemisphere"])
-                    Features = TherapeuticPrediction.extractFullPredictionFeatures(BrainSenseData, stimulationSide["Hemisphere"])
+                    Features = TherapeuticPrediction.extractFullPredictionFeatures(BrainSenseData, stimulationSide["Hemisphere"], recordingId=request.data["recordingId"])
                     data.append({"Features": Features})
                 else:
                     data.append({"NoPrediction": True})
@@ -895,10 +950,8 @@ class QueryPredictionModel(RestViews.APIView):
 
                 for stimulationSide in BrainSenseData["PowerDomain"]["Stimulation"]:
                     if len(np.unique(stimulationSide["Amplitude"])) > 3 and stimulationSide["Name"] == request.data["channel"]:
-                        Features = TherapeuticPrediction.extractPredictionFeatures(BrainSenseData, stimulationSide["Hemisphere"], centerFrequency=request.data["centerFrequency"])
-                        #PredictionModel = models.PredictionModel.objects.filter(recording_id=request.data["recordingId"], recording_channel=stimulationSide["Name"]).first()
-                        #PredictionModel.model_details = Features
-                        #PredictionModel.save()
+                        Features = TherapeuticPrediction.extractPredictionFeatures(BrainSenseData, stimulationSide["Hemisphere"], centerFrequency=request.data["centerFrequency"], recordingId=RecordingID)
+                        TherapeuticPrediction.savePredictionModel(RecordingID, stimulationSide["Name"], Features, request.user.configuration["ProcessingSettings"]["RealtimeStream"]["CardiacFilter"]["value"] == "true")
                         break
                     else:
                         Features = {"NoPrediction": True}
@@ -924,8 +977,7 @@ class QueryMultipleSegmentComparison(RestViews.APIView):
         if Authority["Level"] == 1:
             Authority["Permission"] = Database.verifyPermission(request.user, request.data["id"], Authority, "BrainSenseStream")
 
-            PatientInfo = Database.extractAccess(request.user, request.data["id"])
-            Authority["Devices"] = PatientInfo.device_deidentified_id
+            Authority["Devices"] = Database.getPatientDeviceIDs([request.data["id"]])[str(request.data["id"])]
 
             data = RealtimeStream.queryMultipleSegmentComparison(request.user, request.data["recordingIds"], Authority)
             return Response(status=200, data=data)
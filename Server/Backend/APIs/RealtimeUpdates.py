@@ -19,7 +19,9 @@ Realtime Update Module (Websockets)
 """
 
 from modules import Database
+from modules.Notification import getUserGroup, getInstituteGroup, getNotificationGroup, QUEUE_REDUCED_INTERVAL
 import json
+import asyncio, time
 
 from asgiref.sync import sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
@@ -38,13 +40,41 @@ with open(RESOURCES + "/../codes.json", "r") as file:
 
 DATABASE_PATH = os.environ.get('DATASERVER_PATH')
 
+# Minimum interval (seconds) between "QueueReduced" broadcasts is QUEUE_REDUCED_INTERVAL. Queue events within the interval are coalesced into one broadcast.
+QueueReducedState = {"Pending": False, "LastSent": 0}
+
 class NotificationSystem(AsyncWebsocketConsumer):
     async def connect(self):
         self.scope["authorization"] = False
         await self.accept()
 
     async def disconnect(self, close_code):
-        pass
+        if self.scope["authorization"]:
+            await self.channel_layer.group_discard(getUserGroup(self.scope["user"].unique_user_id), self.channel_name)
+            await self.channel_layer.group_discard(getInstituteGroup(self.scope["user"].institute), self.channel_name)
+            await self.channel_layer.group_discard("BroadcastChannel", self.channel_name)
+
+    async def schedule_queue_reduced(self):
+        """ Broadcast "QueueReduced" to all sockets, at most once every QUEUE_REDUCED_INTERVAL seconds.
+        """
+
+        if QueueReducedState["Pending"]:
+            return
+        QueueReducedState["Pending"] = True
+
+        async def broadcast():
+            try:
+                await asyncio.sleep(max(0, QueueReducedState["LastSent"] + QUEUE_REDUCED_INTERVAL - time.monotonic()))
+                QueueReducedState["Pending"] = False
+                QueueReducedState["LastSent"] = time.monotonic()
+                await self.channel_layer.group_send("BroadcastChannel", {
+                    "type": "broadcast_queue_reduced",
+                    "message": {}
+                })
+            finally:
+                QueueReducedState["Pending"] = False
+
+        asyncio.ensure_future(broadcast())
 
     # Receive message from WebSocket
     async def receive(self, text_data=None, bytes_data=None):
@@ -71,41 +101,43 @@ class NotificationSystem(AsyncWebsocketConsumer):
                         })
 
                     elif request["NotificationType"] == "NewPatient":
-                        await self.channel_layer.group_send("BroadcastChannel", {
+                        await self.channel_layer.group_send(getNotificationGroup(request), {
                             "type": "broadcast_new_patient",
                             "message": {
-                                "UserID": request["TaskUser"],
+                                "UserID": request.get("TaskUser"),
                                 "NewPatient": request["NewPatient"],
                             }
                         })
 
                     elif request["NotificationType"] == "TaskComplete":
-                        await self.channel_layer.group_send("BroadcastChannel", {
+                        await self.channel_layer.group_send(getNotificationGroup(request), {
                             "type": "broadcast_queue_complete",
                             "message": {
-                                "UserID": request["TaskUser"],
+                                "UserID": request.get("TaskUser"),
                                 "TaskID": request["TaskID"],
                                 "State": request["State"],
                                 "Message": request["Message"],
                             }
                         })
+                        await self.schedule_queue_reduced()
 
                     elif request["NotificationType"] == "TaskProcessing":
-                        await self.channel_layer.group_send("BroadcastChannel", {
+                        await self.channel_layer.group_send(getNotificationGroup(request), {
                             "type": "broadcast_queue_update",
                             "message": {
-                                "UserID": request["TaskUser"],
+                                "UserID": request.get("TaskUser"),
                                 "TaskID": request["TaskID"],
                                 "State": request["State"],
                                 "Message": request["Message"],
                             }
                         })
+                        await self.schedule_queue_reduced()
 
                     elif request["NotificationType"] == "AnalysisProcessing":
-                        await self.channel_layer.group_send("BroadcastChannel", {
+                        await self.channel_layer.group_send(getNotificationGroup(request), {
                             "type": "broadcast_analysis_processing",
                             "message": {
-                                "UserID": request["TaskUser"],
+                                "UserID": request.get("TaskUser"),
                                 "TaskID": request["TaskID"],
                                 "State": request["State"],
                                 "Message": request["Message"],
@@ -118,6 +150,8 @@ class NotificationSystem(AsyncWebsocketConsumer):
                 if user:
                     self.scope["user"] = user
                     self.scope["authorization"] = True
+                    await self.channel_layer.group_add(getUserGroup(user.unique_user_id), self.channel_name)
+                    await self.channel_layer.group_add(getInstituteGroup(user.institute), self.channel_name)
                     await self.channel_layer.group_add("BroadcastChannel", self.channel_name)
 
                     return
@@ -130,63 +164,51 @@ class NotificationSystem(AsyncWebsocketConsumer):
 
     # Broadcast Queue Update
     async def broadcast_queue_update(self, event):
-        if "UserID" in event["message"]:
-            if str(self.scope["user"].unique_user_id) == event["message"]["UserID"]:
-                await self.send(text_data=json.dumps({
-                    "Notification": "QueueUpdate",
-                    "UpdateType": "JobUpdate",
-                    "TaskID": event["message"]["TaskID"],
-                    "State": event["message"]["State"],
-                    "Message": event["message"]["Message"],
-                }))
-
-            await self.send(text_data=json.dumps({
-                "Notification": "QueueUpdate",
-                "UpdateType": "QueueReduced",
-            }))
-        pass
+        await self.send(text_data=json.dumps({
+            "Notification": "QueueUpdate",
+            "UpdateType": "JobUpdate",
+            "TaskID": event["message"]["TaskID"],
+            "State": event["message"]["State"],
+            "Message": event["message"]["Message"],
+        }))
 
     # Broadcast Queue Compeltion
     async def broadcast_queue_complete(self, event):
-        if "UserID" in event["message"]:
-            if str(self.scope["user"].unique_user_id) == event["message"]["UserID"]:
-                await self.send(text_data=json.dumps({
-                    "Notification": "QueueUpdate",
-                    "UpdateType": "JobCompletion",
-                    "TaskID": event["message"]["TaskID"],
-                    "State": event["message"]["State"],
-                    "Message": event["message"]["Message"],
-                }))
-
-            await self.send(text_data=json.dumps({
-                "Notification": "QueueUpdate",
-                "UpdateType": "QueueReduced",
-            }))
-        pass
+        await self.send(text_data=json.dumps({
+            "Notification": "QueueUpdate",
+            "UpdateType": "JobCompletion",
+            "TaskID": event["message"]["TaskID"],
+            "State": event["message"]["State"],
+            "Message": event["message"]["Message"],
+        }))
+
+    # Queue updates published by background workers (see Notification module), coalesced with root notifications
+    async def request_queue_reduced(self, event):
+        await self.schedule_queue_reduced()
+
+    # Broadcast Queue Reduction (coalesced, sent to all users)
+    async def broadcast_queue_reduced(self, event):
+        await self.send(text_data=json.dumps({
+            "Notification": "QueueUpdate",
+            "UpdateType": "QueueReduced",
+        }))
 
     # Broadcast New Patient Table
     async def broadcast_new_patient(self, event):
-        if "UserID" in event["message"]:
-            if str(self.scope["user"].unique_user_id) == event["message"]["UserID"]:
-                await self.send(text_data=json.dumps({
-                    "Notification": "PatientTableUpdate",
-                    "UpdateType": "NewPatient",
-                    "NewPatient": event["message"]["NewPatient"],
-                }))
-        pass
+        await self.send(text_data=json.dumps({
+            "Notification": "PatientTableUpdate",
+            "UpdateType": "NewPatient",
+            "NewPatient": event["message"]["NewPatient"],
+        }))
 
     # Broadcast Streams
     async def broadcast_stream(self, event):
         pass
 
     async def broadcast_analysis_processing(self, event):
-        if "UserID" in event["message"]:
-            if str(self.scope["user"].unique_user_id) == event["message"]["UserID"]:
-                await self.send(text_data=json.dumps({
-                    "Notification": "AnalysisUpdate",
-                    "TaskID": event["message"]["TaskID"],
-                    "State": event["message"]["State"],
-                    "Message": event["message"]["Message"],
-                }))
-        pass
-
+        await self.send(text_data=json.dumps({
+            "Notification": "AnalysisUpdate",
+            "TaskID": event["message"]["TaskID"],
+            "State": event["message"]["State"],
+            "Message": event["message"]["Message"],
+        }))
@@ -0,0 +1,77 @@
+""""""
+"""
+=========================================================
+* UF BRAVO Platform
+=========================================================
+
+* Copyright 2023 by Jackson Cagle, Fixel Institute
+* The source code is made available under a Creative Common NonCommercial ShareAlike License (CC BY-NC-SA 4.0) (https://creativecommons.org/licenses/by-nc-sa/4.0/)
+
+ =========================================================
+
+* The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+"""
+"""
+Binary Response Renderers
+===================================================
+Opt-in binary transport for routes that return large numeric arrays. Clients that send
+``Accept: application/x-msgpack`` receive a MessagePack document in which NumPy arrays are
+stored as typed little-endian buffers instead of JSON text. All other clients receive JSON as before.
+
+NumPy arrays are packed as MessagePack extension type ``NDARRAY_EXTENSION`` whose payload is a MessagePack
+array ``[dtype, shape, buffer]``, where dtype is the NumPy type string (e.g. ``<f8``) and buffer is
+the C-ordered raw array data.
+
+@author: Jackson Cagle, University of Florida
+@email: jackson.cagle@neurology.ufl.edu
+"""
+
+import msgpack
+import numpy as np
+
+from rest_framework.renderers import BaseRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+NDARRAY_EXTENSION = 1
+
+def encodeArray(obj):
+    """ MessagePack default encoder for objects not natively supported.
+
+    NumPy arrays are converted to ``NDARRAY_EXTENSION`` extension type, NumPy scalars to Python scalars,
+    and everything else (datetime, UUID, Decimal, QuerySet...) is delegated to the REST Framework JSON encoder
+    so that the decoded content matches the JSON response.
+
+    Args:
+      obj: object to be encoded.
+
+    Returns:
+      MessagePack serializable object.
+    """
+
+    if isinstance(obj, np.ndarray):
+        if obj.dtype.hasobject:
+            return obj.tolist()
+        if obj.dtype.byteorder == ">":
+            obj = obj.astype(obj.dtype.newbyteorder("<"))
+        if not obj.flags.c_contiguous:
+            obj = np.ascontiguousarray(obj)
+        return msgpack.ExtType(NDARRAY_EXTENSION, msgpack.packb([obj.dtype.str, list(obj.shape), obj.data], use_bin_type=True))
+    elif isinstance(obj, np.generic):
+        return obj.item()
+    return JSONEncoder().default(obj)
+
+class MessagePackRenderer(BaseRenderer):
+    """ REST Framework renderer for MessagePack with NumPy array extension.
+
+    Selected through content negotiation when the request contains ``Accept: application/x-msgpack``.
+    """
+
+    media_type = "application/x-msgpack"
+    format = "msgpack"
+    charset = None
+    render_style = "binary"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b""
+        return msgpack.packb(data, default=encodeArray, use_bin_type=True)
@@ -204,11 +204,10 @@ class PatientInformationUpdate(RestViews.APIView):
             MergePatient = models.Patient.objects.filter(deidentified_id=request.data["mergePatientInfo"]).first()
 
             if MergePatient and SourcePatient:
-                for device_id in SourcePatient.device_deidentified_id:
-                    device = models.PerceptDevice.objects.filter(deidentified_id=device_id).first()
-                    device.patient_deidentified_id = MergePatient.deidentified_id
-                    device.save()
-                    MergePatient.addDevice(str(device.deidentified_id))
+                Devices = Database.getDevicesByID(SourcePatient.device_deidentified_id)
+                models.PerceptDevice.objects.filter(deidentified_id__in=Devices.keys()).update(patient_deidentified_id=MergePatient.deidentified_id)
+                for device_id in Devices.keys():
+                    MergePatient.addDevice(device_id)
 
             SourcePatient.delete()
             return Response(status=200)
@@ -28,6 +28,8 @@ import json
 import base64
 import datetime, pytz
 import websocket
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
 
 RESOURCES = str(pathlib.Path(__file__).parent.resolve())
 with open(RESOURCES + "/../codes.json", "r") as file:
@@ -46,6 +48,17 @@ from modules import Database, AnalysisBuilder
 from modules.Percept import Sessions
 from modules.Summit import Sessions as SummitSessions
 
+def requestQueueProcessing():
+    """ Wake up Processing Queue Service workers (see ProcessingQueueService.startService).
+    """
+    try:
+        async_to_sync(get_channel_layer().group_send)("ProcessingQueueManager", {
+            "type": "request_processing_queue",
+            "message": {}
+        })
+    except Exception as e:
+        print(e)
+
 class DeidentificationTable(RestViews.APIView):
     parser_classes = [RestParsers.JSONParser]
     permission_classes = [IsAuthenticated]
@@ -230,6 +243,8 @@ class SessionUpload(RestViews.APIView):
                         Sessions.saveCacheJSON(request.data[key].name, rawBytes)
                         queueItem.save()
 
+            requestQueueProcessing()
+
         #tasks.ProcessUploadQueue.apply_async(countdown=3)
         return Response(status=200)
 
@@ -238,6 +253,7 @@ class RequestProcessingQueue(RestViews.APIView):
     permission_classes = [IsAuthenticated]
     def post(self, request):
         models.ProcessingQueue.objects.filter(owner=request.user.unique_user_id, state="WaitToStart", descriptor__batchSessionId=request.data["batchSessionId"]).update(state="InProgress")
+        requestQueueProcessing()
         #tasks.ProcessUploadQueue.apply_async(countdown=0)
         return Response(status=200)
 
@@ -276,10 +292,10 @@ class SessionRemove(RestViews.APIView):
             deidentification = Database.extractPatientInfo(request.user, request.data["patientId"])
             DeviceIDs = [str(deidentification["Devices"][i]["ID"]) for i in range(len(deidentification["Devices"]))]
 
-            for device in DeviceIDs:
-                device = models.PerceptDevice.objects.filter(deidentified_id=device).first()
+            Devices = Database.getDevicesByID(DeviceIDs)
+            for device in Devices.values():
                 Sessions.deleteDevice(device.deidentified_id)
-                patient.removeDevice(device)
+                patient.removeDevice(str(device.deidentified_id))
                 device.delete()
 
             Authority["Permission"] = Database.verifyPermission(request.user, request.data["patientId"], Authority, "BrainSenseStream")
@@ -56,8 +56,7 @@ class QueryTremorStudyResults(RestViews.APIView):
             return Response(status=400, data={"code": ERROR_CODE["PERMISSION_DENIED"]})
         Authority["Permission"] = Database.verifyPermission(request.user, request.data["id"], Authority, "BrainSenseStream")
 
-        PatientInfo = Database.extractAccess(request.user, request.data["id"])
-        Authority["Devices"] = PatientInfo.device_deidentified_id
+        Authority["Devices"] = Database.getPatientDeviceIDs([request.data["id"]])[str(request.data["id"])]
 
         if "requestOverview" in request.data:
             ExistingAnalysis = AnalysisBuilder.getExistingAnalysis(request.user, request.data["id"], Authority)
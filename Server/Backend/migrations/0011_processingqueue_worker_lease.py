@@ -0,0 +1,28 @@
+# Generated by Django 4.0.6 on 2026-10-18 10:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Backend', '0010_combinedrecordinganalysis_analysis_label'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='processingqueue',
+            name='attempts',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='processingqueue',
+            name='lease_expiry',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddField(
+            model_name='processingqueue',
+            name='worker',
+            field=models.CharField(default='', max_length=255),
+        ),
+    ]
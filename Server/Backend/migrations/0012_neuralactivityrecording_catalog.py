@@ -0,0 +1,32 @@
+# Generated by Django 4.0.6 on 2026-10-18 14:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Backend', '0011_processingqueue_worker_lease'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='neuralactivityrecording',
+            name='recording_sample_count',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='neuralactivityrecording',
+            name='recording_sampling_rate',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='neuralactivityrecording',
+            name='recording_size',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='neuralactivityrecording',
+            index=models.Index(fields=['device_deidentified_id', 'recording_type', 'recording_date'], name='Backend_neu_device__a800de_idx'),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 4.0.6 on 2026-10-18 16:12
+
+from django.db import migrations, models
+import django.utils.timezone
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Backend', '0012_neuralactivityrecording_catalog'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReprocessingCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('job_name', models.CharField(default='', max_length=255)),
+                ('task', models.CharField(default='', max_length=64)),
+                ('device_deidentified_id', models.UUIDField(default=uuid.uuid4)),
+                ('item_id', models.UUIDField(default=uuid.uuid4)),
+                ('state', models.CharField(default='Complete', max_length=32)),
+                ('message', models.TextField(default='')),
+                ('duration', models.FloatField(default=0)),
+                ('completed_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                'unique_together': {('job_name', 'item_id')},
+            },
+        ),
+        migrations.AddIndex(
+            model_name='reprocessingcheckpoint',
+            index=models.Index(fields=['job_name', 'state'], name='Backend_rep_job_nam_91eb2a_idx'),
+        ),
+    ]
@@ -0,0 +1,50 @@
+# Generated by Django 4.0.6 on 2026-10-18 17:05
+
+from django.db import migrations, models
+import uuid
+
+
+def populatePatientDevices(apps, schema_editor):
+    Patient = apps.get_model('Backend', 'Patient')
+    PatientDevice = apps.get_model('Backend', 'PatientDevice')
+
+    # Unique constraint is only created at the end of the migration, duplicated entries are removed here.
+    PatientDevices = dict()
+    for patientID, deviceIDs in Patient.objects.values_list('deidentified_id', 'device_deidentified_id').iterator():
+        if not deviceIDs:
+            continue
+        for deviceID in deviceIDs:
+            try:
+                deviceID = uuid.UUID(str(deviceID))
+            except ValueError:
+                continue
+            if not (patientID, deviceID) in PatientDevices.keys():
+                PatientDevices[(patientID, deviceID)] = PatientDevice(patient_deidentified_id=patientID, device_deidentified_id=deviceID)
+    PatientDevice.objects.bulk_create(list(PatientDevices.values()), batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Backend', '0013_reprocessingcheckpoint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PatientDevice',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('patient_deidentified_id', models.UUIDField(default=uuid.uuid4)),
+                ('device_deidentified_id', models.UUIDField(default=uuid.uuid4)),
+            ],
+            options={
+                'ordering': ['id'],
+                'unique_together': {('patient_deidentified_id', 'device_deidentified_id')},
+            },
+        ),
+        migrations.AddIndex(
+            model_name='patientdevice',
+            index=models.Index(fields=['device_deidentified_id'], name='Backend_pat_device__75e936_idx'),
+        ),
+        migrations.RunPython(populatePatientDevices, migrations.RunPython.noop),
+    ]
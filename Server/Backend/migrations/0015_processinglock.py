@@ -0,0 +1,23 @@
+# Generated by Django 4.0.6 on 2026-10-18 20:12
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Backend', '0014_patientdevice'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProcessingLock',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('lock_key', models.CharField(default='', max_length=64, unique=True)),
+                ('holder', models.CharField(default='', max_length=255)),
+                ('lease_expiry', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+    ]
@@ -177,11 +177,32 @@ class Patient(models.Model):
         if not deviceID in self.device_deidentified_id:
             self.device_deidentified_id.append(deviceID)
             self.save()
+        PatientDevice.objects.get_or_create(patient_deidentified_id=self.deidentified_id, device_deidentified_id=deviceID)
 
     def removeDevice(self, deviceID):
         if deviceID in self.device_deidentified_id:
             self.device_deidentified_id.remove(deviceID)
             self.save()
+        PatientDevice.objects.filter(patient_deidentified_id=self.deidentified_id, device_deidentified_id=deviceID).delete()
+
+    def delete(self, *args, **kwargs):
+        PatientDevice.objects.filter(patient_deidentified_id=self.deidentified_id).delete()
+        return super().delete(*args, **kwargs)
+
+class PatientDevice(models.Model):
+    # Indexed patient-device relation, kept in sync with Patient.device_deidentified_id by Patient.addDevice/removeDevice
+    patient_deidentified_id = models.UUIDField(default=uuid.uuid4)
+    device_deidentified_id = models.UUIDField(default=uuid.uuid4)
+
+    class Meta:
+        ordering = ['id']
+        unique_together = [['patient_deidentified_id', 'device_deidentified_id']]
+        indexes = [
+            models.Index(fields=['device_deidentified_id']),
+        ]
+
+    def __str__(self):
+        return str(self.patient_deidentified_id) + " " + str(self.device_deidentified_id)
 
 class SearchTags(models.Model):
     tag_name = models.CharField(default="", max_length=255)
@@ -330,12 +351,20 @@ class NeuralActivityRecording(models.Model):
     recording_info = models.JSONField(default=dict, null=True)
     recording_duration = models.FloatField(default=0)
 
+    # Recording catalog, metadata populated at ingest (see Database.updateRecordingCatalog) for overview queries
+    recording_sampling_rate = models.FloatField(default=0)
+    recording_sample_count = models.BigIntegerField(default=0)
+    recording_size = models.BigIntegerField(default=0)
+
     recording_datapointer = models.CharField(default="", max_length=255)
 
     source_file = models.CharField(default="", max_length=255)
 
     class Meta:
         ordering = ['recording_date']
+        indexes = [
+            models.Index(fields=['device_deidentified_id', 'recording_type', 'recording_date']),
+        ]
 
     def __str__(self):
         return str(self.device_deidentified_id) + " " + self.recording_type + " " + str(self.recording_id)
@@ -430,3 +459,29 @@ class ProcessingQueue(models.Model):
     datetime = models.DateTimeField(default=timezone.now)
     state = models.CharField(default="InProgress", max_length=255)
     descriptor = models.JSONField(default=dict)
+    worker = models.CharField(default="", max_length=255)
+    lease_expiry = models.DateTimeField(null=True)
+    attempts = models.IntegerField(default=0)
+
+class ProcessingLock(models.Model):
+    # Named locks shared by processing queue workers (see Database.acquireProcessingLock), unique lock_key makes acquisition race-safe
+    lock_key = models.CharField(default="", max_length=64, unique=True)
+    holder = models.CharField(default="", max_length=255)
+    lease_expiry = models.DateTimeField(default=timezone.now)
+
+class ReprocessingCheckpoint(models.Model):
+    # Per-item state of batch reprocessing jobs (manage.py Reprocess), completed items are skipped when a job is resumed
+    job_name = models.CharField(default="", max_length=255)
+    task = models.CharField(default="", max_length=64)
+    device_deidentified_id = models.UUIDField(default=uuid.uuid4)
+    item_id = models.UUIDField(default=uuid.uuid4)
+    state = models.CharField(default="Complete", max_length=32)
+    message = models.TextField(default="")
+    duration = models.FloatField(default=0)
+    completed_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        unique_together = [['job_name', 'item_id']]
+        indexes = [
+            models.Index(fields=['job_name', 'state']),
+        ]
@@ -24,7 +24,6 @@ from datetime import datetime
 import pytz
 from pathlib import Path
 
-import pickle, blosc
 import uuid
 import json
 
@@ -37,13 +36,15 @@ def processInput(argv):
       from BRAVO import asgi
       from Backend import models
       from modules.Percept import Sessions
+      from modules import Database
       from decoder import Percept
 
       if argv[2] == "All":
-        Patients = models.Patient.objects.all()
+        Patients = list(models.Patient.objects.all())
+        Devices = Database.getDevicesByID([device_id for patient in Patients for device_id in patient.device_deidentified_id])
         for patient in Patients:
           for device_id in patient.device_deidentified_id:
-            device = models.PerceptDevice.objects.filter(deidentified_id=device_id).first()
+            device = Devices[str(device_id)]
             Sessions.deleteDevice(device.deidentified_id)
             patient.removeDevice(device_id)
             device.delete()
@@ -142,7 +143,7 @@ def processInput(argv):
       from modules.Percept import Sessions, Therapy, BrainSenseSurvey, BrainSenseStream, BrainSenseEvent, IndefiniteStream, ChronicBrainSense
       from decoder import Percept
       
-      from modules import Database
+      from modules import Database, Reprocessing
 
       OLD_DATABASE_PATH = argv[2]
 
@@ -213,6 +214,7 @@ def processInput(argv):
         )
         batchResult.append(patient)
       models.Patient.objects.bulk_create(batchResult)
+      Database.syncPatientDevices(batchResult)
       
       # Deidentified Patient
       connector.query("""
@@ -305,29 +307,7 @@ def processInput(argv):
       # different data structure and improved extraction code.
 
       # Require to run ProcessingQueueJob after migration.
-      users = models.PlatformUser.objects.all()
-      Authority = {"Level": 1}
-      for user in users:
-        if user.is_admin or user.is_clinician:
-          Patients = models.Patient.objects.filter(institute=user.institute).all()
-        else:
-          Patients = models.Patient.objects.filter(institute=user.email).all()
-
-        for patient in Patients:
-          availableDevices = Database.getPerceptDevices(user, patient.deidentified_id, Authority)
-          for device in availableDevices:
-            availableSessions = models.PerceptSession.objects.filter(device_deidentified_id=device.deidentified_id).all()
-            for session in availableSessions:
-              try:
-                shutil.copyfile(DATABASE_PATH + session.session_file_path,(DATABASE_PATH + session.session_file_path).replace("/sessions/","/cache/"))
-                models.ProcessingQueue(owner=user.unique_user_id, type="decodeJSON", state="InProgress", descriptor={
-                    "filename": session.session_file_path.split("/")[-1],
-                    "device_deidentified_id": str(device.deidentified_id)
-                }).save()
-                Sessions.deleteSessions(user, patient.deidentified_id, [str(session.deidentified_id)], Authority)
-
-              except Exception as e:
-                print(e)
+      Reprocessing.queueSessionDecoding(jobName="MigrateFromV1")
 
       connector.close()
 
@@ -340,32 +320,13 @@ def processInput(argv):
       from decoder import Percept
       import shutil
       
-      from modules import Database
+      from modules import Database, Reprocessing
       DATABASE_PATH = os.environ.get('DATASERVER_PATH')
 
-      users = models.PlatformUser.objects.all()
-      Authority = {"Level": 1}
-      for user in users:
-        if user.is_admin or user.is_clinician:
-          Patients = models.Patient.objects.filter(institute=user.institute).all()
-        else:
-          Patients = models.Patient.objects.filter(institute=user.email).all()
+      # Queue processor is imported before any session or recording is removed
+      from ProcessingQueueService import processQueue
 
-        for patient in Patients:
-          availableDevices = Database.getPerceptDevices(user, patient.deidentified_id, Authority)
-          for device in availableDevices:
-            availableSessions = models.PerceptSession.objects.filter(device_deidentified_id=device.deidentified_id).all()
-            for session in availableSessions:
-              try:
-                shutil.copyfile(DATABASE_PATH + session.session_file_path,(DATABASE_PATH + session.session_file_path).replace("/sessions/","/cache/"))
-                models.ProcessingQueue(owner=user.unique_user_id, type="decodeJSON", state="InProgress", descriptor={
-                    "filename": session.session_file_path.split("/")[-1],
-                    "device_deidentified_id": str(device.deidentified_id),
-                }).save()
-                Sessions.deleteSessions(user, patient.deidentified_id, [str(session.deidentified_id)], Authority)
-
-              except Exception as e:
-                print(e)
+      Reprocessing.queueSessionDecoding(jobName="MigrateFromV2.1")
           
       # Cleanup Database
       models.CombinedRecordingAnalysis.objects.all().delete()
@@ -374,36 +335,36 @@ def processInput(argv):
       models.ImpedanceHistory.objects.all().delete()
       models.NeuralActivityRecording.objects.all().delete()
 
-      # Run Processing Script
-      from ProcessingQueueService import processJSONUploads 
-      processJSONUploads()
+      # Run Processing Script in this process until the queue is drained
+      processQueue(f"DatabaseManager:{os.getpid()}")
 
       # Check for Authorized Access
+      AuthorizedUsers = dict()
+      for authorizeUser in models.DeidentifiedPatientID.objects.all():
+        if not authorizeUser.authorized_patient_id in AuthorizedUsers.keys():
+          AuthorizedUsers[authorizeUser.authorized_patient_id] = list()
+        AuthorizedUsers[authorizeUser.authorized_patient_id].append(authorizeUser)
+
       users = models.PlatformUser.objects.all()
-      Authority = {"Level": 1}
       for user in users:
         if user.is_admin or user.is_clinician:
-          Patients = models.Patient.objects.filter(institute=user.institute).all()
+          Patients = models.Patient.objects.filter(institute=user.institute, deidentified_id__in=AuthorizedUsers.keys()).all()
         else:
-          Patients = models.Patient.objects.filter(institute=user.email).all()
+          Patients = models.Patient.objects.filter(institute=user.email, deidentified_id__in=AuthorizedUsers.keys()).all()
 
         for patient in Patients:
-          AuthorizedUsers = []
-          if models.DeidentifiedPatientID.objects.filter(authorized_patient_id=patient.deidentified_id).exists():
-            AuthorizedUsers = models.DeidentifiedPatientID.objects.filter(authorized_patient_id=patient.deidentified_id).all()
-
-            for authorizeUser in AuthorizedUsers:
-              # First Cleanup Permission
-              Database.AuthorizeResearchAccess(user, authorizeUser.researcher_id, patient.deidentified_id, False)
-
-              # Then Add Permission Again due to different structures
-              Database.AuthorizeResearchAccess(user, authorizeUser.researcher_id, patient.deidentified_id, True)
-              Database.AuthorizeRecordingAccess(user, authorizeUser.researcher_id, patient.deidentified_id, recording_type="TherapyHistory")
-              Database.AuthorizeRecordingAccess(user, authorizeUser.researcher_id, patient.deidentified_id, recording_type="BrainSenseSurvey")
-              Database.AuthorizeRecordingAccess(user, authorizeUser.researcher_id, patient.deidentified_id, recording_type="BrainSenseStreamTimeDomain")
-              Database.AuthorizeRecordingAccess(user, authorizeUser.researcher_id, patient.deidentified_id, recording_type="BrainSenseStreamPowerDomain")
-              Database.AuthorizeRecordingAccess(user, authorizeUser.researcher_id, patient.deidentified_id, recording_type="IndefiniteStream")
-              Database.AuthorizeRecordingAccess(user, authorizeUser.researcher_id, patient.deidentified_id, recording_type="ChronicLFPs")
+          for authorizeUser in AuthorizedUsers[patient.deidentified_id]:
+            # First Cleanup Permission
+            Database.AuthorizeResearchAccess(user, authorizeUser.researcher_id, patient.deidentified_id, False)
+
+            # Then Add Permission Again due to different structures
+            Database.AuthorizeResearchAccess(user, authorizeUser.researcher_id, patient.deidentified_id, True)
+            Database.AuthorizeRecordingAccess(user, authorizeUser.researcher_id, patient.deidentified_id, recording_type="TherapyHistory")
+            Database.AuthorizeRecordingAccess(user, authorizeUser.researcher_id, patient.deidentified_id, recording_type="BrainSenseSurvey")
+            Database.AuthorizeRecordingAccess(user, authorizeUser.researcher_id, patient.deidentified_id, recording_type="BrainSenseStreamTimeDomain")
+            Database.AuthorizeRecordingAccess(user, authorizeUser.researcher_id, patient.deidentified_id, recording_type="BrainSenseStreamPowerDomain")
+            Database.AuthorizeRecordingAccess(user, authorizeUser.researcher_id, patient.deidentified_id, recording_type="IndefiniteStream")
+            Database.AuthorizeRecordingAccess(user, authorizeUser.researcher_id, patient.deidentified_id, recording_type="ChronicLFPs")
 
       return True
 
@@ -411,6 +372,7 @@ def processInput(argv):
       from BRAVO import asgi
       from Backend import models
       from modules.Percept import Sessions
+      from modules import Database
       from decoder import Percept
 
       if argv[2] == "Patient":
@@ -420,11 +382,10 @@ def processInput(argv):
         MergePatient = models.Patient.objects.filter(deidentified_id=PatientID2).first()
 
         if MergePatient and SourcePatient:
-          for device_id in SourcePatient.device_deidentified_id:
-            device = models.PerceptDevice.objects.filter(deidentified_id=device_id).first()
-            device.patient_deidentified_id = MergePatient.deidentified_id
-            device.save()
-            MergePatient.addDevice(str(device.deidentified_id))
+          Devices = Database.getDevicesByID(SourcePatient.device_deidentified_id)
+          models.PerceptDevice.objects.filter(deidentified_id__in=Devices.keys()).update(patient_deidentified_id=MergePatient.deidentified_id)
+          for device_id in Devices.keys():
+            MergePatient.addDevice(device_id)
 
         SourcePatient.delete()
         return True
@@ -432,10 +393,9 @@ def processInput(argv):
       else: 
         PatientID = argv[2]
         SourcePatient = models.Patient.objects.filter(deidentified_id=PatientID).first()
-        for device_id in SourcePatient.device_deidentified_id:
-          device = models.PerceptDevice.objects.filter(deidentified_id=device_id).first()
-          device.patient_deidentified_id = SourcePatient.deidentified_id
-          device.save()
+        Devices = Database.getDevicesByID(SourcePatient.device_deidentified_id)
+        models.PerceptDevice.objects.filter(deidentified_id__in=Devices.keys()).update(patient_deidentified_id=SourcePatient.deidentified_id)
+        for device in Devices.values():
           print(device)
         
         return True
@@ -444,153 +404,90 @@ def processInput(argv):
       from BRAVO import asgi
       from Backend import models
       from modules.Percept import Sessions
-      from modules import Database
+      from modules import Database, Reprocessing
       from decoder import Percept
 
-      if argv[2] == "TherapyHistory":
-        if argv[3] == "All":
-          SessionFiles = models.PerceptSession.objects.all()
-        else:
-          SessionFiles = models.PerceptSession.objects.filter(device_deidentified_id=argv[3]).all()
+      if argv[2] in Reprocessing.REPROCESSING_TASKS.keys():
+        Reprocessing.runReprocessing(argv[2], argv[3], workers=1)
 
-        for sessionFile in SessionFiles:
-          try:
-            JSON = Percept.decodeEncryptedJSON(DATABASE_PATH + sessionFile.session_file_path, key)
-          except:
-            print(sessionFile.session_file_path)
-            continue
-          
-          TherapySettings = Percept.extractTherapySettings(JSON)
-          
-          TherapyHistories = models.TherapyHistory.objects.filter(source_file=str(sessionFile.deidentified_id)).all()
-          for therapy in TherapyHistories:
-            if therapy.therapy_type == "Past Therapy":
-              for newTherapy in TherapySettings["TherapyHistory"]:
-                if therapy.therapy_date == datetime.fromisoformat(newTherapy["DateTime"].replace("Z","+00:00")):
-                  for group in newTherapy["Therapy"]:
-                    if group["GroupId"] == therapy.group_id:
-                      therapy.therapy_details = group
-                      therapy.save()
-            elif therapy.therapy_type == "Pre-visit Therapy":
-              for newTherapy in TherapySettings["PreviousGroups"]:
-                if newTherapy["GroupId"] == therapy.group_id:
-                  therapy.therapy_details = newTherapy
-                  therapy.save()
-            elif therapy.therapy_type == "Post-visit Therapy":
-              for newTherapy in TherapySettings["StimulationGroups"]:
-                if newTherapy["GroupId"] == therapy.group_id:
-                  therapy.therapy_details = newTherapy
-                  therapy.save()
-        
-      elif argv[2] == "Sessions":
-        if argv[3] == "All":
-          SessionFiles = models.PerceptSession.objects.all()
+      elif argv[2] == "Catalog":
+        # Backfill recording catalog (duration, sampling rate, sample count, size, channels, therapy) used by overview queries
+        if len(argv) > 3 and not argv[3] == "All":
+          Recordings = models.NeuralActivityRecording.objects.filter(device_deidentified_id=argv[3]).all()
         else:
-          SessionFiles = models.PerceptSession.objects.filter(device_deidentified_id=argv[3]).all()
+          Recordings = models.NeuralActivityRecording.objects.all()
 
-        for sessionFile in SessionFiles:
-          if not sessionFile.session_file_path.startswith("sessions/"):
-            sessionFile.session_file_path = "sessions/" + sessionFile.session_file_path.split(os.path.sep)[-1]
+        for recording in Recordings.iterator():
           try:
-            JSON = Percept.decodeEncryptedJSON(DATABASE_PATH + sessionFile.session_file_path, key)
-          except:
-            print(sessionFile.session_file_path)
+            RawData = Database.loadSourceDataPointer(recording.recording_datapointer)
+          except Exception as e:
+            print(recording.recording_datapointer, e)
             continue
-          
-          LeadConfigurations = []
-          LeadInformation = JSON["LeadConfiguration"]["Final"]
-          for lead in LeadInformation:
-              LeadConfiguration = dict()
-              LeadConfiguration["TargetLocation"] = lead["Hemisphere"].replace("HemisphereLocationDef.","") + " "
-              if lead["LeadLocation"] == "LeadLocationDef.Vim":
-                  LeadConfiguration["TargetLocation"] += "VIM"
-              elif lead["LeadLocation"] == "LeadLocationDef.Stn":
-                  LeadConfiguration["TargetLocation"] += "STN"
-              elif lead["LeadLocation"] == "LeadLocationDef.Gpi":
-                  LeadConfiguration["TargetLocation"] += "GPi"
-              else:
-                  LeadConfiguration["TargetLocation"] += lead["LeadLocation"].replace("LeadLocationDef.","")
-
-              if lead["ElectrodeNumber"] == "InsPort.ZERO_THREE":
-                  LeadConfiguration["ElectrodeNumber"] = "E00-E03"
-              elif lead["ElectrodeNumber"] == "InsPort.ZERO_SEVEN":
-                  LeadConfiguration["ElectrodeNumber"] = "E00-E07"
-              elif lead["ElectrodeNumber"] == "InsPort.EIGHT_ELEVEN":
-                  LeadConfiguration["ElectrodeNumber"] = "E08-E11"
-              elif lead["ElectrodeNumber"] == "InsPort.EIGHT_FIFTEEN":
-                  LeadConfiguration["ElectrodeNumber"] = "E08-E15"
-              if lead["Model"] == "LeadModelDef.LEAD_B33015":
-                  LeadConfiguration["ElectrodeType"] = "SenSight B33015"
-              elif lead["Model"] == "LeadModelDef.LEAD_B33005":
-                  LeadConfiguration["ElectrodeType"] = "SenSight B33005"
-              elif lead["Model"] == "LeadModelDef.LEAD_3387":
-                  LeadConfiguration["ElectrodeType"] = "Medtronic 3387"
-              elif lead["Model"] == "LeadModelDef.LEAD_3389":
-                  LeadConfiguration["ElectrodeType"] = "Medtronic 3389"
-              elif lead["Model"] == "LeadModelDef.LEAD_OTHER":
-                  LeadConfiguration["ElectrodeType"] = "Unknown Lead"
-              else:
-                  LeadConfiguration["ElectrodeType"] = lead["Model"]
-
-              LeadConfigurations.append(LeadConfiguration)
-
-          SessionDate = datetime.fromtimestamp(Percept.estimateSessionDateTime(JSON),tz=pytz.utc)
-          sessionFile.session_date = SessionDate
-          sessionFile.save()
-        
-          deviceObj = models.PerceptDevice.objects.filter(deidentified_id=sessionFile.device_deidentified_id).first()
-          if len(deviceObj.device_lead_configurations) < len(LeadConfigurations):
-            deviceObj.device_lead_configurations = LeadConfigurations
-            deviceObj.save()
-
-      elif argv[2] == "Impedance":
-        if argv[3] == "All":
-          SessionFiles = models.PerceptSession.objects.all()
-        else:
-          SessionFiles = models.PerceptSession.objects.filter(device_deidentified_id=argv[3]).all()
 
-        for sessionFile in SessionFiles:
-          try:
-            JSON = Percept.decodeEncryptedJSON(DATABASE_PATH + sessionFile.session_file_path, key)
-          except:
-            print(sessionFile.session_file_path)
-            continue
+          if type(RawData) == dict:
+            Database.updateRecordingCatalog(recording, RawData)
+            if recording.recording_type == "BrainSenseStreamPowerDomain" and not "ContactType" in recording.recording_info.keys():
+              recording.recording_info["ContactType"] = ["Ring" for channel in recording.recording_info["Channel"] if channel.endswith(" Power")]
+            recording.save()
 
-          Data = Percept.extractPatientInformation(JSON)
-          if "Impedance" in Data.keys():
-            models.ImpedanceHistory(impedance_record=Data["Impedance"], device_deidentified_id=sessionFile.device_deidentified_id, session_date=sessionFile.session_date).save()
-          
       elif argv[2] == "Recordings":
-        DATABASE_PATH = os.environ.get('DATASERVER_PATH')
+        # Convert legacy .pkl/.bpkl/.mat datapointers to current storage format (chunked recordings when applicable)
+        if len(argv) > 3 and not argv[3] == "All":
+          RecordingGroups = [models.ExternalRecording.objects.filter(patient_deidentified_id=argv[3]).all(), models.NeuralActivityRecording.objects.filter(device_deidentified_id=argv[3]).all()]
+        else:
+          RecordingGroups = [models.ExternalRecording.objects.all(), models.NeuralActivityRecording.objects.all()]
 
-        Recordings = models.ExternalRecording.objects.all()
-        for recording in Recordings:
-          if recording.recording_datapointer.endswith(".pkl"):
+        for Recordings in RecordingGroups:
+          for recording in Recordings:
             try:
-              datastruct = Database.loadSourceDataPointer(recording.recording_datapointer)
-            except:
+              filename = Database.migrateSourceDataPointer(recording.recording_datapointer)
+            except Exception as e:
+              print(recording.recording_datapointer, e)
               continue
-            filename = recording.recording_datapointer.replace(".pkl",".bpkl")
-            pData = pickle.dumps(datastruct)
-            with open(DATABASE_PATH + "recordings" + os.path.sep + filename, "wb+") as file:
-              file.write(blosc.compress(pData))
-            Database.deleteSourceDataPointer(recording.recording_datapointer)
-            recording.recording_datapointer = filename
-            recording.save()
 
-        Recordings = models.NeuralActivityRecording.objects.all()
-        for recording in Recordings:
-          if recording.recording_datapointer.endswith(".pkl"):
-            try:
-              datastruct = Database.loadSourceDataPointer(recording.recording_datapointer)
-            except:
-              continue
-            filename = recording.recording_datapointer.replace(".pkl",".bpkl")
-            pData = pickle.dumps(datastruct)
-            with open(DATABASE_PATH + "recordings" + os.path.sep + filename, "wb+") as file:
-              file.write(blosc.compress(pData))
-            Database.deleteSourceDataPointer(recording.recording_datapointer)
-            recording.recording_datapointer = filename
-            recording.save()
+            if not filename == recording.recording_datapointer:
+              recording.recording_datapointer = filename
+              recording.save()
+
+      return True
 
-      return True
\ No newline at end of file
+    elif argv[1] == "Compact":
+      from BRAVO import asgi
+      from Backend import models
+      from modules import Database
+
+      # Merge small append segments of monthly-partitioned chronic recordings (ChronicLFPs, SummitChronicLogs)
+      if len(argv) > 2 and not argv[2] == "All":
+        Recordings = models.NeuralActivityRecording.objects.filter(device_deidentified_id=argv[2], recording_datapointer__endswith=Database.PARTITIONED_RECORDING_EXTENSION).all()
+      else:
+        Recordings = models.NeuralActivityRecording.objects.filter(recording_datapointer__endswith=Database.PARTITIONED_RECORDING_EXTENSION).all()
+
+      for recording in Recordings.iterator():
+        try:
+          RemovedSegments = Database.compactPartitionedRecording(recording.recording_datapointer)
+        except Exception as e:
+          print(recording.recording_datapointer, e)
+          continue
+        if RemovedSegments > 0:
+          print(f"{recording.recording_datapointer}: {RemovedSegments} segments merged")
+
+      return True
+
+    elif argv[1] == "Reprocess":
+      from BRAVO import asgi
+      from modules import Reprocessing
+
+      # Parallel, resumable reprocessing of stored session files:
+      # Reprocess <TherapyHistory|Sessions|Impedance> <DeviceID|All> [--workers=N] [--job=Name] [--restart] [--dry-run]
+      Options = {"workers": Reprocessing.REPROCESSING_WORKERS, "job": argv[2], "restart": False, "dry-run": False}
+      for option in argv[4:]:
+        name, _, value = option.lstrip("-").partition("=")
+        Options[name] = value if value else True
+
+      if Options["restart"] and not Options["dry-run"]:
+        from Backend import models
+        models.ReprocessingCheckpoint.objects.filter(job_name=Options["job"]).delete()
+
+      Summary = Reprocessing.runReprocessing(argv[2], argv[3], workers=int(Options["workers"]), jobName=Options["job"], dryRun=Options["dry-run"])
+      print(f"Reprocess {argv[2]} [{Options['job']}]: {Summary['Complete']} complete, {Summary['Failed']} failed, {Summary['Skipped']} skipped")
+      return True
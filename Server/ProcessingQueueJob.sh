@@ -1,4 +1,5 @@
 # Guide from https://stackoverflow.com/a/185473
+# ProcessingQueueService is a long-running service. The cron job only restarts it if it is not running.
 
 LOCKFILE=/tmp/bravo_processingqueue_lock.txt
 if [ -e ${LOCKFILE} ] && kill -0 `cat ${LOCKFILE}`; then
@@ -5,15 +5,22 @@
 =========================================================
 
 * Copyright 2023 by Jackson Cagle, Fixel Institute
-* The source code is made available under a Creative Common NonCommercial ShareAlike License (CC BY-NC-SA 4.0) (https://creativecommons.org/licenses/by-nc-sa/4.0/) 
+* The source code is made available under a Creative Common NonCommercial ShareAlike License (CC BY-NC-SA 4.0) (https://creativecommons.org/licenses/by-nc-sa/4.0/)
 
  =========================================================
 
 * The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
 """
 """
-Crontab Queue Processor
+Processing Queue Service
 ===================================================
+Long-running queue processor. A supervisor process keeps a persistent websocket connection to the
+notification system and wakes a pool of worker processes whenever a ``RequestProcessing`` notification is received.
+Workers claim jobs atomically and keep a lease on the job while processing, jobs with expired lease (i.e. crashed worker)
+are returned to the queue. Jobs of the same device or patient are never processed concurrently.
+
+Run ``python3 ProcessingQueueService.py --once`` to process the current queue once in a single process.
+
 @author: Jackson Cagle, University of Florida
 @email: jackson.cagle@neurology.ufl.edu
 @date: Thu Sep 16 12:05:09 2021
@@ -27,6 +34,9 @@ import datetime
 import dateutil
 import shutil
 import time
+import socket
+import threading
+import multiprocessing
 import numpy as np
 import pytz
 from cryptography.fernet import Fernet
@@ -35,476 +45,421 @@ from zipfile import ZipFile
 import websocket
 from BRAVO import asgi
 
+from django.db import transaction, connections
+from django.utils import timezone
+
 from Backend import models
-from modules.Percept import Sessions as PerceptSessions
+from modules.Percept import Sessions as PerceptSessions, TherapeuticPrediction
 from modules.Summit import Sessions as SummitSessions
-from modules import Database, AnalysisBuilder
+from modules import Database, AnalysisBuilder, Notification
 from decoder import Percept, Summit
 
 DATABASE_PATH = os.environ.get('DATASERVER_PATH')
 
-def processJSONUploads():
-    ws = websocket.WebSocket()
-    if models.ProcessingQueue.objects.filter(type="decodeJSON", state="InProgress").exists():
-        print(datetime.datetime.now())
-        BatchQueues = models.ProcessingQueue.objects.filter(type="decodeJSON", state="InProgress").order_by("datetime").all()
-        for queue in BatchQueues:
-            if not models.ProcessingQueue.objects.filter(state="InProgress", queue_id=queue.queue_id).exists():
-                continue
-            queue.state = "Processing"
-            queue.save()
-            try:
-                ws.connect("ws://localhost:3001/socket/notification")
-                ws.send(json.dumps({
-                    "NotificationType": "TaskProcessing",
-                    "TaskUser": str(queue.owner),
-                    "TaskID": str(queue.queue_id),
-                    "Authorization": os.environ["ENCRYPTION_KEY"],
-                    "State": "Processing",
-                    "Message": "",
-                }))
-                ws.close()
-            except Exception as e:
-                print(e)
-
-            print(f"Start Processing {queue.descriptor['filename']}")
-            newPatient = None
-            ErrorMessage = ""
-            ProcessingResult = ""
-            
-            try:
-                JSON = Percept.decodeEncryptedJSON(DATABASE_PATH + "cache" + os.path.sep + queue.descriptor["filename"], os.environ.get('ENCRYPTION_KEY'))
-            except:
-                queue.state = "Error"
-                queue.descriptor["Message"] = "JSON Format Error"
-                print(queue.descriptor["Message"])
-                queue.save()
-                
-                try:
-                    ws.connect("ws://localhost:3001/socket/notification")
-                    ws.send(json.dumps({
-                        "NotificationType": "TaskComplete",
-                        "TaskUser": str(queue.owner),
-                        "TaskID": str(queue.queue_id),
-                        "Authorization": os.environ["ENCRYPTION_KEY"],
-                        "State": "Error",
-                        "Message": queue.descriptor["Message"],
-                    }))
-                    ws.close()
-                except Exception as e:
-                    print(e)
-
-                continue
-
-            try:
-                user = models.PlatformUser.objects.get(unique_user_id=queue.owner)
-                if (user.is_admin or user.is_clinician):
-                    ProcessingResult, newPatient, _ = PerceptSessions.processPerceptJSON(user, queue.descriptor["filename"]) 
-                else:
-                    if "device_deidentified_id" in queue.descriptor:
-                        ProcessingResult, _, _ = PerceptSessions.processPerceptJSON(user, queue.descriptor["filename"], device_deidentified_id=queue.descriptor["device_deidentified_id"])
-                    elif "passkey" in queue.descriptor:
-                        table = Database.getDeidentificationLookupTable(user, queue.descriptor["passkey"])
-                        ProcessingResult, newPatient, _ = PerceptSessions.processPerceptJSON(user, queue.descriptor["filename"], lookupTable=table)
-
-            except Exception as e:
-                ErrorMessage = str(e)
-                print(ErrorMessage)
-
-            print(f"End Processing {queue.descriptor['filename']}")
+PROCESSING_QUEUE_WORKERS = int(os.environ.get('PROCESSING_QUEUE_WORKERS', 2))
+PROCESSING_QUEUE_LEASE = float(os.environ.get('PROCESSING_QUEUE_LEASE', 300))
+PROCESSING_QUEUE_POLL_INTERVAL = float(os.environ.get('PROCESSING_QUEUE_POLL_INTERVAL', 60))
+PROCESSING_QUEUE_MAX_ATTEMPTS = int(os.environ.get('PROCESSING_QUEUE_MAX_ATTEMPTS', 3))
+
+def notifyTaskState(queue, NotificationType, State, Message=""):
+    Notification.publishNotification({
+        "NotificationType": NotificationType,
+        "TaskUser": str(queue.owner),
+        "TaskID": str(queue.queue_id),
+        "State": State,
+        "Message": Message,
+    })
+
+def setQueueError(queue, Message):
+    queue.state = "Error"
+    queue.descriptor["Message"] = Message
+    print(queue.descriptor["Message"])
+    queue.save()
+    notifyTaskState(queue, "TaskComplete", "Error", queue.descriptor["Message"])
+
+def processJSONUpload(queue):
+    newPatient = None
+    ErrorMessage = ""
+    ProcessingResult = ""
+
+    # Keep the encrypted file content so the cached upload can be restored on failure without decoding it here.
+    try:
+        with open(DATABASE_PATH + "cache" + os.path.sep + queue.descriptor["filename"], "rb") as file:
+            EncryptedJSON = file.read()
+    except:
+        setQueueError(queue, "JSON Format Error")
+        return
+
+    try:
+        user = models.PlatformUser.objects.get(unique_user_id=queue.owner)
+        if (user.is_admin or user.is_clinician):
+            ProcessingResult, newPatient, JSON = PerceptSessions.processPerceptJSON(user, queue.descriptor["filename"])
             if ProcessingResult == "Success":
-                queue.state = "Complete"
-                queue.save()
-                try:
-                    ws.connect("ws://localhost:3001/socket/notification")
-                    ws.send(json.dumps({
-                        "NotificationType": "TaskComplete",
-                        "TaskUser": str(queue.owner),
-                        "TaskID": str(queue.queue_id),
-                        "Authorization": os.environ["ENCRYPTION_KEY"],
-                        "State": "Complete",
-                        "Message": ErrorMessage,
-                    }))
-
-                    if newPatient:
-                        newPatient = Database.extractPatientTableRow(str(queue.owner), newPatient)
-                        ws.send(json.dumps({
-                            "NotificationType": "NewPatient",
-                            "TaskUser": str(queue.owner),
-                            "NewPatient": newPatient,
-                            "Authorization": os.environ["ENCRYPTION_KEY"],
-                        }))
-
-                    ws.close()
-                except Exception as e:
-                    print(e)
+                queuePredictionModels(queue, JSON["PatientID"])
+        else:
+            if "device_deidentified_id" in queue.descriptor:
+                ProcessingResult, _, _ = PerceptSessions.processPerceptJSON(user, queue.descriptor["filename"], device_deidentified_id=queue.descriptor["device_deidentified_id"])
+            elif "passkey" in queue.descriptor:
+                table = Database.getDeidentificationLookupTable(user, queue.descriptor["passkey"])
+                ProcessingResult, newPatient, _ = PerceptSessions.processPerceptJSON(user, queue.descriptor["filename"], lookupTable=table)
+
+    except Exception as e:
+        ErrorMessage = str(e)
+        print(ErrorMessage)
+
+    if ProcessingResult == "Success":
+        queue.state = "Complete"
+        queue.save()
+        messages = [{
+            "NotificationType": "TaskComplete",
+            "TaskUser": str(queue.owner),
+            "TaskID": str(queue.queue_id),
+            "State": "Complete",
+            "Message": ErrorMessage,
+        }]
+        if newPatient:
+            messages.append({
+                "NotificationType": "NewPatient",
+                "TaskUser": str(queue.owner),
+                "NewPatient": Database.extractPatientTableRow(str(queue.owner), newPatient),
+            })
+        Notification.publishNotification(*messages)
+    else:
+        setQueueError(queue, ErrorMessage)
+        if not os.path.exists(DATABASE_PATH + "cache" + os.path.sep + queue.descriptor["filename"]):
+            with open(DATABASE_PATH + "cache" + os.path.sep + queue.descriptor["filename"], "wb+") as file:
+                file.write(EncryptedJSON)
+
+def queuePredictionModels(queue, patientId):
+    """ Queue background precomputation of prediction models for BrainSense streaming recordings of a patient.
+    """
+
+    if not models.ProcessingQueue.objects.filter(type="predictionModels", state="InProgress", descriptor__patientId=patientId).exists():
+        models.ProcessingQueue(owner=queue.owner, type="predictionModels", state="InProgress", descriptor={"filename": "PredictionModels_" + patientId, "patientId": patientId}).save()
+
+def processPredictionModels(queue):
+    try:
+        user = models.PlatformUser.objects.get(unique_user_id=queue.owner)
+        CardiacFilter = user.configuration["ProcessingSettings"]["RealtimeStream"]["CardiacFilter"]["value"] == "true"
+        patient = models.Patient.objects.get(deidentified_id=queue.descriptor["patientId"])
+        analysisIds = models.CombinedRecordingAnalysis.objects.filter(device_deidentified_id__in=patient.device_deidentified_id, analysis_name="DefaultBrainSenseStreaming").values_list("deidentified_id", flat=True)
+        ExistingModels = set()
+        StaleModels = set()
+        for recordingId, modelDetails in models.PredictionModel.objects.filter(recording_id__in=analysisIds).values_list("recording_id", "model_details"):
+            if TherapeuticPrediction.isPredictionModelCurrent(modelDetails, CardiacFilter):
+                ExistingModels.add(recordingId)
             else:
-                print(ErrorMessage)
-                queue.state = "Error"
-                queue.descriptor["Message"] = ErrorMessage
-                queue.save()
-                
-                try:
-                    ws.connect("ws://localhost:3001/socket/notification")
-                    ws.send(json.dumps({
-                        "NotificationType": "TaskComplete",
-                        "TaskUser": str(queue.owner),
-                        "TaskID": str(queue.queue_id),
-                        "Authorization": os.environ["ENCRYPTION_KEY"],
-                        "State": "Error",
-                        "Message": queue.descriptor["Message"],
-                    }))
-                    ws.close()
-                except Exception as e:
-                    print(e)
-                
-                PerceptSessions.saveCacheJSON(queue.descriptor["filename"], json.dumps(JSON).encode('utf-8'))
-
-def processAnnotations():
-    ws = websocket.WebSocket()
-    if models.ProcessingQueue.objects.filter(type="annotations", state="Error").exists():
-        print(datetime.datetime.now())
-        BatchQueues = models.ProcessingQueue.objects.filter(type="annotations", state="Error").order_by("datetime").all()
-        for queue in BatchQueues:
-            if not models.ProcessingQueue.objects.filter(state="Error", queue_id=queue.queue_id).exists():
+                StaleModels.add(recordingId)
+        Count = TherapeuticPrediction.precomputePredictionModels([analysisId for analysisId in analysisIds if not analysisId in ExistingModels or analysisId in StaleModels], cardiacFilter=CardiacFilter)
+        print(f"{Count} prediction models computed")
+    except Exception as e:
+        setQueueError(queue, str(e))
+        return
+
+    # Background jobs are not listed to users, completed rows would only accumulate.
+    queue.delete()
+
+def processAnnotation(queue):
+    try:
+        AnalysisBuilder.processAnnotations(DATABASE_PATH + "cache" + os.path.sep + queue.descriptor["filename"], queue.descriptor['patientId'])
+    except Exception as e:
+        setQueueError(queue, str(e))
+        return
+
+    queue.state = "Complete"
+    queue.save()
+
+def processExternalCSVUpload(queue):
+    ErrorMessage = ""
+    try:
+        ProcessedData = AnalysisBuilder.processExternalRecordings(DATABASE_PATH + "cache" + os.path.sep + queue.descriptor["filename"])
+    except:
+        setQueueError(queue, "CSV Format Error")
+        return
+
+    try:
+        ProcessedData["SamplingRate"] = float(queue.descriptor["descriptor"]["SamplingRate"])
+        ProcessedData["StartTime"] = float(queue.descriptor["descriptor"]["StartTime"])/1000 # Javascript Time is in Milliseconds
+        ProcessedData["Missing"] = np.zeros(ProcessedData["Data"].shape)
+        ProcessedData["Duration"] = ProcessedData["Data"].shape[0]/ProcessedData["SamplingRate"]
+        recording = models.ExternalRecording(patient_deidentified_id=queue.descriptor["patientId"],
+                                    recording_type=queue.descriptor["descriptor"]["Label"],
+                                    recording_date=datetime.datetime.fromtimestamp(ProcessedData["StartTime"]).astimezone(pytz.utc),
+                                    recording_duration=ProcessedData["Duration"])
+
+        filename = Database.saveSourceFiles(ProcessedData, "ExternalRecording", "Raw", recording.recording_id, recording.patient_deidentified_id)
+        recording.recording_datapointer = filename
+        recording.save()
+
+    except Exception as e:
+        ErrorMessage = str(e)
+
+    if ErrorMessage == "":
+        queue.state = "Complete"
+        queue.save()
+    else:
+        setQueueError(queue, ErrorMessage)
+
+def processExternalMDATUpload(queue):
+    ErrorMessage = ""
+    try:
+        ProcessedDataList = AnalysisBuilder.processMDATRecordings(DATABASE_PATH + "cache" + os.path.sep + queue.descriptor["filename"])
+    except Exception as e:
+        setQueueError(queue, str(e))
+        return
+
+    try:
+        for ProcessedData in ProcessedDataList:
+            recording = models.ExternalRecording(patient_deidentified_id=queue.descriptor["patientId"],
+                                    recording_type="DelsysMDAT." + ProcessedData["ChannelNames"][0].split(".")[0],
+                                    recording_date=datetime.datetime.fromtimestamp(ProcessedData["StartTime"]).astimezone(pytz.utc),
+                                    recording_duration=ProcessedData["Duration"])
+            filename = Database.saveSourceFiles(ProcessedData, "ExternalRecording", "Raw", recording.recording_id, recording.patient_deidentified_id)
+            recording.recording_datapointer = filename
+            recording.save()
+
+    except Exception as e:
+        ErrorMessage = str(e)
+
+    if ErrorMessage == "":
+        queue.state = "Complete"
+        queue.save()
+    else:
+        setQueueError(queue, ErrorMessage)
+
+def processSummitZIPUpload(queue):
+    ErrorMessage = ""
+    try:
+        with ZipFile(DATABASE_PATH + "cache" + os.path.sep + queue.descriptor["filename"]) as zObject:
+            zObject.extractall(path=DATABASE_PATH + "cache" + os.path.sep + queue.descriptor["filename"].replace(".zip",""))
+
+    except:
+        setQueueError(queue, "ZipFile Format Error")
+        return
+
+    try:
+        user = models.PlatformUser.objects.get(unique_user_id=queue.owner)
+        if "device_deidentified_id" in queue.descriptor:
+            ProcessingResult, _, _ = SummitSessions.processSummitSession(user, DATABASE_PATH + "cache" + os.path.sep + queue.descriptor["filename"].replace(".zip",""), device_deidentified_id=queue.descriptor["device_deidentified_id"])
+            if not ProcessingResult == "Success":
+                raise Exception(ProcessingResult)
+
+    except Exception as e:
+        ErrorMessage = str(e)
+        print(ErrorMessage)
+
+    shutil.rmtree(DATABASE_PATH + "cache" + os.path.sep + queue.descriptor["filename"].replace(".zip",""))
+    os.remove(DATABASE_PATH + "cache" + os.path.sep + queue.descriptor["filename"])
+
+    if ErrorMessage == "":
+        queue.state = "Complete"
+        queue.save()
+    else:
+        setQueueError(queue, ErrorMessage)
+
+QUEUE_HANDLERS = {
+    "decodeJSON": processJSONUpload,
+    "decodeSummitZIP": processSummitZIPUpload,
+    "externalCSVs": processExternalCSVUpload,
+    "externalMDATs": processExternalMDATUpload,
+    "annotations": processAnnotation,
+    "predictionModels": processPredictionModels,
+}
+
+# Background jobs queued by the service itself, not shown in user processing queue.
+BACKGROUND_QUEUE_TYPES = ["predictionModels"]
+
+def getQueueExclusivityKeys(owner, descriptor):
+    """ Keys that may not be processed by two workers at the same time.
+
+    Jobs of the same device (partitioned chronic recordings, therapy, events and impedance deduplication) or the same patient 
+    are processed serially. Files of one upload batch are processed in parallel, the device of a session file that is only known 
+    after decoding is locked by the session processing itself (see Database.acquireProcessingLock function).
+
+    Args:
+      owner: unique user ID of the job owner.
+      descriptor: job descriptor.
+
+    Returns:
+      Set of exclusivity keys.
+    """
+
+    Keys = set()
+    if type(descriptor) == dict and descriptor.get("device_deidentified_id"):
+        Keys.add("Device:" + str(descriptor["device_deidentified_id"]))
+    if type(descriptor) == dict and descriptor.get("patientId"):
+        Keys.add("Patient:" + str(descriptor["patientId"]))
+    return Keys
+
+def claimQueueItem(worker):
+    """ Atomically claim the oldest pending job that does not conflict with jobs being processed.
+
+    Claims are serialized by locking the oldest active job row, so that the exclusivity keys (see getQueueExclusivityKeys function)
+    of a job claimed by one worker are visible to the next claim. Jobs sharing a key with a job in "Processing" state are skipped.
+    The claimed job is moved to "Processing" state with a lease that must be renewed by the worker (see renewQueueLease function).
+
+    Args:
+      worker: Unique worker identifier.
+
+    Returns:
+      ProcessingQueue object, or None if no job can be claimed.
+    """
+
+    with transaction.atomic():
+        models.ProcessingQueue.objects.select_for_update().filter(type__in=QUEUE_HANDLERS.keys(), state__in=["InProgress", "Processing"]).order_by("id").first()
+
+        BusyKeys = set()
+        for owner, descriptor in models.ProcessingQueue.objects.filter(type__in=QUEUE_HANDLERS.keys(), state="Processing").values_list("owner", "descriptor"):
+            BusyKeys.update(getQueueExclusivityKeys(owner, descriptor))
+
+        queue = None
+        for queueId, owner, descriptor in models.ProcessingQueue.objects.filter(type__in=QUEUE_HANDLERS.keys(), state="InProgress").order_by("datetime").values_list("id", "owner", "descriptor"):
+            if len(getQueueExclusivityKeys(owner, descriptor) & BusyKeys) > 0:
                 continue
-            queue.state = "Processing"
-            queue.save()
-            ErrorMessage = ""
-            try:
+            queue = models.ProcessingQueue.objects.select_for_update(skip_locked=True).filter(id=queueId, state="InProgress").first()
+            if queue:
+                break
+
+        if not queue:
+            return None
+        queue.state = "Processing"
+        queue.worker = worker
+        queue.lease_expiry = timezone.now() + datetime.timedelta(seconds=PROCESSING_QUEUE_LEASE)
+        queue.attempts += 1
+        queue.save()
+    return queue
+
+def renewQueueLease(queue, worker, stopEvent):
+    """ Heartbeat thread renewing the lease of a claimed job until stopEvent is set.
+    """
+
+    while not stopEvent.wait(PROCESSING_QUEUE_LEASE / 3):
+        try:
+            models.ProcessingQueue.objects.filter(id=queue.id, state="Processing", worker=worker).update(lease_expiry=timezone.now() + datetime.timedelta(seconds=PROCESSING_QUEUE_LEASE))
+            Database.renewProcessingLocks()
+        except Exception as e:
+            print(e)
+    connections.close_all()
+
+def requeueExpiredLeases():
+    """ Return jobs whose lease expired (worker crashed or killed) to the queue.
+
+    Jobs that exceeded PROCESSING_QUEUE_MAX_ATTEMPTS are marked as Error instead.
+    """
+
+    ExpiredQueues = models.ProcessingQueue.objects.filter(type__in=QUEUE_HANDLERS.keys(), state="Processing", lease_expiry__lt=timezone.now())
+    for queue in ExpiredQueues:
+        if queue.attempts >= PROCESSING_QUEUE_MAX_ATTEMPTS:
+            setQueueError(queue, "Processing Interrupted")
+        else:
+            print(f"Requeue {queue.queue_id} from {queue.worker}")
+            models.ProcessingQueue.objects.filter(id=queue.id, state="Processing", worker=queue.worker).update(state="InProgress", worker="", lease_expiry=None)
+
+def processQueueItem(queue, worker):
+    stopEvent = threading.Event()
+    heartbeat = threading.Thread(target=renewQueueLease, args=(queue, worker, stopEvent), daemon=True)
+    heartbeat.start()
+
+    if not queue.type in BACKGROUND_QUEUE_TYPES:
+        notifyTaskState(queue, "TaskProcessing", "Processing")
+    print(f"{datetime.datetime.now()} [{worker}] Start Processing {queue.descriptor['filename']}")
+    try:
+        QUEUE_HANDLERS[queue.type](queue)
+    except Exception as e:
+        setQueueError(queue, str(e))
+    finally:
+        stopEvent.set()
+        heartbeat.join()
+        # Forked workers exit without running exit handlers, notifications of the job are sent before the next job is claimed.
+        Notification.flushNotifications()
+    print(f"{datetime.datetime.now()} [{worker}] End Processing {queue.descriptor['filename']}")
+
+def processQueue(worker):
+    """ Process all pending jobs, return when the queue is empty.
+    """
+
+    while True:
+        queue = claimQueueItem(worker)
+        if not queue:
+            return
+        processQueueItem(queue, worker)
+
+def queueWorker(index, wakeCondition, wakeCounter):
+    worker = f"{socket.gethostname()}:{os.getpid()}:{index}"
+    while True:
+        generation = wakeCounter.value
+        try:
+            processQueue(worker)
+        except Exception as e:
+            print(e)
+            connections.close_all()
+
+        with wakeCondition:
+            if wakeCounter.value == generation:
+                wakeCondition.wait(PROCESSING_QUEUE_POLL_INTERVAL)
+
+def wakeWorkers(wakeCondition, wakeCounter):
+    with wakeCondition:
+        wakeCounter.value += 1
+        wakeCondition.notify_all()
+
+def startService():
+    """ Start supervisor and worker pool.
+
+    Worker processes are forked after Django and processing modules are imported, so the import cost is paid once.
+    The supervisor wakes workers on ``ProcessQueue`` notification (sent by the notification system on ``RequestProcessing``),
+    or every PROCESSING_QUEUE_POLL_INTERVAL seconds if no notification is received. Dead workers are restarted.
+    """
+
+    context = multiprocessing.get_context("fork")
+    wakeCondition = context.Condition()
+    wakeCounter = context.Value("l", 0)
+
+    # Completed background jobs were kept by earlier versions of the service
+    models.ProcessingQueue.objects.filter(type__in=BACKGROUND_QUEUE_TYPES, state="Complete").delete()
+
+    # Database connections must not be shared with forked workers
+    connections.close_all()
+    workers = [None] * PROCESSING_QUEUE_WORKERS
+
+    ws = None
+    while True:
+        for i in range(len(workers)):
+            if workers[i] == None or not workers[i].is_alive():
+                connections.close_all()
+                workers[i] = context.Process(target=queueWorker, args=(i, wakeCondition, wakeCounter), daemon=True)
+                workers[i].start()
+
+        try:
+            requeueExpiredLeases()
+        except Exception as e:
+            print(e)
+            connections.close_all()
+
+        try:
+            if ws == None:
+                ws = websocket.WebSocket()
                 ws.connect("ws://localhost:3001/socket/notification")
-                ws.send(json.dumps({
-                    "NotificationType": "TaskProcessing",
-                    "TaskUser": str(queue.owner),
-                    "TaskID": str(queue.queue_id),
-                    "Authorization": os.environ["ENCRYPTION_KEY"],
-                    "State": "Processing",
-                    "Message": "",
-                }))
-                ws.close()
-            except Exception as e:
-                print(e)
-
-            print(f"Start Processing {queue.descriptor['filename']}")
-            try:
-                AnalysisBuilder.processAnnotations(DATABASE_PATH + "cache" + os.path.sep + queue.descriptor["filename"], queue.descriptor['patientId'])
-            except Exception as e:
-                queue.state = "Error"
-                queue.descriptor["Message"] = str(e)
-                print(queue.descriptor["Message"])
-                queue.save()
-                
-                try:
-                    ws.connect("ws://localhost:3001/socket/notification")
-                    ws.send(json.dumps({
-                        "NotificationType": "TaskComplete",
-                        "TaskUser": str(queue.owner),
-                        "TaskID": str(queue.queue_id),
-                        "Authorization": os.environ["ENCRYPTION_KEY"],
-                        "State": "Error",
-                        "Message": queue.descriptor["Message"],
-                    }))
-                    ws.close()
-                except Exception as e:
-                    print(e)
-                continue
+                ws.send(json.dumps({"Authorization": os.environ["ENCRYPTION_KEY"], "PersistentConnection": True}))
+                ws.settimeout(PROCESSING_QUEUE_POLL_INTERVAL)
+                wakeWorkers(wakeCondition, wakeCounter)
 
-            print(f"End Processing {queue.descriptor['filename']}")
-            if ErrorMessage == "":
-                queue.state = "Complete"
-                queue.save()
-            else:
-                print(ErrorMessage)
-                queue.state = "Error"
-                queue.descriptor["Message"] = ErrorMessage
-                queue.save()
-                
-                try:
-                    ws.connect("ws://localhost:3001/socket/notification")
-                    ws.send(json.dumps({
-                        "NotificationType": "TaskComplete",
-                        "TaskUser": str(queue.owner),
-                        "TaskID": str(queue.queue_id),
-                        "Authorization": os.environ["ENCRYPTION_KEY"],
-                        "State": "Error",
-                        "Message": queue.descriptor["Message"],
-                    }))
-                    ws.close()
-                except Exception as e:
-                    print(e)
-
-def processExternalRecordingUpload():
-    ws = websocket.WebSocket()
-    if models.ProcessingQueue.objects.filter(type="externalCSVs", state="InProgress").exists():
-        print(datetime.datetime.now())
-        BatchQueues = models.ProcessingQueue.objects.filter(type="externalCSVs", state="InProgress").order_by("datetime").all()
-        for queue in BatchQueues:
-            if not models.ProcessingQueue.objects.filter(state="InProgress", queue_id=queue.queue_id).exists():
-                continue
-            queue.state = "Processing"
-            queue.save()
-            ErrorMessage = ""
-            try:
-                ws.connect("ws://localhost:3001/socket/notification")
-                ws.send(json.dumps({
-                    "NotificationType": "TaskProcessing",
-                    "TaskUser": str(queue.owner),
-                    "TaskID": str(queue.queue_id),
-                    "Authorization": os.environ["ENCRYPTION_KEY"],
-                    "State": "Processing",
-                    "Message": "",
-                }))
-                ws.close()
-            except Exception as e:
-                print(e)
-
-            print(f"Start Processing {queue.descriptor['filename']}")
-            try:
-                ProcessedData = AnalysisBuilder.processExternalRecordings(DATABASE_PATH + "cache" + os.path.sep + queue.descriptor["filename"])
-            except:
-                queue.state = "Error"
-                queue.descriptor["Message"] = "CSV Format Error"
-                print(queue.descriptor["Message"])
-                queue.save()
-                
-                try:
-                    ws.connect("ws://localhost:3001/socket/notification")
-                    ws.send(json.dumps({
-                        "NotificationType": "TaskComplete",
-                        "TaskUser": str(queue.owner),
-                        "TaskID": str(queue.queue_id),
-                        "Authorization": os.environ["ENCRYPTION_KEY"],
-                        "State": "Error",
-                        "Message": queue.descriptor["Message"],
-                    }))
-                    ws.close()
-                except Exception as e:
-                    print(e)
-                continue
-
-            try:
-                ProcessedData["SamplingRate"] = float(queue.descriptor["descriptor"]["SamplingRate"])
-                ProcessedData["StartTime"] = float(queue.descriptor["descriptor"]["StartTime"])/1000 # Javascript Time is in Milliseconds
-                ProcessedData["Missing"] = np.zeros(ProcessedData["Data"].shape)
-                ProcessedData["Duration"] = ProcessedData["Data"].shape[0]/ProcessedData["SamplingRate"]
-                recording = models.ExternalRecording(patient_deidentified_id=queue.descriptor["patientId"], 
-                                         recording_type=queue.descriptor["descriptor"]["Label"], 
-                                         recording_date=datetime.datetime.fromtimestamp(ProcessedData["StartTime"]).astimezone(pytz.utc),
-                                         recording_duration=ProcessedData["Duration"])
-                
-                filename = Database.saveSourceFiles(ProcessedData, "ExternalRecording", "Raw", recording.recording_id, recording.patient_deidentified_id)
-                recording.recording_datapointer = filename
-                recording.save()
-                
-            except Exception as e:
-                ErrorMessage = str(e)
-
-            print(f"End Processing {queue.descriptor['filename']}")
-            if ErrorMessage == "":
-                queue.state = "Complete"
-                queue.save()
-            else:
-                print(ErrorMessage)
-                queue.state = "Error"
-                queue.descriptor["Message"] = ErrorMessage
-                queue.save()
-                
-                try:
-                    ws.connect("ws://localhost:3001/socket/notification")
-                    ws.send(json.dumps({
-                        "NotificationType": "TaskComplete",
-                        "TaskUser": str(queue.owner),
-                        "TaskID": str(queue.queue_id),
-                        "Authorization": os.environ["ENCRYPTION_KEY"],
-                        "State": "Error",
-                        "Message": queue.descriptor["Message"],
-                    }))
-                    ws.close()
-                except Exception as e:
-                    print(e)
-                
-    if models.ProcessingQueue.objects.filter(type="externalMDATs", state="InProgress").exists():
-        print(datetime.datetime.now())
-        BatchQueues = models.ProcessingQueue.objects.filter(type="externalMDATs", state="InProgress").order_by("datetime").all()
-        for queue in BatchQueues:
-            if not models.ProcessingQueue.objects.filter(state="InProgress", queue_id=queue.queue_id).exists():
-                continue
-            queue.state = "Processing"
-            queue.save()
-            ErrorMessage = ""
-            try:
-                ws.connect("ws://localhost:3001/socket/notification")
-                ws.send(json.dumps({
-                    "NotificationType": "TaskProcessing",
-                    "TaskUser": str(queue.owner),
-                    "TaskID": str(queue.queue_id),
-                    "Authorization": os.environ["ENCRYPTION_KEY"],
-                    "State": "Processing",
-                    "Message": "",
-                }))
-                ws.close()
-            except Exception as e:
-                print(e)
-
-            print(f"Start Processing {queue.descriptor['filename']}")
-            try:
-                ProcessedDataList = AnalysisBuilder.processMDATRecordings(DATABASE_PATH + "cache" + os.path.sep + queue.descriptor["filename"])
-            except Exception as e:
-                print(e)
-                queue.state = "Error"
-                queue.descriptor["Message"] = str(e)
-                print(queue.descriptor["Message"])
-                queue.save()
-                
-                try:
-                    ws.connect("ws://localhost:3001/socket/notification")
-                    ws.send(json.dumps({
-                        "NotificationType": "TaskComplete",
-                        "TaskUser": str(queue.owner),
-                        "TaskID": str(queue.queue_id),
-                        "Authorization": os.environ["ENCRYPTION_KEY"],
-                        "State": "Error",
-                        "Message": queue.descriptor["Message"],
-                    }))
-                    ws.close()
-                except Exception as e:
-                    print(e)
-                continue
-
-            try:
-                for ProcessedData in ProcessedDataList:
-                    recording = models.ExternalRecording(patient_deidentified_id=queue.descriptor["patientId"], 
-                                            recording_type="DelsysMDAT." + ProcessedData["ChannelNames"][0].split(".")[0], 
-                                            recording_date=datetime.datetime.fromtimestamp(ProcessedData["StartTime"]).astimezone(pytz.utc),
-                                            recording_duration=ProcessedData["Duration"])
-                    filename = Database.saveSourceFiles(ProcessedData, "ExternalRecording", "Raw", recording.recording_id, recording.patient_deidentified_id)
-                    recording.recording_datapointer = filename
-                    recording.save()
-                
-            except Exception as e:
-                ErrorMessage = str(e)
-
-            print(f"End Processing {queue.descriptor['filename']}")
-            if ErrorMessage == "":
-                queue.state = "Complete"
-                queue.save()
-            else:
-                print(ErrorMessage)
-                queue.state = "Error"
-                queue.descriptor["Message"] = ErrorMessage
-                queue.save()
-                
-                try:
-                    ws.connect("ws://localhost:3001/socket/notification")
-                    ws.send(json.dumps({
-                        "NotificationType": "TaskComplete",
-                        "TaskUser": str(queue.owner),
-                        "TaskID": str(queue.queue_id),
-                        "Authorization": os.environ["ENCRYPTION_KEY"],
-                        "State": "Error",
-                        "Message": queue.descriptor["Message"],
-                    }))
-                    ws.close()
-                except Exception as e:
-                    print(e)
-                
-def processSummitZIPUpload():
-    ws = websocket.WebSocket()
-    if models.ProcessingQueue.objects.filter(type="decodeSummitZIP", state="InProgress").exists():
-        print(datetime.datetime.now())
-        BatchQueues = models.ProcessingQueue.objects.filter(type="decodeSummitZIP", state="InProgress").order_by("datetime").all()
-        for queue in BatchQueues:
-            if not models.ProcessingQueue.objects.filter(state="InProgress", queue_id=queue.queue_id).exists():
-                continue
-            queue.state = "Processing"
-            queue.save()
-            ErrorMessage = ""
-            try:
-                ws.connect("ws://localhost:3001/socket/notification")
-                ws.send(json.dumps({
-                    "NotificationType": "TaskProcessing",
-                    "TaskUser": str(queue.owner),
-                    "TaskID": str(queue.queue_id),
-                    "Authorization": os.environ["ENCRYPTION_KEY"],
-                    "State": "Processing",
-                    "Message": "",
-                }))
-                ws.close()
-            except Exception as e:
-                print(e)
-
-            print(f"Start Processing {queue.descriptor['filename']}")
-            try:
-                with ZipFile(DATABASE_PATH + "cache" + os.path.sep + queue.descriptor["filename"]) as zObject:
-                    zObject.extractall(path=DATABASE_PATH + "cache" + os.path.sep + queue.descriptor["filename"].replace(".zip",""))
-                
-            except:
-                queue.state = "Error"
-                queue.descriptor["Message"] = "ZipFile Format Error"
-                print(queue.descriptor["Message"])
-                queue.save()
-                
-                try:
-                    ws.connect("ws://localhost:3001/socket/notification")
-                    ws.send(json.dumps({
-                        "NotificationType": "TaskComplete",
-                        "TaskUser": str(queue.owner),
-                        "TaskID": str(queue.queue_id),
-                        "Authorization": os.environ["ENCRYPTION_KEY"],
-                        "State": "Error",
-                        "Message": queue.descriptor["Message"],
-                    }))
-                    ws.close()
-                except Exception as e:
-                    print(e)
-                continue
-            
-            try:
-                user = models.PlatformUser.objects.get(unique_user_id=queue.owner)
-                if "device_deidentified_id" in queue.descriptor:
-                    ProcessingResult, _, _ = SummitSessions.processSummitSession(user, DATABASE_PATH + "cache" + os.path.sep + queue.descriptor["filename"].replace(".zip",""), device_deidentified_id=queue.descriptor["device_deidentified_id"])
-                    if not ProcessingResult == "Success":
-                        raise Exception(ProcessingResult)
-                    
-            except Exception as e:
-                ErrorMessage = str(e)
-                print(ErrorMessage)
-
-            print(f"End Processing {queue.descriptor['filename']}")
-            if ErrorMessage == "":
-                queue.state = "Complete"
-                queue.save()
-
-                shutil.rmtree(DATABASE_PATH + "cache" + os.path.sep + queue.descriptor["filename"].replace(".zip",""))
-                os.remove(DATABASE_PATH + "cache" + os.path.sep + queue.descriptor["filename"])
-
-            else:
-                queue.state = "Error"
-                queue.descriptor["Message"] = ErrorMessage
-                queue.save()
-
-                shutil.rmtree(DATABASE_PATH + "cache" + os.path.sep + queue.descriptor["filename"].replace(".zip",""))
-                os.remove(DATABASE_PATH + "cache" + os.path.sep + queue.descriptor["filename"])
-                
-                try:
-                    ws.connect("ws://localhost:3001/socket/notification")
-                    ws.send(json.dumps({
-                        "NotificationType": "TaskComplete",
-                        "TaskUser": str(queue.owner),
-                        "TaskID": str(queue.queue_id),
-                        "Authorization": os.environ["ENCRYPTION_KEY"],
-                        "State": "Error",
-                        "Message": queue.descriptor["Message"],
-                    }))
-                    ws.close()
-                except Exception as e:
-                    print(e)
-                
+            message = json.loads(ws.recv())
+            if message.get("Notification") == "ProcessQueue":
+                wakeWorkers(wakeCondition, wakeCounter)
 
+        except websocket.WebSocketTimeoutException:
+            wakeWorkers(wakeCondition, wakeCounter)
 
+        except Exception as e:
+            print(e)
+            ws = None
+            wakeWorkers(wakeCondition, wakeCounter)
+            time.sleep(PROCESSING_QUEUE_POLL_INTERVAL)
 
 if __name__ == '__main__':
-    processJSONUploads()
-    processSummitZIPUpload()
-    processExternalRecordingUpload()
-    processAnnotations()
+    if "--once" in sys.argv:
+        requeueExpiredLeases()
+        processQueue(f"{socket.gethostname()}:{os.getpid()}")
+    else:
+        startService()
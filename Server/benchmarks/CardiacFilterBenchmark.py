@@ -0,0 +1,193 @@
+""""""
+"""
+=========================================================
+* UF BRAVO Platform
+=========================================================
+
+* Copyright 2023 by Jackson Cagle, Fixel Institute
+* The source code is made available under a Creative Common NonCommercial ShareAlike License (CC BY-NC-SA 4.0) (https://creativecommons.org/licenses/by-nc-sa/4.0/)
+
+ =========================================================
+
+* The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+"""
+"""
+Cardiac Filter Benchmark
+===================================================
+Compare ``modules.CardiacFilter`` with the per-sample/per-beat loops it replaced (Percept BrainSenseStream.processRealtimeStreams)
+on synthetic ECG-contaminated LFP, with and without a large stimulation transient.
+
+Run ``python3 benchmarks/CardiacFilterBenchmark.py [duration in seconds]`` from the Server directory.
+
+@author: Jackson Cagle, University of Florida
+@email: jackson.cagle@neurology.ufl.edu
+"""
+
+import os, sys, pathlib, time
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent.resolve()))
+
+import numpy as np
+from scipy import signal, stats, optimize
+
+from modules import CardiacFilter
+
+def legacyRollingKurtosis(data, Window):
+    KurtosisIndex = range(0, len(data)-Window)
+    ExpectedKurtosis = np.zeros((len(KurtosisIndex)))
+    for j in range(len(KurtosisIndex)):
+        zScore = stats.zscore(data[KurtosisIndex[j]:KurtosisIndex[j]+Window])
+        ExpectedKurtosis[j] = np.mean(np.power(zScore, 4))
+    return ExpectedKurtosis
+
+def legacyKurtosisFilter(data):
+    Window = 125
+    ExpectedKurtosis = legacyRollingKurtosis(data, Window)
+
+    [b,a] = signal.butter(3, np.array([0.5, 2])*2/250, "bandpass")
+    ExpectedKurtosis = signal.filtfilt(b,a,ExpectedKurtosis)
+    Peaks, _ = signal.find_peaks(ExpectedKurtosis, distance=125)
+    Peaks += int(Window/2)
+
+    CardiacEpochs = []
+    SearchWindow = 100
+    for j in range(len(Peaks)):
+        if ExpectedKurtosis[Peaks[j]-int(Window/2)] < 1.2:
+            continue
+
+        ShiftPeak = 0
+        if Peaks[j]-SearchWindow-ShiftPeak < 0 or Peaks[j]+SearchWindow-ShiftPeak >= len(data):
+            continue 
+        findPeak = np.argmax(data[Peaks[j]-SearchWindow:Peaks[j]+SearchWindow])
+        ShiftPeak = SearchWindow-findPeak
+        if Peaks[j]-SearchWindow-ShiftPeak < 0 or Peaks[j]+SearchWindow-ShiftPeak >= len(data):
+            continue 
+        CardiacEpochs.append(data[Peaks[j]-SearchWindow-ShiftPeak:Peaks[j]+SearchWindow-ShiftPeak])
+
+    EKGTemplate = np.mean(np.array(CardiacEpochs), axis=0)
+    EKGTemplate = EKGTemplate / (np.max(EKGTemplate)-np.min(EKGTemplate))
+
+    def EKGTemplateFunc(xdata, amplitude, offset):
+        return EKGTemplate * amplitude + offset
+
+    CardiacFiltered = np.array(data)
+    for j in range(len(Peaks)):
+        ShiftPeak = 0
+        if Peaks[j]-SearchWindow-ShiftPeak < 0 or Peaks[j]+SearchWindow-ShiftPeak >= len(data):
+            continue 
+
+        findPeak = np.argmax(data[Peaks[j]-SearchWindow:Peaks[j]+SearchWindow])
+        ShiftPeak = SearchWindow-findPeak
+        if Peaks[j]-SearchWindow-ShiftPeak < 0 or Peaks[j]+SearchWindow-ShiftPeak >= len(data):
+            continue
+        
+        sliceSelection = np.arange(Peaks[j]-SearchWindow-ShiftPeak, Peaks[j]+SearchWindow-ShiftPeak)
+        Original = data[sliceSelection]
+        params, covmat = optimize.curve_fit(EKGTemplateFunc, sliceSelection, Original)
+        CardiacFiltered[sliceSelection] = Original - EKGTemplateFunc(sliceSelection, *params)
+    return CardiacFiltered
+
+def legacyFixedPeakFilter(data, SamplingRate):
+    data = np.array(data)
+    posPeaks,_ = signal.find_peaks(data, prominence=[10,200], distance=SamplingRate*0.5)
+    PosCardiacVariability = np.std(np.diff(posPeaks))
+    negPeaks,_ = signal.find_peaks(-data, prominence=[10,200], distance=SamplingRate*0.5)
+    NegCardiacVariability = np.std(np.diff(negPeaks))
+
+    if PosCardiacVariability < NegCardiacVariability:
+        peaks = posPeaks
+    else:
+        peaks = negPeaks
+    CardiacRate = int(np.mean(np.diff(peaks)))
+
+    PrePeak = int(CardiacRate*0.25)
+    PostPeak = int(CardiacRate*0.65)
+    EKGMatrix = np.zeros((len(peaks)-2,PrePeak+PostPeak))
+    for j in range(1,len(peaks)-1):
+        if peaks[j]+PostPeak < len(data) and peaks[j]-PrePeak > 0:
+            EKGMatrix[j-1,:] = data[peaks[j]-PrePeak:peaks[j]+PostPeak]
+
+    EKGTemplate = np.mean(EKGMatrix,axis=0)
+    EKGTemplate = EKGTemplate / (np.max(EKGTemplate)-np.min(EKGTemplate))
+
+    def EKGTemplateFunc(xdata, amplitude, offset):
+        return EKGTemplate * amplitude + offset
+
+    for j in range(len(peaks)):
+        if peaks[j]-PrePeak < 0:
+            pass
+        elif peaks[j]+PostPeak >= len(data) :
+            pass
+        else:
+            sliceSelection = np.arange(peaks[j]-PrePeak,peaks[j]+PostPeak)
+            params, covmat = optimize.curve_fit(EKGTemplateFunc, sliceSelection, data[sliceSelection])
+            data[sliceSelection] = data[sliceSelection] - EKGTemplateFunc(sliceSelection, *params)
+    return data
+
+def generateContaminatedLFP(duration, SamplingRate=250, transient=False, seed=0):
+    """ Synthetic LFP (1/f noise with beta burst) contaminated by ECG-like QRS complexes at ~70 bpm.
+    
+    If transient is True, a 1e4x stimulation artifact (200 ms) is added after the first 10% of the signal.
+    """
+
+    rng = np.random.default_rng(seed)
+    N = int(duration*SamplingRate)
+    t = np.arange(N) / SamplingRate
+    [b,a] = signal.butter(1, 5*2/SamplingRate, "lowpass")
+    LFP = signal.lfilter(b, a, rng.standard_normal(N)) * 10 + np.sin(2*np.pi*20*t) * 3
+
+    BeatTimes = np.cumsum(rng.normal(60/70, 0.03, int(duration*1.5)))
+    BeatTimes = BeatTimes[BeatTimes < duration - 1]
+    QRS = signal.windows.gaussian(int(SamplingRate*0.08), std=SamplingRate*0.012) * 60 - signal.windows.gaussian(int(SamplingRate*0.08), std=SamplingRate*0.03) * 15
+    for beat in BeatTimes:
+        index = int(beat*SamplingRate)
+        LFP[index:index+len(QRS)] += QRS
+
+    if transient:
+        start = int(N*0.1)
+        LFP[start:start+int(SamplingRate*0.2)] += 1e4 * np.max(np.abs(LFP)) * np.hanning(int(SamplingRate*0.2))
+    return LFP
+
+def timeit(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+def compareKurtosis(data, Window=125):
+    Legacy, LegacyTime = timeit(legacyRollingKurtosis, data, Window)
+    Vectorized, VectorizedTime = timeit(CardiacFilter.rollingKurtosis, data, Window)
+    assert np.array_equal(np.isnan(Legacy), np.isnan(Vectorized)), "Constant windows differ"
+    Valid = ~np.isnan(Legacy)
+    Difference = np.max(np.abs(Legacy[Valid] - Vectorized[Valid]))
+    assert np.allclose(Legacy[Valid], Vectorized[Valid], rtol=1e-9, atol=1e-9), f"Kurtosis differs by {Difference}"
+    return LegacyTime, VectorizedTime, Difference
+
+def compareFilter(legacyFunc, vectorizedFunc, data):
+    Legacy, LegacyTime = timeit(legacyFunc, data)
+    Vectorized, VectorizedTime = timeit(vectorizedFunc, data)
+    Difference = np.max(np.abs(Legacy - Vectorized)) / np.max(np.abs(data))
+    assert Difference < 1e-6, f"Filtered signal differs by {Difference} of signal amplitude"
+    return LegacyTime, VectorizedTime, Difference
+
+if __name__ == '__main__':
+    Duration = float(sys.argv[1]) if len(sys.argv) > 1 else 120
+    SamplingRate = 250
+
+    print(f"Synthetic ECG-contaminated LFP, {Duration:.0f} s at {SamplingRate} Hz")
+    print(f"{'Case':40s} {'Legacy (s)':>12s} {'Vectorized (s)':>15s} {'Speedup':>9s} {'Max Difference':>15s}")
+    for transient in [False, True]:
+        data = generateContaminatedLFP(Duration, SamplingRate, transient=transient)
+        Label = " (transient)" if transient else ""
+
+        # Constant segment (i.e. packet loss filled with zeros) must produce NaN kurtosis in both implementations
+        KurtosisData = np.array(data)
+        KurtosisData[int(len(data)*0.5):int(len(data)*0.5)+500] = 0
+        Results = {
+            "Rolling Kurtosis" + Label: compareKurtosis(KurtosisData),
+            "Kurtosis Template Filter" + Label: compareFilter(legacyKurtosisFilter, lambda x: CardiacFilter.kurtosisTemplateFilter(x, SamplingRate, window=125), data),
+        }
+        if not transient:
+            Results["Fixed Peak Template Filter"] = compareFilter(lambda x: legacyFixedPeakFilter(x, SamplingRate), lambda x: CardiacFilter.fixedPeakTemplateFilter(x, SamplingRate), data)
+
+        for case in Results.keys():
+            LegacyTime, VectorizedTime, Difference = Results[case]
+            print(f"{case:40s} {LegacyTime:12.3f} {VectorizedTime:15.4f} {LegacyTime/VectorizedTime:8.0f}x {Difference:15.2e}")
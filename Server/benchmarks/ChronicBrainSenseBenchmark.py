@@ -0,0 +1,146 @@
+""""""
+"""
+=========================================================
+* UF BRAVO Platform
+=========================================================
+
+* Copyright 2023 by Jackson Cagle, Fixel Institute
+* The source code is made available under a Creative Common NonCommercial ShareAlike License (CC BY-NC-SA 4.0) (https://creativecommons.org/licenses/by-nc-sa/4.0/)
+
+ =========================================================
+
+* The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+"""
+"""
+Chronic BrainSense Benchmark
+===================================================
+Compare ``modules.Percept.ChronicBrainSense`` with the per-sample loops it replaced, on synthetic 10-minute Chronic LFPs
+with random dropouts and multi-day gaps:
+
+  - Merge: set membership loop on "DateTime" objects vs. ``mergeChronicLFPs`` on history and overlapping new samples.
+  - Normalization: per-sample ``rangeSelection`` windows vs. ``rollingWindowStatistics`` in ``normalizeCircadianPower``
+    (windows widened to 3 samples) and ``normalizeChronicLFPs`` (z-score by standard error), including isolated samples
+    and windows of identical samples (undefined normalized power).
+
+Merged samples must be identical and normalized power must match within 1e-12 (relative to values above 1). Requires the server environment (decoder).
+
+Run ``python3 benchmarks/ChronicBrainSenseBenchmark.py [history in days]`` from the Server directory.
+
+@author: Jackson Cagle, University of Florida
+@email: jackson.cagle@neurology.ufl.edu
+"""
+
+import os, sys, pathlib, time
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent.resolve()))
+sys.path.append(os.environ.get("PYTHON_UTILITY"))
+
+from datetime import datetime, timedelta
+import copy
+import pytz
+import numpy as np
+from scipy import stats
+from utility.PythonUtility import rangeSelection
+
+from BRAVO import asgi
+from modules.Percept import ChronicBrainSense
+
+def legacyMergeChronicLFPs(pastChronicLFPs, newChronicLFPs):
+    pastChronicLFPs = copy.deepcopy(pastChronicLFPs)
+    Common = set(newChronicLFPs["DateTime"]) & set(pastChronicLFPs["DateTime"])
+
+    toInclude = np.zeros(len(newChronicLFPs["DateTime"]), dtype=bool)
+    for i in range(len(newChronicLFPs["DateTime"])):
+        if not newChronicLFPs["DateTime"][i] in Common:
+            toInclude[i] = True
+
+    if np.any(toInclude):
+        pastChronicLFPs["DateTime"] = np.concatenate((pastChronicLFPs["DateTime"], newChronicLFPs["DateTime"][toInclude]),axis=0)
+        pastChronicLFPs["Amplitude"] = np.concatenate((pastChronicLFPs["Amplitude"], newChronicLFPs["Amplitude"][toInclude]),axis=0)
+        pastChronicLFPs["LFP"] = np.concatenate((pastChronicLFPs["LFP"], newChronicLFPs["LFP"][toInclude]),axis=0)
+
+        sortedIndex = np.argsort(pastChronicLFPs["DateTime"],axis=0).flatten()
+        pastChronicLFPs["DateTime"] = pastChronicLFPs["DateTime"][sortedIndex]
+        pastChronicLFPs["Amplitude"] = pastChronicLFPs["Amplitude"][sortedIndex]
+        pastChronicLFPs["LFP"] = pastChronicLFPs["LFP"][sortedIndex]
+    return pastChronicLFPs
+
+def legacyNormalizeChronicLFPs(xdata, tdata):
+    normPower = np.zeros(xdata.shape)
+    for i in range(len(xdata)):
+        PeriodSelection = rangeSelection(tdata, [tdata[i]-12*3600, tdata[i]+12*3600])
+        normPower[i] = (xdata[i] - np.mean(xdata[PeriodSelection])) / stats.sem(xdata[PeriodSelection])
+    return normPower
+
+def legacyNormalizeCircadianPower(Power, Timestamp):
+    if len(Power) < 3:
+        return stats.zscore(Power)
+
+    normPower = np.zeros(Power.shape)
+    for i in range(len(Power)):
+        refPower = 0
+        PeriodSelection = rangeSelection(Timestamp, [Timestamp[i]-12*3600, Timestamp[i]+12*3600])
+        while np.sum(PeriodSelection) < 3:
+            refPower += 1
+            PeriodSelection = rangeSelection(Timestamp, [Timestamp[i]-12*refPower*3600, Timestamp[i]+12*refPower*3600])
+        normPower[i] = (Power[i] - np.mean(Power[PeriodSelection])) / np.std(Power[PeriodSelection])
+    return normPower
+
+def generateChronicLFPs(rng, start, days):
+    """ Chronic LFPs every 10 minutes with 10% random dropouts, a 3-day gap with isolated samples and 2 days of constant power.
+    """
+
+    Timestamp = start + np.arange(0, days*86400, 600)
+    Keep = rng.random(len(Timestamp)) > 0.1
+    Gap = (Timestamp > start + days*86400/2) & (Timestamp < start + days*86400/2 + 3*86400)
+    Keep[Gap] = False
+    Keep[np.flatnonzero(Gap)[::150]] = True
+    Timestamp = Timestamp[Keep]
+    LFP = np.round(rng.standard_normal(len(Timestamp)) * 100 + 1000 + 200*np.sin(2*np.pi*Timestamp/86400))
+    LFP[(Timestamp > start + 10*86400) & (Timestamp < start + 12*86400)] = 500
+    return {
+        "DateTime": np.array([datetime.fromtimestamp(int(t), tz=pytz.utc) for t in Timestamp], dtype=object),
+        "Amplitude": np.round(rng.uniform(0, 4, size=len(Timestamp)), 1),
+        "LFP": LFP,
+    }
+
+def timeit(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+if __name__ == '__main__':
+    Days = int(sys.argv[1]) if len(sys.argv) > 1 else 90
+    rng = np.random.default_rng(0)
+    start = datetime(2023, 1, 1, tzinfo=pytz.utc).timestamp()
+
+    print(f"Synthetic Chronic LFPs, {Days} days of history")
+    print(f"{'Stage':28s} {'Samples':>8s} {'Legacy (s)':>11s} {'New (s)':>9s} {'Max Error':>10s}")
+
+    # New session overlapping the last 2 weeks of history, with its own values for samples already stored
+    History = generateChronicLFPs(rng, start, Days)
+    NewSession = generateChronicLFPs(rng, start + (Days-14)*86400, 30)
+    Legacy, LegacyTime = timeit(legacyMergeChronicLFPs, History, NewSession)
+    New, NewTime = timeit(ChronicBrainSense.mergeChronicLFPs, ChronicBrainSense.mergeChronicLFPs(None, History), NewSession)
+    assert np.array_equal(ChronicBrainSense.getChronicTimestamp(Legacy), New["Timestamp"]), "Merged timestamps differ"
+    assert np.array_equal(Legacy["Amplitude"], New["Amplitude"]) and np.array_equal(Legacy["LFP"], New["LFP"]), "Merged samples differ"
+    print(f"{'Merge':28s} {len(New['Timestamp']):8d} {LegacyTime:11.3f} {NewTime:9.4f} {0:10.1e}")
+
+    Timestamp = New["Timestamp"].astype(float)
+    Power = New["LFP"]
+    for name, legacyFunction, newFunction in [("normalizeCircadianPower", legacyNormalizeCircadianPower, ChronicBrainSense.normalizeCircadianPower),
+                                              ("normalizeChronicLFPs", legacyNormalizeChronicLFPs, ChronicBrainSense.normalizeChronicLFPs)]:
+        # Unsorted input, as in per-therapy selections of processChronicLFPs
+        order = rng.permutation(len(Timestamp))
+        Legacy, LegacyTime = timeit(legacyFunction, Power[order], Timestamp[order])
+        New, NewTime = timeit(newFunction, Power[order], Timestamp[order])
+        assert np.array_equal(np.isfinite(Legacy), np.isfinite(New)), f"{name} undefined samples differ"
+        Error = np.nanmax(np.abs(Legacy - New) / np.maximum(1, np.abs(Legacy)))
+        assert Error < 1e-12, f"{name} differs by {Error}"
+        print(f"{name:28s} {len(Power):8d} {LegacyTime:11.3f} {NewTime:9.4f} {Error:10.1e}")
+
+    # Isolated samples, every window must be widened
+    Timestamp = np.array([0, 100000, 200000, 300000, 400000.0])
+    Power = np.array([1, 5, 2, 8, 3.0])
+    Error = np.max(np.abs(legacyNormalizeCircadianPower(Power, Timestamp) - ChronicBrainSense.normalizeCircadianPower(Power, Timestamp)))
+    assert Error < 1e-12, f"normalizeCircadianPower differs by {Error} on isolated samples"
+    print(f"{'Isolated samples':28s} {len(Power):8d} {'-':>11s} {'-':>9s} {Error:10.1e}")
@@ -0,0 +1,95 @@
+""""""
+"""
+=========================================================
+* UF BRAVO Platform
+=========================================================
+
+* Copyright 2023 by Jackson Cagle, Fixel Institute
+* The source code is made available under a Creative Common NonCommercial ShareAlike License (CC BY-NC-SA 4.0) (https://creativecommons.org/licenses/by-nc-sa/4.0/)
+
+ =========================================================
+
+* The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+"""
+"""
+Missing Label Benchmark
+===================================================
+Compare ``modules.MissingLabel.windowMissingLabel`` with the per-bin ``rangeSelection`` loop it replaced (spectrogram
+missing labels of realtime streams) on random Missing masks: sparse packet loss, bursts, no or all samples missing,
+and missing samples at the first and last sample. Bins include edge bins whose window extends past either end of the
+recording, bins entirely outside the recording, and bin times on and off the sample grid.
+
+Run ``python3 benchmarks/MissingLabelBenchmark.py [number of random trials]`` from the Server directory.
+
+@author: Jackson Cagle, University of Florida
+@email: jackson.cagle@neurology.ufl.edu
+"""
+
+import os, sys, pathlib, time
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent.resolve()))
+sys.path.append(os.environ.get("PYTHON_UTILITY"))
+
+import numpy as np
+from utility.PythonUtility import rangeSelection
+
+from modules import MissingLabel
+
+def legacyMissingLabel(missing, TimeArray, SpectrogramTime):
+    Labels = np.zeros(SpectrogramTime.shape, dtype=bool)
+    for j in range(len(Labels)):
+        if np.any(missing[rangeSelection(TimeArray, [SpectrogramTime[j]-2, SpectrogramTime[j]+2])]):
+            Labels[j] = True
+    return Labels
+
+def generateMissingMask(rng, length, pattern):
+    missing = np.zeros(length)
+    if pattern == "Sparse":
+        missing[rng.random(length) < 0.001] = 1
+    elif pattern == "Bursts":
+        for start in rng.integers(0, length, size=5):
+            missing[start:start+rng.integers(1, 500)] = 1
+    elif pattern == "All":
+        missing[:] = 1
+    elif pattern == "Edges":
+        missing[0] = 1
+        missing[-1] = 1
+    return missing
+
+def generateSpectrogramTime(rng, duration, SamplingRate):
+    """ Bin centers of a 4 s window spectrogram with 0.5 s step, with edge bins and bins outside the recording.
+    """
+
+    Time = np.arange(2, duration-2, 0.5)
+    Edges = np.array([-3, -2, -2 + 1/SamplingRate, 0, 1, duration-1, duration, duration + 2 - 1/SamplingRate, duration + 2, duration + 3])
+    OffGrid = rng.uniform(-3, duration+3, size=20)
+    return np.sort(np.concatenate((Time, Edges, OffGrid)))
+
+if __name__ == '__main__':
+    Trials = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    rng = np.random.default_rng(0)
+
+    LegacyTime = 0
+    VectorizedTime = 0
+    Bins = 0
+    for trial in range(Trials):
+        SamplingRate = rng.choice([250, 500, 1000])
+        duration = rng.uniform(5, 120)
+        TimeArray = np.arange(int(duration*SamplingRate)) / SamplingRate
+        SpectrogramTime = generateSpectrogramTime(rng, TimeArray[-1], SamplingRate)
+
+        for pattern in ["None", "Sparse", "Bursts", "All", "Edges"]:
+            missing = generateMissingMask(rng, len(TimeArray), pattern)
+
+            start = time.perf_counter()
+            Legacy = legacyMissingLabel(missing, TimeArray, SpectrogramTime)
+            LegacyTime += time.perf_counter() - start
+
+            start = time.perf_counter()
+            Vectorized = MissingLabel.windowMissingLabel(missing, TimeArray, SpectrogramTime-2, SpectrogramTime+2)
+            VectorizedTime += time.perf_counter() - start
+
+            assert np.array_equal(Legacy, Vectorized), f"Labels differ ({pattern} missing, {SamplingRate} Hz, {duration:.1f} s) at bins {SpectrogramTime[Legacy != Vectorized]}"
+            Bins += len(SpectrogramTime)
+
+    print(f"{Trials*5} random Missing masks, {Bins} bins: labels identical")
+    print(f"Legacy {LegacyTime:.3f} s, Vectorized {VectorizedTime:.3f} s, Speedup {LegacyTime/VectorizedTime:.0f}x")
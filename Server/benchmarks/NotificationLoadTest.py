@@ -0,0 +1,169 @@
+""""""
+"""
+=========================================================
+* UF BRAVO Platform
+=========================================================
+
+* Copyright 2023 by Jackson Cagle, Fixel Institute
+* The source code is made available under a Creative Common NonCommercial ShareAlike License (CC BY-NC-SA 4.0) (https://creativecommons.org/licenses/by-nc-sa/4.0/)
+
+ =========================================================
+
+* The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+"""
+"""
+Notification Load Test
+===================================================
+Load test of ``Backend.APIs.RealtimeUpdates.NotificationSystem`` against the in-memory channel layer, with many
+authenticated sockets (users of several institutes) in a temporary test database:
+
+  - A root socket sends job progress/completion notifications of random users, some targeted to the whole institute.
+    Every socket must receive exactly the notifications of its own user and institute.
+  - Queue updates of root notifications and of background workers (``request_queue_reduced`` events sent by
+    ``modules.Notification``) must be coalesced into at most one "QueueReduced" broadcast every QUEUE_REDUCED_INTERVAL
+    seconds, and a last broadcast must follow the last queue update.
+
+Deliveries are compared with the fan-out of broadcasting every notification to every socket. Requires the server
+environment (database, ``ENCRYPTION_KEY``).
+
+Run ``python3 benchmarks/NotificationLoadTest.py [users] [sockets per user] [jobs]`` from the Server directory.
+
+@author: Jackson Cagle, University of Florida
+@email: jackson.cagle@neurology.ufl.edu
+"""
+
+import os, sys, pathlib, time
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent.resolve()))
+os.environ["QUEUE_REDUCED_INTERVAL"] = os.environ.get("QUEUE_REDUCED_INTERVAL", "0.5")
+
+import asyncio, json, random, uuid
+
+from BRAVO import asgi
+from django.db import connection
+from channels.layers import channel_layers, InMemoryChannelLayer
+from channels.testing import WebsocketCommunicator
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from Backend import models
+from Backend.APIs.RealtimeUpdates import NotificationSystem
+from modules.Notification import QUEUE_REDUCED_INTERVAL
+
+def createUsers(Users, Institutes):
+    UserList = list()
+    for n in range(Users):
+        user = models.PlatformUser(email=f"user{n}@benchmark.org", user_name=f"User {n}", institute=f"Institute {n % Institutes}", is_clinician=True)
+        user.save()
+        refresh = RefreshToken.for_user(user)
+        refresh["user"] = str(user.unique_user_id)
+        UserList.append((user, str(refresh)))
+    return UserList
+
+def generateNotifications(UserList, Jobs, UpdatesPerJob, seed=0):
+    """ Progress updates and completion of jobs owned by random users, interleaved. One job out of 10 targets the institute.
+    """
+
+    rng = random.Random(seed)
+    Streams = list()
+    for j in range(Jobs):
+        user, _ = rng.choice(UserList)
+        Target = {"TaskUser": str(user.unique_user_id)}
+        if j % 10 == 0:
+            Target["TaskInstitute"] = user.institute
+        TaskID = str(uuid.UUID(int=rng.getrandbits(128)))
+        Streams.append([dict(Target, NotificationType="TaskProcessing", TaskID=TaskID, State="InProgress", Message=f"{i}/{UpdatesPerJob}") for i in range(UpdatesPerJob)] +
+                       [dict(Target, NotificationType="TaskComplete", TaskID=TaskID, State="Complete", Message="")])
+
+    Messages = list()
+    while len(Streams) > 0:
+        stream = rng.choice(Streams)
+        Messages.append(stream.pop(0))
+        if len(stream) == 0:
+            Streams.remove(stream)
+    return Messages
+
+def expectedNotifications(Messages, user):
+    return [(message["TaskID"], message["State"], message["Message"]) for message in Messages
+            if ("TaskInstitute" in message.keys() and message["TaskInstitute"] == user.institute) or (not "TaskInstitute" in message.keys() and message["TaskUser"] == str(user.unique_user_id))]
+
+async def receiveAll(client, timeout):
+    """ All messages received by the socket until none arrives for ``timeout`` seconds, and the time of the last message.
+    """
+
+    Received = list()
+    LastReceived = time.monotonic()
+    while True:
+        try:
+            Received.append(json.loads(await client.receive_from(timeout=timeout)))
+            LastReceived = time.monotonic()
+        except asyncio.TimeoutError:
+            return Received, LastReceived
+
+async def runLoadTest(UserList, SocketsPerUser, Messages, WorkerUpdates):
+    Clients = list()
+    for user, token in UserList:
+        for i in range(SocketsPerUser):
+            client = WebsocketCommunicator(NotificationSystem.as_asgi(), "/socket/notification")
+            connected, _ = await client.connect()
+            assert connected, "Socket not accepted"
+            await client.send_to(text_data=json.dumps({"Authorization": token}))
+            Clients.append((user, client))
+
+    root = WebsocketCommunicator(NotificationSystem.as_asgi(), "/socket/notification")
+    await root.connect()
+    # Sockets are only added to their groups once the authorization is processed
+    await asyncio.sleep(1)
+
+    start = time.monotonic()
+    channel_layer = channel_layers["default"]
+    for i in range(len(Messages)):
+        await root.send_to(text_data=json.dumps(dict(Messages[i], Authorization=os.environ["ENCRYPTION_KEY"])))
+        if i % max(1, int(len(Messages) / WorkerUpdates)) == 0:
+            await channel_layer.group_send("BroadcastChannel", {"type": "request_queue_reduced", "message": {}})
+    SendDuration = time.monotonic() - start
+
+    # Socket messages are queued by the communicators, the last broadcast is sent up to QUEUE_REDUCED_INTERVAL after the last update
+    Results = await asyncio.gather(*[receiveAll(client, timeout=QUEUE_REDUCED_INTERVAL*3) for user, client in Clients])
+    Received = [result[0] for result in Results]
+    Duration = max([result[1] for result in Results]) - start
+
+    for user, client in Clients:
+        await client.disconnect()
+    await root.disconnect()
+    return Clients, Received, SendDuration, Duration
+
+if __name__ == '__main__':
+    Users = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    SocketsPerUser = int(sys.argv[2]) if len(sys.argv) > 2 else 2
+    Jobs = int(sys.argv[3]) if len(sys.argv) > 3 else 200
+    UpdatesPerJob = 5
+    Institutes = 5
+
+    channel_layers.set("default", InMemoryChannelLayer(capacity=100000))
+    DatabaseName = connection.settings_dict["NAME"]
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        UserList = createUsers(Users, Institutes)
+        Messages = generateNotifications(UserList, Jobs, UpdatesPerJob)
+        Clients, Received, SendDuration, Duration = asyncio.run(runLoadTest(UserList, SocketsPerUser, Messages, WorkerUpdates=Jobs))
+
+        Deliveries = 0
+        MaximumBroadcasts = int(Duration / QUEUE_REDUCED_INTERVAL) + 1
+        BroadcastCounts = list()
+        for (user, client), Notifications in zip(Clients, Received):
+            JobNotifications = [(notification["TaskID"], notification["State"], notification["Message"]) for notification in Notifications if notification["UpdateType"] in ["JobUpdate", "JobCompletion"]]
+            assert JobNotifications == expectedNotifications(Messages, user), f"Notifications of {user.email} differ from its own and institute notifications"
+
+            Broadcasts = len([notification for notification in Notifications if notification["UpdateType"] == "QueueReduced"])
+            assert 1 <= Broadcasts <= MaximumBroadcasts, f"{Broadcasts} QueueReduced broadcasts in {Duration:.1f} s (interval {QUEUE_REDUCED_INTERVAL} s)"
+            BroadcastCounts.append(Broadcasts)
+            Deliveries += len(Notifications)
+
+        print(f"{len(Clients)} sockets ({Users} users, {Institutes} institutes), {len(Messages)} notifications and {Jobs} worker queue updates in {Duration:.2f} s")
+        print(f"Root notifications sent at {len(Messages)/SendDuration:.0f} messages/s")
+        print(f"Every socket received exactly its own and institute notifications")
+        print(f"QueueReduced broadcasts per socket: {min(BroadcastCounts)}-{max(BroadcastCounts)} (limit {MaximumBroadcasts} at {QUEUE_REDUCED_INTERVAL} s interval)")
+        # Broadcasting sends every notification and a QueueReduced per notification to every socket
+        print(f"Socket deliveries: {Deliveries}, broadcast to all sockets: {2 * len(Messages) * len(Clients)}")
+
+    finally:
+        connection.creation.destroy_test_db(DatabaseName, verbosity=0)
@@ -0,0 +1,182 @@
+""""""
+"""
+=========================================================
+* UF BRAVO Platform
+=========================================================
+
+* Copyright 2023 by Jackson Cagle, Fixel Institute
+* The source code is made available under a Creative Common NonCommercial ShareAlike License (CC BY-NC-SA 4.0) (https://creativecommons.org/licenses/by-nc-sa/4.0/)
+
+ =========================================================
+
+* The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+"""
+"""
+Percept Session Benchmark
+===================================================
+Compare peak memory and throughput of Percept session processing (``modules.Percept.Sessions``) with the whole-file
+approach it replaced, on a synthetic session JSON with Indefinite Streaming and BrainSense streaming recordings:
+
+  - Decryption: ``Fernet.decrypt`` of the whole cache file vs. chunked ``decryptCacheJSON``.
+  - Streaming sections: ``json.loads`` of the whole session vs. ``loadSessionSkeleton`` and lazy ``iterateStreamingSection``.
+  - BrainSense streams: decoding all items at once vs. one recording at a time with ``iterateRealtimeStreams``.
+
+Outputs of both approaches are checked to be identical. Requires the server environment (``ENCRYPTION_KEY``, decoder).
+
+Run ``python3 benchmarks/PerceptSessionBenchmark.py [number of recordings] [recording duration in seconds]`` from the Server directory.
+
+@author: Jackson Cagle, University of Florida
+@email: jackson.cagle@neurology.ufl.edu
+"""
+
+import os, sys, pathlib, time, tempfile, shutil
+import tracemalloc
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent.resolve()))
+
+from datetime import datetime, timedelta
+import json
+import numpy as np
+from cryptography.fernet import Fernet
+
+from BRAVO import asgi
+from modules.Percept import Sessions
+
+def generateTimeDomainItem(FirstPacketDateTime, Channel, duration, SamplingRate, rng):
+    Samples = int(duration*SamplingRate)
+    PacketSize = 62
+    Packets = int(np.ceil(Samples / PacketSize))
+    return {
+        "Pass": "FIRST",
+        "GlobalSequences": ",".join([str(i % 256) for i in range(Packets)]),
+        "TicksInMses": ",".join([str(1000 + i*250) for i in range(Packets)]) + ",",
+        "GlobalPacketSizes": ",".join([str(PacketSize)] * (Packets-1) + [str(Samples - PacketSize*(Packets-1))]) + ",",
+        "SampleRateInHz": SamplingRate,
+        "Gain": 250,
+        "Channel": Channel,
+        "FirstPacketDateTime": FirstPacketDateTime,
+        "TimeDomainData": np.round(rng.standard_normal(Samples) * 10, 6).tolist()
+    }
+
+def generatePowerItem(FirstPacketDateTime, duration, rng):
+    Therapy = {"FrequencyInHertz": 130, "PulseWidthInMicroSecond": 60, "LowerLimitInMilliAmps": 0, "UpperLimitInMilliAmps": 3.0,
+               "LowerLfpThreshold": 0, "UpperLfpThreshold": 0, "SensingSetup": {"FrequencyInHertz": 20.5, "ChannelSignalResult": {}}}
+    return {
+        "FirstPacketDateTime": FirstPacketDateTime,
+        "SampleRateInHz": 2,
+        "Channel": "ZERO_TWO_LEFT,ZERO_TWO_RIGHT",
+        "TherapySnapshot": {"Left": dict(Therapy), "Right": dict(Therapy)},
+        "LfpData": [{
+            "Left": {"LFP": int(rng.integers(100, 2000)), "mA": 1.5},
+            "Right": {"LFP": int(rng.integers(100, 2000)), "mA": 1.5},
+            "TicksInMs": 1000 + i*500,
+            "Seq": i % 256
+        } for i in range(int(duration*2))]
+    }
+
+def generateSession(Recordings, duration, seed=0):
+    """ Synthetic session JSON bytes, ``Recordings`` Indefinite Streaming and BrainSense streaming recordings of ``duration`` seconds each.
+    """
+
+    rng = np.random.default_rng(seed)
+    SessionDate = datetime(2023, 1, 1)
+    JSON = {
+        "SessionDate": SessionDate.isoformat() + "Z",
+        "SessionEndDate": (SessionDate + timedelta(hours=2)).isoformat() + "Z",
+        "PatientInformation": {"Initial": {}, "Final": {"PatientFirstName": "Synthetic", "PatientLastName": "Patient", "PatientId": "0",
+                                                      "PatientGender": "PatientGenderDef.UNKNOWN", "PatientDateOfBirth": "1970-01-01T00:00:00Z", "Diagnosis": "DiagnosisTypeDef.ParkinsonsDisease"}},
+        "DeviceInformation": {"Initial": {}, "Final": {"Neurostimulator": "Percept PC", "NeurostimulatorSerialNumber": "SYNTHETIC0000", "NeurostimulatorLocation": "InsLocationDef.Chest"}},
+        "IndefiniteStreaming": [],
+        "BrainSenseTimeDomain": [],
+        "BrainSenseLfp": [],
+        "DiagnosticData": {},
+    }
+    for n in range(Recordings):
+        FirstPacketDateTime = (SessionDate + timedelta(minutes=n*10)).isoformat() + "Z"
+        for Channel in ["ZERO_THREE_LEFT", "ONE_THREE_LEFT", "ZERO_TWO_LEFT", "ZERO_THREE_RIGHT", "ONE_THREE_RIGHT", "ZERO_TWO_RIGHT"]:
+            JSON["IndefiniteStreaming"].append(generateTimeDomainItem(FirstPacketDateTime, Channel, duration, 250, rng))
+
+        FirstPacketDateTime = (SessionDate + timedelta(minutes=n*10+5)).isoformat() + "Z"
+        for Channel in ["ZERO_TWO_LEFT", "ZERO_TWO_RIGHT"]:
+            JSON["BrainSenseTimeDomain"].append(generateTimeDomainItem(FirstPacketDateTime, Channel, duration, 250, rng))
+        JSON["BrainSenseLfp"].append(generatePowerItem(FirstPacketDateTime, duration, rng))
+    return json.dumps(JSON).encode("utf-8")
+
+def measure(func, *args, **kwargs):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    duration = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, duration, peak
+
+def legacyDecrypt(filename):
+    with open(Sessions.DATABASE_PATH + "cache" + os.path.sep + filename, "rb") as file:
+        return Fernet(Sessions.key).decrypt(file.read())
+
+def legacyParseSections(rawBytes):
+    JSON = json.loads(rawBytes)
+    return {section: [json.dumps(item) for item in JSON[section]] for section in Sessions.STREAMING_SECTIONS}
+
+def lazyParseSections(rawBytes):
+    _, SectionRanges = Sessions.loadSessionSkeleton(rawBytes)
+    Digests = dict()
+    for section in Sessions.STREAMING_SECTIONS:
+        Digests[section] = [json.dumps(item) for item in Sessions.iterateStreamingSection(rawBytes, SectionRanges, section)]
+    return Digests
+
+def summarizeRealtimeStreams(StreamingTD, StreamingPower):
+    StreamingTD = sorted(StreamingTD, key=lambda stream: (stream["FirstPacketDateTime"], stream["Channel"]))
+    StreamingPower = sorted(StreamingPower, key=lambda stream: (stream["FirstPacketDateTime"], stream["Channel"]))
+    return [(stream["FirstPacketDateTime"], stream["Channel"], np.asarray(stream["Data"]).tobytes(), np.asarray(stream["Missing"]).tobytes()) for stream in StreamingTD] + \
+           [(stream["FirstPacketDateTime"], stream["Channel"], np.asarray(stream["Power"]).tobytes(), np.asarray(stream["Stimulation"]).tobytes()) for stream in StreamingPower]
+
+def legacyDecodeRealtimeStreams(rawBytes):
+    JSON, SectionRanges = Sessions.loadSessionSkeleton(rawBytes)
+    StreamData = Sessions.extractStreamingSection(Sessions.getStreamingContext(JSON), {
+        "BrainSenseLfp": list(Sessions.iterateStreamingSection(rawBytes, SectionRanges, "BrainSenseLfp")),
+        "BrainSenseTimeDomain": list(Sessions.iterateStreamingSection(rawBytes, SectionRanges, "BrainSenseTimeDomain"))
+    })
+    return summarizeRealtimeStreams(StreamData["StreamingTD"], StreamData["StreamingPower"])
+
+def lazyDecodeRealtimeStreams(rawBytes):
+    JSON, SectionRanges = Sessions.loadSessionSkeleton(rawBytes)
+    StreamingTD = list()
+    StreamingPower = list()
+    for StreamData in Sessions.iterateRealtimeStreams(Sessions.getStreamingContext(JSON), rawBytes, SectionRanges):
+        StreamingTD.extend(StreamData["StreamingTD"])
+        StreamingPower.extend(StreamData["StreamingPower"])
+    return summarizeRealtimeStreams(StreamingTD, StreamingPower)
+
+if __name__ == '__main__':
+    Recordings = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    Duration = float(sys.argv[2]) if len(sys.argv) > 2 else 60
+
+    TemporaryPath = tempfile.mkdtemp()
+    os.mkdir(TemporaryPath + os.path.sep + "cache")
+    Sessions.DATABASE_PATH = TemporaryPath + os.path.sep
+    try:
+        rawBytes = generateSession(Recordings, Duration)
+        Sessions.saveCacheJSON("PerceptSessionBenchmark.json", rawBytes)
+        print(f"Synthetic session, {Recordings} recordings of {Duration:.0f} s, {len(rawBytes)/1e6:.1f} MB")
+        print(f"{'Stage':24s} {'Legacy (s)':>11s} {'Legacy (MB)':>12s} {'New (s)':>9s} {'New (MB)':>9s}")
+
+        Legacy, LegacyTime, LegacyPeak = measure(legacyDecrypt, "PerceptSessionBenchmark.json")
+        New, NewTime, NewPeak = measure(Sessions.decryptCacheJSON, "PerceptSessionBenchmark.json")
+        assert Legacy == bytes(New) == rawBytes, "Decrypted session differs"
+        print(f"{'Decryption':24s} {LegacyTime:11.3f} {LegacyPeak/1e6:12.1f} {NewTime:9.3f} {NewPeak/1e6:9.1f}")
+        del Legacy, New
+
+        Legacy, LegacyTime, LegacyPeak = measure(legacyParseSections, rawBytes)
+        New, NewTime, NewPeak = measure(lazyParseSections, rawBytes)
+        assert Legacy == New, "Streaming section items differ"
+        print(f"{'Streaming Sections':24s} {LegacyTime:11.3f} {LegacyPeak/1e6:12.1f} {NewTime:9.3f} {NewPeak/1e6:9.1f}")
+        del Legacy, New
+
+        Legacy, LegacyTime, LegacyPeak = measure(legacyDecodeRealtimeStreams, rawBytes)
+        New, NewTime, NewPeak = measure(lazyDecodeRealtimeStreams, rawBytes)
+        assert Legacy == New, "Decoded BrainSense streams differ"
+        print(f"{'BrainSense Streams':24s} {LegacyTime:11.3f} {LegacyPeak/1e6:12.1f} {NewTime:9.3f} {NewPeak/1e6:9.1f}")
+
+    finally:
+        shutil.rmtree(TemporaryPath)
@@ -0,0 +1,159 @@
+""""""
+"""
+=========================================================
+* UF BRAVO Platform
+=========================================================
+
+* Copyright 2023 by Jackson Cagle, Fixel Institute
+* The source code is made available under a Creative Common NonCommercial ShareAlike License (CC BY-NC-SA 4.0) (https://creativecommons.org/licenses/by-nc-sa/4.0/)
+
+ =========================================================
+
+* The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+"""
+"""
+Response Renderer Benchmark
+===================================================
+Compare response size and render/decode latency of ``Backend.APIs.Renderers.MessagePackRenderer`` with the REST Framework
+JSON renderer on a synthetic neural activity payload, and check that MessagePack responses decoded by
+``BRAVOPlatformAPI.decodeResponse`` match the JSON response for ndarrays (all dtypes, byte orders and memory layouts
+used by the server), datetimes, UUIDs, Decimals and non-array payloads.
+
+Run ``python3 benchmarks/RendererBenchmark.py [recording duration in seconds]`` from the Server directory.
+
+@author: Jackson Cagle, University of Florida
+@email: jackson.cagle@neurology.ufl.edu
+"""
+
+import os, sys, pathlib, time
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent.resolve()))
+
+import uuid
+from decimal import Decimal
+from datetime import datetime, date, timezone
+import numpy as np
+import requests
+
+from django.conf import settings
+settings.configure()
+
+from rest_framework.renderers import JSONRenderer
+
+from Backend.APIs.Renderers import MessagePackRenderer
+from BRAVOPlatformAPI import decodeResponse
+
+def generateNeuralActivity(duration, SamplingRate=250, seed=0):
+    """ Synthetic realtime stream response: 2-channel time domain, spectrogram and power with timestamps.
+    """
+
+    rng = np.random.default_rng(seed)
+    Time = np.arange(int(duration*SamplingRate)) / SamplingRate
+    SpectrogramTime = np.arange(2, duration-2, 0.5)
+    return {
+        "Time": Time,
+        "Channels": ["E00-E02 Left", "E00-E02 Right"],
+        "Data": rng.standard_normal((len(Time), 2)),
+        "Missing": rng.random((len(Time), 2)) < 0.001,
+        "Spectrogram": [{
+            "Time": SpectrogramTime,
+            "Frequency": np.arange(0, 125.5, 0.5),
+            "Power": rng.random((251, len(SpectrogramTime))).astype(np.float32),
+        } for i in range(2)],
+        "Stimulation": rng.integers(0, 40, size=(int(duration*2), 2)).astype(np.int16) / 10,
+        "StartTime": datetime(2023, 1, 1, 12, 0, 0, tzinfo=timezone.utc),
+        "RecordingID": uuid.UUID(int=int(rng.integers(0, 2**62))),
+    }
+
+def equivalencePayloads():
+    rng = np.random.default_rng(1)
+    Matrix = rng.standard_normal((50, 4))
+    return {
+        "Float64": Matrix,
+        "Float32": Matrix.astype(np.float32),
+        "Int16": rng.integers(-1000, 1000, size=100).astype(np.int16),
+        "Int64": np.arange(10, dtype=np.int64) * 2**40,
+        "Bool": Matrix > 0,
+        "BigEndian": Matrix.astype(">f8"),
+        "Transposed": Matrix.T,
+        "Strided": Matrix[::3, 1:3],
+        "Empty": np.zeros((0, 3)),
+        "Scalar": np.array(3.5),
+        "NumPyScalars": [np.float64(1.25), np.int32(7), np.bool_(True)],
+        "Objects": np.array(["E00-E02", None, 1.5], dtype=object),
+        "DateTime": datetime(2023, 5, 1, 8, 30, 15, 250000, tzinfo=timezone.utc),
+        "NaiveDateTime": datetime(2023, 5, 1, 8, 30, 15),
+        "Date": date(2023, 5, 1),
+        "UUID": uuid.UUID("12345678-1234-5678-1234-567812345678"),
+        "Decimal": Decimal("1.10"),
+        "Nested": {"List": [1, "two", None, {"Three": [3.0, False]}], "Empty": {}, "Text": "µV²/Hz"},
+    }
+
+def makeResponse(content, contentType):
+    response = requests.Response()
+    response.status_code = 200
+    response.headers["Content-Type"] = contentType
+    response._content = content
+    return response
+
+def toJSONTypes(data):
+    """ Decoded MessagePack content with ndarrays converted to lists, as in the JSON response.
+    """
+
+    if isinstance(data, np.ndarray):
+        return data.tolist()
+    elif isinstance(data, dict):
+        return {key: toJSONTypes(data[key]) for key in data.keys()}
+    elif isinstance(data, list):
+        return [toJSONTypes(item) for item in data]
+    return data
+
+def checkRoundTrip(payload):
+    JSONContent = JSONRenderer().render(payload)
+    MessagePackContent = MessagePackRenderer().render(payload)
+    Expected = decodeResponse(makeResponse(JSONContent, "application/json"))
+    Decoded = decodeResponse(makeResponse(MessagePackContent, "application/x-msgpack"))
+    assert toJSONTypes(Decoded) == Expected, "MessagePack response differs from JSON response"
+    return Decoded
+
+def timeit(func, *args, repeat=5):
+    Durations = list()
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        Durations.append(time.perf_counter() - start)
+    return result, min(Durations)
+
+if __name__ == '__main__':
+    Duration = float(sys.argv[1]) if len(sys.argv) > 1 else 300
+
+    # Round-trip of every payload type, each on its own and as top-level values
+    Payloads = equivalencePayloads()
+    Decoded = checkRoundTrip(Payloads)
+    for key in Payloads.keys():
+        checkRoundTrip({key: Payloads[key]})
+        if not isinstance(Payloads[key], dict):
+            checkRoundTrip([Payloads[key]])
+    for payload in [[], {}, "Success", 42, None]:
+        if not payload == None:
+            checkRoundTrip(payload)
+    assert MessagePackRenderer().render(None) == b""
+
+    for key in ["Float64", "Float32", "Int16", "Int64", "Bool", "BigEndian", "Transposed", "Strided", "Empty", "Scalar"]:
+        Expected = np.asarray(Payloads[key])
+        assert isinstance(Decoded[key], np.ndarray) and Decoded[key].shape == Expected.shape and Decoded[key].dtype == Expected.dtype.newbyteorder("<"), f"{key} array type differs"
+        assert np.array_equal(Decoded[key], Expected), f"{key} array values differ"
+    NaNArray = np.array([np.nan, np.inf, -np.inf, 0.0])
+    assert np.array_equal(decodeResponse(makeResponse(MessagePackRenderer().render({"NaN": NaNArray}), "application/x-msgpack"))["NaN"], NaNArray, equal_nan=True)
+    print(f"Round-trip: {len(Payloads)} payload types identical to JSON response")
+
+    # Size and latency on a realtime stream response
+    payload = generateNeuralActivity(Duration)
+    JSONContent, JSONRenderTime = timeit(JSONRenderer().render, payload)
+    MessagePackContent, MessagePackRenderTime = timeit(MessagePackRenderer().render, payload)
+    _, JSONDecodeTime = timeit(decodeResponse, makeResponse(JSONContent, "application/json"))
+    _, MessagePackDecodeTime = timeit(decodeResponse, makeResponse(MessagePackContent, "application/x-msgpack"))
+
+    print(f"Synthetic realtime stream, {Duration:.0f} s at 250 Hz")
+    print(f"{'Format':12s} {'Size (MB)':>10s} {'Render (s)':>11s} {'Decode (s)':>11s}")
+    print(f"{'JSON':12s} {len(JSONContent)/1e6:10.2f} {JSONRenderTime:11.4f} {JSONDecodeTime:11.4f}")
+    print(f"{'MessagePack':12s} {len(MessagePackContent)/1e6:10.2f} {MessagePackRenderTime:11.4f} {MessagePackDecodeTime:11.4f}")
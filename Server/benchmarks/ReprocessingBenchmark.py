@@ -0,0 +1,224 @@
+""""""
+"""
+=========================================================
+* UF BRAVO Platform
+=========================================================
+
+* Copyright 2023 by Jackson Cagle, Fixel Institute
+* The source code is made available under a Creative Common NonCommercial ShareAlike License (CC BY-NC-SA 4.0) (https://creativecommons.org/licenses/by-nc-sa/4.0/)
+
+ =========================================================
+
+* The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+"""
+"""
+Reprocessing Benchmark
+===================================================
+Compare ``modules.Reprocessing`` with the serial per-row loops of ``DatabaseManager.py`` it replaced, on a synthetic
+dataset (institutes, clinicians, patients, devices and encrypted session files) in a temporary test database:
+
+  - Requeue (``MigrateFromV1``/``MigrateFromV2.1``): user → patient → device → session walk vs. ``queueSessionDecoding``.
+  - Refresh Sessions: serial loop vs. ``runReprocessing`` with 1 and ``workers`` processes, and a resumed job.
+
+Database state after both approaches is checked to be identical. Requires the server environment (database, ``ENCRYPTION_KEY``, decoder).
+
+Run ``python3 benchmarks/ReprocessingBenchmark.py [devices] [sessions per device] [workers]`` from the Server directory.
+
+@author: Jackson Cagle, University of Florida
+@email: jackson.cagle@neurology.ufl.edu
+"""
+
+import os, sys, pathlib, time, tempfile, shutil
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent.resolve()))
+
+import random, uuid, json
+from datetime import datetime, timedelta
+import pytz
+from cryptography.fernet import Fernet
+
+from BRAVO import asgi
+from django.db import connection
+
+from Backend import models
+from modules import Database, Reprocessing
+from modules.Percept import Sessions
+from decoder import Percept
+
+LEAD_CONFIGURATIONS = [
+    {"Hemisphere": "HemisphereLocationDef.Left", "LeadLocation": "LeadLocationDef.Stn", "ElectrodeNumber": "InsPort.ZERO_THREE", "Model": "LeadModelDef.LEAD_B33015"},
+    {"Hemisphere": "HemisphereLocationDef.Right", "LeadLocation": "LeadLocationDef.Stn", "ElectrodeNumber": "InsPort.EIGHT_ELEVEN", "Model": "LeadModelDef.LEAD_B33015"},
+]
+
+def generateDataset(Devices, SessionsPerDevice, seed=0):
+    """ Synthetic institutes with two clinicians each, and researchers with their own patients. Each patient has one device.
+    """
+
+    rng = random.Random(seed)
+    def randomUUID():
+        return uuid.UUID(int=rng.getrandbits(128), version=4)
+
+    Users = list()
+    Patients = list()
+    PerceptDevices = list()
+    SessionFiles = list()
+    secureEncoder = Fernet(Sessions.key)
+    for n in range(Devices):
+        if n % 5 == 4:
+            Institute = f"researcher{n}@benchmark.org"
+            Users.append(models.PlatformUser(email=Institute, user_name=f"Researcher {n}", institute="Independent", unique_user_id=randomUUID()))
+            AuthorityLevel = "Research"
+        else:
+            Institute = f"Institute {n // 20}"
+            if n % 20 == 0:
+                Users.extend([models.PlatformUser(email=f"clinician{i}.{n}@benchmark.org", user_name=f"Clinician {i}", institute=Institute, is_clinician=True, unique_user_id=randomUUID()) for i in range(2)])
+            AuthorityLevel = "Clinic"
+
+        patient = models.Patient(institute=Institute, deidentified_id=randomUUID())
+        device = models.PerceptDevice(deidentified_id=randomUUID(), patient_deidentified_id=patient.deidentified_id, authority_level=AuthorityLevel, authority_user=Institute)
+        patient.device_deidentified_id = [str(device.deidentified_id)]
+        Patients.append(patient)
+        PerceptDevices.append(device)
+
+        for i in range(SessionsPerDevice):
+            SessionDate = datetime(2023, 1, 1, tzinfo=pytz.utc) + timedelta(days=n*SessionsPerDevice + i)
+            sessionFile = models.PerceptSession(deidentified_id=randomUUID(), device_deidentified_id=device.deidentified_id, session_date=datetime(2020, 1, 1, tzinfo=pytz.utc))
+            sessionFile.session_file_path = "sessions/" + str(sessionFile.deidentified_id) + ".json"
+            JSON = {
+                "SessionDate": SessionDate.isoformat().replace("+00:00", "Z"),
+                "SessionEndDate": (SessionDate + timedelta(hours=1)).isoformat().replace("+00:00", "Z"),
+                "LeadConfiguration": {"Initial": LEAD_CONFIGURATIONS, "Final": LEAD_CONFIGURATIONS[:1 + i % 2]},
+            }
+            with open(Sessions.DATABASE_PATH + sessionFile.session_file_path, "wb+") as file:
+                file.write(secureEncoder.encrypt(json.dumps(JSON).encode("utf-8")))
+            SessionFiles.append(sessionFile)
+
+    models.PlatformUser.objects.bulk_create(Users)
+    models.Patient.objects.bulk_create(Patients)
+    Database.syncPatientDevices(Patients)
+    models.PerceptDevice.objects.bulk_create(PerceptDevices)
+    models.PerceptSession.objects.bulk_create(SessionFiles)
+
+def clearDataset():
+    for model in [models.PlatformUser, models.Patient, models.PatientDevice, models.PerceptDevice, models.PerceptSession, models.ProcessingQueue, models.ReprocessingCheckpoint]:
+        model.objects.all().delete()
+    for folder in ["sessions", "cache"]:
+        shutil.rmtree(Sessions.DATABASE_PATH + folder)
+        os.mkdir(Sessions.DATABASE_PATH + folder)
+
+def legacyQueueSessionDecoding():
+    DATABASE_PATH = Sessions.DATABASE_PATH
+    users = models.PlatformUser.objects.all()
+    Authority = {"Level": 1}
+    for user in users:
+        if user.is_admin or user.is_clinician:
+            Patients = models.Patient.objects.filter(institute=user.institute).all()
+        else:
+            Patients = models.Patient.objects.filter(institute=user.email).all()
+
+        for patient in Patients:
+            availableDevices = Database.getPerceptDevices(user, patient.deidentified_id, Authority)
+            for device in availableDevices:
+                availableSessions = models.PerceptSession.objects.filter(device_deidentified_id=device.deidentified_id).all()
+                for session in availableSessions:
+                    try:
+                        shutil.copyfile(DATABASE_PATH + session.session_file_path,(DATABASE_PATH + session.session_file_path).replace("/sessions/","/cache/"))
+                        models.ProcessingQueue(owner=user.unique_user_id, type="decodeJSON", state="InProgress", descriptor={
+                            "filename": session.session_file_path.split("/")[-1],
+                            "device_deidentified_id": str(device.deidentified_id),
+                        }).save()
+                        Sessions.deleteSessions(user, patient.deidentified_id, [str(session.deidentified_id)], Authority)
+
+                    except Exception as e:
+                        print(e)
+
+def legacyRefreshSessions():
+    DATABASE_PATH = Sessions.DATABASE_PATH
+    SessionFiles = models.PerceptSession.objects.all()
+    for sessionFile in SessionFiles:
+        if not sessionFile.session_file_path.startswith("sessions/"):
+            sessionFile.session_file_path = "sessions/" + sessionFile.session_file_path.split(os.path.sep)[-1]
+        try:
+            JSON = Percept.decodeEncryptedJSON(DATABASE_PATH + sessionFile.session_file_path, Sessions.key)
+        except:
+            print(sessionFile.session_file_path)
+            continue
+
+        LeadConfigurations = Reprocessing.extractLeadConfigurations(JSON)
+        SessionDate = datetime.fromtimestamp(Percept.estimateSessionDateTime(JSON),tz=pytz.utc)
+        sessionFile.session_date = SessionDate
+        sessionFile.save()
+
+        deviceObj = models.PerceptDevice.objects.filter(deidentified_id=sessionFile.device_deidentified_id).first()
+        if len(deviceObj.device_lead_configurations) < len(LeadConfigurations):
+            deviceObj.device_lead_configurations = LeadConfigurations
+            deviceObj.save()
+
+def queueState():
+    return sorted([(str(item.owner), json.dumps(item.descriptor, sort_keys=True)) for item in models.ProcessingQueue.objects.all()]), \
+           sorted(os.listdir(Sessions.DATABASE_PATH + "cache")), models.PerceptSession.objects.count()
+
+def sessionState():
+    return sorted([(str(sessionFile.deidentified_id), sessionFile.session_date) for sessionFile in models.PerceptSession.objects.all()]), \
+           sorted([(str(device.deidentified_id), json.dumps(device.device_lead_configurations)) for device in models.PerceptDevice.objects.all()])
+
+def measure(func, *args, **kwargs):
+    QueryCount = [0]
+    def countQuery(execute, sql, params, many, context):
+        QueryCount[0] += 1
+        return execute(sql, params, many, context)
+
+    with connection.execute_wrapper(countQuery):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        duration = time.perf_counter() - start
+    return result, duration, QueryCount[0]
+
+def runCase(Devices, SessionsPerDevice, func, *args, **kwargs):
+    clearDataset()
+    generateDataset(Devices, SessionsPerDevice)
+    _, duration, queryCount = measure(func, *args, **kwargs)
+    return duration, queryCount
+
+if __name__ == '__main__':
+    Devices = int(sys.argv[1]) if len(sys.argv) > 1 else 40
+    SessionsPerDevice = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    Workers = int(sys.argv[3]) if len(sys.argv) > 3 else 4
+
+    TemporaryPath = tempfile.mkdtemp()
+    for folder in ["sessions", "cache"]:
+        os.mkdir(TemporaryPath + os.path.sep + folder)
+    Sessions.DATABASE_PATH = TemporaryPath + os.path.sep
+    Reprocessing.DATABASE_PATH = TemporaryPath + os.path.sep
+
+    DatabaseName = connection.settings_dict["NAME"]
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        print(f"Synthetic dataset, {Devices} devices with {SessionsPerDevice} sessions each")
+        print(f"{'Case':40s} {'Time (s)':>10s} {'Queries':>9s}")
+
+        LegacyTime, LegacyQueries = runCase(Devices, SessionsPerDevice, legacyQueueSessionDecoding)
+        LegacyState = queueState()
+        print(f"{'Requeue, legacy loop':40s} {LegacyTime:10.2f} {LegacyQueries:9d}")
+        NewTime, NewQueries = runCase(Devices, SessionsPerDevice, Reprocessing.queueSessionDecoding, jobName="Benchmark")
+        assert queueState() == LegacyState, "Queued sessions differ"
+        print(f"{'Requeue, queueSessionDecoding':40s} {NewTime:10.2f} {NewQueries:9d}")
+
+        LegacyTime, LegacyQueries = runCase(Devices, SessionsPerDevice, legacyRefreshSessions)
+        LegacyState = sessionState()
+        print(f"{'Refresh Sessions, legacy loop':40s} {LegacyTime:10.2f} {LegacyQueries:9d}")
+        NewTime, NewQueries = runCase(Devices, SessionsPerDevice, Reprocessing.runReprocessing, "Sessions", "All", workers=1, jobName="Benchmark")
+        assert sessionState() == LegacyState, "Refreshed sessions differ"
+        print(f"{'Refresh Sessions, 1 worker':40s} {NewTime:10.2f} {NewQueries:9d}")
+
+        # Queries of forked workers are not captured by the parent process
+        NewTime, _ = runCase(Devices, SessionsPerDevice, Reprocessing.runReprocessing, "Sessions", "All", workers=Workers, jobName="Benchmark")
+        assert sessionState() == LegacyState, "Refreshed sessions differ"
+        print(f"{f'Refresh Sessions, {Workers} workers':40s} {NewTime:10.2f} {'-':>9s}")
+
+        Summary, ResumeTime, ResumeQueries = measure(Reprocessing.runReprocessing, "Sessions", "All", workers=Workers, jobName="Benchmark")
+        assert Summary["Skipped"] == Devices * SessionsPerDevice and Summary["Total"] == 0, "Completed sessions are processed again"
+        print(f"{'Refresh Sessions, resumed job':40s} {ResumeTime:10.2f} {ResumeQueries:9d}")
+
+    finally:
+        connection.creation.destroy_test_db(DatabaseName, verbosity=0)
+        shutil.rmtree(TemporaryPath)
@@ -0,0 +1,212 @@
+""""""
+"""
+=========================================================
+* UF BRAVO Platform
+=========================================================
+
+* Copyright 2023 by Jackson Cagle, Fixel Institute
+* The source code is made available under a Creative Common NonCommercial ShareAlike License (CC BY-NC-SA 4.0) (https://creativecommons.org/licenses/by-nc-sa/4.0/)
+
+ =========================================================
+
+* The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+"""
+"""
+Therapeutic Prediction Benchmark
+===================================================
+Regression check of ``modules.Percept.TherapeuticPrediction`` against the per-bin and per-frequency loops it replaced
+(``processSpectrogram``, ``extractFrequencyOfInterest`` and ``extractFullPredictionFeatures``) on synthetic BrainSense
+recordings with a stimulation-amplitude ramp on the left channel and constant amplitude on the right channel:
+
+  - Stimulation changes on spectrogram bins, exactly 3 s before/after bins, before the recording starts and after it ends.
+  - Bins with zero power (excluded from constant stimulation) and missing packets.
+  - A frequency with constant power (undefined correlation) in every other recording.
+
+Stimulation labels must be identical, the frequency of interest identical and features within 1e-9 (relative).
+Requires the server environment (decoder).
+
+Run ``python3 benchmarks/TherapeuticPredictionBenchmark.py [number of random recordings]`` from the Server directory.
+
+@author: Jackson Cagle, University of Florida
+@email: jackson.cagle@neurology.ufl.edu
+"""
+
+import os, sys, pathlib, time
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent.resolve()))
+sys.path.append(os.environ.get("PYTHON_UTILITY"))
+
+import copy
+import numpy as np
+from scipy import stats
+from decoder import Percept
+from utility import SignalProcessingUtility as SPU
+from utility.PythonUtility import rangeSelection
+
+from BRAVO import asgi
+from modules.Percept import TherapeuticPrediction
+
+def legacyProcessSpectrogram(stream, channel):
+    for series in stream["PowerDomain"]["Stimulation"]:
+        if channel == series["Name"]:
+            StimulationSeries = series
+
+    StimulationSeries["Time"] += stream["TimeDomain"]["StartTime"] - stream["PowerDomain"]["StartTime"]
+
+    for i in range(len(stream["TimeDomain"]["ChannelNames"])):
+        if stream["TimeDomain"]["ChannelNames"][i] == channel:
+            stream["TimeDomain"]["Spectrogram"][i]["ConstantStimulation"] = np.ones(stream["TimeDomain"]["Spectrogram"][i]["Time"].shape, dtype=bool)
+            stream["TimeDomain"]["Spectrogram"][i]["logPower"] = 10*np.log10(stream["TimeDomain"]["Spectrogram"][i]["Power"])
+            stream["TimeDomain"]["Spectrogram"][i]["ConstantStimulation"][np.isinf(stream["TimeDomain"]["Spectrogram"][i]["logPower"][0,:])] = False
+            for t in StimulationSeries["Time"]:
+                stream["TimeDomain"]["Spectrogram"][i]["ConstantStimulation"][rangeSelection(stream["TimeDomain"]["Spectrogram"][i]["Time"], [t-3, t+3])] = False
+
+            stream["TimeDomain"]["Spectrogram"][i]["Stimulation"] = np.zeros(stream["TimeDomain"]["Spectrogram"][i]["Time"].shape)
+            for t in range(len(stream["TimeDomain"]["Spectrogram"][i]["Time"])):
+                Stim = np.where(StimulationSeries["Time"] < stream["TimeDomain"]["Spectrogram"][i]["Time"][t])[0]
+                if len(Stim) == 0:
+                    stream["TimeDomain"]["Spectrogram"][i]["Stimulation"][t] = StimulationSeries["Amplitude"][0]
+                else:
+                    stream["TimeDomain"]["Spectrogram"][i]["Stimulation"][t] = StimulationSeries["Amplitude"][Stim[-1]]
+
+    return stream
+
+def legacyExtractFrequencyOfInterest(stream, channel):
+    for i in range(len(stream["TimeDomain"]["ChannelNames"])):
+        if stream["TimeDomain"]["ChannelNames"][i] == channel:
+            if len(np.unique(stream["TimeDomain"]["Spectrogram"][i]["Stimulation"][stream["TimeDomain"]["Spectrogram"][i]["ConstantStimulation"]])) > 2:
+                ModulationIndex = np.zeros(stream["TimeDomain"]["Spectrogram"][i]["Frequency"].shape)
+                for f in range(len(stream["TimeDomain"]["Spectrogram"][i]["Frequency"])):
+                    ModulationIndex[f] = np.var(stream["TimeDomain"]["Spectrogram"][i]["logPower"][f,:][stream["TimeDomain"]["Spectrogram"][i]["ConstantStimulation"]])
+
+                TargetFrequency = rangeSelection(stream["TimeDomain"]["Spectrogram"][i]["Frequency"], [5,50])
+                maxModulation = np.max(ModulationIndex[TargetFrequency])
+                SelectedData = np.bitwise_and(stream["TimeDomain"]["Spectrogram"][i]["ConstantStimulation"], stream["TimeDomain"]["Spectrogram"][i]["Missing"] == 0)
+
+                CorrelationIndex = np.zeros(stream["TimeDomain"]["Spectrogram"][i]["Frequency"].shape)
+                for f in range(len(stream["TimeDomain"]["Spectrogram"][i]["Frequency"])):
+                    CorrelationIndex[f], _ = stats.pearsonr(stream["TimeDomain"]["Spectrogram"][i]["Stimulation"][SelectedData], stream["TimeDomain"]["Spectrogram"][i]["Power"][f,:][SelectedData])
+
+                CorrelationIndex = np.power(CorrelationIndex,2)
+                maxCorrelation = np.max(CorrelationIndex[TargetFrequency])
+
+                CombinedFeature = SPU.smooth(ModulationIndex/maxModulation * CorrelationIndex/maxCorrelation,5)
+                maxFeature = np.max(CombinedFeature[TargetFrequency])
+
+                TargetFrequency = rangeSelection(stream["TimeDomain"]["Spectrogram"][i]["Frequency"], [5,50])
+
+                GoodnessOfFit = np.mean(CombinedFeature[TargetFrequency]) / np.mean(CombinedFeature[~TargetFrequency])
+                return stream["TimeDomain"]["Spectrogram"][i]["Frequency"][CombinedFeature == maxFeature][0], GoodnessOfFit
+    return -1, -1
+
+def legacyExtractFullPredictionFeatures(BrainSenseData, HemisphereInfo):
+    for channel in BrainSenseData["TimeDomain"]["ChannelNames"]:
+        contacts, hemisphere = Percept.reformatChannelName(channel)
+        if HemisphereInfo.startswith(hemisphere):
+            BrainSenseData = legacyProcessSpectrogram(BrainSenseData, channel)
+
+            for i in range(len(BrainSenseData["TimeDomain"]["ChannelNames"])):
+                if BrainSenseData["TimeDomain"]["ChannelNames"][i] == channel:
+                    break
+
+            constantStimulation = np.bitwise_and(BrainSenseData["TimeDomain"]["Spectrogram"][i]["ConstantStimulation"], BrainSenseData["TimeDomain"]["Spectrogram"][i]["Missing"] == 0)
+            StimulationAmplitude = BrainSenseData["TimeDomain"]["Spectrogram"][i]["Stimulation"][constantStimulation]
+            uniqueAmplitude = sorted(np.unique(StimulationAmplitude))
+
+            FullFeatures = np.zeros((len(BrainSenseData["TimeDomain"]["Spectrogram"][i]["Frequency"])+1, len(uniqueAmplitude)))
+            for j in range(len(BrainSenseData["TimeDomain"]["Spectrogram"][i]["Frequency"])):
+                freq = BrainSenseData["TimeDomain"]["Spectrogram"][i]["Frequency"][j]
+                FrequencyOfInterest = rangeSelection(BrainSenseData["TimeDomain"]["Spectrogram"][i]["Frequency"], [freq - 3, freq + 3])
+                BrainPower = np.mean(BrainSenseData["TimeDomain"]["Spectrogram"][i]["Power"][:,constantStimulation][FrequencyOfInterest], axis=0)
+
+                simplifiedYData = []
+                for k in range(len(uniqueAmplitude)):
+                    simplifiedYData.append(np.median(BrainPower[StimulationAmplitude==uniqueAmplitude[k]]))
+
+                FullFeatures[j,:] = np.array(simplifiedYData)
+            FullFeatures[-1,:] = np.array(uniqueAmplitude)
+            return FullFeatures
+
+    return None
+
+def generateRecording(rng, duration=600, constantPower=False):
+    """ Synthetic BrainSense recording. Left stimulation ramps 0-3.5 mA and modulates 20 Hz power, right stimulation is constant.
+
+    The time domain starts 1.5 s before the power domain, so stimulation times are shifted by -1.5 s onto the spectrogram:
+    changes are placed before the first bin, on the first bin, exactly on a bin, exactly 3 s after a bin, off the bin grid,
+    and after the last bin. With ``constantPower``, power at 90 Hz is constant (undefined correlation and goodness of fit).
+    """
+
+    Time = np.arange(0, duration, 0.5)
+    Frequency = np.arange(0, 100, 0.9765625)
+    ChangeTime = np.sort(np.concatenate(([-5, 1.5], rng.choice(Time[10:-10], size=6, replace=False) + rng.choice([0, 1.5, 4.5, 0.2], size=6), [duration + 10])))
+    Amplitude = np.round(np.linspace(0, 3.5, len(ChangeTime)), 1)
+
+    Spectrogram = list()
+    Stimulation = list()
+    for Channel, StimulationAmplitude in [("ZERO_TWO_LEFT", Amplitude), ("ONE_THREE_RIGHT", np.full(len(ChangeTime), 2.0))]:
+        Modulation = np.interp(Time, ChangeTime - 1.5, StimulationAmplitude)
+        Power = np.exp(rng.standard_normal((len(Frequency), len(Time)))) * (1 + np.outer(np.exp(-((Frequency - 20) / 3)**2), Modulation))
+        Power[:,rng.choice(len(Time), size=3, replace=False)] = 0
+        if constantPower:
+            Power[np.argmin(np.abs(Frequency - 90)),:] = 1
+        Spectrogram.append({"Time": Time, "Frequency": Frequency, "Power": Power, "Missing": (rng.random(len(Time)) < 0.05).astype(float)})
+        Stimulation.append({"Name": Channel, "Hemisphere": "Left GPi" if Channel.endswith("LEFT") else "Right GPi", "Time": ChangeTime.copy(), "Amplitude": StimulationAmplitude})
+
+    return {
+        "PowerDomain": {"Stimulation": Stimulation, "StartTime": 100},
+        "TimeDomain": {"StartTime": 98.5, "ChannelNames": ["ZERO_TWO_LEFT", "ONE_THREE_RIGHT"], "Spectrogram": Spectrogram}
+    }
+
+def assertClose(Legacy, New, message):
+    assert np.array_equal(np.isnan(Legacy), np.isnan(New)), message
+    assert np.allclose(Legacy, New, rtol=1e-9, atol=0, equal_nan=True), message
+
+def timeit(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+if __name__ == '__main__':
+    Trials = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    rng = np.random.default_rng(0)
+
+    Durations = {"Spectrogram": [0, 0], "Frequency of Interest": [0, 0], "Full Features": [0, 0]}
+    for trial in range(Trials):
+        BrainSenseData = generateRecording(rng, constantPower=trial % 2 == 1)
+        for i in range(len(BrainSenseData["TimeDomain"]["ChannelNames"])):
+            channel = BrainSenseData["TimeDomain"]["ChannelNames"][i]
+            HemisphereInfo = BrainSenseData["PowerDomain"]["Stimulation"][i]["Hemisphere"]
+
+            Legacy, LegacyTime = timeit(legacyProcessSpectrogram, copy.deepcopy(BrainSenseData), channel)
+            New, NewTime = timeit(TherapeuticPrediction.processSpectrogram, copy.deepcopy(BrainSenseData), channel)
+            Durations["Spectrogram"][0] += LegacyTime
+            Durations["Spectrogram"][1] += NewTime
+            for key in ["ConstantStimulation", "Stimulation"]:
+                assert np.array_equal(Legacy["TimeDomain"]["Spectrogram"][i][key], New["TimeDomain"]["Spectrogram"][i][key]), f"{key} of {channel} differs"
+
+            LegacyFeature, LegacyTime = timeit(legacyExtractFrequencyOfInterest, Legacy, channel)
+            NewFeature, NewTime = timeit(TherapeuticPrediction.extractFrequencyOfInterest, New, channel)
+            Durations["Frequency of Interest"][0] += LegacyTime
+            Durations["Frequency of Interest"][1] += NewTime
+            assert LegacyFeature[0] == NewFeature[0], f"Frequency of interest of {channel} differs"
+            assertClose(LegacyFeature[1], NewFeature[1], f"Goodness of fit of {channel} differs")
+            if channel.endswith("RIGHT"):
+                assert NewFeature == (-1, -1), "Frequency of interest found with constant stimulation"
+
+            Legacy, LegacyTime = timeit(legacyExtractFullPredictionFeatures, copy.deepcopy(BrainSenseData), HemisphereInfo)
+            New, NewTime = timeit(TherapeuticPrediction.extractFullPredictionFeatures, copy.deepcopy(BrainSenseData), HemisphereInfo)
+            Durations["Full Features"][0] += LegacyTime
+            Durations["Full Features"][1] += NewTime
+            assert Legacy.shape == New.shape, f"Full features shape of {channel} differs"
+            assertClose(Legacy, New, f"Full features of {channel} differ")
+
+        # Cached features are returned for the same recording and recomputed for a different recording
+        Features = TherapeuticPrediction.extractFullPredictionFeatures(copy.deepcopy(BrainSenseData), "Left GPi", recordingId=f"Benchmark{trial}")
+        assert np.array_equal(TherapeuticPrediction.extractFullPredictionFeatures(copy.deepcopy(BrainSenseData), "Left GPi", recordingId=f"Benchmark{trial}"), Features)
+        BrainSenseData["TimeDomain"]["Spectrogram"][0]["Power"] *= 2
+        assertClose(TherapeuticPrediction.extractFullPredictionFeatures(copy.deepcopy(BrainSenseData), "Left GPi", recordingId=f"Benchmark{trial}")[:-1], Features[:-1] * 2, "Cached features of a changed recording")
+
+    print(f"{Trials} synthetic recordings (ramp and constant stimulation channels): outputs identical")
+    print(f"{'Stage':24s} {'Legacy (s)':>11s} {'New (s)':>9s} {'Speedup':>8s}")
+    for key in Durations.keys():
+        print(f"{key:24s} {Durations[key][0]:11.3f} {Durations[key][1]:9.3f} {Durations[key][0]/Durations[key][1]:7.0f}x")
@@ -23,6 +23,7 @@ RESOURCES = str(pathlib.Path(__file__).parent.parent.resolve())
 
 from datetime import datetime, date, timedelta
 import pickle
+import blosc
 import dateutil, pytz
 import numpy as np
 import pandas as pd
@@ -30,12 +31,17 @@ from cryptography.fernet import Fernet
 import json
 from io import BytesIO
 import copy
-import websocket
+import shutil
+import uuid
+import hashlib
+import multiprocessing
 from scipy import signal, io, stats, optimize, interpolate
 from specparam import SpectralModel
 
+from django.db import connections
+
 from Backend import models
-from modules import Database
+from modules import Database, CardiacFilter, MissingLabel, Notification
 from modules.Percept import BrainSenseStream
 
 from decoder import DelsysTrigno
@@ -43,6 +49,17 @@ from utility import PythonUtility
 from utility import SignalProcessingUtility as SPU
 
 DATABASE_PATH = os.environ.get('DATASERVER_PATH')
+ANALYSIS_PROCESSING_WORKERS = int(os.environ.get('ANALYSIS_PROCESSING_WORKERS', 1))
+
+# Version identifier of analysis step handlers. Increment when handler output changes so that cached step results are recomputed.
+ANALYSIS_STEP_VERSION = 2
+ANALYSIS_UNCACHEABLE_STEPS = ["extractAnnotations"]
+
+# Memory budget (MB) for intermediate step results. If 0, all step results are persisted as AnalysisOutput.
+# Otherwise only output steps are persisted, intermediates stay in memory and spill to cache folder past the budget.
+# Intermediates are stored by step hash at the end of processing so that later runs can reuse them (see storeIntermediateResults).
+ANALYSIS_INTERMEDIATE_MEMORY = float(os.environ.get('ANALYSIS_INTERMEDIATE_MEMORY', 0))*1024*1024
+IntermediateResults = {"PersistentSteps": None, "Data": {}, "Size": 0}
 key = os.environ.get('ENCRYPTION_KEY')
 
 def getExistingAnalysis(user, patientId, authority):
@@ -89,6 +106,7 @@ def deleteAnalysis(user, patientId, analysisId, authority):
         analysis = models.CombinedRecordingAnalysis.objects.filter(device_deidentified_id=patientId, deidentified_id=analysisId).first()
         if "AnalysisConfiguration" in analysis.recording_type:
             deleteAnalysisConfiguration(user, patientId, analysisId)
+        shutil.rmtree(getIntermediateStorePath(analysis.deidentified_id), ignore_errors=True)
         analysis.delete()
 
     return True
@@ -223,10 +241,7 @@ def loadAnalysisConfiguration(user, patientId, analysisId):
 
 def deleteAnalysisConfiguration(user, patientId, analysisId):
     analysisConfig = models.NeuralActivityRecording.objects.filter(device_deidentified_id=patientId, recording_type="AnalysisConfiguration", recording_info={"Creator": str(user.unique_user_id), "Analysis": str(analysisId)}).first()
-    try: 
-        os.remove(DATABASE_PATH + "recordings" + os.path.sep + analysisConfig.recording_datapointer)
-    except:
-        pass
+    Database.deleteSourceDataPointer(analysisConfig.recording_datapointer)
     analysisConfig.delete()
 
 def updateAnalysis(user, patientId, analysisId, steps, authority):
@@ -234,9 +249,13 @@ def updateAnalysis(user, patientId, analysisId, steps, authority):
     
     Configuration["AnalysisSteps"] = steps
     if "Results" in Configuration.keys():
+        # Previous results are kept for reuse by processAnalysis and removed there if no longer referenced.
+        if not "CachedResults" in Configuration.keys():
+            Configuration["CachedResults"] = []
+        Configuration["CachedResults"].extend([result for result in Configuration["Results"] if "Hash" in result.keys()])
         analysis = models.CombinedRecordingAnalysis.objects.filter(deidentified_id=analysisId, device_deidentified_id=patientId).first()
         for k in range(len(Configuration["Results"])):
-            if "ProcessedData" in Configuration["Results"][k].keys():
+            if "ProcessedData" in Configuration["Results"][k].keys() and not "Hash" in Configuration["Results"][k].keys():
                 removeResultDataFile(Configuration["Results"][k]["ProcessedData"])
                 index = [i for i in range(len(analysis.recording_list)) if analysis.recording_list[i] == Configuration["Results"][k]["ProcessedData"]]
                 if len(index) > 0:
@@ -588,20 +607,13 @@ def startAnalysis(user, patientId, analysisId, authority):
 
     processingqueue = models.ProcessingQueue(owner=user.unique_user_id, type="ProcessAnalysis", state="InProgress", descriptor=Descriptor)
     processingqueue.save()
-    try:
-        ws = websocket.WebSocket()
-        ws.connect("ws://localhost:3001/socket/notification")
-        ws.send(json.dumps({
-            "NotificationType": "AnalysisProcessing",
-            "TaskUser": str(user.unique_user_id),
-            "TaskID": str(analysis.deidentified_id),
-            "Authorization": os.environ["ENCRYPTION_KEY"],
-            "State": "StartProcessing",
-            "Message": "",
-        }))
-        ws.close()
-    except Exception as e:
-        print(e)
+    Notification.publishNotification({
+        "NotificationType": "AnalysisProcessing",
+        "TaskUser": str(user.unique_user_id),
+        "TaskID": str(analysis.deidentified_id),
+        "State": "StartProcessing",
+        "Message": "",
+    })
 
     return "Success"
 
@@ -627,13 +639,132 @@ def createResultDataFile(Data, patientId, recordingType, recordingDuration):
     recording.save()
     return recording
 
+def getPersistentSteps(AnalysisSteps):
+    """ List of step IDs whose results are persisted when intermediates are kept in memory.
+
+    Persisted steps are view and export steps, steps with "persist" configuration, 
+    and steps whose output is not used by any later step (including the final step).
+    """
+
+    PersistentSteps = []
+    for i in range(len(AnalysisSteps)):
+        step = AnalysisSteps[i]
+        Consumers = [laterStep for laterStep in AnalysisSteps[i+1:] if step["config"]["output"] in [laterStep["config"][key] for key in ["targetRecording", "secondTargetRecording", "labelRecording"] if key in laterStep["config"].keys()]]
+        if step["type"]["value"] in ["view", "export"] or ("persist" in step["config"].keys() and step["config"]["persist"]) or len(Consumers) == 0:
+            PersistentSteps.append(step["id"])
+    return PersistentSteps
+
+def saveStepResult(Data, step, analysis):
+    """ Save analysis step result.
+
+    Results are saved as AnalysisOutput recordings unless intermediate results are kept in memory (see processAnalysis) 
+    and the step is not a persistent step. 
+
+    Returns:
+      Result ID to be used with loadStepResult function.
+    """
+
+    if IntermediateResults["PersistentSteps"] == None or step["id"] in IntermediateResults["PersistentSteps"]:
+        recording = createResultDataFile(Data, str(analysis.device_deidentified_id), "AnalysisOutput", 0)
+        analysis.recording_type.append(recording.recording_type)
+        analysis.recording_list.append(str(recording.recording_id))
+        return str(recording.recording_id)
+    
+    resultId = "Intermediate_" + uuid.uuid4().hex
+    size = Database.estimateDataSize(Data)
+    if IntermediateResults["Size"] + size > ANALYSIS_INTERMEDIATE_MEMORY:
+        os.makedirs(DATABASE_PATH + "cache", exist_ok=True)
+        filename = DATABASE_PATH + "cache" + os.path.sep + resultId + ".bpkl"
+        with open(filename, "wb+") as file:
+            file.write(blosc.compress(pickle.dumps(Data)))
+        IntermediateResults["Data"][resultId] = {"Filename": filename}
+    else:
+        IntermediateResults["Data"][resultId] = {"Data": Data}
+        IntermediateResults["Size"] += size
+    return resultId
+
+def getIntermediateStorePath(analysisId, stepHash=None):
+    path = DATABASE_PATH + "cache" + os.path.sep + "AnalysisIntermediates" + os.path.sep + str(analysisId)
+    if stepHash == None:
+        return path
+    return path + os.path.sep + stepHash + ".bpkl"
+
+def storeIntermediateResults(analysis, Results):
+    """ Store intermediate step results kept in memory (or spilled) under their step hash.
+
+    Stored results are not queryable (no AnalysisOutput recording), they are only reused by processAnalysis when the step hash is unchanged.
+    Results are marked with "Intermediate" instead of "ProcessedData".
+    """
+
+    for result in Results:
+        if not "ProcessedData" in result.keys() or not result["ProcessedData"] in IntermediateResults["Data"].keys():
+            continue
+
+        resultId = result["ProcessedData"]
+        del result["ProcessedData"]
+        if not "Hash" in result.keys():
+            continue
+        
+        filename = getIntermediateStorePath(analysis.deidentified_id, result["Hash"])
+        try:
+            if not "Stored" in IntermediateResults["Data"][resultId].keys():
+                os.makedirs(getIntermediateStorePath(analysis.deidentified_id), exist_ok=True)
+                if "Filename" in IntermediateResults["Data"][resultId].keys():
+                    shutil.move(IntermediateResults["Data"][resultId]["Filename"], filename)
+                else:
+                    with open(filename, "wb+") as file:
+                        file.write(blosc.compress(pickle.dumps(IntermediateResults["Data"][resultId]["Data"])))
+                IntermediateResults["Data"][resultId] = {"Filename": filename, "Stored": True}
+            result["Intermediate"] = True
+        except Exception as e:
+            print(e)
+
+def loadStoredIntermediateResult(analysis, result):
+    """ Register a stored intermediate result of a previous run for reuse.
+
+    Returns:
+      Result dictionary with "ProcessedData" to be used with loadStepResult function, None if the stored result is missing.
+    """
+
+    filename = getIntermediateStorePath(analysis.deidentified_id, result["Hash"])
+    if not os.path.exists(filename):
+        return None
+    
+    resultId = "Intermediate_" + result["Hash"]
+    IntermediateResults["Data"][resultId] = {"Filename": filename, "Stored": True}
+    result = copy.deepcopy(result)
+    del result["Intermediate"]
+    result["ProcessedData"] = resultId
+    return result
+
+def loadStepResult(resultId):
+    """ Load analysis step result saved by saveStepResult function.
+    """
+
+    if resultId in IntermediateResults["Data"].keys():
+        if "Filename" in IntermediateResults["Data"][resultId].keys():
+            with open(IntermediateResults["Data"][resultId]["Filename"], "rb") as file:
+                return pickle.loads(blosc.decompress(file.read()))
+        return copy.deepcopy(IntermediateResults["Data"][resultId]["Data"])
+    
+    recording = models.ExternalRecording.objects.filter(recording_id=resultId).first()
+    return Database.loadSourceDataPointer(recording.recording_datapointer)
+
+def clearIntermediateResults():
+    for resultId in IntermediateResults["Data"].keys():
+        if "Filename" in IntermediateResults["Data"][resultId].keys() and not "Stored" in IntermediateResults["Data"][resultId].keys():
+            try:
+                os.remove(IntermediateResults["Data"][resultId]["Filename"])
+            except Exception as e:
+                print(e)
+    IntermediateResults["PersistentSteps"] = None
+    IntermediateResults["Data"] = {}
+    IntermediateResults["Size"] = 0
+
 def removeResultDataFile(recordingId):
     recording = models.ExternalRecording.objects.filter(recording_id=recordingId).first()
     if recording:
-        try:
-            os.remove(DATABASE_PATH + "recordings" + os.path.sep + recording.recording_datapointer)
-        except:
-            pass
+        Database.deleteSourceDataPointer(recording.recording_datapointer)
         recording.delete()
 
 def JSONEncode(item):
@@ -689,6 +820,64 @@ def queryResultData(user, patientId, analysisId, resultId, download, authority):
     
     return JSONEncode(ProcessedData), GraphOptions
 
+ParallelStepFunction = None
+
+def executeStepTask(processRawData, task):
+    recordingId, datapointer, RawData = task
+    if datapointer:
+        RawData = Database.loadSourceDataPointer(datapointer)
+    return processRawData(RawData, recordingId)
+
+def executeParallelStepTask(task):
+    return executeStepTask(ParallelStepFunction, task)
+
+def processStepRecordings(processRawData, targetSignal, RecordingIds, Results, Configuration, parallel=False):
+    """ Apply a per-recording processing function to all inputs of an analysis step.
+
+    Inputs are raw recordings whose descriptor type matches targetSignal, followed by each entry of previous step results labeled targetSignal.
+    If the step is parallel-safe (no database access and no shared state in processRawData) and ANALYSIS_PROCESSING_WORKERS is greater than 1, 
+    recordings are processed by a forked process pool. Raw recordings are loaded within the worker processes. 
+
+    Args:
+      processRawData: function (RawData, recordingId) returning processed data. 
+      targetSignal: recording type or result label to be processed.
+      RecordingIds: list of recording IDs in analysis descriptor.
+      Results: list of previous step results.
+      Configuration: analysis configuration.
+      parallel: Boolean indicating if processRawData is parallel-safe.
+
+    Returns:
+      List of processed data, in input order regardless of execution mode.
+    """
+
+    Tasks = []
+    for recordingId in RecordingIds:
+        if Configuration["Descriptor"][recordingId]["Type"] == targetSignal:
+            recording = models.ExternalRecording.objects.filter(recording_id=recordingId).first()
+            if not recording:
+                recording = models.NeuralActivityRecording.objects.filter(recording_id=recordingId).first()
+            if recording:
+                Tasks.append((recordingId, recording.recording_datapointer, None))
+    
+    # Previous step results are processed with the descriptor of the last recording in analysis. 
+    lastRecordingId = list(RecordingIds)[-1] if len(RecordingIds) > 0 else None
+    for result in Results:
+        if result["ResultLabel"] == targetSignal:
+            RawData = loadStepResult(result["ProcessedData"])
+            for i in range(len(RawData)):
+                Tasks.append((lastRecordingId, None, RawData[i]))
+    
+    if parallel and ANALYSIS_PROCESSING_WORKERS > 1 and len(Tasks) > 1:
+        global ParallelStepFunction
+        ParallelStepFunction = processRawData
+
+        # Forked workers must not share the parent database connection
+        connections.close_all()
+        with multiprocessing.get_context("fork").Pool(min(ANALYSIS_PROCESSING_WORKERS, len(Tasks))) as pool:
+            return pool.map(executeParallelStepTask, Tasks, chunksize=1)
+
+    return [executeStepTask(processRawData, task) for task in Tasks]
+
 def handleFilterProcessing(step, RecordingIds, Results, Configuration, analysis):
     print("Start Filter")
     targetSignal = step["config"]["targetRecording"]
@@ -702,7 +891,7 @@ def handleFilterProcessing(step, RecordingIds, Results, Configuration, analysis)
     highpass = float(step["config"]["highpass"])
     lowpass = float(step["config"]["lowpass"])
 
-    def processRawData(RawData):
+    def processRawData(RawData, recordingId):
         if highpass == 0:
             [b,a] = signal.butter(5, np.array([lowpass])*2/RawData["SamplingRate"], 'lp', output='ba')
         elif lowpass == 0:
@@ -715,36 +904,14 @@ def handleFilterProcessing(step, RecordingIds, Results, Configuration, analysis)
         RawData["ResultType"] = "TimeDomain"
         return RawData
 
-    ProcessedData = []
-    for recordingId in RecordingIds:
-        if Configuration["Descriptor"][recordingId]["Type"] == targetSignal:
-            if models.ExternalRecording.objects.filter(recording_id=recordingId).exists():
-                recording = models.ExternalRecording.objects.filter(recording_id=recordingId).first()
-                RawData = Database.loadSourceDataPointer(recording.recording_datapointer)
-            elif models.NeuralActivityRecording.objects.filter(recording_id=recordingId).exists():
-                recording = models.NeuralActivityRecording.objects.filter(recording_id=recordingId).first()
-                RawData = Database.loadSourceDataPointer(recording.recording_datapointer)
-
-            RawData = processRawData(RawData=RawData)
-            ProcessedData.append(RawData)
-    
-    for result in Results:
-        if result["ResultLabel"] == targetSignal:
-            recording = models.ExternalRecording.objects.filter(recording_id=result["ProcessedData"]).first()
-            RawData = Database.loadSourceDataPointer(recording.recording_datapointer)
-            
-            for i in range(len(RawData)):
-                RawData[i] = processRawData(RawData=RawData[i])
-                ProcessedData.append(RawData[i])
+    ProcessedData = processStepRecordings(processRawData, targetSignal, RecordingIds, Results, Configuration, parallel=True)
 
-    recording = createResultDataFile(ProcessedData, str(analysis.device_deidentified_id), "AnalysisOutput", 0)
-    analysis.recording_type.append(recording.recording_type)
-    analysis.recording_list.append(str(recording.recording_id))
+    resultId = saveStepResult(ProcessedData, step, analysis)
 
     return {
         "ResultLabel": step["config"]["output"],
         "Id": step["id"],
-        "ProcessedData": str(recording.recording_id),
+        "ProcessedData": resultId,
         "Type": "TimeDomain"
     }
 
@@ -752,42 +919,20 @@ def handleWienerFilterProcessing(step, RecordingIds, Results, Configuration, ana
     print("Start Wiener Filter")
     targetSignal = step["config"]["targetRecording"]
 
-    def processRawData(RawData):
+    def processRawData(RawData, recordingId):
         Errors = signal.wiener(RawData["Data"], mysize=int(RawData["SamplingRate"]/2))
         RawData["Data"] = RawData["Data"] - Errors
         RawData["ResultType"] = "TimeDomain"
         return RawData
 
-    ProcessedData = []
-    for recordingId in RecordingIds:
-        if Configuration["Descriptor"][recordingId]["Type"] == targetSignal:
-            if models.ExternalRecording.objects.filter(recording_id=recordingId).exists():
-                recording = models.ExternalRecording.objects.filter(recording_id=recordingId).first()
-                RawData = Database.loadSourceDataPointer(recording.recording_datapointer)
-            elif models.NeuralActivityRecording.objects.filter(recording_id=recordingId).exists():
-                recording = models.NeuralActivityRecording.objects.filter(recording_id=recordingId).first()
-                RawData = Database.loadSourceDataPointer(recording.recording_datapointer)
-
-            RawData = processRawData(RawData=RawData)
-            ProcessedData.append(RawData)
-    
-    for result in Results:
-        if result["ResultLabel"] == targetSignal:
-            recording = models.ExternalRecording.objects.filter(recording_id=result["ProcessedData"]).first()
-            RawData = Database.loadSourceDataPointer(recording.recording_datapointer)
-            
-            for i in range(len(RawData)):
-                RawData[i] = processRawData(RawData=RawData[i])
-                ProcessedData.append(RawData[i])
+    ProcessedData = processStepRecordings(processRawData, targetSignal, RecordingIds, Results, Configuration, parallel=True)
 
-    recording = createResultDataFile(ProcessedData, str(analysis.device_deidentified_id), "AnalysisOutput", 0)
-    analysis.recording_type.append(recording.recording_type)
-    analysis.recording_list.append(str(recording.recording_id))
+    resultId = saveStepResult(ProcessedData, step, analysis)
 
     return {
         "ResultLabel": step["config"]["output"],
         "Id": step["id"],
-        "ProcessedData": str(recording.recording_id),
+        "ProcessedData": resultId,
         "Type": "TimeDomain"
     }
 
@@ -801,98 +946,13 @@ def handleCardiacFilterProcessing(step, RecordingIds, Results, Configuration, an
         SamplingRate = RawData["SamplingRate"]
 
         for i in range(Signal.shape[1]):
-            posPeaks,_ = signal.find_peaks(Signal[:,i], prominence=[10,200], distance=SamplingRate*0.5)
-            PosCardiacVariability = np.std(np.diff(posPeaks))
-            negPeaks,_ = signal.find_peaks(-Signal[:,i], prominence=[10,200], distance=SamplingRate*0.5)
-            NegCardiacVariability = np.std(np.diff(negPeaks))
-
-            if PosCardiacVariability < NegCardiacVariability:
-                peaks = posPeaks
-            else:
-                peaks = negPeaks
-            CardiacRate = int(np.mean(np.diff(peaks)))
-
-            PrePeak = int(CardiacRate*0.25)
-            PostPeak = int(CardiacRate*0.65)
-            EKGMatrix = np.zeros((len(peaks)-2,PrePeak+PostPeak))
-            for j in range(1,len(peaks)-1):
-                if peaks[j]+PostPeak < len(Signal[:,i]) and peaks[j]-PrePeak > 0:
-                    EKGMatrix[j-1,:] = Signal[peaks[j]-PrePeak:peaks[j]+PostPeak,i]
-
-            EKGTemplate = np.mean(EKGMatrix,axis=0)
-            EKGTemplate = EKGTemplate / (np.max(EKGTemplate)-np.min(EKGTemplate))
-
-            def EKGTemplateFunc(xdata, amplitude, offset):
-                return EKGTemplate * amplitude + offset
-
-            for j in range(len(peaks)):
-                if peaks[j]-PrePeak < 0:
-                    pass
-                elif peaks[j]+PostPeak >= len(Signal[:,i]) :
-                    pass
-                else:
-                    sliceSelection = np.arange(peaks[j]-PrePeak,peaks[j]+PostPeak)
-                    params, covmat = optimize.curve_fit(EKGTemplateFunc, sliceSelection, Signal[sliceSelection,i])
-                    Signal[sliceSelection,i] = Signal[sliceSelection,i] - EKGTemplateFunc(sliceSelection, *params)
+            Signal[:,i] = CardiacFilter.fixedPeakTemplateFilter(Signal[:,i], SamplingRate)
 
         RawData["Data"] = Signal
         return RawData
 
     def KurtosisFilterr(RawData):
-        Signal = RawData["Data"]
-        SamplingRate = RawData["SamplingRate"]
-
-        Window = int(SamplingRate/2)
-        KurtosisIndex = range(0, len(Signal)-Window)
-        ExpectedKurtosis = np.zeros((len(KurtosisIndex)))
-        for j in range(len(KurtosisIndex)):
-            zScore = stats.zscore(Signal[KurtosisIndex[j]:KurtosisIndex[j]+Window])
-            ExpectedKurtosis[j] = np.mean(np.power(zScore, 4))
-
-        [b,a] = signal.butter(3, np.array([0.5, 2])*2/SamplingRate, "bandpass")
-        ExpectedKurtosis = signal.filtfilt(b,a,ExpectedKurtosis)
-        Peaks, _ = signal.find_peaks(ExpectedKurtosis, distance=Window)
-        Peaks += int(Window/2)
-
-        CardiacFiltered = copy.deepcopy(RawData["Data"])
-        for i in range(Signal.shape[1]):
-            CardiacEpochs = []
-            SearchWindow = 100
-            for j in range(len(Peaks)):
-                if ExpectedKurtosis[Peaks[j]-int(Window/2)] < 1.2:
-                    continue
-                ShiftPeak = 0
-                if Peaks[j]-SearchWindow-ShiftPeak < 0 or Peaks[j]+SearchWindow-ShiftPeak >= len(Signal[:,i]):
-                    continue 
-                findPeak = np.argmax(Signal[Peaks[j]-SearchWindow:Peaks[j]+SearchWindow, i])
-                ShiftPeak = SearchWindow-findPeak
-                if Peaks[j]-SearchWindow-ShiftPeak < 0 or Peaks[j]+SearchWindow-ShiftPeak >= len(Signal[:,i]):
-                    continue 
-                CardiacEpochs.append(Signal[Peaks[j]-SearchWindow-ShiftPeak:Peaks[j]+SearchWindow-ShiftPeak, i])
-
-            if len(CardiacEpochs) == 0:
-                continue
-            
-            EKGTemplate = np.mean(np.array(CardiacEpochs), axis=0)
-            EKGTemplate = EKGTemplate / (np.max(EKGTemplate)-np.min(EKGTemplate))
-
-            def EKGTemplateFunc(xdata, amplitude, offset):
-                return EKGTemplate * amplitude + offset
-
-            for j in range(len(Peaks)):
-                ShiftPeak = 0
-                if Peaks[j]-SearchWindow-ShiftPeak < 0 or Peaks[j]+SearchWindow-ShiftPeak >= len(Signal[:,i]):
-                    continue
-                findPeak = np.argmax(Signal[Peaks[j]-SearchWindow:Peaks[j]+SearchWindow,i])
-                ShiftPeak = SearchWindow-findPeak
-                if Peaks[j]-SearchWindow-ShiftPeak < 0 or Peaks[j]+SearchWindow-ShiftPeak >= len(Signal[:,i]):
-                    continue
-                sliceSelection = np.arange(Peaks[j]-SearchWindow-ShiftPeak, Peaks[j]+SearchWindow-ShiftPeak)
-                Original = Signal[sliceSelection,i]
-                params, covmat = optimize.curve_fit(EKGTemplateFunc, sliceSelection, Original)
-                CardiacFiltered[sliceSelection,i] = Original - EKGTemplateFunc(sliceSelection, *params)
-        
-        RawData["Data"] = CardiacFiltered
+        RawData["Data"] = CardiacFilter.kurtosisTemplateFilter(RawData["Data"], RawData["SamplingRate"])
         return RawData
 
     def LMSDecoupler(RawData):
@@ -911,7 +971,7 @@ def handleCardiacFilterProcessing(step, RecordingIds, Results, Configuration, an
         RawData["Data"][:,1] = DecoupledSignal1[len(Signal):]
         return RawData
 
-    def processRawData(RawData):
+    def processRawData(RawData, recordingId):
         if filterMethod == "Kurtosis-peak Detection Template Matching":
             return KurtosisFilterr(RawData)
         elif filterMethod == "Fixed Height Peak Detection Template Matching":
@@ -920,38 +980,16 @@ def handleCardiacFilterProcessing(step, RecordingIds, Results, Configuration, an
             return LMSDecoupler(RawData)
         return RawData
 
-    ProcessedData = []
-    for recordingId in RecordingIds:
-        if Configuration["Descriptor"][recordingId]["Type"] == targetSignal:
-            if models.ExternalRecording.objects.filter(recording_id=recordingId).exists():
-                recording = models.ExternalRecording.objects.filter(recording_id=recordingId).first()
-                RawData = Database.loadSourceDataPointer(recording.recording_datapointer)
-            elif models.NeuralActivityRecording.objects.filter(recording_id=recordingId).exists():
-                recording = models.NeuralActivityRecording.objects.filter(recording_id=recordingId).first()
-                RawData = Database.loadSourceDataPointer(recording.recording_datapointer)
-            
-            RawData = processRawData(RawData)
-            RawData["ResultType"] = "TimeDomain"
-            ProcessedData.append(RawData)
-    
-    for result in Results:
-        if result["ResultLabel"] == targetSignal:
-            recording = models.ExternalRecording.objects.filter(recording_id=result["ProcessedData"]).first()
-            RawData = Database.loadSourceDataPointer(recording.recording_datapointer)
-            
-            for i in range(len(RawData)):
-                RawData[i] = processRawData(RawData[i])
-                RawData[i]["ResultType"] = "TimeDomain"
-                ProcessedData.append(RawData[i])
+    ProcessedData = processStepRecordings(processRawData, targetSignal, RecordingIds, Results, Configuration, parallel=True)
+    for RawData in ProcessedData:
+        RawData["ResultType"] = "TimeDomain"
 
-    recording = createResultDataFile(ProcessedData, str(analysis.device_deidentified_id), "AnalysisOutput", 0)
-    analysis.recording_type.append(recording.recording_type)
-    analysis.recording_list.append(str(recording.recording_id))
+    resultId = saveStepResult(ProcessedData, step, analysis)
 
     return {
         "ResultLabel": step["config"]["output"],
         "Id": step["id"],
-        "ProcessedData": str(recording.recording_id),
+        "ProcessedData": resultId,
         "Type": "TimeDomain"
     }
 
@@ -965,7 +1003,7 @@ def handleExtractTimeFrequencyAnalysis(step, RecordingIds, Results, Configuratio
     frequencyResolution = float(step["config"]["frequencyResolution"])
     dropMissing = step["config"]["dropMissing"]
 
-    def processRawData(RawData):
+    def processRawData(RawData, recordingId):
         RawData["ResultType"] = "RawSpectrogram"
         for i in range(len(RawData["ChannelNames"])):
             if RawData["ChannelNames"][i] in Configuration["Descriptor"][recordingId]["Channels"].keys():
@@ -982,7 +1020,7 @@ def handleExtractTimeFrequencyAnalysis(step, RecordingIds, Results, Configuratio
                 Spectrum = SPU.autoregressiveSpectrogram(RawData["Data"][:,i], window=window, overlap=overlap, frequency_resolution=1/window, fs=RawData["SamplingRate"], order=modelOrder)
             
             RawData["Spectrogram"].append(Spectrum)
-            RawData["Spectrogram"][i]["Missing"] = SPU.calculateMissingLabel(RawData["Missing"][:,i], window=window, overlap=overlap, fs=RawData["SamplingRate"])
+            RawData["Spectrogram"][i]["Missing"] = MissingLabel.calculateMissingLabel(RawData["Missing"][:,i], RawData["Spectrogram"][i]["Time"], window=window, fs=RawData["SamplingRate"])
             RawData["Spectrogram"][i]["Type"] = "Spectrogram"
             RawData["Spectrogram"][i]["Time"] += RawData["StartTime"] + (Configuration["Descriptor"][recordingId]["TimeShift"]/1000)# TODO Check later
 
@@ -997,35 +1035,14 @@ def handleExtractTimeFrequencyAnalysis(step, RecordingIds, Results, Configuratio
         del RawData["Data"], RawData["Time"], RawData["Missing"]
         return RawData
 
-    ProcessedData = []
-    for recordingId in RecordingIds:
-        if Configuration["Descriptor"][recordingId]["Type"] == targetSignal:
-            if models.ExternalRecording.objects.filter(recording_id=recordingId).exists():
-                recording = models.ExternalRecording.objects.filter(recording_id=recordingId).first()
-                RawData = Database.loadSourceDataPointer(recording.recording_datapointer)
-            elif models.NeuralActivityRecording.objects.filter(recording_id=recordingId).exists():
-                recording = models.NeuralActivityRecording.objects.filter(recording_id=recordingId).first()
-                RawData = Database.loadSourceDataPointer(recording.recording_datapointer)
-
-            RawData = processRawData(RawData=RawData)
-            ProcessedData.append(RawData)
-    
-    for result in Results:
-        if result["ResultLabel"] == targetSignal:
-            recording = models.ExternalRecording.objects.filter(recording_id=result["ProcessedData"]).first()
-            RawData = Database.loadSourceDataPointer(recording.recording_datapointer)
-            for i in range(len(RawData)):
-                RawData[i] = processRawData(RawData=RawData[i])
-                ProcessedData.append(RawData[i])
+    ProcessedData = processStepRecordings(processRawData, targetSignal, RecordingIds, Results, Configuration, parallel=True)
 
-    recording = createResultDataFile(ProcessedData, str(analysis.device_deidentified_id), "AnalysisOutput", 0)
-    analysis.recording_type.append(recording.recording_type)
-    analysis.recording_list.append(str(recording.recording_id))
+    resultId = saveStepResult(ProcessedData, step, analysis)
 
     return {
         "ResultLabel": step["config"]["output"],
         "Id": step["id"],
-        "ProcessedData": str(recording.recording_id),
+        "ProcessedData": resultId,
         "Type": "RawSpectrogram"
     }
 
@@ -1054,8 +1071,7 @@ def handleCrossCorrelationAnalysis(step, RecordingIds, Results, Configuration, a
     SecondaryInput = None
     for result in Results:
         if result["ResultLabel"] == targetRecording:
-            recording = models.ExternalRecording.objects.filter(recording_id=result["ProcessedData"]).first()
-            RawData = Database.loadSourceDataPointer(recording.recording_datapointer)
+            RawData = loadStepResult(result["ProcessedData"])
             
             PrimaryInput = {
                 "Type": result["Type"],
@@ -1073,8 +1089,7 @@ def handleCrossCorrelationAnalysis(step, RecordingIds, Results, Configuration, a
                             PrimaryInput["Data"]["Feature"] = np.concatenate((PrimaryInput["Data"]["Feature"], RawData[i]["Spectrogram"][channel]["logPower"]), axis=1)
 
         if result["ResultLabel"] == secondTargetRecording:
-            recording = models.ExternalRecording.objects.filter(recording_id=result["ProcessedData"]).first()
-            RawData = Database.loadSourceDataPointer(recording.recording_datapointer)
+            RawData = loadStepResult(result["ProcessedData"])
             
             SecondaryInput = {
                 "Type": result["Type"],
@@ -1125,14 +1140,12 @@ def handleCrossCorrelationAnalysis(step, RecordingIds, Results, Configuration, a
                 r, p = stats.pearsonr(PrimaryInput["Data"]["Feature"][i,PrimarySelection], SecondaryInput["Data"]["Feature"][j,SecondarySelection])
                 ResultData["Matrix"][i,j] = r
 
-    recording = createResultDataFile(ResultData, str(analysis.device_deidentified_id), "AnalysisOutput", 0)
-    analysis.recording_type.append(recording.recording_type)
-    analysis.recording_list.append(str(recording.recording_id))
+    resultId = saveStepResult(ResultData, step, analysis)
 
     return {
         "ResultLabel": step["config"]["output"],
         "Id": step["id"],
-        "ProcessedData": str(recording.recording_id),
+        "ProcessedData": resultId,
         "Type": "CrossCorrelationMatrix"
     }
 
@@ -1140,7 +1153,7 @@ def handleExtractAnnotationPSDs(step, RecordingIds, Results, Configuration, anal
     print("Start Extract Annotation")
     targetSignal = step["config"]["targetRecording"]
 
-    def processRawData(RawData):
+    def processRawData(RawData, recordingId):
         RawData["ResultType"] = "RawPSDs"
         if not "Spectrogram" in RawData.keys():
             for i in range(len(RawData["ChannelNames"])):
@@ -1181,26 +1194,7 @@ def handleExtractAnnotationPSDs(step, RecordingIds, Results, Configuration, anal
         } for item in annotations]
         return RawData
 
-    ProcessedData = []
-    for recordingId in RecordingIds:
-        if Configuration["Descriptor"][recordingId]["Type"] == targetSignal:
-            if models.ExternalRecording.objects.filter(recording_id=recordingId).exists():
-                recording = models.ExternalRecording.objects.filter(recording_id=recordingId).first()
-                RawData = Database.loadSourceDataPointer(recording.recording_datapointer)
-            elif models.NeuralActivityRecording.objects.filter(recording_id=recordingId).exists():
-                recording = models.NeuralActivityRecording.objects.filter(recording_id=recordingId).first()
-                RawData = Database.loadSourceDataPointer(recording.recording_datapointer)
-
-            RawData = processRawData(RawData=RawData)
-            ProcessedData.append(RawData)
-    
-    for result in Results:
-        if result["ResultLabel"] == targetSignal:
-            recording = models.ExternalRecording.objects.filter(recording_id=result["ProcessedData"]).first()
-            RawData = Database.loadSourceDataPointer(recording.recording_datapointer)
-            for i in range(len(RawData)):
-                RawData[i] = processRawData(RawData=RawData[i])
-                ProcessedData.append(RawData[i])
+    ProcessedData = processStepRecordings(processRawData, targetSignal, RecordingIds, Results, Configuration)
 
     ResultData = {"ResultType": "RawEventPSDs"}
     for i in range(len(ProcessedData)):
@@ -1237,14 +1231,12 @@ def handleExtractAnnotationPSDs(step, RecordingIds, Results, Configuration, anal
                             ResultData[ProcessedData[i]["ChannelNames"][j]][annotation["Name"]]["PSDs"].append(PSDs[:,k])
                     ResultData[ProcessedData[i]["ChannelNames"][j]][annotation["Name"]]["Frequency"] = ProcessedData[i]["Spectrogram"][j]["Frequency"]
 
-    recording = createResultDataFile(ResultData, str(analysis.device_deidentified_id), "AnalysisOutput", 0)
-    analysis.recording_type.append(recording.recording_type)
-    analysis.recording_list.append(str(recording.recording_id))
+    resultId = saveStepResult(ResultData, step, analysis)
 
     return {
         "ResultLabel": step["config"]["output"],
         "Id": step["id"],
-        "ProcessedData": str(recording.recording_id),
+        "ProcessedData": resultId,
         "Type": "RawEventPSDs"
     }
 
@@ -1266,8 +1258,7 @@ def handleNormalizeProcessing(step, RecordingIds, Results, Configuration, analys
     ResultType = "RawPSDs"
     for result in Results:
         if result["ResultLabel"] == targetSignal:
-            recording = models.ExternalRecording.objects.filter(recording_id=result["ProcessedData"]).first()
-            RawData = Database.loadSourceDataPointer(recording.recording_datapointer)
+            RawData = loadStepResult(result["ProcessedData"])
             ResultType = result["Type"]
             if result["Type"] == "RawSpectrogram":
                 for k in range(len(RawData)):
@@ -1332,14 +1323,12 @@ def handleNormalizeProcessing(step, RecordingIds, Results, Configuration, analys
                                 RawData[channelName][event]["PSDs"][i] = np.array(RawData[channelName][event]["PSDs"][i]) - MeanRefPower
                 ProcessedData = RawData
 
-    recording = createResultDataFile(ProcessedData, str(analysis.device_deidentified_id), "AnalysisOutput", 0)
-    analysis.recording_type.append(recording.recording_type)
-    analysis.recording_list.append(str(recording.recording_id))
+    resultId = saveStepResult(ProcessedData, step, analysis)
 
     return {
         "ResultLabel": step["config"]["output"],
         "Id": step["id"],
-        "ProcessedData": str(recording.recording_id),
+        "ProcessedData": resultId,
         "Type": ResultType
     }
 
@@ -1360,8 +1349,7 @@ def handleCalculateSpectralFeatures(step, RecordingIds, Results, Configuration,
     ProcessedData = None
     for result in Results:
         if result["ResultLabel"] == targetSignal:
-            recording = models.ExternalRecording.objects.filter(recording_id=result["ProcessedData"]).first()
-            RawData = Database.loadSourceDataPointer(recording.recording_datapointer)
+            RawData = loadStepResult(result["ProcessedData"])
 
             SpectralFeatures = []
             if result["Type"] == "RawEventPSDs":
@@ -1404,14 +1392,12 @@ def handleCalculateSpectralFeatures(step, RecordingIds, Results, Configuration,
                         SpectralFeatures.append(Features)
             ProcessedData = {"ResultType": "SpectralFeatures", "Features": SpectralFeatures}
 
-    recording = createResultDataFile(ProcessedData, str(analysis.device_deidentified_id), "AnalysisOutput", 0)
-    analysis.recording_type.append(recording.recording_type)
-    analysis.recording_list.append(str(recording.recording_id))
+    resultId = saveStepResult(ProcessedData, step, analysis)
 
     return {
         "ResultLabel": step["config"]["output"],
         "Id": step["id"],
-        "ProcessedData": str(recording.recording_id),
+        "ProcessedData": resultId,
         "Type": "SpectralFeatures"
     }
 
@@ -1423,30 +1409,11 @@ def handleExtractNarrowBandFeature(step, RecordingIds, Results, Configuration, a
     step["config"]["frequencyRangeEnd"] = float(step["config"]["frequencyRangeEnd"])
     step["config"]["averageDuration"] = float(step["config"]["averageDuration"])
     
-    def processRawData(RawData):
+    def processRawData(RawData, recordingId):
         return RawData
 
-    ProcessedData = []
+    ProcessedData = processStepRecordings(processRawData, targetSignal, RecordingIds, Results, Configuration)
     LabeledData = []
-    for recordingId in RecordingIds:
-        if Configuration["Descriptor"][recordingId]["Type"] == targetSignal:
-            if models.ExternalRecording.objects.filter(recording_id=recordingId).exists():
-                recording = models.ExternalRecording.objects.filter(recording_id=recordingId).first()
-                RawData = Database.loadSourceDataPointer(recording.recording_datapointer)
-            elif models.NeuralActivityRecording.objects.filter(recording_id=recordingId).exists():
-                recording = models.NeuralActivityRecording.objects.filter(recording_id=recordingId).first()
-                RawData = Database.loadSourceDataPointer(recording.recording_datapointer)
-
-            RawData = processRawData(RawData=RawData)
-            ProcessedData.append(RawData)
-        
-    for result in Results:
-        if result["ResultLabel"] == targetSignal:
-            recording = models.ExternalRecording.objects.filter(recording_id=result["ProcessedData"]).first()
-            RawData = Database.loadSourceDataPointer(recording.recording_datapointer)
-            for i in range(len(RawData)):
-                RawData[i] = processRawData(RawData=RawData[i])
-                ProcessedData.append(RawData[i])
             
     ResultData = {"ResultType": "NarrowBandFeatures", "Time": [], "Channel": [], "NarrowBandPower": [], "NarrowBandFrequency": []}
     for i in range(len(ProcessedData)):
@@ -1498,14 +1465,12 @@ def handleExtractNarrowBandFeature(step, RecordingIds, Results, Configuration, a
                 ResultData["NarrowBandFrequency"].append(PeakFrequency.tolist())
     
 
-    recording = createResultDataFile(ResultData, str(analysis.device_deidentified_id), "AnalysisOutput", 0)
-    analysis.recording_type.append(recording.recording_type)
-    analysis.recording_list.append(str(recording.recording_id))
+    resultId = saveStepResult(ResultData, step, analysis)
 
     return {
         "ResultLabel": step["config"]["output"],
         "Id": step["id"],
-        "ProcessedData": str(recording.recording_id),
+        "ProcessedData": resultId,
         "Type": "NarrowBandFeatures"
     }
 
@@ -1542,8 +1507,7 @@ def handleViewRecordings(step, RecordingIds, Results, Configuration, analysis):
     ProcessedData = []
     for result in Results:
         if result["ResultLabel"] == targetSignal:
-            recording = models.ExternalRecording.objects.filter(recording_id=result["ProcessedData"]).first()
-            RawData = Database.loadSourceDataPointer(recording.recording_datapointer)
+            RawData = loadStepResult(result["ProcessedData"])
             if result["Type"] == "RawPSDs":
                 for channelName in RawData.keys():
                     if channelName == "ResultType":
@@ -1554,16 +1518,84 @@ def handleViewRecordings(step, RecordingIds, Results, Configuration, analysis):
                 RawData["ResultType"] = "PSDs"
             ProcessedData.append(RawData)
             
-    recording = createResultDataFile(ProcessedData, str(analysis.device_deidentified_id), "AnalysisOutput", 0)
-    analysis.recording_type.append(recording.recording_type)
-    analysis.recording_list.append(str(recording.recording_id))
+    resultId = saveStepResult(ProcessedData, step, analysis)
     return {
         "ResultLabel": step["config"]["output"],
         "Id": step["id"],
-        "ProcessedData": str(recording.recording_id),
+        "ProcessedData": resultId,
         "Type": "VisualizationData"
     }
 
+def getRecordingVersions(RecordingIds):
+    """ Content version of all recordings in analysis, used for step result hashing.
+    """
+
+    RecordingVersions = {}
+    for recordingId in RecordingIds:
+        recording = models.ExternalRecording.objects.filter(recording_id=recordingId).first()
+        if not recording:
+            recording = models.NeuralActivityRecording.objects.filter(recording_id=recordingId).first()
+        if recording:
+            RecordingVersions[recordingId] = [recording.recording_datapointer, Database.getSourceDataPointerVersion(recording.recording_datapointer)]
+    return RecordingVersions
+
+def computeStepHash(step, RecordingIds, Results, Configuration, RecordingVersions):
+    """ Compute hash identifying the result of an analysis step.
+
+    The hash covers the step type and configuration, the hashes of previous step results used as input, 
+    and descriptor and content version of raw recordings used as input. 
+    Steps depending on data outside of the analysis (i.e. annotations) always receive a new hash. 
+
+    Returns:
+      Hexadecimal hash string.
+    """
+
+    if step["type"]["value"] in ANALYSIS_UNCACHEABLE_STEPS:
+        return uuid.uuid4().hex
+    
+    Inputs = [step["config"][key] for key in ["targetRecording", "secondTargetRecording", "labelRecording"] if key in step["config"].keys()]
+    if step["type"]["value"] == "export":
+        Inputs = [Configuration["Descriptor"][recordingId]["Type"] for recordingId in RecordingIds]
+
+    Identifier = {
+        "Version": ANALYSIS_STEP_VERSION,
+        "Type": step["type"]["value"],
+        "Config": step["config"],
+        "Results": [result["Hash"] if "Hash" in result.keys() else uuid.uuid4().hex for result in Results if result["ResultLabel"] in Inputs],
+        "Recordings": [[recordingId, Configuration["Descriptor"][recordingId], RecordingVersions[recordingId] if recordingId in RecordingVersions.keys() else None] 
+                       for recordingId in RecordingIds if Configuration["Descriptor"][recordingId]["Type"] in Inputs],
+    }
+    return hashlib.sha256(json.dumps(Identifier, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+def collectOrphanedResults(analysis, Results, CachedResults):
+    """ Remove result files that are not referenced by current results.
+
+    This includes results of previous runs that were not reused and AnalysisOutput recordings left in analysis without any reference.
+    """
+
+    ReferencedIds = [result["ProcessedData"] for result in Results if "ProcessedData" in result.keys()]
+    OrphanedIds = [result["ProcessedData"] for result in CachedResults if "ProcessedData" in result.keys() and not result["ProcessedData"] in ReferencedIds]
+    for i in range(len(analysis.recording_list)):
+        if analysis.recording_type[i] == "AnalysisOutput" and not analysis.recording_list[i] in ReferencedIds:
+            OrphanedIds.append(analysis.recording_list[i])
+    
+    for recordingId in set(OrphanedIds):
+        removeResultDataFile(recordingId)
+        index = [i for i in range(len(analysis.recording_list)) if analysis.recording_list[i] == recordingId]
+        if len(index) > 0:
+            del(analysis.recording_type[index[0]])
+            del(analysis.recording_list[index[0]])
+
+    # Stored intermediate results
+    ReferencedHashes = [result["Hash"] for result in Results if "Intermediate" in result.keys()]
+    if os.path.exists(getIntermediateStorePath(analysis.deidentified_id)):
+        for filename in os.listdir(getIntermediateStorePath(analysis.deidentified_id)):
+            if not filename.replace(".bpkl","") in ReferencedHashes:
+                try:
+                    os.remove(getIntermediateStorePath(analysis.deidentified_id) + os.path.sep + filename)
+                except Exception as e:
+                    print(e)
+
 def processAnalysis(user, analysisId):
     analysis = models.CombinedRecordingAnalysis.objects.filter(deidentified_id=analysisId).first()
     if not analysis:
@@ -1571,53 +1603,66 @@ def processAnalysis(user, analysisId):
     
     Configuration = loadAnalysisConfiguration(user, str(analysis.device_deidentified_id), analysisId)
     RecordingIds = Configuration["Descriptor"].keys()
+    RecordingVersions = getRecordingVersions(RecordingIds)
 
+    # Results of previous runs are reused if the step hash is unchanged
+    CachedResults = []
     if "Results" in Configuration.keys():
-        for k in range(len(Configuration["Results"])):
-            if "ProcessedData" in Configuration["Results"][k].keys():
-                removeResultDataFile(Configuration["Results"][k]["ProcessedData"])
-                index = [i for i in range(len(analysis.recording_list)) if analysis.recording_list[i] == Configuration["Results"][k]["ProcessedData"]]
-                if len(index) > 0:
-                    del(analysis.recording_type[index[0]])
-                    del(analysis.recording_list[index[0]])
-                analysis.save()
+        CachedResults.extend(Configuration["Results"])
+    if "CachedResults" in Configuration.keys():
+        CachedResults.extend(Configuration["CachedResults"])
+    ReusableResults = {}
+    for result in CachedResults:
+        if "Hash" in result.keys() and ("ProcessedData" in result.keys() or "Intermediate" in result.keys()):
+            ReusableResults[result["Hash"]] = result
+
+    clearIntermediateResults()
+    if ANALYSIS_INTERMEDIATE_MEMORY > 0:
+        IntermediateResults["PersistentSteps"] = getPersistentSteps(Configuration["AnalysisSteps"])
 
     Results = []
     for i in range(len(Configuration["AnalysisSteps"])):
         step = Configuration["AnalysisSteps"][i]
+        StepHash = computeStepHash(step, RecordingIds, Results, Configuration, RecordingVersions)
+        if StepHash in ReusableResults.keys():
+            if "Intermediate" in ReusableResults[StepHash].keys():
+                Result = loadStoredIntermediateResult(analysis, ReusableResults[StepHash])
+                if Result:
+                    print(f"Reuse {step['type']['value']} Intermediate Result")
+                    Results.append(Result)
+                    continue
+            elif models.ExternalRecording.objects.filter(recording_id=ReusableResults[StepHash]["ProcessedData"]).exists():
+                print(f"Reuse {step['type']['value']} Result")
+                Results.append(ReusableResults[StepHash])
+                continue
+
         try:
+            Result = None
             if step["type"]["value"] == "filter":
                 Result = handleFilterProcessing(step, RecordingIds, Results, Configuration, analysis)
-                Results.append(Result)
             elif step["type"]["value"] == "cardiacFilter":
                 Result = handleCardiacFilterProcessing(step, RecordingIds, Results, Configuration, analysis)
-                Results.append(Result)
             elif step["type"]["value"] == "wienerFilter":
                 Result = handleWienerFilterProcessing(step, RecordingIds, Results, Configuration, analysis)
-                Results.append(Result)
             elif step["type"]["value"] == "export":
                 Result = handleExportStructure(step, RecordingIds, Results, Configuration, analysis)
-                Results.append(Result)
             elif step["type"]["value"] == "extractTimeFrequencyAnalysis":
                 Result = handleExtractTimeFrequencyAnalysis(step, RecordingIds, Results, Configuration, analysis)
-                Results.append(Result)
             elif step["type"]["value"] == "crossCorrelationAnalysis":
                 Result = handleCrossCorrelationAnalysis(step, RecordingIds, Results, Configuration, analysis)
-                Results.append(Result)
             elif step["type"]["value"] == "extractAnnotations":
                 Result = handleExtractAnnotationPSDs(step, RecordingIds, Results, Configuration, analysis)
-                Results.append(Result)
             elif step["type"]["value"] == "calculateSpectralFeatures":
                 Result = handleCalculateSpectralFeatures(step, RecordingIds, Results, Configuration, analysis)
-                Results.append(Result)
             elif step["type"]["value"] == "extractNarrowBandFeature":
                 Result = handleExtractNarrowBandFeature(step, RecordingIds, Results, Configuration, analysis)
-                Results.append(Result)
             elif step["type"]["value"] == "normalize":
                 Result = handleNormalizeProcessing(step, RecordingIds, Results, Configuration, analysis)
-                Results.append(Result)
             elif step["type"]["value"] == "view":
                 Result = handleViewRecordings(step, RecordingIds, Results, Configuration, analysis)
+            
+            if Result:
+                Result["Hash"] = StepHash
                 Results.append(Result)
                 
         except Exception as e:
@@ -1628,9 +1673,15 @@ def processAnalysis(user, analysisId):
                 "ErrorMessage": str(e)
             })
 
+    # Intermediate results cannot be queried, they are stored by step hash for reuse in later runs
+    storeIntermediateResults(analysis, Results)
+    clearIntermediateResults()
+
+    collectOrphanedResults(analysis, Results, CachedResults)
     Configuration["Results"] = Results
+    Configuration["CachedResults"] = []
     saveAnalysisConfiguration(Configuration, user, str(analysis.device_deidentified_id), analysis.deidentified_id)
     analysis.analysis_date = datetime.now().astimezone(pytz.utc)
     analysis.save()
 
-    return Results
\ No newline at end of file
+    return Results
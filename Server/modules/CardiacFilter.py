@@ -0,0 +1,237 @@
+""""""
+"""
+=========================================================
+* UF BRAVO Platform
+=========================================================
+
+* Copyright 2023 by Jackson Cagle, Fixel Institute
+* The source code is made available under a Creative Common NonCommercial ShareAlike License (CC BY-NC-SA 4.0) (https://creativecommons.org/licenses/by-nc-sa/4.0/)
+
+ =========================================================
+
+* The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+"""
+"""
+Cardiac Artifact Removal Module
+===================================================
+Shared cardiac filters used by Percept/Summit streaming processing and the Analysis Builder.
+All filters are template-matching filters: cardiac epochs are located in the signal, averaged into a template,
+and the template (scaled by amplitude and offset) is subtracted from each epoch.
+
+@author: Jackson Cagle, University of Florida
+@email: jackson.cagle@neurology.ufl.edu
+"""
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy import signal
+
+ROLLING_KURTOSIS_BLOCK = 4096
+
+def rollingKurtosis(data, window):
+    """ Sliding-window kurtosis
+
+    Equivalent to ``np.mean(stats.zscore(data[j:j+window])**4, axis=0)`` for every window start j in ``range(len(data)-window)``.
+    Moments are computed per window from a strided view of the signal (blocks of ROLLING_KURTOSIS_BLOCK windows at a time), 
+    so that a large transient only affects the windows containing it.
+
+    Args:
+      data: 1D signal array, or 2D array (samples x channels) for per-channel kurtosis.
+      window: window length in samples.
+
+    Returns:
+      Kurtosis array with length ``len(data)-window`` (and same number of channels as data if 2D). 
+      Windows with constant signal are NaN.
+    """
+
+    data = np.asarray(data, dtype=float)
+    count = len(data) - window
+    if count <= 0:
+        return np.zeros((0,) + data.shape[1:])
+
+    kurtosis = np.zeros((count,) + data.shape[1:])
+    for start in range(0, count, ROLLING_KURTOSIS_BLOCK):
+        stop = min(start + ROLLING_KURTOSIS_BLOCK, count)
+        windows = sliding_window_view(data[start:stop+window-1], window, axis=0)
+        squared = windows - np.mean(windows, axis=-1, keepdims=True)
+        squared *= squared
+        variance = np.mean(squared, axis=-1)
+        squared *= squared
+        with np.errstate(divide="ignore", invalid="ignore"):
+            kurtosis[start:stop] = np.mean(squared, axis=-1) / variance**2
+
+        # Kurtosis of a constant window is undefined (NaN, as with zscore)
+        kurtosis[start:stop][np.ptp(windows, axis=-1) == 0] = np.nan
+    return kurtosis
+
+def fitTemplate(epochs, template):
+    """ Batched least-square fit of cardiac template
+
+    Closed-form solution of ``epoch = template * amplitude + offset`` for all epochs at once.
+    This is the same linear model previously fitted per epoch with ``optimize.curve_fit``.
+
+    Args:
+      epochs: 2D array (epochs x samples) of cardiac epochs.
+      template: 1D cardiac template with the same number of samples as each epoch.
+
+    Returns:
+      Tuple (amplitude, offset) of 1D arrays with one value per epoch.
+    """
+
+    epochs = np.atleast_2d(epochs)
+    templateMean = np.mean(template)
+    centeredTemplate = template - templateMean
+    amplitude = (epochs - np.mean(epochs, axis=1, keepdims=True)) @ centeredTemplate / np.sum(centeredTemplate**2)
+    offset = np.mean(epochs, axis=1) - amplitude * templateMean
+    return amplitude, offset
+
+def subtractTemplate(data, starts, template, sequential=False):
+    """ Subtract fitted cardiac template from all epochs.
+
+    Args:
+      data: 1D signal array.
+      starts: sorted array of epoch starting indexes. All epochs must be within the signal.
+      template: 1D cardiac template. Epoch length is the template length.
+      sequential: If True, each epoch is fitted on the signal after subtraction of previous epochs (i.e. in-place filtering).
+        Otherwise all epochs are fitted on the original signal.
+
+    Returns:
+      Filtered copy of the signal.
+    """
+
+    filtered = np.array(data, dtype=float)
+    starts = np.asarray(starts, dtype=int)
+    if len(starts) == 0:
+        return filtered
+
+    length = len(template)
+    index = starts[:,np.newaxis] + np.arange(length)
+    amplitude, offset = fitTemplate(filtered[index], template)
+    residual = filtered[index] - (template * amplitude[:,np.newaxis] + offset[:,np.newaxis])
+
+    if not sequential:
+        # Later epochs overwrite earlier ones in overlapping region
+        for j in range(len(starts)):
+            filtered[index[j]] = residual[j]
+        return filtered
+
+    # Epochs that do not overlap with the previous epoch only depend on the original signal.
+    # Overlapping epochs are refitted in order after the non-overlapping ones are subtracted.
+    overlapped = np.concatenate(([False], starts[1:] < starts[:-1] + length))
+    for j in np.where(~overlapped)[0]:
+        filtered[index[j]] = residual[j]
+    for j in np.where(overlapped)[0]:
+        amplitude, offset = fitTemplate(filtered[index[j]], template)
+        filtered[index[j]] -= template * amplitude[0] + offset[0]
+    return filtered
+
+def alignCardiacEpochs(data, peaks, searchWindow):
+    """ Align cardiac epochs to the maximum of the signal around each detected peak.
+
+    Args:
+      data: 1D signal array.
+      peaks: array of approximate cardiac peak indexes.
+      searchWindow: half-width of the search window (and of the cardiac epoch) in samples.
+
+    Returns:
+      Tuple (selection, starts) where selection is a boolean array indicating which peaks produced a valid epoch
+      and starts is the epoch starting indexes of valid peaks. Epoch length is ``2*searchWindow``.
+    """
+
+    peaks = np.asarray(peaks, dtype=int)
+    selection = np.bitwise_and(peaks - searchWindow >= 0, peaks + searchWindow < len(data))
+    starts = np.zeros(len(peaks), dtype=int)
+    if np.any(selection):
+        index = peaks[selection,np.newaxis] + np.arange(-searchWindow, searchWindow)
+        starts[selection] = peaks[selection] - 2*searchWindow + np.argmax(data[index], axis=1)
+    selection = np.bitwise_and(selection, np.bitwise_and(starts >= 0, starts + 2*searchWindow < len(data)))
+    return selection, starts[selection]
+
+def kurtosisTemplateFilter(data, samplingRate, window=None, searchWindow=100, threshold=1.2):
+    """ Kurtosis-peak Detection Template Matching cardiac filter
+
+    Cardiac peaks are detected as peaks of the band-passed (0.5-2Hz) sliding-window kurtosis.
+    Epochs around peaks with kurtosis above threshold are averaged to form the template
+    which is then fitted and subtracted at every detected peak.
+
+    Args:
+      data: 1D signal array, or 2D array (samples x channels). For 2D array, kurtosis is averaged across channels
+        for peak detection while templates are computed per channel.
+      samplingRate: sampling rate of the signal in Hz.
+      window: kurtosis window length in samples. Default to half a second.
+      searchWindow: half-width of each cardiac epoch in samples.
+      threshold: minimum kurtosis for an epoch to be included in the template.
+
+    Returns:
+      Filtered copy of the signal.
+    """
+
+    if window == None:
+        window = int(samplingRate/2)
+
+    data = np.asarray(data, dtype=float)
+    ExpectedKurtosis = rollingKurtosis(data, window)
+    if data.ndim == 2:
+        ExpectedKurtosis = np.mean(ExpectedKurtosis, axis=1)
+
+    [b,a] = signal.butter(3, np.array([0.5, 2])*2/samplingRate, "bandpass")
+    ExpectedKurtosis = signal.filtfilt(b,a,ExpectedKurtosis)
+    Peaks, _ = signal.find_peaks(ExpectedKurtosis, distance=window)
+    TemplateSelection = ExpectedKurtosis[Peaks] >= threshold
+    Peaks += int(window/2)
+
+    CardiacFiltered = np.array(data)
+    for i in range(1 if data.ndim == 1 else data.shape[1]):
+        Channel = data if data.ndim == 1 else data[:,i]
+        selection, starts = alignCardiacEpochs(Channel, Peaks, searchWindow)
+        TemplateStarts = starts[TemplateSelection[selection]]
+        if len(TemplateStarts) == 0:
+            continue
+
+        EKGTemplate = np.mean(Channel[TemplateStarts[:,np.newaxis] + np.arange(2*searchWindow)], axis=0)
+        EKGTemplate = EKGTemplate / (np.max(EKGTemplate)-np.min(EKGTemplate))
+        if data.ndim == 1:
+            CardiacFiltered = subtractTemplate(Channel, starts, EKGTemplate)
+        else:
+            CardiacFiltered[:,i] = subtractTemplate(Channel, starts, EKGTemplate)
+
+    return CardiacFiltered
+
+def fixedPeakTemplateFilter(data, samplingRate):
+    """ Fixed Peak Find cardiac filter
+
+    Cardiac peaks are detected directly from the signal (positive or negative peaks, whichever is more regular).
+    Epochs from 25% of the cardiac period before each peak to 65% after are averaged into the template
+    which is then fitted and subtracted from each epoch sequentially.
+
+    Args:
+      data: 1D signal array.
+      samplingRate: sampling rate of the signal in Hz.
+
+    Returns:
+      Filtered copy of the signal.
+    """
+
+    data = np.asarray(data, dtype=float)
+    posPeaks,_ = signal.find_peaks(data, prominence=[10,200], distance=samplingRate*0.5)
+    PosCardiacVariability = np.std(np.diff(posPeaks))
+    negPeaks,_ = signal.find_peaks(-data, prominence=[10,200], distance=samplingRate*0.5)
+    NegCardiacVariability = np.std(np.diff(negPeaks))
+
+    if PosCardiacVariability < NegCardiacVariability:
+        peaks = posPeaks
+    else:
+        peaks = negPeaks
+    CardiacRate = int(np.mean(np.diff(peaks)))
+
+    PrePeak = int(CardiacRate*0.25)
+    PostPeak = int(CardiacRate*0.65)
+
+    # Template is averaged over all but the first and last peaks, with out-of-bound epochs counted as zeros.
+    TemplatePeaks = peaks[1:-1]
+    TemplatePeaks = TemplatePeaks[np.bitwise_and(TemplatePeaks+PostPeak < len(data), TemplatePeaks-PrePeak > 0)]
+    EKGTemplate = np.sum(data[TemplatePeaks[:,np.newaxis] + np.arange(-PrePeak, PostPeak)], axis=0) / (len(peaks)-2)
+    EKGTemplate = EKGTemplate / (np.max(EKGTemplate)-np.min(EKGTemplate))
+
+    peaks = peaks[np.bitwise_and(peaks-PrePeak >= 0, peaks+PostPeak < len(data))]
+    return subtractTemplate(data, peaks-PrePeak, EKGTemplate, sequential=True)
@@ -0,0 +1,206 @@
+""""""
+"""
+=========================================================
+* UF BRAVO Platform
+=========================================================
+
+* Copyright 2023 by Jackson Cagle, Fixel Institute
+* The source code is made available under a Creative Common NonCommercial ShareAlike License (CC BY-NC-SA 4.0) (https://creativecommons.org/licenses/by-nc-sa/4.0/)
+
+ =========================================================
+
+* The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+"""
+"""
+Chronic Power Aggregation Module
+===================================================
+Circadian and event-locked aggregation of chronic power trends shared by Percept (``ChronicBrainSense``)
+and Summit RC+S (``ChronicLogs``) processing pipelines.
+
+Samples are sorted once and all windows are located with binary search. Circadian bin statistics (count, mean, standard error,
+outlier rejection) are grouped reductions over all bins at once, and event-locked power is interpolated for all events in a single call.
+Processed results are kept in a process-wide cache keyed by the data version (content digest of the therapy inputs),
+the timezone offset and the processing options.
+
+@author: Jackson Cagle, University of Florida
+@email: jackson.cagle@neurology.ufl.edu
+"""
+
+import os
+import copy
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+AGGREGATION_VERSION = 1
+
+CIRCADIAN_BIN_INTERVAL = 300
+CIRCADIAN_HALF_WINDOW = 20*60
+EVENT_LOCKED_TIME_ARRAY = np.arange(37)*600 - 180*60
+
+AGGREGATION_CACHE_SIZE = int(os.environ.get('CHRONIC_AGGREGATION_CACHE_SIZE', 256))
+AggregationCache = OrderedDict()
+AggregationCacheLock = threading.Lock()
+
+def getWindowMembership(t, centers, halfWindow):
+    """ Expand windows of sorted timestamps into (window, sample) index pairs.
+
+    Args:
+      t: sorted 1D timestamp array.
+      centers: 1D array of window centers.
+      halfWindow: half window length. Windows include both edges.
+
+    Returns:
+      Tuple (windowIndex, sampleIndex) of 1D arrays, grouped by window in ascending order.
+    """
+
+    startIndex = np.searchsorted(t, centers - halfWindow, side="left")
+    endIndex = np.searchsorted(t, centers + halfWindow, side="right")
+    count = endIndex - startIndex
+    windowIndex = np.repeat(np.arange(len(centers)), count)
+    sampleIndex = np.arange(np.sum(count)) - np.repeat(np.cumsum(count) - count - startIndex, count)
+    return windowIndex, sampleIndex
+
+def circadianAggregation(Power, Timestamp, rejectOutliers=False):
+    """ Median and 2x standard error of power around each 5-minute bin of the day.
+
+    Each bin includes all samples within +/- 20 minutes of the bin time (without wrapping around midnight).
+
+    Args:
+      Power: 1D power array.
+      Timestamp: 1D time of day array (seconds from midnight), same length as Power.
+      rejectOutliers: iteratively remove samples with absolute z-score of 3 or above within each bin before reduction.
+
+    Returns:
+      Tuple (AverageTimestamp, AveragePower, StdErrPower) of 1D arrays. Bins without samples are set to 0.
+    """
+
+    AverageTimestamp = np.arange(24*3600 // CIRCADIAN_BIN_INTERVAL) * CIRCADIAN_BIN_INTERVAL
+    order = np.argsort(Timestamp, kind="stable")
+    t = np.asarray(Timestamp, dtype=float)[order]
+    x = np.asarray(Power, dtype=float)[order]
+
+    binIndex, sampleIndex = getWindowMembership(t, AverageTimestamp, CIRCADIAN_HALF_WINDOW)
+    values = x[sampleIndex]
+    numBins = len(AverageTimestamp)
+    windowSize = np.bincount(binIndex, minlength=numBins)
+    windowStart = np.cumsum(windowSize) - windowSize
+
+    keep = np.ones(len(values), dtype=bool)
+    while True:
+        count = np.bincount(binIndex, weights=keep, minlength=numBins)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mean = np.bincount(binIndex, weights=values*keep, minlength=numBins) / count
+            std = np.sqrt(np.bincount(binIndex, weights=np.where(keep, values - mean[binIndex], 0)**2, minlength=numBins) / count)
+        if not rejectOutliers:
+            break
+
+        # Same rule as scipy.stats.zscore (ddof=0): constant bins produce NaN z-scores and are removed entirely.
+        with np.errstate(invalid="ignore"):
+            newKeep = keep & (np.abs(values - mean[binIndex]) < 3*std[binIndex])
+        if np.array_equal(newKeep, keep):
+            break
+        keep = newKeep
+
+    AveragePower = np.zeros(numBins)
+    StdErrPower = np.zeros(numBins)
+    valid = count > 0
+    StdErrPower[valid] = std[valid] / np.sqrt(count[valid]) * 2
+
+    # Windows are contiguous in the membership arrays, so each median only partitions the samples of its own window.
+    for i in np.where(valid)[0]:
+        window = values[windowStart[i]:windowStart[i]+windowSize[i]]
+        if rejectOutliers:
+            window = window[keep[windowStart[i]:windowStart[i]+windowSize[i]]]
+        AveragePower[i] = np.median(window)
+    return AverageTimestamp, AveragePower, StdErrPower
+
+def eventLockedAggregation(Power, Timestamp, EventTime, minimumCount):
+    """ Power trend 3 hours before and after each event, sampled every 10 minutes.
+
+    Events with fewer than ``minimumCount`` samples within the window are excluded. Power is linearly interpolated
+    from samples within the window only, times outside the first/last sample of the window take the edge value.
+
+    Args:
+      Power: 1D power array.
+      Timestamp: 1D timestamp array (seconds), same length as Power. Does not need to be sorted.
+      EventTime: 1D array of event timestamps (seconds).
+      minimumCount: minimum number of samples within the window for an event to be included.
+
+    Returns:
+      Tuple (EventLockedPower, EventToInclude). EventLockedPower is a (included events x 37) array
+      and EventToInclude an index array of included events.
+    """
+
+    order = np.argsort(Timestamp, kind="stable")
+    t = np.asarray(Timestamp, dtype=float)[order]
+    x = np.asarray(Power, dtype=float)[order]
+    EventTime = np.asarray(EventTime, dtype=float)
+
+    startIndex = np.searchsorted(t, EventTime + EVENT_LOCKED_TIME_ARRAY[0], side="left")
+    endIndex = np.searchsorted(t, EventTime + EVENT_LOCKED_TIME_ARRAY[-1], side="right")
+    EventToInclude = np.where(endIndex - startIndex >= minimumCount)[0]
+    if len(EventToInclude) == 0 or len(t) == 0:
+        return np.zeros((0, len(EVENT_LOCKED_TIME_ARRAY))), np.zeros(0, dtype=int)
+
+    QueryTime = EventTime[EventToInclude].reshape(-1,1) + EVENT_LOCKED_TIME_ARRAY.reshape(1,-1)
+    QueryTime = np.clip(QueryTime, t[startIndex[EventToInclude]].reshape(-1,1), t[endIndex[EventToInclude]-1].reshape(-1,1))
+    return np.interp(QueryTime, t, x), EventToInclude
+
+def getDataVersion(*data):
+    """ Content digest of processing inputs, used as data version of cached aggregation results.
+
+    Args:
+      data: arrays or lists (numeric or string) of processing inputs.
+
+    Returns:
+      Hexadecimal digest string.
+    """
+
+    digest = hashlib.sha1()
+    for item in data:
+        item = np.asarray(item)
+        if item.dtype.kind in "OUS":
+            item = np.asarray([str(value) for value in item.flat], dtype=str)
+        digest.update(item.dtype.str.encode("utf-8") + str(item.shape).encode("utf-8"))
+        digest.update(np.ascontiguousarray(item).tobytes())
+    return digest.hexdigest()
+
+def getCachedAggregation(key):
+    """ Retrieve processed per-therapy result from the aggregation cache.
+
+    Args:
+      key: tuple of data version and processing options.
+
+    Returns:
+      Copy of cached result. None if not cached.
+    """
+
+    with AggregationCacheLock:
+        if not key in AggregationCache.keys():
+            return None
+        AggregationCache.move_to_end(key)
+        result = AggregationCache[key]
+    return copy.deepcopy(result)
+
+def setCachedAggregation(key, result):
+    """ Store processed per-therapy result in the aggregation cache.
+
+    Least recently used results are evicted beyond ``CHRONIC_AGGREGATION_CACHE_SIZE`` entries.
+
+    Args:
+      key: tuple of data version and processing options.
+      result: processed result.
+    """
+
+    if AGGREGATION_CACHE_SIZE <= 0:
+        return
+
+    result = copy.deepcopy(result)
+    with AggregationCacheLock:
+        AggregationCache[key] = result
+        AggregationCache.move_to_end(key)
+        while len(AggregationCache) > AGGREGATION_CACHE_SIZE:
+            AggregationCache.popitem(last=False)
@@ -0,0 +1,179 @@
+""""""
+"""
+=========================================================
+* UF BRAVO Platform
+=========================================================
+
+* Copyright 2023 by Jackson Cagle, Fixel Institute
+* The source code is made available under a Creative Common NonCommercial ShareAlike License (CC BY-NC-SA 4.0) (https://creativecommons.org/licenses/by-nc-sa/4.0/)
+
+ =========================================================
+
+* The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+"""
+"""
+Batch Curve Fitting Module
+===================================================
+Fit many stimulation amplitude to brain power curves at once with the exponential decay model
+``y = a * (1/b)^x + c`` used by therapeutic prediction.
+
+The decay rate is fitted as ``k = log(b)`` so that ``b`` stays positive. For a fixed ``k`` the model is linear in ``a`` and ``c``,
+so the initial guess is the best linear least-squares fit over a grid of decay rates. All curves are then refined together
+with a vectorized Levenberg-Marquardt iteration, each curve keeping its own damping factor and convergence state.
+
+@author: Jackson Cagle, University of Florida
+@email: jackson.cagle@neurology.ufl.edu
+"""
+
+import numpy as np
+
+DECAY_RATE_GRID = np.linspace(-10, 10, 81)
+
+def padCurves(xdata, ydata):
+    """ Stack curves of different lengths into padded arrays.
+
+    Args:
+      xdata: list of 1D amplitude arrays.
+      ydata: list of 1D power arrays, same lengths as xdata.
+
+    Returns:
+      Tuple (X, Y, W) of (curves x points) arrays. W is 1 for valid points and 0 for padding.
+    """
+
+    length = max([len(x) for x in xdata]) if len(xdata) > 0 else 0
+    X = np.zeros((len(xdata), length))
+    Y = np.zeros((len(xdata), length))
+    W = np.zeros((len(xdata), length))
+    for i in range(len(xdata)):
+        X[i,:len(xdata[i])] = xdata[i]
+        Y[i,:len(ydata[i])] = ydata[i]
+        W[i,:len(xdata[i])] = 1
+    return X, Y, W
+
+def linearizedDecayGuess(X, Y, W):
+    """ Initial guess of decay parameters from linear least-squares over a grid of decay rates.
+
+    Args:
+      X: (curves x points) amplitude array, shifted so that each curve starts at 0.
+      Y: (curves x points) normalized power array.
+      W: (curves x points) point weights.
+
+    Returns:
+      (curves x 3) array of (a, k, c).
+    """
+
+    span = np.maximum(np.max(np.where(W > 0, X, 0), axis=1), 1e-6)
+    k = DECAY_RATE_GRID.reshape(1,-1) / span.reshape(-1,1)
+    E = np.exp(-k[:,:,None] * X[:,None,:])
+    w = W[:,None,:]
+    n = np.sum(W, axis=1).reshape(-1,1)
+
+    meanE = np.sum(w*E, axis=2) / n
+    meanY = (np.sum(W*Y, axis=1) / n[:,0]).reshape(-1,1)
+    covariance = np.sum(w * (E - meanE[:,:,None]) * (Y[:,None,:] - meanY[:,:,None]), axis=2)
+    variance = np.sum(w * (E - meanE[:,:,None])**2, axis=2)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        a = np.where(variance > 0, covariance / variance, 0)
+    c = meanY - a * meanE
+    error = np.sum(w * (Y[:,None,:] - a[:,:,None]*E - c[:,:,None])**2, axis=2)
+
+    best = np.argmin(error, axis=1)
+    rows = np.arange(len(best))
+    return np.stack((a[rows,best], k[rows,best], c[rows,best]), axis=1)
+
+def decayJacobian(X, W, params):
+    """ Model values and Jacobian with respect to (a, k, c) for all curves.
+    """
+
+    with np.errstate(over="ignore", invalid="ignore"):
+        E = np.exp(-params[:,1:2] * X)
+        model = params[:,0:1] * E + params[:,2:3]
+        J = np.stack((E, -params[:,0:1] * X * E, np.ones(X.shape)), axis=2) * W[:,:,None]
+    return model, J
+
+def fitPowerDecayBatch(xdata, ydata, maxIterations=200, tolerance=1e-10):
+    """ Fit ``y = a * (1/b)^x + c`` to many curves at once.
+
+    Args:
+      xdata: list of 1D amplitude arrays (one per curve).
+      ydata: list of 1D power arrays (one per curve), same lengths as xdata.
+      maxIterations: maximum number of Levenberg-Marquardt iterations.
+      tolerance: relative decrease of residual sum of squares below which a curve is considered converged.
+
+    Returns:
+      Dictionary with (curves x 3) "Parameters" array of (a, b, c) and per-curve convergence diagnostics:
+      "Converged" (boolean), "Iterations", "ResidualSumSquares" and "RSquared". Curves that reach maxIterations keep 
+      their best parameters so far and are reported as not converged.
+    """
+
+    X, Y, W = padCurves(xdata, ydata)
+    numCurves = X.shape[0]
+    if numCurves == 0:
+        return {"Parameters": np.zeros((0,3)), "Converged": np.zeros(0, dtype=bool), "Iterations": np.zeros(0, dtype=int),
+                "ResidualSumSquares": np.zeros(0), "RSquared": np.zeros(0)}
+
+    # Shift amplitudes to start at 0 and normalize power for numerical stability, parameters are converted back at the end.
+    n = np.sum(W, axis=1)
+    offset = np.min(np.where(W > 0, X, np.inf), axis=1)
+    X = (X - offset.reshape(-1,1)) * W
+    meanY = np.sum(W*Y, axis=1) / n
+    scaleY = np.sqrt(np.sum(W * (Y - meanY.reshape(-1,1))**2, axis=1) / n)
+    scaleY[~(scaleY > 0)] = 1
+    Y = (Y - meanY.reshape(-1,1)) / scaleY.reshape(-1,1) * W
+
+    params = linearizedDecayGuess(X, Y, W)
+    model, J = decayJacobian(X, W, params)
+    residualSum = np.sum(W * (Y - model)**2, axis=1)
+    damping = np.full(numCurves, 1e-3)
+    active = np.ones(numCurves, dtype=bool)
+    converged = np.zeros(numCurves, dtype=bool)
+    iterations = np.zeros(numCurves, dtype=int)
+
+    for iteration in range(maxIterations):
+        if not np.any(active):
+            break
+
+        index = np.where(active)[0]
+        residual = (Y[index] - model[index]) * W[index]
+        JTJ = np.einsum("nmi,nmj->nij", J[index], J[index])
+        JTr = np.einsum("nmi,nm->ni", J[index], residual)
+        diagonal = np.diagonal(JTJ, axis1=1, axis2=2)
+        A = JTJ + (damping[index].reshape(-1,1) * diagonal + 1e-12)[:,:,None] * np.eye(3).reshape(1,3,3)
+        step = np.linalg.solve(A, JTr[:,:,None])[:,:,0]
+
+        candidate = params[index] + step
+        candidateModel, candidateJ = decayJacobian(X[index], W[index], candidate)
+        with np.errstate(over="ignore", invalid="ignore"):
+            candidateSum = np.sum(W[index] * (Y[index] - candidateModel)**2, axis=1)
+        iterations[index] += 1
+
+        improved = np.isfinite(candidateSum) & (candidateSum <= residualSum[index])
+        accepted = index[improved]
+        relativeChange = (residualSum[accepted] - candidateSum[improved]) / np.maximum(residualSum[accepted], 1e-300)
+
+        params[accepted] = candidate[improved]
+        model[accepted] = candidateModel[improved]
+        J[accepted] = candidateJ[improved]
+        residualSum[accepted] = candidateSum[improved]
+        damping[accepted] = np.maximum(damping[accepted] / 10, 1e-12)
+        damping[index[~improved]] *= 10
+
+        finished = accepted[(relativeChange < tolerance) | (residualSum[accepted] < 1e-24)]
+        converged[finished] = True
+        active[finished] = False
+
+        # Even a vanishing gradient step does not improve the fit, the curve is at a stationary point.
+        stalled = index[~improved][damping[index[~improved]] > 1e12]
+        active[stalled] = False
+        converged[stalled] = True
+
+    # Curves approaching a step function (decay rate diverging) leave the finite parameter range and are reported as not converged.
+    with np.errstate(over="ignore", invalid="ignore"):
+        RSquared = 1 - residualSum / n
+        b = np.exp(params[:,1])
+        a = params[:,0] * scaleY * np.power(b, offset)
+    c = params[:,2] * scaleY + meanY
+    Parameters = np.stack((a, b, c), axis=1)
+    converged &= np.all(np.isfinite(Parameters), axis=1)
+    return {"Parameters": Parameters, "Converged": converged, "Iterations": iterations,
+            "ResidualSumSquares": residualSum * scaleY * scaleY, "RSquared": RSquared}
@@ -18,7 +18,7 @@ Common Database Processing Module
 @email: jackson.cagle@neurology.ufl.edu
 """
 
-import os, sys, pathlib
+import os, sys, pathlib, shutil
 RESOURCES = str(pathlib.Path(__file__).parent.parent.resolve())
 
 from datetime import datetime, date, timedelta
@@ -30,6 +30,12 @@ from cryptography.fernet import Fernet
 import scipy.io as sio
 import json
 import blosc
+import copy
+import hashlib
+import threading
+import socket, time
+from collections import OrderedDict
+import uuid
 
 from Backend import models
 from decoder import Percept
@@ -254,11 +260,27 @@ def AuthorizeRecordingAccess(user, researcher_id, patient_id, recording_id="", r
             if models.ResearchAuthorizedAccess.objects.filter(researcher_id=researcher_id, authorized_patient_id=patient_id, authorized_recording_id=recording_id).exists():
                 models.ResearchAuthorizedAccess.objects.filter(researcher_id=researcher_id, authorized_patient_id=patient_id, authorized_recording_id=recording_id).all().delete()
 
-def extractPatientTableRow(user, patient, deidentifiedId=None):
+def extractPatientTableRow(user, patient, deidentifiedId=None, Devices=None):
+    """ Patient table row (name, diagnosis, devices with days since implant and last seen date).
+
+    Args:
+      user: BRAVO Platform User object. 
+      patient: Patient object.
+      deidentifiedId: Deidentified Patient object shown instead of the patient identity (research access).
+      Devices: dictionary of PerceptDevice objects keyed by device ID (see ``getDevicesByID``) that includes the patient's devices. 
+        Devices are queried for this patient only if not provided.
+
+    Returns:
+      Dictionary of patient table row.
+    """
+
     key = os.environ.get('ENCRYPTION_KEY')
 
+    if Devices == None:
+        Devices = getDevicesByID(list(patient.device_deidentified_id) + (list(deidentifiedId.device_deidentified_id) if deidentifiedId else []))
+
     if deidentifiedId:
-        info = extractPatientTableRow(user, deidentifiedId)
+        info = extractPatientTableRow(user, deidentifiedId, Devices=Devices)
     else:
         info = dict()
         info["FirstName"] = patient.getPatientFirstName(key)
@@ -273,12 +295,11 @@ def extractPatientTableRow(user, patient, deidentifiedId=None):
         info["LastChange"] = patient.last_change.timestamp()
 
     lastTimestamp = datetime.fromtimestamp(0, tz=pytz.utc)
-    deviceIDs = patient.device_deidentified_id
+    deviceIDs = list(patient.device_deidentified_id)
     for id in deviceIDs:
-        device = models.PerceptDevice.objects.filter(deidentified_id=id).first()
+        device = Devices.get(str(id))
         if device == None:
-            patient.device_deidentified_id.remove(id)
-            patient.save()
+            patient.removeDevice(id)
             continue
 
         if not (user.is_admin or user.is_clinician):
@@ -333,9 +354,9 @@ def extractPatientInfo(user, patientUniqueID, deidentifiedId=None):
     if info["Gender"] == "":
         fileSize = 0
         sessionPath = ""
+        DeviceSessions = getDeviceSessions([device.deidentified_id for device in availableDevices])
         for device in availableDevices:
-            availableSessions = models.PerceptSession.objects.filter(device_deidentified_id=device.deidentified_id).all()
-            for session in availableSessions:
+            for session in DeviceSessions[str(device.deidentified_id)]:
                 if os.path.exists(DATABASE_PATH + session.session_file_path):
                     if os.path.getsize(DATABASE_PATH + session.session_file_path) < fileSize or fileSize == 0:
                         fileSize = os.path.getsize(DATABASE_PATH + session.session_file_path)
@@ -396,6 +417,137 @@ def getPerceptDevices(user, patientUniqueID, authority):
 
     return availableDevices
 
+def getPatientDeviceIDs(patientIDs):
+    """ Device IDs of multiple patients from the patient-device relation with a single query.
+
+    Args:
+      patientIDs: list of deidentified patient IDs.
+
+    Returns:
+      Dictionary of device ID (string) lists, in the order devices were added, keyed by patient ID (string).
+    """
+
+    PatientDevices = {str(patientID): list() for patientID in patientIDs}
+    for patientID, deviceID in models.PatientDevice.objects.filter(patient_deidentified_id__in=patientIDs).values_list("patient_deidentified_id", "device_deidentified_id"):
+        PatientDevices[str(patientID)].append(str(deviceID))
+
+    # Patients created outside of Patient.addDevice (i.e. bulk imports) may not have relation rows yet, use the device list stored on the patient instead.
+    MissingPatients = [patientID for patientID in PatientDevices.keys() if len(PatientDevices[patientID]) == 0]
+    if len(MissingPatients) > 0:
+        for patientID, deviceIDs in models.Patient.objects.filter(deidentified_id__in=MissingPatients).values_list("deidentified_id", "device_deidentified_id"):
+            if deviceIDs:
+                PatientDevices[str(patientID)] = [str(deviceID) for deviceID in deviceIDs]
+    return PatientDevices
+
+def syncPatientDevices(patients):
+    """ Create missing patient-device relation rows from the device list stored on each patient.
+
+    Required after bulk operations that bypass Patient.addDevice (i.e. ``bulk_create``).
+
+    Args:
+      patients: list of Patient objects.
+
+    Returns:
+      Number of relation rows created.
+    """
+
+    ExistingRelations = set(models.PatientDevice.objects.filter(patient_deidentified_id__in=[patient.deidentified_id for patient in patients]).values_list("patient_deidentified_id", "device_deidentified_id"))
+    NewRelations = dict()
+    for patient in patients:
+        for deviceID in patient.device_deidentified_id:
+            try:
+                deviceID = uuid.UUID(str(deviceID))
+            except ValueError:
+                continue
+            if not (patient.deidentified_id, deviceID) in ExistingRelations:
+                NewRelations[(patient.deidentified_id, deviceID)] = models.PatientDevice(patient_deidentified_id=patient.deidentified_id, device_deidentified_id=deviceID)
+    models.PatientDevice.objects.bulk_create(list(NewRelations.values()), batch_size=1000)
+    return len(NewRelations)
+
+PROCESSING_LOCK_LEASE = float(os.environ.get('PROCESSING_LOCK_LEASE', os.environ.get('PROCESSING_QUEUE_LEASE', 300)))
+PROCESSING_LOCK_POLL_INTERVAL = float(os.environ.get('PROCESSING_LOCK_POLL_INTERVAL', 0.5))
+
+def getProcessingLockHolder():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def acquireProcessingLock(lockKey):
+    """ Acquire a named lock shared by all processing workers, wait until the lock is available.
+
+    The lock row is created with ``get_or_create`` on the unique ``lock_key``, so only one worker can hold the lock. 
+    Locks of a crashed worker are taken over once their lease expires, leases of a running worker are renewed by 
+    renewProcessingLocks function.
+
+    Args:
+      lockKey: name of the lock (i.e. device identity of a session file).
+    """
+
+    lockKey = hashlib.sha256(lockKey.encode("utf-8")).hexdigest()
+    holder = getProcessingLockHolder()
+    while True:
+        LeaseExpiry = datetime.now(tz=pytz.utc) + timedelta(seconds=PROCESSING_LOCK_LEASE)
+        lock, created = models.ProcessingLock.objects.get_or_create(lock_key=lockKey, defaults={"holder": holder, "lease_expiry": LeaseExpiry})
+        if created or lock.holder == holder:
+            return
+
+        if lock.lease_expiry < datetime.now(tz=pytz.utc):
+            if models.ProcessingLock.objects.filter(id=lock.id, holder=lock.holder, lease_expiry=lock.lease_expiry).update(holder=holder, lease_expiry=LeaseExpiry) > 0:
+                return
+        time.sleep(PROCESSING_LOCK_POLL_INTERVAL)
+
+def releaseProcessingLock(lockKey):
+    lockKey = hashlib.sha256(lockKey.encode("utf-8")).hexdigest()
+    models.ProcessingLock.objects.filter(lock_key=lockKey, holder=getProcessingLockHolder()).delete()
+
+def renewProcessingLocks():
+    """ Renew leases of all processing locks held by this process.
+    """
+
+    models.ProcessingLock.objects.filter(holder=getProcessingLockHolder()).update(lease_expiry=datetime.now(tz=pytz.utc) + timedelta(seconds=PROCESSING_LOCK_LEASE))
+
+def getDevicesByID(deviceIDs):
+    """ Resolve multiple device IDs with a single query.
+
+    Args:
+      deviceIDs: list of deidentified device IDs.
+
+    Returns:
+      Dictionary of PerceptDevice objects keyed by device ID (string). Devices that do not exist are omitted.
+    """
+
+    if len(deviceIDs) == 0:
+        return dict()
+    return {str(device.deidentified_id): device for device in models.PerceptDevice.objects.filter(deidentified_id__in=deviceIDs).all()}
+
+def getPatientDevicesByID(patientIDs):
+    """ Devices of multiple patients with two queries regardless of the number of patients and devices.
+
+    Args:
+      patientIDs: list of deidentified patient IDs.
+
+    Returns:
+      Dictionary of PerceptDevice object lists keyed by patient ID (string).
+    """
+
+    PatientDeviceIDs = getPatientDeviceIDs(patientIDs)
+    Devices = getDevicesByID([deviceID for deviceIDs in PatientDeviceIDs.values() for deviceID in deviceIDs])
+    return {patientID: [Devices[deviceID] for deviceID in PatientDeviceIDs[patientID] if deviceID in Devices.keys()] for patientID in PatientDeviceIDs.keys()}
+
+def getDeviceSessions(deviceIDs):
+    """ Session files of multiple devices with a single query.
+
+    Args:
+      deviceIDs: list of deidentified device IDs.
+
+    Returns:
+      Dictionary of PerceptSession object lists keyed by device ID (string).
+    """
+
+    DeviceSessions = {str(deviceID): list() for deviceID in deviceIDs}
+    if len(deviceIDs) > 0:
+        for session in models.PerceptSession.objects.filter(device_deidentified_id__in=deviceIDs).all():
+            DeviceSessions[str(session.device_deidentified_id)].append(session)
+    return DeviceSessions
+
 def extractAccess(user, patient_id):
     if not (user.is_clinician or user.is_admin):
         if models.DeidentifiedPatientID.objects.filter(researcher_id=user.unique_user_id, deidentified_id=patient_id):
@@ -424,6 +576,25 @@ def verifyAccess(user, patient_id):
         else:
             return 0
 
+def getAuthorizedTimeRange(authority):
+    """ Time range of time-limited research access, as used to restrict partitioned reads.
+
+    An end of 0 is unbounded (default [0,0] authorization grants the entire history), same as BrainSenseEvent.
+
+    Args:
+      authority: User permission structure with "Level" and "Permission" (see verifyPermission function).
+
+    Returns:
+      [start, end] Unix timestamps, or None if the access is not limited in time.
+    """
+
+    if not authority["Level"] == 2 or not type(authority["Permission"]) == list:
+        return None
+    
+    if authority["Permission"][0] <= 0 and authority["Permission"][1] <= 0:
+        return None
+    return [authority["Permission"][0], authority["Permission"][1] if authority["Permission"][1] > 0 else np.inf]
+
 def verifyPermission(user, patient_id, authority, access_type):
     if authority["Level"] == 1:
         return [0, 0]
@@ -469,15 +640,22 @@ def verifyPermission(user, patient_id, authority, access_type):
 
 def extractPatientList(user):
     PatientInfo = list()
-    patients = models.Patient.objects.filter(institute=user.institute).all()
+    patients = list(models.Patient.objects.filter(institute=user.institute).all())
+
+    DeidentifiedPatientID = list(models.DeidentifiedPatientID.objects.filter(researcher_id=user.unique_user_id).all())
+    DeidentifiedPatients = {str(patient.deidentified_id): patient for patient in models.Patient.objects.filter(deidentified_id__in=[deidentified_patient.deidentified_id for deidentified_patient in DeidentifiedPatientID], institute=user.unique_user_id).all()}
+    AuthorizedPatients = {str(patient.deidentified_id): patient for patient in models.Patient.objects.filter(deidentified_id__in=[deidentified_patient.authorized_patient_id for deidentified_patient in DeidentifiedPatientID]).all()}
+
+    # All devices shown in the table are resolved with one query
+    Devices = getDevicesByID([deviceID for patient in patients + list(DeidentifiedPatients.values()) + list(AuthorizedPatients.values()) for deviceID in patient.device_deidentified_id])
+
     for patient in patients:
-        info = extractPatientTableRow(user, patient)
+        info = extractPatientTableRow(user, patient, Devices=Devices)
         PatientInfo.append(info)
 
-    DeidentifiedPatientID = models.DeidentifiedPatientID.objects.filter(researcher_id=user.unique_user_id).all()
     for deidentified_patient in DeidentifiedPatientID:
-        patient = models.Patient.objects.filter(deidentified_id=deidentified_patient.deidentified_id, institute=user.unique_user_id).first()
-        info = extractPatientTableRow(user, models.Patient.objects.filter(deidentified_id=deidentified_patient.authorized_patient_id).first(), deidentifiedId=patient)
+        patient = DeidentifiedPatients.get(str(deidentified_patient.deidentified_id))
+        info = extractPatientTableRow(user, AuthorizedPatients.get(str(deidentified_patient.authorized_patient_id)), deidentifiedId=patient, Devices=Devices)
         PatientInfo.append(info)
 
     PatientInfo = sorted(PatientInfo, key=lambda patient: patient["LastName"]+", "+patient["FirstName"])
@@ -486,21 +664,19 @@ def extractPatientList(user):
 def extractPatientAccessTable(user):
     PatientInfo = list()
     if (user.is_admin or user.is_clinician):
-        researcherIds = {}
-        patients = models.Patient.objects.filter(institute=user.institute).all()
+        patients = list(models.Patient.objects.filter(institute=user.institute).all())
     else:
-        researcherIds = {}
-        patients = models.Patient.objects.filter(institute=user.email).all()
+        patients = list(models.Patient.objects.filter(institute=user.email).all())
+
+    Devices = getDevicesByID([deviceID for patient in patients for deviceID in patient.device_deidentified_id])
+    PatientResearchers = {str(patient.deidentified_id): list() for patient in patients}
+    for patientId, researcherId in models.DeidentifiedPatientID.objects.filter(authorized_patient_id__in=[patient.deidentified_id for patient in patients]).values_list("authorized_patient_id", "researcher_id"):
+        PatientResearchers[str(patientId)].append(str(researcherId))
+    researcherIds = {str(researcher.unique_user_id): researcher for researcher in models.PlatformUser.objects.filter(unique_user_id__in=[userId for AuthorizedUsers in PatientResearchers.values() for userId in AuthorizedUsers]).all()}
 
     for patient in patients:
-        info = extractPatientTableRow(user, patient)
-        AuthorizedUsers = []
-        if models.DeidentifiedPatientID.objects.filter(authorized_patient_id=info["ID"]).exists():
-            AuthorizedUsers = models.DeidentifiedPatientID.objects.filter(authorized_patient_id=info["ID"]).values("researcher_id").all()
-            AuthorizedUsers = [str(AuthUser["researcher_id"]) for AuthUser in AuthorizedUsers]
-            for userId in AuthorizedUsers:
-                if not userId in researcherIds.keys():
-                    researcherIds[userId] = models.PlatformUser.objects.filter(unique_user_id=userId).first()
+        info = extractPatientTableRow(user, patient, Devices=Devices)
+        AuthorizedUsers = [userId for userId in PatientResearchers[info["ID"]] if userId in researcherIds.keys()]
         
         PatientInfo.append({
             "ID": info["ID"],
@@ -586,19 +762,561 @@ def saveResultMATFiles(datastruct, datatype, info, id, device_id):
     sio.savemat(DATABASE_PATH + "recordings" + os.path.sep + filename, datastruct, long_field_names=True)
     return filename
 
+RECORDING_CHUNK_DURATION = 60
+CHUNKED_RECORDING_EXTENSION = ".brec"
+CHUNKED_RECORDING_ARRAYS = ["Data", "Missing"]
+PARTITIONED_RECORDING_EXTENSION = ".bpart"
+
+RECORDING_CACHE_SIZE = float(os.environ.get('RECORDING_CACHE_SIZE', 512)) * 1024 * 1024
+RecordingCache = OrderedDict()
+RecordingCacheLock = threading.Lock()
+RecordingCacheStatistics = {"Hits": 0, "Misses": 0, "Evictions": 0, "Invalidations": 0, "Bytes": 0}
+
+def estimateDataSize(datastruct):
+    """ Estimate in-memory size (bytes) of a decoded recording structure.
+
+    Args:
+      datastruct: Decoded recording structure (nested dictionaries/lists of numpy arrays).
+
+    Returns:
+      Estimated size in bytes.
+    """
+
+    if type(datastruct) == np.ndarray:
+        if datastruct.dtype == object:
+            return int(np.sum([estimateDataSize(item) for item in datastruct.flat])) + datastruct.nbytes
+        return datastruct.nbytes
+    elif type(datastruct) == dict:
+        return sys.getsizeof(datastruct) + int(np.sum([estimateDataSize(datastruct[key]) for key in datastruct.keys()]))
+    elif type(datastruct) in [list, tuple]:
+        return sys.getsizeof(datastruct) + int(np.sum([estimateDataSize(item) for item in datastruct]))
+    return sys.getsizeof(datastruct)
+
+def getSourceDataPointerVersion(filename):
+    """ Retrieve modification time of a datapointer, used to validate cached recordings.
+
+    Args:
+      filename: recording datapointer as stored in SQL Database.
+
+    Returns:
+      Modification time in nanoseconds. None if the datapointer does not exist. 
+    """
+
+    path = DATABASE_PATH + "recordings" + os.path.sep + filename
+    if filename.endswith(CHUNKED_RECORDING_EXTENSION):
+        path = os.path.join(path, "header.json")
+    elif filename.endswith(PARTITIONED_RECORDING_EXTENSION):
+        path = os.path.join(path, "manifest.json")
+    
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+def getCachedSourceData(filename):
+    """ Retrieve decoded recording from process-wide recording cache.
+
+    A copy is returned because most processing functions modify the recording structure in place.
+
+    Args:
+      filename: recording datapointer as stored in SQL Database.
+
+    Returns:
+      Decoded recording structure. None if the recording is not cached or the file has been modified.
+    """
+
+    version = getSourceDataPointerVersion(filename)
+    with RecordingCacheLock:
+        if filename in RecordingCache.keys() and RecordingCache[filename]["Version"] == version:
+            RecordingCache.move_to_end(filename)
+            RecordingCacheStatistics["Hits"] += 1
+            datastruct = RecordingCache[filename]["Data"]
+        else:
+            RecordingCacheStatistics["Misses"] += 1
+            return None
+    return copy.deepcopy(datastruct)
+
+def setCachedSourceData(filename, datastruct):
+    """ Store decoded recording in process-wide recording cache. 
+    
+    Least recently used recordings are evicted until the cache fits within ``RECORDING_CACHE_SIZE`` bytes.
+    Recordings larger than the cache size are not cached.
+
+    Args:
+      filename: recording datapointer as stored in SQL Database.
+      datastruct: Decoded recording structure.
+    """
+
+    version = getSourceDataPointerVersion(filename)
+    size = estimateDataSize(datastruct)
+    if version == None or size > RECORDING_CACHE_SIZE:
+        return
+
+    datastruct = copy.deepcopy(datastruct)
+    with RecordingCacheLock:
+        if filename in RecordingCache.keys():
+            RecordingCacheStatistics["Bytes"] -= RecordingCache.pop(filename)["Size"]
+
+        while len(RecordingCache) > 0 and RecordingCacheStatistics["Bytes"] + size > RECORDING_CACHE_SIZE:
+            _, evicted = RecordingCache.popitem(last=False)
+            RecordingCacheStatistics["Bytes"] -= evicted["Size"]
+            RecordingCacheStatistics["Evictions"] += 1
+        
+        RecordingCache[filename] = {"Version": version, "Size": size, "Data": datastruct}
+        RecordingCacheStatistics["Bytes"] += size
+
+def invalidateCachedSourceData(filename):
+    """ Remove recording from process-wide recording cache. 
+
+    Args:
+      filename: recording datapointer as stored in SQL Database.
+    """
+
+    with RecordingCacheLock:
+        if filename in RecordingCache.keys():
+            RecordingCacheStatistics["Bytes"] -= RecordingCache.pop(filename)["Size"]
+            RecordingCacheStatistics["Invalidations"] += 1
+
+def getSourceDataCacheStatistics():
+    """ Retrieve hit/miss counters of process-wide recording cache.
+
+    Returns:
+      Dictionary of cache counters, including number of cached recordings and total cached bytes.
+    """
+
+    with RecordingCacheLock:
+        statistics = dict(RecordingCacheStatistics)
+        statistics["Recordings"] = len(RecordingCache)
+    return statistics
+
+def isChunkableRecording(datastruct):
+    """ Check if a recording structure can be stored in chunked format.
+
+    A chunkable recording is a dictionary with a 2D ``Data`` array (samples x channels) accompanied by
+    ``SamplingRate``, ``StartTime`` and one ``ChannelNames`` entry per column. 
+
+    Args:
+      datastruct: Recording structure to be saved.
+
+    Returns:
+      Boolean indicating if the recording can be stored in chunked format.
+    """
+
+    if not type(datastruct) == dict:
+        return False
+    
+    for key in ["SamplingRate", "StartTime", "ChannelNames", "Data"]:
+        if not key in datastruct.keys():
+            return False
+    
+    if not type(datastruct["Data"]) == np.ndarray or not datastruct["Data"].ndim == 2:
+        return False
+    
+    if not len(datastruct["ChannelNames"]) == datastruct["Data"].shape[1]:
+        return False
+    
+    if "Missing" in datastruct.keys():
+        if not type(datastruct["Missing"]) == np.ndarray or not datastruct["Missing"].shape == datastruct["Data"].shape:
+            return False
+    
+    return True
+
+def saveChunkedRecording(datastruct, path):
+    """ Save recording structure in chunked, memory-mappable format.
+
+    The recording is stored as a folder. ``header.json`` contains SamplingRate, StartTime, ChannelNames and chunk layout.
+    Each channel of each sample-indexed array (``Data`` and ``Missing``) is split into time chunks of ``RECORDING_CHUNK_DURATION`` seconds
+    and saved as individual ``.npy`` files. All other keys are stored as blosc-compressed pickle in ``extra.bpkl``.
+
+    Args:
+      datastruct: Recording structure (see isChunkableRecording function).
+      path: Full path to the chunked recording folder.
+    """
+
+    SampleCount = datastruct["Data"].shape[0]
+    ChunkSize = int(np.max((1, np.round(RECORDING_CHUNK_DURATION * datastruct["SamplingRate"]))))
+    
+    temporaryPath = path + ".tmp"
+    if os.path.exists(temporaryPath):
+        shutil.rmtree(temporaryPath)
+    os.mkdir(temporaryPath)
+
+    Header = {
+        "Version": 1,
+        "SamplingRate": float(datastruct["SamplingRate"]),
+        "StartTime": float(datastruct["StartTime"]),
+        "ChannelNames": [str(channel) for channel in datastruct["ChannelNames"]],
+        "SampleCount": int(SampleCount),
+        "ChunkSize": ChunkSize,
+        "ChunkCount": int(np.ceil(SampleCount / ChunkSize)),
+        "Arrays": dict()
+    }
+    
+    for key in CHUNKED_RECORDING_ARRAYS:
+        if not key in datastruct.keys():
+            continue
+
+        Header["Arrays"][key] = str(datastruct[key].dtype)
+        for channel in range(datastruct[key].shape[1]):
+            for chunk in range(Header["ChunkCount"]):
+                np.save(os.path.join(temporaryPath, f"{key}.{channel}.{chunk}.npy"), datastruct[key][chunk*ChunkSize:(chunk+1)*ChunkSize, channel])
+    
+    Extra = {key: datastruct[key] for key in datastruct.keys() if not key in CHUNKED_RECORDING_ARRAYS}
+    with open(os.path.join(temporaryPath, "extra.bpkl"), "wb+") as file:
+        file.write(blosc.compress(pickle.dumps(Extra)))
+    
+    with open(os.path.join(temporaryPath, "header.json"), "w+") as file:
+        json.dump(Header, file)
+    
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(temporaryPath, path)
+
+def loadChunkedRecording(path, timeRange=None, channels=None):
+    """ Load recording structure from chunked format.
+
+    Only the chunks overlapping the requested time range are opened, and they are accessed through memory-mapping
+    so that only the requested samples are read from disk.
+
+    Args:
+      path: Full path to the chunked recording folder.
+      timeRange: [start, end] in seconds relative to the recording StartTime, both ends inclusive. Default to None (entire recording).
+      channels: List of channel names to be loaded. Default to None (all channels).
+
+    Returns:
+      Recording structure with the same keys as the saved structure. StartTime and Duration always describe the entire recording,
+      ``SampleOffset`` is the index of the first returned sample within the entire recording.
+    """
+
+    with open(os.path.join(path, "header.json"), "r") as file:
+        Header = json.load(file)
+    
+    with open(os.path.join(path, "extra.bpkl"), "rb") as file:
+        datastruct = pickle.loads(blosc.decompress(file.read()))
+    
+    StartIndex = 0
+    EndIndex = Header["SampleCount"]
+    if timeRange:
+        StartIndex = int(np.clip(np.floor(timeRange[0] * Header["SamplingRate"]), 0, Header["SampleCount"]))
+        EndIndex = int(np.clip(np.ceil(timeRange[1] * Header["SamplingRate"]) + 1, StartIndex, Header["SampleCount"]))
+
+    ChannelIndexes = list(range(len(Header["ChannelNames"])))
+    if channels:
+        ChannelIndexes = [Header["ChannelNames"].index(channel) for channel in channels if channel in Header["ChannelNames"]]
+
+    for key in Header["Arrays"].keys():
+        datastruct[key] = np.zeros((EndIndex-StartIndex, len(ChannelIndexes)), dtype=Header["Arrays"][key])
+        if EndIndex == StartIndex:
+            continue
+
+        for n in range(len(ChannelIndexes)):
+            for chunk in range(StartIndex // Header["ChunkSize"], (EndIndex-1) // Header["ChunkSize"] + 1):
+                ChunkStart = chunk * Header["ChunkSize"]
+                ChunkData = np.load(os.path.join(path, f"{key}.{ChannelIndexes[n]}.{chunk}.npy"), mmap_mode="r")
+                SelectionStart = np.max((StartIndex, ChunkStart))
+                SelectionEnd = np.min((EndIndex, ChunkStart + len(ChunkData)))
+                datastruct[key][SelectionStart-StartIndex:SelectionEnd-StartIndex, n] = ChunkData[SelectionStart-ChunkStart:SelectionEnd-ChunkStart]
+
+    datastruct["SamplingRate"] = Header["SamplingRate"]
+    datastruct["StartTime"] = Header["StartTime"]
+    datastruct["ChannelNames"] = [Header["ChannelNames"][i] for i in ChannelIndexes]
+    if timeRange or channels:
+        datastruct["SampleOffset"] = StartIndex
+
+    return datastruct
+
+def getPartitionedArrays(datastruct, group=None):
+    """ Get the dictionary holding time-indexed arrays of a partitioned recording structure.
+
+    Args:
+      datastruct: Recording structure.
+      group: Key of the sub-dictionary containing time-indexed arrays. Default to None (arrays are at top level).
+
+    Returns:
+      Dictionary of time-indexed arrays.
+    """
+
+    if group == None:
+        return datastruct
+    return datastruct[group]
+
+def loadPartitionManifest(path):
+    if not os.path.exists(os.path.join(path, "manifest.json")):
+        return None
+    with open(os.path.join(path, "manifest.json"), "r") as file:
+        return json.load(file)
+
+def savePartitionManifest(path, Manifest):
+    with open(os.path.join(path, "manifest.json.tmp"), "w+") as file:
+        json.dump(Manifest, file)
+    os.replace(os.path.join(path, "manifest.json.tmp"), os.path.join(path, "manifest.json"))
+
+def loadPartitionSegments(path, Manifest, segments):
+    """ Load and concatenate time-indexed arrays of partition segments, sorted by time.
+    """
+
+    Arrays = dict()
+    for key in Manifest["Arrays"].keys():
+        Arrays[key] = list()
+    
+    for segment in segments:
+        with open(os.path.join(path, segment["File"]), "rb") as file:
+            SegmentData = pickle.loads(blosc.decompress(file.read()))
+        for key in Arrays.keys():
+            Arrays[key].append(SegmentData[key])
+    
+    for key in Arrays.keys():
+        if len(Arrays[key]) > 0:
+            Arrays[key] = np.concatenate(Arrays[key], axis=0)
+        else:
+            Arrays[key] = np.zeros((0,) + tuple(Manifest["Arrays"][key]["Shape"]), dtype=Manifest["Arrays"][key]["Type"])
+    
+    if len(segments) > 1:
+        SortedIndex = np.argsort(Arrays[Manifest["TimeKey"]], kind="stable")
+        for key in Arrays.keys():
+            Arrays[key] = Arrays[key][SortedIndex]
+    return Arrays
+
+def getPartitionName(timestamp):
+    """ Partition (calendar month in UTC, ``YYYY-MM``) of Unix timestamps.
+    """
+
+    return np.asarray(timestamp, dtype=float).astype("datetime64[s]").astype("datetime64[M]").astype(str)
+
+def savePartitionedRecording(datastruct, datatype, info, id, device_id, timeKey, group=None):
+    """ Append time-indexed data to an append-only, time-partitioned recording.
+
+    The recording is stored as a folder with ``manifest.json`` describing the segments, one or more
+    blosc-compressed segments per calendar month, and ``extra.bpkl`` for keys that are not time-indexed. 
+    Only segments overlapping the time range of the new data are read to remove samples that already exist, 
+    and new samples are written as new segments, so existing segments are never rewritten (see compactPartitionedRecording function).
+
+    Args:
+      datastruct: Recording structure with new samples. All arrays in the time-indexed dictionary must have the same length as ``timeKey`` array.
+      datatype: Recording type, used as part of the datapointer (see saveSourceFiles function).
+      info: Recording info, used as part of the datapointer.
+      id: Recording ID, used as part of the datapointer.
+      device_id: Device deidentified ID, used as part of the datapointer.
+      timeKey: Key of the Unix timestamp array (seconds).
+      group: Key of the sub-dictionary containing time-indexed arrays. Default to None (arrays are at top level).
+
+    Returns:
+      Tuple of datapointer and number of new samples saved.
+    """
+
+    try:
+        os.mkdir(DATABASE_PATH + "recordings" + os.path.sep + str(device_id))
+    except Exception:
+        pass
+
+    filename = str(device_id) + os.path.sep + datatype + "_" + info + "_" + str(id) + PARTITIONED_RECORDING_EXTENSION
+    path = DATABASE_PATH + "recordings" + os.path.sep + filename
+    os.makedirs(path, exist_ok=True)
+
+    NewArrays = getPartitionedArrays(datastruct, group)
+    Manifest = loadPartitionManifest(path)
+    if Manifest == None:
+        Manifest = {"Version": 1, "TimeKey": timeKey, "Group": group, "Arrays": dict(), "Segments": list(), "NextSegment": 0}
+        for key in NewArrays.keys():
+            if type(NewArrays[key]) == np.ndarray and len(NewArrays[key]) == len(NewArrays[timeKey]):
+                Manifest["Arrays"][key] = {"Type": np.asarray(NewArrays[key]).dtype.str, "Shape": list(np.asarray(NewArrays[key]).shape[1:])}
+
+    Extra = {key: datastruct[key] for key in datastruct.keys() if not key == group} if group else dict()
+    Extra.update({key: NewArrays[key] for key in NewArrays.keys() if not key in Manifest["Arrays"].keys()})
+    if len(Extra) > 0:
+        with open(os.path.join(path, "extra.bpkl"), "wb+") as file:
+            file.write(blosc.compress(pickle.dumps(Extra)))
+
+    Timestamp = np.asarray(NewArrays[timeKey])
+    Timestamp, Index = np.unique(Timestamp, return_index=True)
+    NewArrays = {key: np.asarray(NewArrays[key])[Index] for key in Manifest["Arrays"].keys()}
+
+    if len(Timestamp) > 0:
+        Overlapping = [segment for segment in Manifest["Segments"] if segment["End"] >= Timestamp[0] and segment["Start"] <= Timestamp[-1]]
+        if len(Overlapping) > 0:
+            Existing = loadPartitionSegments(path, Manifest, Overlapping)[timeKey]
+            toInclude = ~np.isin(Timestamp, Existing)
+            Timestamp = Timestamp[toInclude]
+            NewArrays = {key: NewArrays[key][toInclude] for key in NewArrays.keys()}
+
+    Partitions = getPartitionName(Timestamp)
+    for partition in np.unique(Partitions):
+        Selection = Partitions == partition
+        Segment = {"File": f"{partition}.{Manifest['NextSegment']:06d}.bpkl", "Partition": str(partition),
+                   "Start": float(Timestamp[Selection][0]), "End": float(Timestamp[Selection][-1]), "Count": int(np.sum(Selection))}
+        with open(os.path.join(path, Segment["File"]), "wb+") as file:
+            file.write(blosc.compress(pickle.dumps({key: NewArrays[key][Selection] for key in NewArrays.keys()})))
+        Manifest["Segments"].append(Segment)
+        Manifest["NextSegment"] += 1
+
+    invalidateCachedSourceData(filename)
+    savePartitionManifest(path, Manifest)
+    return filename, len(Timestamp)
+
+def savePartitionedExtra(filename, extra):
+    """ Replace keys of a partitioned recording that are not time-indexed (i.e., derived summaries).
+
+    Args:
+      filename: partitioned recording datapointer as stored in SQL Database.
+      extra: Dictionary of keys to be stored alongside the time-indexed group.
+    """
+
+    path = DATABASE_PATH + "recordings" + os.path.sep + filename
+    with open(os.path.join(path, "extra.bpkl"), "wb+") as file:
+        file.write(blosc.compress(pickle.dumps(extra)))
+    invalidateCachedSourceData(filename)
+    savePartitionManifest(path, loadPartitionManifest(path))
+
+def loadPartitionedRecording(filename, timeRange=None):
+    """ Load a partitioned recording, optionally restricted to a time range.
+
+    Only segments overlapping the time range are read.
+
+    Args:
+      filename: partitioned recording datapointer as stored in SQL Database.
+      timeRange: [start, end] Unix timestamps (inclusive). Default to None (entire recording).
+
+    Returns:
+      Recording structure in the same layout as saved (see savePartitionedRecording function).
+    """
+
+    path = DATABASE_PATH + "recordings" + os.path.sep + filename
+    Manifest = loadPartitionManifest(path)
+
+    Segments = Manifest["Segments"]
+    if timeRange:
+        Segments = [segment for segment in Segments if segment["End"] >= timeRange[0] and segment["Start"] <= timeRange[1]]
+    Arrays = loadPartitionSegments(path, Manifest, Segments)
+    if timeRange:
+        Selection = (Arrays[Manifest["TimeKey"]] >= timeRange[0]) & (Arrays[Manifest["TimeKey"]] <= timeRange[1])
+        Arrays = {key: Arrays[key][Selection] for key in Arrays.keys()}
+
+    datastruct = dict()
+    if os.path.exists(os.path.join(path, "extra.bpkl")):
+        with open(os.path.join(path, "extra.bpkl"), "rb") as file:
+            datastruct = pickle.loads(blosc.decompress(file.read()))
+    
+    if Manifest["Group"]:
+        datastruct[Manifest["Group"]] = Arrays
+    else:
+        datastruct.update(Arrays)
+    return datastruct
+
+def compactPartitionedRecording(filename):
+    """ Merge all segments of each partition of a partitioned recording into one segment.
+
+    Args:
+      filename: partitioned recording datapointer as stored in SQL Database.
+
+    Returns:
+      Number of segments removed.
+    """
+
+    path = DATABASE_PATH + "recordings" + os.path.sep + filename
+    Manifest = loadPartitionManifest(path)
+    if Manifest == None:
+        return 0
+
+    SegmentCount = len(Manifest["Segments"])
+    Partitions = list(dict.fromkeys([segment["Partition"] for segment in Manifest["Segments"]]))
+    Removed = list()
+    for partition in Partitions:
+        Segments = [segment for segment in Manifest["Segments"] if segment["Partition"] == partition]
+        if len(Segments) < 2:
+            continue
+
+        Arrays = loadPartitionSegments(path, Manifest, Segments)
+        Segment = {"File": f"{partition}.{Manifest['NextSegment']:06d}.bpkl", "Partition": partition,
+                   "Start": float(Arrays[Manifest["TimeKey"]][0]), "End": float(Arrays[Manifest["TimeKey"]][-1]), "Count": len(Arrays[Manifest["TimeKey"]])}
+        with open(os.path.join(path, Segment["File"]), "wb+") as file:
+            file.write(blosc.compress(pickle.dumps(Arrays)))
+        Manifest["NextSegment"] += 1
+        Manifest["Segments"] = [segment for segment in Manifest["Segments"] if not segment in Segments] + [Segment]
+        Removed.extend(Segments)
+
+    if len(Removed) == 0:
+        return 0
+
+    Manifest["Segments"] = sorted(Manifest["Segments"], key=lambda segment: segment["Start"])
+    savePartitionManifest(path, Manifest)
+    invalidateCachedSourceData(filename)
+    for segment in Removed:
+        os.remove(os.path.join(path, segment["File"]))
+    return SegmentCount - len(Manifest["Segments"])
+
 def saveSourceFiles(datastruct, datatype, info, id, device_id):
     try:
         os.mkdir(DATABASE_PATH + "recordings" + os.path.sep + str(device_id))
     except Exception:
         pass
 
-    filename = str(device_id) + os.path.sep + datatype + "_" + info + "_" + str(id) + ".bpkl"
-    pData = pickle.dumps(datastruct)
-    with open(DATABASE_PATH + "recordings" + os.path.sep + filename, "wb+") as file:
-        file.write(blosc.compress(pData))
+    filename = str(device_id) + os.path.sep + datatype + "_" + info + "_" + str(id)
+    invalidateCachedSourceData(filename + ".bpkl")
+    invalidateCachedSourceData(filename + CHUNKED_RECORDING_EXTENSION)
+    if isChunkableRecording(datastruct):
+        saveChunkedRecording(datastruct, DATABASE_PATH + "recordings" + os.path.sep + filename + CHUNKED_RECORDING_EXTENSION)
+        deleteSourceDataPointer(filename + ".bpkl")
+        filename += CHUNKED_RECORDING_EXTENSION
+    else:
+        pData = pickle.dumps(datastruct)
+        with open(DATABASE_PATH + "recordings" + os.path.sep + filename + ".bpkl", "wb+") as file:
+            file.write(blosc.compress(pData))
+        deleteSourceDataPointer(filename + CHUNKED_RECORDING_EXTENSION)
+        filename += ".bpkl"
     return filename
 
+def updateRecordingCatalog(recording, datastruct):
+    """ Populate recording catalog of a NeuralActivityRecording.
+
+    The catalog (duration, sampling rate, sample count, file size, channels and therapy snapshot) is stored 
+    in the SQL Database so that overview queries do not need to load the recording data. The recording is not saved.
+
+    Args:
+      recording: NeuralActivityRecording object with a valid datapointer.
+      datastruct: Decoded recording structure saved at the datapointer.
+    """
+
+    if "Duration" in datastruct.keys():
+        recording.recording_duration = datastruct["Duration"]
+    if "SamplingRate" in datastruct.keys():
+        recording.recording_sampling_rate = datastruct["SamplingRate"]
+    if "Data" in datastruct.keys():
+        recording.recording_sample_count = len(datastruct["Data"])
+    
+    # Chunked (.brec) and partitioned (.bpart) recordings are directories, their size is the total size of all files within.
+    path = DATABASE_PATH + "recordings" + os.path.sep + recording.recording_datapointer
+    if os.path.isdir(path):
+        recording.recording_size = getDirectorySize(path)
+    elif os.path.exists(path):
+        recording.recording_size = os.path.getsize(path)
+
+    if not recording.recording_info:
+        recording.recording_info = dict()
+    if "ChannelNames" in datastruct.keys() and not "Channel" in recording.recording_info.keys():
+        recording.recording_info["Channel"] = datastruct["ChannelNames"]
+    if "Descriptor" in datastruct.keys() and "Therapy" in datastruct["Descriptor"].keys():
+        recording.recording_info["Therapy"] = datastruct["Descriptor"]["Therapy"]
+
 def loadSourceDataPointer(filename, bytes=False):
+    if not bytes:
+        datastruct = getCachedSourceData(filename)
+        if datastruct is not None:
+            return datastruct
+
+    if filename.endswith(PARTITIONED_RECORDING_EXTENSION):
+        datastruct = loadPartitionedRecording(filename)
+        if bytes:
+            return blosc.compress(pickle.dumps(datastruct))
+        setCachedSourceData(filename, datastruct)
+        return datastruct
+
+    if filename.endswith(CHUNKED_RECORDING_EXTENSION):
+        datastruct = loadChunkedRecording(DATABASE_PATH + "recordings" + os.path.sep + filename)
+        if bytes:
+            return blosc.compress(pickle.dumps(datastruct))
+        setCachedSourceData(filename, datastruct)
+        return datastruct
+
     with open(DATABASE_PATH + "recordings" + os.path.sep + filename, "rb") as file:
         if bytes:
             datastruct = file.read()
@@ -609,10 +1327,177 @@ def loadSourceDataPointer(filename, bytes=False):
                 datastruct = pickle.loads(blosc.decompress(file.read()))
             else:
                 datastruct = sio.loadmat(file, simplify_cells=True)["ProcessedData"]
+            setCachedSourceData(filename, datastruct)
+    return datastruct
+
+def loadSourceDataRange(filename, timeRange=None, channels=None):
+    """ Load a time range and/or channel subset of a recording.
+
+    Chunked recordings are read through memory-mapped chunks. Other formats are fully loaded and then sliced, 
+    so the return structure is identical regardless of storage format.
+
+    Args:
+      filename: recording datapointer as stored in SQL Database.
+      timeRange: [start, end] in seconds relative to the recording StartTime, both ends inclusive. Default to None (entire recording).
+      channels: List of channel names to be loaded. Default to None (all channels).
+
+    Returns:
+      Recording structure (see loadChunkedRecording function). ``SampleOffset`` is set whenever a subset is requested.
+    """
+
+    if filename.endswith(CHUNKED_RECORDING_EXTENSION):
+        return loadChunkedRecording(DATABASE_PATH + "recordings" + os.path.sep + filename, timeRange=timeRange, channels=channels)
+    
+    datastruct = loadSourceDataPointer(filename)
+    if not isChunkableRecording(datastruct) or not (timeRange or channels):
+        return datastruct
+
+    StartIndex = 0
+    EndIndex = datastruct["Data"].shape[0]
+    if timeRange:
+        StartIndex = int(np.clip(np.floor(timeRange[0] * datastruct["SamplingRate"]), 0, EndIndex))
+        EndIndex = int(np.clip(np.ceil(timeRange[1] * datastruct["SamplingRate"]) + 1, StartIndex, EndIndex))
+    
+    ChannelIndexes = list(range(len(datastruct["ChannelNames"])))
+    if channels:
+        ChannelIndexes = [datastruct["ChannelNames"].index(channel) for channel in channels if channel in datastruct["ChannelNames"]]
+
+    for key in CHUNKED_RECORDING_ARRAYS:
+        if key in datastruct.keys():
+            datastruct[key] = datastruct[key][StartIndex:EndIndex, ChannelIndexes]
+    datastruct["ChannelNames"] = [datastruct["ChannelNames"][i] for i in ChannelIndexes]
+    datastruct["SampleOffset"] = StartIndex
     return datastruct
 
+def migrateSourceDataPointer(filename):
+    """ Convert legacy datapointer (``.pkl``, ``.bpkl`` or ``.mat``) to the current storage format.
+
+    Recordings that fit the chunked layout are stored as chunked recordings, all others as blosc-compressed pickle.
+    The legacy file is removed after the new file is written.
+
+    Args:
+      filename: recording datapointer as stored in SQL Database.
+
+    Returns:
+      New recording datapointer. Unchanged if the recording is already in current format.
+    """
+
+    if filename.endswith(CHUNKED_RECORDING_EXTENSION) or filename.endswith(PARTITIONED_RECORDING_EXTENSION):
+        return filename
+    
+    datastruct = loadSourceDataPointer(filename)
+    if filename.endswith(".bpkl") and not isChunkableRecording(datastruct):
+        return filename
+
+    newFilename = str(pathlib.Path(filename).with_suffix(""))
+    if isChunkableRecording(datastruct):
+        saveChunkedRecording(datastruct, DATABASE_PATH + "recordings" + os.path.sep + newFilename + CHUNKED_RECORDING_EXTENSION)
+        newFilename += CHUNKED_RECORDING_EXTENSION
+    else:
+        with open(DATABASE_PATH + "recordings" + os.path.sep + newFilename + ".bpkl", "wb+") as file:
+            file.write(blosc.compress(pickle.dumps(datastruct)))
+        newFilename += ".bpkl"
+    
+    if not newFilename == filename:
+        deleteSourceDataPointer(filename)
+    return newFilename
+
+def getDerivedProductPointer(filename, parameters, version):
+    """ Generate content-addressed datapointer for derived products (i.e., processed results) of a recording.
+
+    Derived products are stored separately from the raw recording in ``<device>/derived/<recording>/`` folder. 
+    The product name is ``<variant>_<revision>``, where variant is a hash of the recording and processing parameters and 
+    revision is a hash of the algorithm version and raw data version. Multiple variants of the same recording are stored 
+    side by side, older revisions of a variant are removed by ``saveDerivedProduct``.
+
+    Args:
+      filename: raw recording datapointer as stored in SQL Database.
+      parameters: Dictionary of processing parameters (must be JSON serializable).
+      version: Version identifier of the processing algorithm.
+
+    Returns:
+      Datapointer of the derived product.
+    """
+
+    device, name = os.path.split(str(pathlib.Path(filename).with_suffix("")))
+    Variant = json.dumps({"Recording": name, "Parameters": parameters}, sort_keys=True)
+    Revision = json.dumps({"Version": version, "Source": getSourceDataPointerVersion(filename)}, sort_keys=True)
+    return os.path.join(device, "derived", name, hashlib.sha256(Variant.encode("utf-8")).hexdigest() + "_" + hashlib.sha256(Revision.encode("utf-8")).hexdigest() + ".bpkl")
+
+def loadDerivedProduct(filename, parameters, version):
+    """ Load derived product of a recording.
+
+    Args:
+      filename: raw recording datapointer as stored in SQL Database.
+      parameters: Dictionary of processing parameters (see getDerivedProductPointer function).
+      version: Version identifier of the processing algorithm.
+
+    Returns:
+      Derived product structure. None if the product has not been computed. 
+    """
+
+    pointer = getDerivedProductPointer(filename, parameters, version)
+    if not os.path.exists(DATABASE_PATH + "recordings" + os.path.sep + pointer):
+        return None
+    return loadSourceDataPointer(pointer)
+
+def saveDerivedProduct(datastruct, filename, parameters, version):
+    """ Save derived product of a recording without modifying the raw recording.
+
+    Older revisions of the same variant (computed with an older algorithm version or from an older raw recording) 
+    can no longer be loaded and are removed, along with products saved before variants were tracked.
+
+    Args:
+      datastruct: Derived product structure.
+      filename: raw recording datapointer as stored in SQL Database.
+      parameters: Dictionary of processing parameters (see getDerivedProductPointer function).
+      version: Version identifier of the processing algorithm.
+
+    Returns:
+      Datapointer of the derived product.
+    """
+
+    pointer = getDerivedProductPointer(filename, parameters, version)
+    path, product = os.path.split(DATABASE_PATH + "recordings" + os.path.sep + pointer)
+    os.makedirs(path, exist_ok=True)
+    invalidateCachedSourceData(pointer)
+    with open(DATABASE_PATH + "recordings" + os.path.sep + pointer, "wb+") as file:
+        file.write(blosc.compress(pickle.dumps(datastruct)))
+    
+    Variant = product.split("_")[0]
+    for existingProduct in os.listdir(path):
+        if existingProduct == product:
+            continue
+        if existingProduct.startswith(Variant + "_") or not "_" in existingProduct:
+            invalidateCachedSourceData(os.path.join(os.path.dirname(pointer), existingProduct))
+            try:
+                os.remove(os.path.join(path, existingProduct))
+            except OSError:
+                pass
+    return pointer
+
+def deleteDerivedProducts(filename):
+    """ Delete all derived products of a recording.
+
+    Args:
+      filename: raw recording datapointer as stored in SQL Database.
+    """
+
+    device, name = os.path.split(str(pathlib.Path(filename).with_suffix("")))
+    path = os.path.join(DATABASE_PATH + "recordings", device, "derived", name)
+    if os.path.exists(path):
+        for pointer in os.listdir(path):
+            invalidateCachedSourceData(os.path.join(device, "derived", name, pointer))
+        shutil.rmtree(path, ignore_errors=True)
+
 def deleteSourceDataPointer(filename):
+    invalidateCachedSourceData(filename)
+    if not os.path.sep + "derived" + os.path.sep in filename:
+        deleteDerivedProducts(filename)
     try:
-        os.remove(DATABASE_PATH + "recordings" + os.path.sep + filename)
+        if filename.endswith(CHUNKED_RECORDING_EXTENSION) or filename.endswith(PARTITIONED_RECORDING_EXTENSION):
+            shutil.rmtree(DATABASE_PATH + "recordings" + os.path.sep + filename)
+        else:
+            os.remove(DATABASE_PATH + "recordings" + os.path.sep + filename)
     except:
         pass
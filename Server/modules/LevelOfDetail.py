@@ -0,0 +1,139 @@
+""""""
+"""
+=========================================================
+* UF BRAVO Platform
+=========================================================
+
+* Copyright 2023 by Jackson Cagle, Fixel Institute
+* The source code is made available under a Creative Common NonCommercial ShareAlike License (CC BY-NC-SA 4.0) (https://creativecommons.org/licenses/by-nc-sa/4.0/)
+
+ =========================================================
+
+* The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+"""
+"""
+Time-series Level of Detail Module
+===================================================
+Min/max decimation pyramid for rendering long time-series. Each level stores the minimum and maximum of consecutive
+bins of the level below, so a viewport (time range and pixel width) can be served with about two points per pixel
+while preserving peaks that plain subsampling would drop.
+
+@author: Jackson Cagle, University of Florida
+@email: jackson.cagle@neurology.ufl.edu
+"""
+
+import numpy as np
+
+# Decimation factor between consecutive pyramid levels, and minimum number of bins in the coarsest level.
+PYRAMID_FACTOR = 4
+PYRAMID_MINIMUM_LENGTH = 512
+PYRAMID_VERSION = 1
+
+def buildDecimationPyramid(data):
+    """ Build min/max decimation pyramid of a 1D signal.
+
+    Args:
+      data: 1D signal array.
+
+    Returns:
+      List of levels from finest to coarsest. Each level is a dictionary with "Factor" (number of original samples per bin),
+      "Min" and "Max" arrays. Trailing samples that do not fill a complete bin are included in a final partial bin.
+    """
+
+    data = np.asarray(data, dtype=float).flatten()
+    Pyramid = list()
+    LevelMin = data
+    LevelMax = data
+    Factor = 1
+    while len(LevelMin) > PYRAMID_MINIMUM_LENGTH:
+        Padding = (-len(LevelMin)) % PYRAMID_FACTOR
+        if Padding > 0:
+            LevelMin = np.concatenate((LevelMin, np.repeat(LevelMin[-1], Padding)))
+            LevelMax = np.concatenate((LevelMax, np.repeat(LevelMax[-1], Padding)))
+        LevelMin = np.min(LevelMin.reshape(-1, PYRAMID_FACTOR), axis=1)
+        LevelMax = np.max(LevelMax.reshape(-1, PYRAMID_FACTOR), axis=1)
+        Factor *= PYRAMID_FACTOR
+        Pyramid.append({"Factor": Factor, "Min": LevelMin, "Max": LevelMax})
+    return Pyramid
+
+def buildStreamPyramid(TimeDomain):
+    """ Build decimation pyramids of all channels of a processed streaming TimeDomain structure.
+
+    Args:
+      TimeDomain: processed TimeDomain structure with "Data" (samples x channels) and "Filtered" (list of channels).
+
+    Returns:
+      Dictionary with "Data" and "Filtered" lists of per-channel pyramids.
+    """
+
+    return {
+        "Data": [buildDecimationPyramid(TimeDomain["Data"][:,i]) for i in range(TimeDomain["Data"].shape[1])],
+        "Filtered": [buildDecimationPyramid(TimeDomain["Filtered"][i]) for i in range(len(TimeDomain["Filtered"]))],
+    }
+
+def queryViewport(data, samplingRate, viewport, pyramid=None, offset=0):
+    """ Extract the samples needed to render a viewport of a 1D signal.
+
+    The coarsest pyramid level that still provides at least one bin per pixel is used. Each bin is returned as
+    a minimum and a maximum point so that the rendered envelope matches the full-resolution signal.
+    If the viewport contains fewer than two samples per pixel, the original samples are returned.
+
+    Args:
+      data: 1D signal array.
+      samplingRate: sampling rate of the signal in Hz.
+      viewport: dictionary with "Start" and "End" (seconds relative to first sample) and "Width" (pixels).
+      pyramid: decimation pyramid from ``buildDecimationPyramid``. Built on the fly from ``data`` if not provided.
+      offset: index of the first sample of ``data`` within the entire signal, if only a segment covering the viewport 
+        is loaded (see Database.loadSourceDataRange function). A provided pyramid must be built from the entire signal. 
+
+    Returns:
+      Tuple (Time, Data) of 1D arrays. Time is in seconds relative to the first sample.
+    """
+
+    data = np.asarray(data).flatten()
+    StartIndex = int(np.clip(np.floor(viewport["Start"] * samplingRate), offset, offset + len(data)))
+    EndIndex = int(np.clip(np.ceil(viewport["End"] * samplingRate) + 1, StartIndex, offset + len(data)))
+    Width = max(int(viewport["Width"]), 1)
+
+    if EndIndex - StartIndex <= 2 * Width:
+        return np.arange(StartIndex, EndIndex) / samplingRate, data[StartIndex-offset:EndIndex-offset]
+
+    PyramidOffset = 0
+    if pyramid == None:
+        pyramid = buildDecimationPyramid(data)
+        PyramidOffset = offset
+
+    Level = None
+    for level in pyramid:
+        if (EndIndex - StartIndex) / level["Factor"] >= Width:
+            Level = level
+    if Level == None:
+        return np.arange(StartIndex, EndIndex) / samplingRate, data[StartIndex-offset:EndIndex-offset]
+
+    StartBin = (StartIndex - PyramidOffset) // Level["Factor"]
+    EndBin = min(int(np.ceil((EndIndex - PyramidOffset) / Level["Factor"])), len(Level["Min"]))
+    BinTime = (PyramidOffset + np.arange(StartBin, EndBin) * Level["Factor"] + Level["Factor"] / 2) / samplingRate
+    Time = np.repeat(BinTime, 2)
+    Data = np.empty(len(Time))
+    Data[0::2] = Level["Min"][StartBin:EndBin]
+    Data[1::2] = Level["Max"][StartBin:EndBin]
+    return Time, Data
+
+def parseViewport(request):
+    """ Parse viewport from API request body.
+
+    Args:
+      request: request body dictionary with optional "viewport" entry containing "start", "end" (seconds relative to recording start) and "width" (pixels).
+
+    Returns:
+      Viewport dictionary for ``queryViewport``, or None if no viewport is requested.
+    """
+
+    if not "viewport" in request.keys() or not request["viewport"]:
+        return None
+
+    return {
+        "Start": float(request["viewport"]["start"]),
+        "End": float(request["viewport"]["end"]),
+        "Width": int(request["viewport"]["width"]),
+    }
@@ -0,0 +1,81 @@
+""""""
+"""
+=========================================================
+* UF BRAVO Platform
+=========================================================
+
+* Copyright 2023 by Jackson Cagle, Fixel Institute
+* The source code is made available under a Creative Common NonCommercial ShareAlike License (CC BY-NC-SA 4.0) (https://creativecommons.org/licenses/by-nc-sa/4.0/)
+
+ =========================================================
+
+* The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+"""
+"""
+Missing Data Labelling Module
+===================================================
+Map sample-level missing flags onto time-frequency grids (spectrogram bins, decimated wavelet samples).
+A bin is labelled missing if any sample within its window is missing. Windows are resolved with a cumulative sum
+of the missing flags so that labelling is linear in the number of samples regardless of the number of bins.
+
+@author: Jackson Cagle, University of Florida
+@email: jackson.cagle@neurology.ufl.edu
+"""
+
+import numpy as np
+
+def windowMissingLabel(missing, sampleTime, windowStart, windowEnd):
+    """ Label windows that contain missing samples.
+
+    Equivalent to ``np.any(missing[rangeSelection(sampleTime, [windowStart[j], windowEnd[j]])])`` for every window j.
+
+    Args:
+      missing: 1D array of sample-level missing flags (non-zero is missing).
+      sampleTime: 1D sorted array of sample timestamps, same length as missing.
+      windowStart: 1D array of window start times (inclusive).
+      windowEnd: 1D array of window end times (inclusive).
+
+    Returns:
+      Boolean array with one label per window.
+    """
+
+    missing = np.asarray(missing).flatten() != 0
+    cumulative = np.concatenate(([0], np.cumsum(missing)))
+    startIndex = np.searchsorted(sampleTime, windowStart, side="left")
+    endIndex = np.searchsorted(sampleTime, windowEnd, side="right")
+    endIndex = np.maximum(endIndex, startIndex)
+    return cumulative[endIndex] - cumulative[startIndex] > 0
+
+def calculateMissingLabel(missing, timeArray, window, fs):
+    """ Label spectrogram bins that contain missing samples.
+
+    Args:
+      missing: 1D array of sample-level missing flags (non-zero is missing).
+      timeArray: 1D array of spectrogram bin center times in seconds, relative to the first sample.
+      window: window length in seconds.
+      fs: sampling rate of the signal in Hz.
+
+    Returns:
+      Boolean array with one label per spectrogram bin.
+    """
+
+    sampleTime = np.arange(len(missing)) / fs
+    timeArray = np.asarray(timeArray)
+    return windowMissingLabel(missing, sampleTime, timeArray - window/2, timeArray + window/2 - 1/fs)
+
+def decimateMissingLabel(missing, step):
+    """ Label decimated samples whose decimation window contains missing samples.
+
+    Each sample kept by ``missing[::step]`` is labelled missing if any sample within half a step around it is missing.
+
+    Args:
+      missing: 1D array of sample-level missing flags (non-zero is missing).
+      step: decimation step in samples.
+
+    Returns:
+      Boolean array with the same length as ``missing[::step]``.
+    """
+
+    sampleIndex = np.arange(len(missing))
+    keptIndex = sampleIndex[::step]
+    return windowMissingLabel(missing, sampleIndex, keptIndex - int(step/2), keptIndex + int((step-1)/2))
@@ -0,0 +1,236 @@
+""""""
+"""
+=========================================================
+* UF BRAVO Platform
+=========================================================
+
+* Copyright 2023 by Jackson Cagle, Fixel Institute
+* The source code is made available under a Creative Common NonCommercial ShareAlike License (CC BY-NC-SA 4.0) (https://creativecommons.org/licenses/by-nc-sa/4.0/)
+
+ =========================================================
+
+* The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+"""
+"""
+Notification Publisher Module
+===================================================
+Publish notifications from background workers (processing queue, analysis processing) directly into the channel layer
+instead of opening a websocket to the notification system for every message.
+
+Messages use the same format as root notifications received by ``Backend.APIs.RealtimeUpdates.NotificationSystem``.
+``publishNotification`` only places messages in a per-process queue, a background thread collects bursts of messages
+for NOTIFICATION_BATCH_INTERVAL seconds, drops superseded progress updates, and sends the batch through its own event loop
+so that a slow channel layer never blocks job processing. "QueueReduced" broadcasts are not sent by the publisher, queue updates
+are forwarded to the rate limiter of the notification system (``NotificationSystem.schedule_queue_reduced``) at most once every 
+QUEUE_REDUCED_INTERVAL seconds per process.
+
+@author: Jackson Cagle, University of Florida
+@email: jackson.cagle@neurology.ufl.edu
+"""
+
+import os
+import asyncio
+import atexit
+import hashlib
+import queue
+import threading
+import time
+
+from channels.layers import get_channel_layer
+
+NOTIFICATION_BATCH_INTERVAL = float(os.environ.get('NOTIFICATION_BATCH_INTERVAL', 0.2))
+NOTIFICATION_QUEUE_SIZE = int(os.environ.get('NOTIFICATION_QUEUE_SIZE', 1000))
+NOTIFICATION_FLUSH_TIMEOUT = float(os.environ.get('NOTIFICATION_FLUSH_TIMEOUT', 5))
+QUEUE_REDUCED_INTERVAL = float(os.environ.get('QUEUE_REDUCED_INTERVAL', 2))
+
+NOTIFICATION_EVENTS = {
+    "NewPatient": "broadcast_new_patient",
+    "TaskComplete": "broadcast_queue_complete",
+    "TaskProcessing": "broadcast_queue_update",
+    "AnalysisProcessing": "broadcast_analysis_processing",
+}
+
+def getUserGroup(userID):
+    """ Channel group containing all sockets of a single user.
+
+    Args:
+      userID: unique user ID of BRAVO Platform User.
+
+    Returns:
+      Channel group name.
+    """
+
+    return "User_" + str(userID)
+
+def getInstituteGroup(institute):
+    """ Channel group containing all sockets of users from the same institute.
+
+    Institute names are hashed because channel group names only allow ASCII alphanumerics, hyphens, underscores, and periods.
+
+    Args:
+      institute: institute name of BRAVO Platform User.
+
+    Returns:
+      Channel group name.
+    """
+
+    return "Institute_" + hashlib.md5(institute.encode("utf-8")).hexdigest()
+
+def getNotificationGroup(message):
+    """ Channel group targeted by a notification.
+
+    Args:
+      message: notification with "TaskUser" (unique user ID) or "TaskInstitute" (institute name).
+
+    Returns:
+      Channel group name.
+    """
+
+    if "TaskInstitute" in message.keys():
+        return getInstituteGroup(message["TaskInstitute"])
+    return getUserGroup(message["TaskUser"])
+
+def createNotificationEvent(message):
+    """ Convert notification message into channel layer event.
+
+    Args:
+      message: notification with "NotificationType" (see NOTIFICATION_EVENTS) and its content.
+
+    Returns:
+      Tuple (group, event). Group is None if the notification type is unknown.
+    """
+
+    if not message["NotificationType"] in NOTIFICATION_EVENTS.keys():
+        return None, None
+
+    content = {"UserID": message.get("TaskUser")}
+    for key in ["NewPatient", "TaskID", "State", "Message"]:
+        if key in message.keys():
+            content[key] = message[key]
+    return getNotificationGroup(message), {"type": NOTIFICATION_EVENTS[message["NotificationType"]], "message": content}
+
+def coalesceNotifications(messages):
+    """ Remove superseded notifications from a batch.
+
+    Progress updates ("TaskProcessing", "AnalysisProcessing") followed by a later notification of the same task are dropped,
+    all other notifications are kept in order.
+
+    Args:
+      messages: list of notification messages in the order they were published.
+
+    Returns:
+      Tuple (events, queueUpdated). Events is a list of (group, event) tuples to be sent, queueUpdated indicates if the batch contains any queue update.
+    """
+
+    Latest = dict()
+    for i in range(len(messages)):
+        if messages[i]["NotificationType"] in ["TaskProcessing", "TaskComplete", "AnalysisProcessing"]:
+            Latest[messages[i].get("TaskID")] = i
+
+    Events = list()
+    QueueReduced = False
+    for i in range(len(messages)):
+        if messages[i]["NotificationType"] in ["TaskProcessing", "AnalysisProcessing"] and Latest[messages[i].get("TaskID")] != i:
+            continue
+        if messages[i]["NotificationType"] in ["TaskProcessing", "TaskComplete"]:
+            QueueReduced = True
+
+        group, event = createNotificationEvent(messages[i])
+        if group:
+            Events.append((group, event))
+
+    return Events, QueueReduced
+
+class NotificationPublisher:
+    """ Per-process background publisher.
+
+    The publisher thread owns a persistent event loop so that the channel layer connection is reused between batches.
+    A pending "QueueReduced" request is sent once QUEUE_REDUCED_INTERVAL seconds passed since the last request, or on flush.
+    """
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self.messages = queue.Queue(maxsize=NOTIFICATION_QUEUE_SIZE)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def publish(self, messages):
+        for message in messages:
+            try:
+                self.messages.put_nowait(message)
+            except queue.Full:
+                print(f"Notification queue full, dropping {message['NotificationType']} notification")
+
+    def run(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        QueueReducedPending = False
+        QueueReducedLastSent = 0
+        while True:
+            # Flush requests (None) are counted as queue items so that flush waits until they are processed
+            Batch = list()
+            try:
+                if QueueReducedPending:
+                    Batch.append(self.messages.get(timeout=max(0, QueueReducedLastSent + QUEUE_REDUCED_INTERVAL - time.monotonic())))
+                else:
+                    Batch.append(self.messages.get())
+            except queue.Empty:
+                pass
+
+            if len(Batch) > 0:
+                BatchEnd = time.monotonic() + NOTIFICATION_BATCH_INTERVAL
+                while not None in Batch:
+                    try:
+                        Batch.append(self.messages.get(timeout=max(0, BatchEnd - time.monotonic())))
+                    except queue.Empty:
+                        break
+
+            Events, QueueUpdated = coalesceNotifications([message for message in Batch if not message == None])
+            QueueReducedPending = QueueReducedPending or QueueUpdated
+            if QueueReducedPending and (None in Batch or time.monotonic() >= QueueReducedLastSent + QUEUE_REDUCED_INTERVAL):
+                Events.append(("BroadcastChannel", {"type": "request_queue_reduced", "message": {}}))
+                QueueReducedPending = False
+                QueueReducedLastSent = time.monotonic()
+
+            try:
+                channel_layer = get_channel_layer()
+                loop.run_until_complete(asyncio.gather(*[channel_layer.group_send(group, event) for group, event in Events]))
+            except Exception as e:
+                print(e)
+
+            for i in range(len(Batch)):
+                self.messages.task_done()
+
+    def flush(self, timeout=NOTIFICATION_FLUSH_TIMEOUT):
+        try:
+            self.messages.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        Deadline = time.monotonic() + timeout
+        while self.messages.unfinished_tasks > 0 and time.monotonic() < Deadline:
+            time.sleep(0.05)
+
+Publisher = None
+def publishNotification(*messages):
+    """ Publish notifications without blocking the caller.
+
+    Args:
+      messages: notification messages in the same format as root notifications of the notification system
+        (i.e. "NotificationType", "TaskUser", "TaskID", "State", "Message").
+    """
+
+    global Publisher
+    if Publisher == None or Publisher.pid != os.getpid():
+        Publisher = NotificationPublisher()
+    Publisher.publish(messages)
+
+def flushNotifications():
+    """ Wait (up to NOTIFICATION_FLUSH_TIMEOUT seconds) for pending notifications to be sent. 
+    
+    Called at process exit, and at the end of each job by processes that exit without running exit handlers (forked workers).
+    """
+
+    if Publisher != None and Publisher.pid == os.getpid():
+        Publisher.flush()
+
+atexit.register(flushNotifications)
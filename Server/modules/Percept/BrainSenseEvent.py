@@ -39,6 +39,9 @@ key = os.environ.get('ENCRYPTION_KEY')
 def saveBrainSenseEvents(deviceID, LfpFrequencySnapshotEvents, sourceFile):
     """ Save Events Data in MySQL Database.
 
+    Existing events of the device within the time range of the new events are fetched with a single query 
+    and matched by (event name, event time, sensing) key instead of querying the database for every event.
+
     Args:
       deviceID: UUID4 deidentified id for each unique Percept device.
       LfpFrequencySnapshotEvents: Event-snapshot Power Spectrum data extracted from JSON file.
@@ -49,25 +52,33 @@ def saveBrainSenseEvents(deviceID, LfpFrequencySnapshotEvents, sourceFile):
     """
 
     NewRecordingFound = False
+    if len(LfpFrequencySnapshotEvents) == 0:
+        return NewRecordingFound
+
+    EventTimes = [datetime.fromtimestamp(Percept.getTimestamp(event["DateTime"]),tz=pytz.utc) for event in LfpFrequencySnapshotEvents]
+    ExistingEvents = dict()
+    for eventID, eventName, eventTime, sensingExist, neuralPSD in models.PatientCustomEvents.objects.filter(device_deidentified_id=deviceID, event_time__gte=min(EventTimes), event_time__lte=max(EventTimes)).values_list("id", "event_name", "event_time", "sensing_exist", "neural_psd"):
+        ExistingEvents[(eventName, eventTime, sensingExist)] = {"id": eventID, "Empty": not neuralPSD}
+
     batchStorage = list()
-    for event in LfpFrequencySnapshotEvents:
-        EventTime = datetime.fromtimestamp(Percept.getTimestamp(event["DateTime"]),tz=pytz.utc)
-        SensingExist = False
-        if "LfpFrequencySnapshotEvents" in event.keys():
-            SensingExist = True
-            EventData = event["LfpFrequencySnapshotEvents"]
-
-        if not models.PatientCustomEvents.objects.filter(device_deidentified_id=deviceID, event_name=event["EventName"], event_time=EventTime, sensing_exist=SensingExist).exists():
+    updatedEvents = list()
+    for event, EventTime in zip(LfpFrequencySnapshotEvents, EventTimes):
+        SensingExist = "LfpFrequencySnapshotEvents" in event.keys()
+        EventKey = (event["EventName"], EventTime, SensingExist)
+
+        if not EventKey in ExistingEvents.keys():
             customEvent = models.PatientCustomEvents(device_deidentified_id=deviceID, event_name=event["EventName"], event_time=EventTime, sensing_exist=SensingExist, source_file=sourceFile)
             if SensingExist:
-                customEvent.neural_psd = EventData
+                customEvent.neural_psd = event["LfpFrequencySnapshotEvents"]
             batchStorage.append(customEvent)
-        else:
-            if SensingExist:
-                customEvent = models.PatientCustomEvents.objects.filter(device_deidentified_id=deviceID, event_name=event["EventName"], event_time=EventTime, sensing_exist=SensingExist).first()
-                if len(customEvent.neural_psd.keys()) == 0:
-                    customEvent.neural_psd = EventData
-                    customEvent.save()
+            ExistingEvents[EventKey] = {"id": None, "Empty": False}
+
+        elif SensingExist and ExistingEvents[EventKey]["Empty"]:
+            updatedEvents.append(models.PatientCustomEvents(id=ExistingEvents[EventKey]["id"], neural_psd=event["LfpFrequencySnapshotEvents"]))
+            ExistingEvents[EventKey]["Empty"] = False
+
+    if len(updatedEvents) > 0:
+        models.PatientCustomEvents.objects.bulk_update(updatedEvents, ["neural_psd"])
 
     if len(batchStorage) > 0:
         NewRecordingFound = True
@@ -120,7 +131,85 @@ def queryPatientEventPSDsByTime(user, patientUniqueID, timeRange, authority):
 
     return PatientEventPSDs
 
+def getEventPSDMatrix(EventPSDs, hemisphere, authority):
+    """ Collect event PSDs of one hemisphere into a dense matrix.
+
+    Args:
+      EventPSDs: list of (event_name, neural_psd) tuples of sensing events.
+      hemisphere: Percept hemisphere definition (HemisphereLocationDef.Left or HemisphereLocationDef.Right).
+      authority: User permission structure indicating the type of access the user has.
+
+    Returns:
+      Tuple (PSDs, EventName, EventTime, GroupId). PSDs is a float32 (events x frequency bins) matrix, 
+      zero-padded to at least 100 bins. Events outside of the permission range are excluded.
+    """
+
+    EventName = list()
+    EventTime = list()
+    GroupId = list()
+    FFTBinData = list()
+    for eventName, neuralPSD in EventPSDs:
+        if not neuralPSD or not hemisphere in neuralPSD.keys():
+            continue
+
+        EventTimestamp = Percept.getTimestamp(neuralPSD[hemisphere]["DateTime"])
+        if EventTimestamp > authority["Permission"][0] and (authority["Permission"][1] == 0 or EventTimestamp < authority["Permission"][1]):
+            EventName.append(eventName)
+            EventTime.append(EventTimestamp)
+            GroupId.append(neuralPSD[hemisphere]["GroupId"])
+            FFTBinData.append(neuralPSD[hemisphere]["FFTBinData"])
+
+    PSDs = np.zeros((len(FFTBinData), max([100] + [len(data) for data in FFTBinData])), dtype=np.float32)
+    for i in range(len(FFTBinData)):
+        PSDs[i,:len(FFTBinData[i])] = FFTBinData[i]
+    return PSDs, EventName, np.array(EventTime), GroupId
+
+def getEventTherapyIndex(TherapyConfigurations, deviceID, TherapyKey, EventTime, GroupId):
+    """ Assign each event to the first therapy configuration of its group programmed after the event.
+
+    Configurations of each group are sorted by programming date once, and all events are assigned with binary search.
+
+    Args:
+      TherapyConfigurations: list of therapy configurations ordered by time extracted from ``Therapy.queryTherapyConfigurations``.
+      deviceID: deidentified id (string) of the device that recorded the events.
+      TherapyKey: hemisphere key of the therapy details (LeftHemisphere or RightHemisphere).
+      EventTime: 1D array of event timestamps.
+      GroupId: list of therapy group of each event.
+
+    Returns:
+      1D index array into TherapyConfigurations for each event, -1 if no configuration matches.
+    """
+
+    TherapyIndex = np.full(len(EventTime), -1, dtype=int)
+    Candidates = [i for i in range(len(TherapyConfigurations)) if TherapyConfigurations[i]["DeviceID"] == deviceID and TherapyKey in TherapyConfigurations[i]["Therapy"].keys()]
+    GroupId = np.array(GroupId, dtype=object)
+    for group in uniqueList(GroupId.tolist()):
+        GroupCandidates = np.array([i for i in Candidates if TherapyConfigurations[i]["TherapyGroup"] == group], dtype=int)
+        if len(GroupCandidates) == 0:
+            continue
+
+        TherapyDates = np.array([TherapyConfigurations[i]["TherapyDate"] for i in GroupCandidates])
+        order = np.argsort(TherapyDates, kind="stable")
+        selectedEvents = np.where(GroupId == group)[0]
+        position = np.searchsorted(TherapyDates[order], EventTime[selectedEvents], side="right")
+        valid = position < len(order)
+        TherapyIndex[selectedEvents[valid]] = GroupCandidates[order[position[valid]]]
+    return TherapyIndex
+
 def queryPatientEventPSDs(user, patientUniqueID, TherapyHistory, authority):
+    """ Query event PSDs of all Percept devices with the therapy configuration active at each event.
+
+    Args:
+      user: BRAVO Platform User object. 
+      patientUniqueID: Deidentified patient ID as referenced in SQL Database. 
+      TherapyHistory: therapy change history of the patient (unused, therapy configurations are queried directly).
+      authority: User permission structure indicating the type of access the user has.
+
+    Returns:
+      List of event PSDs per device hemisphere. "PSDs" is a float32 (events x frequency bins) matrix and 
+      "Therapy" and "EventName" are lists aligned with its rows. Events without matching therapy configuration are excluded.
+    """
+
     PatientEventPSDs = list()
     if not authority["Permission"]:
         return PatientEventPSDs
@@ -128,74 +217,93 @@ def queryPatientEventPSDs(user, patientUniqueID, TherapyHistory, authority):
     availableDevices = Database.getPerceptDevices(user, patientUniqueID, authority)
     TherapyConfigurations = Therapy.queryTherapyConfigurations(user, patientUniqueID, authority, therapyType="Past Therapy")
     for device in availableDevices:
-        EventPSDs = models.PatientCustomEvents.objects.filter(device_deidentified_id=device.deidentified_id, sensing_exist=True).all()
+        EventPSDs = list(models.PatientCustomEvents.objects.filter(device_deidentified_id=device.deidentified_id, sensing_exist=True).values_list("event_name", "neural_psd"))
         if len(EventPSDs) > 0:
             leads = device.device_lead_configurations
             for hemisphere in ["HemisphereLocationDef.Left","HemisphereLocationDef.Right"]:
-                if device.device_name == "":
-                    PatientEventPSDs.append({"Device": str(device.deidentified_id) if not (user.is_admin or user.is_clinician) else device.getDeviceSerialNumber(key), "DeviceLocation": device.device_location, "PSDs": list(), "EventName": list(), "Therapy": list()})
-                else:
-                    PatientEventPSDs.append({"Device": device.device_name, "DeviceLocation": device.device_location, "PSDs": list(), "EventName": list(), "Therapy": list()})
-
+                HemisphereName = None
                 for lead in leads:
                     if lead["TargetLocation"].startswith(hemisphere.replace("HemisphereLocationDef.","")):
-                        PatientEventPSDs[-1]["Hemisphere"] = lead["TargetLocation"]
+                        HemisphereName = lead["TargetLocation"]
+                if HemisphereName == None:
+                    continue
+
+                if device.device_name == "":
+                    PatientEventPSDs.append({"Device": str(device.deidentified_id) if not (user.is_admin or user.is_clinician) else device.getDeviceSerialNumber(key), "DeviceLocation": device.device_location})
+                else:
+                    PatientEventPSDs.append({"Device": device.device_name, "DeviceLocation": device.device_location})
 
                 TherapyKey = hemisphere.replace("HemisphereLocationDef.","") + "Hemisphere"
-                for eventPSD in EventPSDs:
-                    if hemisphere in eventPSD.neural_psd.keys():
-                        EventTimestamp = Percept.getTimestamp(eventPSD.neural_psd[hemisphere]["DateTime"])
-                        if EventTimestamp > authority["Permission"][0]:
-                            if authority["Permission"][1] > 0 and EventTimestamp < authority["Permission"][1]:
-                                for therapy in TherapyConfigurations:
-                                    if therapy["DeviceID"] == str(device.deidentified_id) and therapy["TherapyGroup"] == eventPSD.neural_psd[hemisphere]["GroupId"] and therapy["TherapyDate"] > EventTimestamp and TherapyKey in therapy["Therapy"].keys():
-                                        PatientEventPSDs[-1]["Therapy"].append(therapy["Therapy"][TherapyKey])
-                                        if len(eventPSD.neural_psd[hemisphere]["FFTBinData"]) < 100: 
-                                            eventPSD.neural_psd[hemisphere]["FFTBinData"].extend([0 for i in range(100-len(eventPSD.neural_psd[hemisphere]["FFTBinData"]))])
-                                        PatientEventPSDs[-1]["PSDs"].append(eventPSD.neural_psd[hemisphere]["FFTBinData"])
-                                        PatientEventPSDs[-1]["EventName"].append(eventPSD.event_name)
-                                        break
-                            elif authority["Permission"][1] == 0:
-                                for therapy in TherapyConfigurations:
-                                    if therapy["DeviceID"] == str(device.deidentified_id) and therapy["TherapyGroup"] == eventPSD.neural_psd[hemisphere]["GroupId"] and therapy["TherapyDate"] > EventTimestamp and TherapyKey in therapy["Therapy"].keys():
-                                        PatientEventPSDs[-1]["Therapy"].append(therapy["Therapy"][TherapyKey])
-                                        if len(eventPSD.neural_psd[hemisphere]["FFTBinData"]) < 100: 
-                                            eventPSD.neural_psd[hemisphere]["FFTBinData"].extend([0 for i in range(100-len(eventPSD.neural_psd[hemisphere]["FFTBinData"]))])
-                                        PatientEventPSDs[-1]["PSDs"].append(eventPSD.neural_psd[hemisphere]["FFTBinData"])
-                                        PatientEventPSDs[-1]["EventName"].append(eventPSD.event_name)
-                                        break
+                PSDs, EventName, EventTime, GroupId = getEventPSDMatrix(EventPSDs, hemisphere, authority)
+                TherapyIndex = getEventTherapyIndex(TherapyConfigurations, str(device.deidentified_id), TherapyKey, EventTime, GroupId)
+                selectedEvents = np.where(TherapyIndex >= 0)[0]
 
-    i = 0
-    while i < len(PatientEventPSDs):
-        if not "Hemisphere" in PatientEventPSDs[i]:
-            del(PatientEventPSDs[i])
-        else:
-            i += 1
+                PatientEventPSDs[-1]["PSDs"] = PSDs[selectedEvents,:]
+                PatientEventPSDs[-1]["EventName"] = [EventName[j] for j in selectedEvents]
+                PatientEventPSDs[-1]["Therapy"] = [TherapyConfigurations[TherapyIndex[j]]["Therapy"][TherapyKey] for j in selectedEvents]
+                PatientEventPSDs[-1]["Hemisphere"] = HemisphereName
 
     return PatientEventPSDs
 
 def processEventPSDs(PatientEventPSDs):
+    """ Average event PSDs for each therapy configuration and event name.
+
+    Events are grouped by (therapy configuration, event name) in order of first appearance, 
+    and mean and standard error of all groups are computed with grouped reductions over the sorted PSD matrix.
+
+    Args:
+      PatientEventPSDs: list of event PSDs per device hemisphere from ``queryPatientEventPSDs`` or ``queryPatientEventPSDsByTime``.
+
+    Returns:
+      PatientEventPSDs with "Render" list added to each entry.
+    """
+
     def formatTherapyString(Therapy):
         return f"Stimulation {Percept.reformatStimulationChannel(Therapy['Channel'])} {Therapy['Frequency']}Hz {Therapy['PulseWidth']}uS"
 
     for i in range(len(PatientEventPSDs)):
         PatientEventPSDs[i]["Render"] = list()
-        PatientEventPSDs[i]["PSDs"] = np.array(PatientEventPSDs[i]["PSDs"])
-        StimulationConfigurations = [PatientEventPSDs[i]["Therapy"][j] if PatientEventPSDs[i]["Therapy"][j] == "Generic" else formatTherapyString(PatientEventPSDs[i]["Therapy"][j]) for j in range(len(PatientEventPSDs[i]["Therapy"]))]
-        uniqueConfiguration = uniqueList(StimulationConfigurations)
-        for config in uniqueConfiguration:
-            PatientEventPSDs[i]["Render"].append({"Therapy": config, "Hemisphere": PatientEventPSDs[i]["Device"] + " " + PatientEventPSDs[i]["Hemisphere"], "Events": list()})
-
-            selectedPSDs = iterativeCompare(StimulationConfigurations, config, "equal").flatten()
-            Events = listSelection(PatientEventPSDs[i]["EventName"], selectedPSDs)
-            for eventName in uniqueList(Events):
-                eventSelection = iterativeCompare(PatientEventPSDs[i]["EventName"], eventName, "equal").flatten()
-                PatientEventPSDs[i]["Render"][-1]["Events"].append({
-                    "EventName": eventName,
-                    "Count": f"(n={np.sum(np.bitwise_and(selectedPSDs, eventSelection))})",
-                    "MeanPSD": np.mean(PatientEventPSDs[i]["PSDs"][np.bitwise_and(selectedPSDs, eventSelection),:],axis=0).flatten(),
-                    "StdPSD": SPU.stderr(PatientEventPSDs[i]["PSDs"][np.bitwise_and(selectedPSDs, eventSelection),:],axis=0).flatten()
-                })
+        PatientEventPSDs[i]["PSDs"] = np.asarray(PatientEventPSDs[i]["PSDs"])
+        if len(PatientEventPSDs[i]["EventName"]) == 0:
+            continue
+
+        # Events of the same query share therapy objects, so each configuration is only formatted once.
+        TherapyStrings = dict()
+        Configurations = dict()
+        Groups = dict()
+        GroupIndex = np.zeros(len(PatientEventPSDs[i]["EventName"]), dtype=int)
+        for j in range(len(PatientEventPSDs[i]["EventName"])):
+            therapy = PatientEventPSDs[i]["Therapy"][j]
+            if therapy == "Generic":
+                config = therapy
+            else:
+                if not id(therapy) in TherapyStrings.keys():
+                    TherapyStrings[id(therapy)] = formatTherapyString(therapy)
+                config = TherapyStrings[id(therapy)]
+
+            if not config in Configurations.keys():
+                Configurations[config] = len(Configurations)
+                PatientEventPSDs[i]["Render"].append({"Therapy": config, "Hemisphere": PatientEventPSDs[i]["Device"] + " " + PatientEventPSDs[i]["Hemisphere"], "Events": list()})
+
+            groupKey = (config, PatientEventPSDs[i]["EventName"][j])
+            if not groupKey in Groups.keys():
+                Groups[groupKey] = len(Groups)
+            GroupIndex[j] = Groups[groupKey]
+
+        order = np.argsort(GroupIndex, kind="stable")
+        PSDs = PatientEventPSDs[i]["PSDs"][order].astype(np.float64)
+        Count = np.bincount(GroupIndex, minlength=len(Groups))
+        GroupStart = np.cumsum(Count) - Count
+        MeanPSD = np.add.reduceat(PSDs, GroupStart, axis=0) / Count.reshape(-1,1)
+        StdPSD = np.sqrt(np.add.reduceat((PSDs - MeanPSD[GroupIndex[order]])**2, GroupStart, axis=0) / Count.reshape(-1,1)) / np.sqrt(Count.reshape(-1,1))
+
+        for (config, eventName), group in Groups.items():
+            PatientEventPSDs[i]["Render"][Configurations[config]]["Events"].append({
+                "EventName": eventName,
+                "Count": f"(n={Count[group]})",
+                "MeanPSD": MeanPSD[group],
+                "StdPSD": StdPSD[group]
+            })
 
     return PatientEventPSDs
 
@@ -39,10 +39,16 @@ from decoder import Percept
 from utility import SignalProcessingUtility as SPU
 from utility.PythonUtility import *
 
+from django.db import transaction
+
 from Backend import models
-from modules import Database
+from modules import Database, CardiacFilter, MissingLabel, LevelOfDetail
 
 DATABASE_PATH = os.environ.get('DATASERVER_PATH')
+
+# Version identifier of processRealtimeStreams output. Increment when the processing algorithm changes 
+# so that previously stored derived products are no longer used. 
+PROCESSING_VERSION = 2
 key = os.environ.get('ENCRYPTION_KEY')
 
 def saveRealtimeStreams(deviceID, StreamingTD, StreamingPower, sourceFile):
@@ -232,40 +238,50 @@ def saveRealtimeStreams(deviceID, StreamingTD, StreamingPower, sourceFile):
             del(PowerDomainRecordings[i])
             del(TimeDomainRecordings[i])
     
+    # Existing recordings and analyses of this session are queried once and matched in memory.
+    TimeDomainDates = [datetime.fromtimestamp(Recording["StartTime"]).astimezone(tz=pytz.utc) for Recording in TimeDomainRecordings]
+    PowerDomainDates = [datetime.fromtimestamp(Recording["StartTime"]).astimezone(tz=pytz.utc) for Recording in PowerDomainRecordings]
+    ExistingRecordings = dict()
+    for recording in models.NeuralActivityRecording.objects.filter(device_deidentified_id=deviceID, recording_type__in=["BrainSenseStreamTimeDomain", "BrainSenseStreamPowerDomain"], recording_date__in=TimeDomainDates+PowerDomainDates).all():
+        if recording.recording_info and "Channel" in recording.recording_info.keys():
+            recordingKey = (recording.recording_type, recording.recording_date, json.dumps(recording.recording_info["Channel"]))
+            if not recordingKey in ExistingRecordings.keys():
+                ExistingRecordings[recordingKey] = recording
+    
+    NewRecordings = []
     TimeDomainRecordingModel = []
     for i in range(len(TimeDomainRecordings)):
-        recording_date = datetime.fromtimestamp(TimeDomainRecordings[i]["StartTime"]).astimezone(tz=pytz.utc)
-        recording_info = {"Channel": TimeDomainRecordings[i]["ChannelNames"]}
-        if not models.NeuralActivityRecording.objects.filter(device_deidentified_id=deviceID, recording_type="BrainSenseStreamTimeDomain", recording_date=recording_date, recording_info__Channel=TimeDomainRecordings[i]["ChannelNames"]).exists():
-            recording = models.NeuralActivityRecording(device_deidentified_id=deviceID, recording_date=recording_date, source_file=sourceFile, recording_type="BrainSenseStreamTimeDomain", recording_info=recording_info)
+        recordingKey = ("BrainSenseStreamTimeDomain", TimeDomainDates[i], json.dumps(TimeDomainRecordings[i]["ChannelNames"]))
+        if not recordingKey in ExistingRecordings.keys():
+            recording_info = {"Channel": TimeDomainRecordings[i]["ChannelNames"]}
+            recording = models.NeuralActivityRecording(device_deidentified_id=deviceID, recording_date=TimeDomainDates[i], source_file=sourceFile, recording_type="BrainSenseStreamTimeDomain", recording_info=recording_info)
             filename = Database.saveSourceFiles(TimeDomainRecordings[i], "BrainSenseStreamTimeDomain", "Raw", recording.recording_id, recording.device_deidentified_id)
             recording.recording_datapointer = filename
-            recording.recording_duration = TimeDomainRecordings[i]["Duration"]
-            recording.save()
-            TimeDomainRecordingModel.append(recording)
+            Database.updateRecordingCatalog(recording, TimeDomainRecordings[i])
+            ExistingRecordings[recordingKey] = recording
+            NewRecordings.append(recording)
             NewRecordingFound = True
-        else:
-            recording = models.NeuralActivityRecording.objects.filter(device_deidentified_id=deviceID, recording_type="BrainSenseStreamTimeDomain", recording_date=recording_date, recording_info__Channel=TimeDomainRecordings[i]["ChannelNames"]).first()
-            TimeDomainRecordingModel.append(recording)
+        TimeDomainRecordingModel.append(ExistingRecordings[recordingKey])
 
     PowerDomainRecordingModel = []
     for i in range(len(PowerDomainRecordings)):
-        recording_date = datetime.fromtimestamp(PowerDomainRecordings[i]["StartTime"]).astimezone(tz=pytz.utc)
-        recording_info = {"Channel": PowerDomainRecordings[i]["ChannelNames"]}
-        if not models.NeuralActivityRecording.objects.filter(device_deidentified_id=deviceID, recording_type="BrainSenseStreamPowerDomain", recording_date=recording_date, recording_info__Channel=PowerDomainRecordings[i]["ChannelNames"]).exists():
-            recording = models.NeuralActivityRecording(device_deidentified_id=deviceID, recording_date=recording_date, source_file=sourceFile, recording_type="BrainSenseStreamPowerDomain", recording_info=recording_info)
+        recordingKey = ("BrainSenseStreamPowerDomain", PowerDomainDates[i], json.dumps(PowerDomainRecordings[i]["ChannelNames"]))
+        if not recordingKey in ExistingRecordings.keys():
+            recording_info = {"Channel": PowerDomainRecordings[i]["ChannelNames"]}
+            recording = models.NeuralActivityRecording(device_deidentified_id=deviceID, recording_date=PowerDomainDates[i], source_file=sourceFile, recording_type="BrainSenseStreamPowerDomain", recording_info=recording_info)
             filename = Database.saveSourceFiles(PowerDomainRecordings[i], "BrainSenseStreamPowerDomain", "Raw", recording.recording_id, recording.device_deidentified_id)
             recording.recording_datapointer = filename
-            recording.recording_duration = PowerDomainRecordings[i]["Duration"]
-            recording.save()
-            PowerDomainRecordingModel.append(recording)
+            recording.recording_info["ContactType"] = ["Ring" for channel in PowerDomainRecordings[i]["ChannelNames"] if channel.endswith(" Power")]
+            Database.updateRecordingCatalog(recording, PowerDomainRecordings[i])
+            ExistingRecordings[recordingKey] = recording
+            NewRecordings.append(recording)
             NewRecordingFound = True
-        else:
-            recording = models.NeuralActivityRecording.objects.filter(device_deidentified_id=deviceID, recording_type="BrainSenseStreamPowerDomain", recording_date=recording_date, recording_info__Channel=PowerDomainRecordings[i]["ChannelNames"]).first()
-            PowerDomainRecordingModel.append(recording)
+        PowerDomainRecordingModel.append(ExistingRecordings[recordingKey])
 
+    ExistingAnalysisDates = set(models.CombinedRecordingAnalysis.objects.filter(device_deidentified_id=deviceID, analysis_name="DefaultBrainSenseStreaming", analysis_date__in=TimeDomainDates).values_list("analysis_date", flat=True))
+    NewAnalyses = []
     for i in range(len(TimeDomainRecordings)):
-        recording_date = datetime.fromtimestamp(TimeDomainRecordings[i]["StartTime"]).astimezone(tz=pytz.utc)
+        recording_date = TimeDomainDates[i]
         CorrespondingRecordingFound = False
         for j in range(len(PowerDomainRecordings)):
             LatestStartTime = np.max((PowerDomainRecordings[j]["StartTime"], TimeDomainRecordings[i]["StartTime"]))
@@ -277,17 +293,43 @@ def saveRealtimeStreams(deviceID, StreamingTD, StreamingPower, sourceFile):
                     if CorrespondingRecordingFound:
                         raise Exception("Multiple Corresponding Power Channel?")
                 
-                    if not models.CombinedRecordingAnalysis.objects.filter(device_deidentified_id=deviceID, analysis_name="DefaultBrainSenseStreaming", analysis_date=recording_date).exists():
+                    if not recording_date in ExistingAnalysisDates:
                         recording_list = [str(TimeDomainRecordingModel[i].recording_id), str(PowerDomainRecordingModel[j].recording_id)]
                         recording_type = ["BrainSenseRecording", "BrainSenseRecording"]
-                        models.CombinedRecordingAnalysis(device_deidentified_id=deviceID, analysis_name="DefaultBrainSenseStreaming", analysis_date=recording_date, 
-                                                                    recording_list=recording_list, recording_type=recording_type).save()
+                        NewAnalyses.append(models.CombinedRecordingAnalysis(device_deidentified_id=deviceID, analysis_name="DefaultBrainSenseStreaming", analysis_date=recording_date, 
+                                                                    recording_list=recording_list, recording_type=recording_type))
+                        ExistingAnalysisDates.add(recording_date)
                         CorrespondingRecordingFound = True
                 else:
                     print(f"Matching Data with low overlap: {Overlap} - {ShortestDuration}")
     
+    with transaction.atomic():
+        models.NeuralActivityRecording.objects.bulk_create(NewRecordings)
+        models.CombinedRecordingAnalysis.objects.bulk_create(NewAnalyses)
+
     return NewRecordingFound
 
+def getProcessingParameters(cardiacFilter=False):
+    """ Processing parameters used by processRealtimeStreams
+
+    The parameters identify the derived product (filtered data, wavelet and spectrogram) of a streaming recording 
+    in the derived product store (see Database.getDerivedProductPointer function).
+
+    Args:
+      cardiacFilter: Boolean indicating if cardiac filter is applied.
+
+    Returns:
+      Dictionary of processing parameters.
+    """
+
+    return {
+        "CardiacFilter": cardiacFilter,
+        "CardiacFilterMethod": "Kurtosis" if cardiacFilter else "None",
+        "SpectrogramWindow": 1.0,
+        "SpectrogramOverlap": 0.5,
+        "WaveletMovingAverage": 0.5,
+    }
+
 def processRealtimeStreams(stream, cardiacFilter=False):
     """ Process Streaming Data 
 
@@ -321,95 +363,13 @@ def processRealtimeStreams(stream, cardiacFilter=False):
             stream["TimeDomain"]["Filtered"][i] -= PredictedSignal
 
             if filterMethod == "Fixed Peak Find":
-                # Cardiac Filter
-                posPeaks,_ = signal.find_peaks(stream["TimeDomain"]["Filtered"][i], prominence=[10,200], distance=stream["TimeDomain"]["SamplingRate"]*0.5)
-                PosCardiacVariability = np.std(np.diff(posPeaks))
-                negPeaks,_ = signal.find_peaks(-stream["TimeDomain"]["Filtered"][i], prominence=[10,200], distance=stream["TimeDomain"]["SamplingRate"]*0.5)
-                NegCardiacVariability = np.std(np.diff(negPeaks))
-
-                if PosCardiacVariability < NegCardiacVariability:
-                    peaks = posPeaks
-                else:
-                    peaks = negPeaks
-                CardiacRate = int(np.mean(np.diff(peaks)))
-
-                PrePeak = int(CardiacRate*0.25)
-                PostPeak = int(CardiacRate*0.65)
-                EKGMatrix = np.zeros((len(peaks)-2,PrePeak+PostPeak))
-                for j in range(1,len(peaks)-1):
-                    if peaks[j]+PostPeak < len(stream["TimeDomain"]["Filtered"][i]) and peaks[j]-PrePeak > 0:
-                        EKGMatrix[j-1,:] = stream["TimeDomain"]["Filtered"][i][peaks[j]-PrePeak:peaks[j]+PostPeak]
-
-                EKGTemplate = np.mean(EKGMatrix,axis=0)
-                EKGTemplate = EKGTemplate / (np.max(EKGTemplate)-np.min(EKGTemplate))
-
-                def EKGTemplateFunc(xdata, amplitude, offset):
-                    return EKGTemplate * amplitude + offset
-
-                for j in range(len(peaks)):
-                    if peaks[j]-PrePeak < 0:
-                        pass
-                    elif peaks[j]+PostPeak >= len(stream["TimeDomain"]["Filtered"][i]) :
-                        pass
-                    else:
-                        sliceSelection = np.arange(peaks[j]-PrePeak,peaks[j]+PostPeak)
-                        params, covmat = optimize.curve_fit(EKGTemplateFunc, sliceSelection, stream["TimeDomain"]["Filtered"][i][sliceSelection])
-                        stream["TimeDomain"]["Filtered"][i][sliceSelection] = stream["TimeDomain"]["Filtered"][i][sliceSelection] - EKGTemplateFunc(sliceSelection, *params)
-
+                stream["TimeDomain"]["Filtered"][i] = CardiacFilter.fixedPeakTemplateFilter(stream["TimeDomain"]["Filtered"][i], stream["TimeDomain"]["SamplingRate"])
             else:
-                Window = 125
-                KurtosisIndex = range(0, len(stream["TimeDomain"]["Filtered"][i])-Window)
-                ExpectedKurtosis = np.zeros((len(KurtosisIndex)))
-                for j in range(len(KurtosisIndex)):
-                    zScore = stats.zscore(stream["TimeDomain"]["Filtered"][i][KurtosisIndex[j]:KurtosisIndex[j]+Window])
-                    ExpectedKurtosis[j] = np.mean(np.power(zScore, 4))
-
-                [b,a] = signal.butter(3, np.array([0.5, 2])*2/250, "bandpass")
-                ExpectedKurtosis = signal.filtfilt(b,a,ExpectedKurtosis)
-                Peaks, _ = signal.find_peaks(ExpectedKurtosis, distance=125)
-                Peaks += int(Window/2)
-
-                CardiacEpochs = []
-                SearchWindow = 100
-                for j in range(len(Peaks)):
-                    if ExpectedKurtosis[Peaks[j]-int(Window/2)] < 1.2:
-                        continue
-
-                    ShiftPeak = 0
-                    if Peaks[j]-SearchWindow-ShiftPeak < 0 or Peaks[j]+SearchWindow-ShiftPeak >= len(stream["TimeDomain"]["Filtered"][i]):
-                        continue 
-                    findPeak = np.argmax(stream["TimeDomain"]["Filtered"][i][Peaks[j]-SearchWindow:Peaks[j]+SearchWindow])
-                    ShiftPeak = SearchWindow-findPeak
-                    if Peaks[j]-SearchWindow-ShiftPeak < 0 or Peaks[j]+SearchWindow-ShiftPeak >= len(stream["TimeDomain"]["Filtered"][i]):
-                        continue 
-                    CardiacEpochs.append(stream["TimeDomain"]["Filtered"][i][Peaks[j]-SearchWindow-ShiftPeak:Peaks[j]+SearchWindow-ShiftPeak])
-
-                EKGTemplate = np.mean(np.array(CardiacEpochs), axis=0)
-                EKGTemplate = EKGTemplate / (np.max(EKGTemplate)-np.min(EKGTemplate))
-
-                def EKGTemplateFunc(xdata, amplitude, offset):
-                    return EKGTemplate * amplitude + offset
-
-                CardiacFiltered = copy.deepcopy(stream["TimeDomain"]["Filtered"][i])
-                for j in range(len(Peaks)):
-                    ShiftPeak = 0
-                    if Peaks[j]-SearchWindow-ShiftPeak < 0 or Peaks[j]+SearchWindow-ShiftPeak >= len(stream["TimeDomain"]["Filtered"][i]):
-                        continue 
-
-                    findPeak = np.argmax(stream["TimeDomain"]["Filtered"][i][Peaks[j]-SearchWindow:Peaks[j]+SearchWindow])
-                    ShiftPeak = SearchWindow-findPeak
-                    if Peaks[j]-SearchWindow-ShiftPeak < 0 or Peaks[j]+SearchWindow-ShiftPeak >= len(stream["TimeDomain"]["Filtered"][i]):
-                        continue
-                    
-                    sliceSelection = np.arange(Peaks[j]-SearchWindow-ShiftPeak, Peaks[j]+SearchWindow-ShiftPeak)
-                    Original = stream["TimeDomain"]["Filtered"][i][sliceSelection]
-                    params, covmat = optimize.curve_fit(EKGTemplateFunc, sliceSelection, Original)
-                    CardiacFiltered[sliceSelection] = Original - EKGTemplateFunc(sliceSelection, *params)
-                stream["TimeDomain"]["Filtered"][i] = CardiacFiltered
+                stream["TimeDomain"]["Filtered"][i] = CardiacFilter.kurtosisTemplateFilter(stream["TimeDomain"]["Filtered"][i], stream["TimeDomain"]["SamplingRate"], window=125)
 
         # Wavelet Computation
         stream["TimeDomain"]["Wavelet"].append(SPU.waveletTimeFrequency(stream["TimeDomain"]["Filtered"][i], freq=np.arange(0.5,100.5,0.5), ma=int(stream["TimeDomain"]["SamplingRate"]/2), fs=stream["TimeDomain"]["SamplingRate"]))
-        stream["TimeDomain"]["Wavelet"][i]["Missing"] = stream["TimeDomain"]["Missing"][:,i][::int(stream["TimeDomain"]["SamplingRate"]/2)]
+        stream["TimeDomain"]["Wavelet"][i]["Missing"] = MissingLabel.decimateMissingLabel(stream["TimeDomain"]["Missing"][:,i], int(stream["TimeDomain"]["SamplingRate"]/2))
         stream["TimeDomain"]["Wavelet"][i]["Power"] = stream["TimeDomain"]["Wavelet"][i]["Power"][:,::int(stream["TimeDomain"]["SamplingRate"]/2)]
         stream["TimeDomain"]["Wavelet"][i]["Time"] = stream["TimeDomain"]["Wavelet"][i]["Time"][::int(stream["TimeDomain"]["SamplingRate"]/2)]
         stream["TimeDomain"]["Wavelet"][i]["Type"] = "Wavelet"
@@ -421,10 +381,7 @@ def processRealtimeStreams(stream, cardiacFilter=False):
         stream["TimeDomain"]["Spectrogram"][i]["Time"] += 0 # TODO Check later
         
         TimeArray = np.arange(len(stream["TimeDomain"]["Filtered"][i])) / stream["TimeDomain"]["SamplingRate"]
-        stream["TimeDomain"]["Spectrogram"][i]["Missing"] = np.zeros(stream["TimeDomain"]["Spectrogram"][i]["Time"].shape, dtype=bool)
-        for j in range(len(stream["TimeDomain"]["Spectrogram"][i]["Missing"])):
-            if np.any(stream["TimeDomain"]["Missing"][rangeSelection(TimeArray, [stream["TimeDomain"]["Spectrogram"][i]["Time"][j]-2, stream["TimeDomain"]["Spectrogram"][i]["Time"][j]+2]), i]):
-                stream["TimeDomain"]["Spectrogram"][i]["Missing"][j] = True
+        stream["TimeDomain"]["Spectrogram"][i]["Missing"] = MissingLabel.windowMissingLabel(stream["TimeDomain"]["Missing"][:,i], TimeArray, stream["TimeDomain"]["Spectrogram"][i]["Time"]-2, stream["TimeDomain"]["Spectrogram"][i]["Time"]+2)
         del(stream["TimeDomain"]["Spectrogram"][i]["logPower"])
 
     return stream
@@ -471,15 +428,18 @@ def queryRealtimeStreamRecording(analysis, cardiacFilter=False, refresh=False):
         BrainSenseData["Info"].update(TimeRecording.recording_info)
         BrainSenseData["TimeDomain"] = Database.loadSourceDataPointer(TimeRecording.recording_datapointer)
     
-    if not "CardiacFilter" in TimeRecording.recording_info:
-        TimeRecording.recording_info["CardiacFilter"] = cardiacFilter
-        TimeRecording.save()
-
-    if not "Spectrogram" in BrainSenseData["TimeDomain"].keys() or (refresh or not TimeRecording.recording_info["CardiacFilter"] == cardiacFilter):
-        TimeRecording.recording_info["CardiacFilter"] = cardiacFilter
+    ProcessingParameters = getProcessingParameters(cardiacFilter)
+    DerivedProduct = None
+    if not refresh:
+        DerivedProduct = Database.loadDerivedProduct(TimeRecording.recording_datapointer, ProcessingParameters, PROCESSING_VERSION)
+    
+    if DerivedProduct:
+        BrainSenseData["TimeDomain"].update(DerivedProduct)
+    else:
         BrainSenseData = processRealtimeStreams(BrainSenseData, cardiacFilter=cardiacFilter)
-        Database.saveSourceFiles(BrainSenseData["TimeDomain"], "BrainSenseStreamTimeDomain", "Raw", TimeRecording.recording_id, TimeRecording.device_deidentified_id)
-        TimeRecording.save()
+        BrainSenseData["TimeDomain"]["Pyramid"] = LevelOfDetail.buildStreamPyramid(BrainSenseData["TimeDomain"])
+        Database.saveDerivedProduct({key: BrainSenseData["TimeDomain"][key] for key in ["Filtered", "Wavelet", "Spectrogram", "Pyramid"]}, 
+                                    TimeRecording.recording_datapointer, ProcessingParameters, PROCESSING_VERSION)
     
     if "Alignment" in PowerRecording.recording_info.keys():
         BrainSenseData["PowerDomain"]["StartTime"] += PowerRecording.recording_info["Alignment"]/1000
@@ -488,6 +448,7 @@ def queryRealtimeStreamRecording(analysis, cardiacFilter=False, refresh=False):
     BrainSenseData["Info"].update(PowerRecording.recording_info)
     BrainSenseData["Info"].update(TimeRecording.recording_info)
     BrainSenseData["Info"]["Device"] = "Percept PC"
+    BrainSenseData["Info"]["CardiacFilter"] = cardiacFilter
 
     RecordingID = analysis.deidentified_id
     
@@ -520,15 +481,15 @@ def queryMultipleSegmentComparison(user, recordingIds, authority):
         if str(recording.device_deidentified_id) in authority["Devices"]:
             BrainSenseData = Database.loadSourceDataPointer(recording.recording_datapointer)
 
-            if len(recording.recording_info["Channel"]) == 2:
-                info = "Bilateral"
-            else:
-                info = "Unilateral"
-
+            # Spectrogram is stored as derived product, the raw recording is left untouched.
             if not "Spectrogram" in BrainSenseData.keys():
-                BrainSenseData = processRealtimeStreams(BrainSenseData)
-                Database.saveSourceFiles(BrainSenseData, recording.recording_type, info, recording.recording_id, recording.device_deidentified_id)
-                recording.save()
+                ProcessingParameters = getProcessingParameters()
+                DerivedProduct = Database.loadDerivedProduct(recording.recording_datapointer, ProcessingParameters, PROCESSING_VERSION)
+                if DerivedProduct == None:
+                    BrainSenseData = processRealtimeStreams(BrainSenseData)
+                    DerivedProduct = {"Spectrogram": BrainSenseData["Spectrogram"]}
+                    Database.saveDerivedProduct(DerivedProduct, recording.recording_datapointer, ProcessingParameters, PROCESSING_VERSION)
+                BrainSenseData.update(DerivedProduct)
             
             BrainSenseData["Stimulation"] = processRealtimeStreamStimulationAmplitude(BrainSenseData)
             for StimulationSeries in BrainSenseData["Stimulation"]:
@@ -602,15 +563,12 @@ def mergeRealtimeStreamData(recordings):
     else:
         info = "Unilateral"
         
-    Database.saveSourceFiles(CombinedData, recordings[0].recording_type, info, recordings[0].recording_id, recordings[0].device_deidentified_id)
+    recordings[0].recording_datapointer = Database.saveSourceFiles(CombinedData, recordings[0].recording_type, info, recordings[0].recording_id, recordings[0].device_deidentified_id)
     recordings[0].recording_duration = CombinedData["Time"][-1]
     recordings[0].save()
 
     for i in range(1, len(recordings)):
-        try:
-            os.remove(DATABASE_PATH + "recordings" + os.path.sep + recordings[i].recording_datapointer)
-        except:
-            pass
+        Database.deleteSourceDataPointer(recordings[i].recording_datapointer)
         recordings[i].delete()
     
     return True
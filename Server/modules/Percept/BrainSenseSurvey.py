@@ -23,11 +23,14 @@ import os, sys, pathlib
 RESOURCES = str(pathlib.Path(__file__).parent.parent.resolve())
 sys.path.append(os.environ.get("PYTHON_UTILITY"))
 
+import json
 from datetime import datetime
 import pytz
 import numpy as np
 from scipy import signal
 
+from django.db import transaction
+
 from Backend import models
 from modules import Database
 
@@ -54,6 +57,13 @@ def saveBrainSenseSurvey(deviceID, streamList, sourceFile):
         StreamDates.append(datetime.fromtimestamp(stream["FirstPacketDateTime"], tz=pytz.utc))
     UniqueSessionDates = np.unique(StreamDates)
 
+    # Existing recordings are queried once and matched in memory.
+    ExistingRecordings = set()
+    for recording in models.NeuralActivityRecording.objects.filter(device_deidentified_id=deviceID, recording_type="BrainSenseSurvey", recording_date__in=list(UniqueSessionDates)).all():
+        if recording.recording_info and "Channel" in recording.recording_info.keys():
+            ExistingRecordings.add((recording.recording_date, json.dumps(recording.recording_info["Channel"])))
+
+    NewRecordings = []
     for date in UniqueSessionDates:
         Recording = dict()
         Recording["SamplingRate"] = streamList[0]["SamplingRate"]
@@ -93,13 +103,17 @@ def saveBrainSenseSurvey(deviceID, streamList, sourceFile):
         Recording["Duration"] = Recording["Data"].shape[0] / Recording["SamplingRate"]
         recording_info = {"Channel": Recording["ChannelNames"]}
 
-        if not models.NeuralActivityRecording.objects.filter(device_deidentified_id=deviceID, recording_type="BrainSenseSurvey", recording_date=date, recording_info=recording_info).exists():
+        if not (date, json.dumps(recording_info["Channel"])) in ExistingRecordings:
             recording = models.NeuralActivityRecording(device_deidentified_id=deviceID, recording_date=date, recording_type="BrainSenseSurvey", recording_info=recording_info, source_file=sourceFile)
             filename = Database.saveSourceFiles(Recording, "BrainSenseSurvey", "Combined", recording.recording_id, recording.device_deidentified_id)
             recording.recording_datapointer = filename
-            recording.save()
+            Database.updateRecordingCatalog(recording, Recording)
+            ExistingRecordings.add((date, json.dumps(recording_info["Channel"])))
+            NewRecordings.append(recording)
             NewRecordingFound = True
-            
+    
+    with transaction.atomic():
+        models.NeuralActivityRecording.objects.bulk_create(NewRecordings)
     return NewRecordingFound
 
 def querySurveyResults(user, patientUniqueID, options, requestRaw, authority):
@@ -137,11 +151,15 @@ def querySurveyResults(user, patientUniqueID, options, requestRaw, authority):
                 
             if not "PSDMethod" in survey["Descriptor"].keys():
                 survey = processBrainSenseSurvey(survey, options["PSDMethod"]["value"])
-                Database.saveSourceFiles(survey, "BrainSenseSurvey", "Combined", recording.recording_id, recording.device_deidentified_id)
+                recording.recording_datapointer = Database.saveSourceFiles(survey, "BrainSenseSurvey", "Combined", recording.recording_id, recording.device_deidentified_id)
+                Database.updateRecordingCatalog(recording, survey)
+                recording.save()
             
             if not options["PSDMethod"]["value"] == survey["Descriptor"]["PSDMethod"]:
                 survey = processBrainSenseSurvey(survey, options["PSDMethod"]["value"])
-                Database.saveSourceFiles(survey, "BrainSenseSurvey", "Combined", recording.recording_id, recording.device_deidentified_id)
+                recording.recording_datapointer = Database.saveSourceFiles(survey, "BrainSenseSurvey", "Combined", recording.recording_id, recording.device_deidentified_id)
+                Database.updateRecordingCatalog(recording, survey)
+                recording.save()
 
             # Monopolar Estimation
 
@@ -39,8 +39,10 @@ from decoder import Percept
 from utility import SignalProcessingUtility as SPU
 from utility.PythonUtility import *
 
+from django.db import transaction
+
 from Backend import models
-from modules import Database
+from modules import Database, ChronicAggregation
 
 key = os.environ.get('ENCRYPTION_KEY')
 
@@ -57,44 +59,112 @@ def saveChronicLFP(deviceID, ChronicLFPs, sourceFile):
     """
 
     NewRecordingFound = False
+
+    # Existing recordings are queried once and matched in memory.
+    ExistingRecordings = dict()
+    for recording in models.NeuralActivityRecording.objects.filter(device_deidentified_id=deviceID, recording_type="ChronicLFPs").all():
+        if recording.recording_info and "Hemisphere" in recording.recording_info.keys():
+            if not recording.recording_info["Hemisphere"] in ExistingRecordings.keys():
+                ExistingRecordings[recording.recording_info["Hemisphere"]] = recording
+
+    NewRecordings = []
+    UpdatedRecordings = []
+    LegacyDataPointers = []
     for key in ChronicLFPs.keys():
         recording_info = {"Hemisphere": key}
-        if not models.NeuralActivityRecording.objects.filter(device_deidentified_id=deviceID, recording_type="ChronicLFPs", recording_info__Hemisphere=recording_info["Hemisphere"]).exists():
+        if not key in ExistingRecordings.keys():
             recording = models.NeuralActivityRecording(device_deidentified_id=deviceID, recording_type="ChronicLFPs", recording_info=recording_info)
-            filename = Database.saveSourceFiles(ChronicLFPs[key], "ChronicLFPs", key.replace("HemisphereLocationDef.",""), recording.recording_id, recording.device_deidentified_id)
+            filename, NewSamples = Database.savePartitionedRecording(mergeChronicLFPs(None, ChronicLFPs[key]), "ChronicLFPs", key.replace("HemisphereLocationDef.",""), recording.recording_id, recording.device_deidentified_id, "Timestamp")
             recording.recording_datapointer = filename
-            recording.save()
+            NewRecordings.append(recording)
             NewRecordingFound = True
         else:
-            recording = models.NeuralActivityRecording.objects.filter(device_deidentified_id=deviceID, recording_type="ChronicLFPs", recording_info__Hemisphere=recording_info["Hemisphere"]).first()
-            pastChronicLFPs = Database.loadSourceDataPointer(recording.recording_datapointer)
-
-            Common = set(ChronicLFPs[key]["DateTime"]) & set(pastChronicLFPs["DateTime"])
-
-            toInclude = np.zeros(len(ChronicLFPs[key]["DateTime"]), dtype=bool)
-            IndexToInclude = list()
-            for i in range(len(ChronicLFPs[key]["DateTime"])):
-                if not ChronicLFPs[key]["DateTime"][i] in Common:
-                    toInclude[i] = True
-
-            if np.any(toInclude):
-                pastChronicLFPs["DateTime"] = np.concatenate((pastChronicLFPs["DateTime"], ChronicLFPs[key]["DateTime"][toInclude]),axis=0)
-                pastChronicLFPs["Amplitude"] = np.concatenate((pastChronicLFPs["Amplitude"], ChronicLFPs[key]["Amplitude"][toInclude]),axis=0)
-                pastChronicLFPs["LFP"] = np.concatenate((pastChronicLFPs["LFP"], ChronicLFPs[key]["LFP"][toInclude]),axis=0)
-
-                sortedIndex = np.argsort(pastChronicLFPs["DateTime"],axis=0).flatten()
-                pastChronicLFPs["DateTime"] = pastChronicLFPs["DateTime"][sortedIndex]
-                pastChronicLFPs["Amplitude"] = pastChronicLFPs["Amplitude"][sortedIndex]
-                pastChronicLFPs["LFP"] = pastChronicLFPs["LFP"][sortedIndex]
-                filename = Database.saveSourceFiles(pastChronicLFPs, "ChronicLFPs", key.replace("HemisphereLocationDef.",""), recording.recording_id, recording.device_deidentified_id)
+            recording = ExistingRecordings[key]
+            
+            # Chronic LFPs stored as a single file are converted to partitioned storage on first update.
+            if not recording.recording_datapointer.endswith(Database.PARTITIONED_RECORDING_EXTENSION):
+                LegacyDataPointers.append(recording.recording_datapointer)
+                pastChronicLFPs = Database.loadSourceDataPointer(recording.recording_datapointer)
+                Database.savePartitionedRecording(mergeChronicLFPs(None, pastChronicLFPs), "ChronicLFPs", key.replace("HemisphereLocationDef.",""), recording.recording_id, recording.device_deidentified_id, "Timestamp")
+
+            filename, NewSamples = Database.savePartitionedRecording(mergeChronicLFPs(None, ChronicLFPs[key]), "ChronicLFPs", key.replace("HemisphereLocationDef.",""), recording.recording_id, recording.device_deidentified_id, "Timestamp")
+            if NewSamples > 0:
                 NewRecordingFound = True
 
-                if recording.recording_datapointer.endswith(".pkl"):
-                    recording.recording_datapointer.replace(".pkl",".bpkl")
-                    recording.save()
+            if not recording.recording_datapointer == filename:
+                recording.recording_datapointer = filename
+                UpdatedRecordings.append(recording)
+
+    with transaction.atomic():
+        models.NeuralActivityRecording.objects.bulk_create(NewRecordings)
+        models.NeuralActivityRecording.objects.bulk_update(UpdatedRecordings, ["recording_datapointer"])
+
+    for filename in LegacyDataPointers:
+        Database.deleteSourceDataPointer(filename)
 
     return NewRecordingFound
 
+def getChronicTimestamp(ChronicLFPs):
+    """ Get sample timestamps of a Chronic LFP structure.
+
+    Chronic LFPs are stored with "Timestamp" as int64 Unix timestamps (seconds). 
+    Structures extracted from JSON file (or stored before this format) only contain "DateTime" objects.
+
+    Args:
+      ChronicLFPs: Chronic (Power-band) structure with "Timestamp" or "DateTime".
+
+    Returns:
+      int64 array of Unix timestamps.
+    """
+
+    if "Timestamp" in ChronicLFPs.keys():
+        return np.asarray(ChronicLFPs["Timestamp"], dtype=np.int64)
+    return np.array([np.round(time.timestamp()) for time in ChronicLFPs["DateTime"]], dtype=np.int64).reshape(-1)
+
+def mergeChronicLFPs(pastChronicLFPs, newChronicLFPs):
+    """ Merge new Chronic LFP samples into existing history.
+
+    Samples are sorted by timestamp and duplicated timestamps are removed, existing samples take priority over new samples.
+
+    Args:
+      pastChronicLFPs: Stored Chronic (Power-band) structure, or None if there is no history.
+      newChronicLFPs: Chronic (Power-band) structure extracted from JSON file.
+
+    Returns:
+      Chronic (Power-band) structure with "Timestamp", "Amplitude" and "LFP" arrays.
+    """
+
+    Structures = [newChronicLFPs] if pastChronicLFPs == None else [pastChronicLFPs, newChronicLFPs]
+    Timestamp = np.concatenate([getChronicTimestamp(data) for data in Structures])
+    Amplitude = np.concatenate([np.asarray(data["Amplitude"]) for data in Structures], axis=0)
+    LFP = np.concatenate([np.asarray(data["LFP"]) for data in Structures], axis=0)
+
+    # np.unique returns the first occurrence of each timestamp in sorted order.
+    Timestamp, Index = np.unique(Timestamp, return_index=True)
+    return {"Timestamp": Timestamp, "Amplitude": Amplitude[Index], "LFP": LFP[Index]}
+
+def loadChronicLFPs(recording, timeRange=None):
+    """ Load Chronic LFPs of a recording, optionally restricted to a time range.
+
+    Only partitions overlapping the time range are read from partitioned storage.
+
+    Args:
+      recording: NeuralActivityRecording object of ChronicLFPs type.
+      timeRange: [start, end] Unix timestamps. Default to None (entire history).
+
+    Returns:
+      Chronic (Power-band) structure with "Timestamp", "Amplitude" and "LFP" arrays.
+    """
+
+    if recording.recording_datapointer.endswith(Database.PARTITIONED_RECORDING_EXTENSION):
+        return Database.loadPartitionedRecording(recording.recording_datapointer, timeRange)
+
+    ChronicLFPs = mergeChronicLFPs(None, Database.loadSourceDataPointer(recording.recording_datapointer))
+    if timeRange:
+        Selection = (ChronicLFPs["Timestamp"] >= timeRange[0]) & (ChronicLFPs["Timestamp"] <= timeRange[1])
+        ChronicLFPs = {key: ChronicLFPs[key][Selection] for key in ChronicLFPs.keys()}
+    return ChronicLFPs
+
 def queryChronicLFPsByTime(user, patientUniqueID, timeRange, authority):
     LFPTrends = list()
     availableDevices = Database.getPerceptDevices(user, patientUniqueID, authority)
@@ -103,7 +173,7 @@ def queryChronicLFPsByTime(user, patientUniqueID, timeRange, authority):
         for hemisphere in ["HemisphereLocationDef.Left","HemisphereLocationDef.Right"]:
             recording = models.NeuralActivityRecording.objects.filter(device_deidentified_id=device.deidentified_id, recording_type="ChronicLFPs", recording_info__Hemisphere=hemisphere).first()
             if not recording == None:
-                ChronicLFPs = Database.loadSourceDataPointer(recording.recording_datapointer)
+                ChronicLFPs = loadChronicLFPs(recording, [timeRange[0].timestamp(), timeRange[1].timestamp()])
                 if device.device_name == "":
                     LFPTrends.append({"Device": str(device.deidentified_id) if not (user.is_admin or user.is_clinician) else device.getDeviceSerialNumber(key), "DeviceLocation": device.device_location})
                 else:
@@ -113,10 +183,9 @@ def queryChronicLFPsByTime(user, patientUniqueID, timeRange, authority):
                     if lead["TargetLocation"].startswith(hemisphere.replace("HemisphereLocationDef.","")):
                         LFPTrends[-1]["Hemisphere"] = lead["TargetLocation"]
 
-                LFPTimestamps = ChronicLFPs["DateTime"]
+                LFPTimestamps = getChronicTimestamp(ChronicLFPs).astype(float)
                 LFPPowers = ChronicLFPs["LFP"]
                 StimulationAmplitude = ChronicLFPs["Amplitude"]
-                LFPTimestamps = np.array([time.timestamp() for time in LFPTimestamps])
                 LFPTrends[-1]["Timestamp"] = list()
                 LFPTrends[-1]["Power"] = list()
                 LFPTrends[-1]["Amplitude"] = list()
@@ -183,12 +252,64 @@ def queryChronicLFPsByTime(user, patientUniqueID, timeRange, authority):
 
     return LFPTrends
 
+def rollingWindowStatistics(xdata, tdata, halfWindow, minimumCount=1):
+    """ Mean and variance of all samples within +/- halfWindow seconds of each sample.
+
+    Window bounds are found with binary search on sorted timestamps and window sums with cumulative sums, 
+    so the cost is independent of the window length. Windows with fewer than ``minimumCount`` samples are widened
+    by multiples of halfWindow until they contain enough samples.
+
+    Args:
+      xdata: 1D data array.
+      tdata: 1D timestamp array (seconds), same length as xdata. Does not need to be sorted.
+      halfWindow: half window length in seconds.
+      minimumCount: minimum number of samples per window.
+
+    Returns:
+      Tuple (mean, variance, count) of arrays aligned with xdata. Variance is the population variance (ddof=0).
+    """
+
+    order = np.argsort(tdata, kind="stable")
+    t = np.asarray(tdata, dtype=float)[order]
+    x = np.asarray(xdata, dtype=float)[order]
+
+    # Centering and extended precision cumulative sums keep window variance precise over long histories.
+    offset = np.mean(x)
+    cumulativeSum = np.concatenate(([0], np.cumsum(x - offset, dtype=np.longdouble)))
+    cumulativeSquare = np.concatenate(([0], np.cumsum((x - offset)**2, dtype=np.longdouble)))
+    cumulativeChanges = np.concatenate(([0], np.cumsum(x[1:] != x[:-1])))
+
+    windowScale = np.ones(len(t))
+    startIndex = np.searchsorted(t, t - halfWindow, side="left")
+    endIndex = np.searchsorted(t, t + halfWindow, side="right")
+    insufficient = endIndex - startIndex < minimumCount
+    while np.any(insufficient):
+        windowScale[insufficient] += 1
+        startIndex[insufficient] = np.searchsorted(t, t[insufficient] - halfWindow*windowScale[insufficient], side="left")
+        endIndex[insufficient] = np.searchsorted(t, t[insufficient] + halfWindow*windowScale[insufficient], side="right")
+        insufficient = endIndex - startIndex < minimumCount
+
+    count = endIndex - startIndex
+    mean = (cumulativeSum[endIndex] - cumulativeSum[startIndex]) / count
+    variance = np.maximum((cumulativeSquare[endIndex] - cumulativeSquare[startIndex]) / count - mean*mean, 0)
+    mean += offset
+
+    # Cumulative sums leave rounding residue in windows of identical samples, which must have exactly zero variance.
+    constant = cumulativeChanges[endIndex-1] == cumulativeChanges[startIndex]
+    mean[constant] = x[startIndex[constant]]
+    variance[constant] = 0
+
+    result = [np.zeros(len(t)), np.zeros(len(t)), np.zeros(len(t), dtype=int)]
+    result[0][order] = mean
+    result[1][order] = variance
+    result[2][order] = count
+    return tuple(result)
+
 def normalizeChronicLFPs(xdata, tdata, method="zscore"):
-    normPower = np.zeros(xdata.shape)
     if method == "zscore":
-        for i in range(len(xdata)):
-            PeriodSelection = rangeSelection(tdata, [tdata[i]-12*3600, tdata[i]+12*3600])
-            normPower[i] = (xdata[i] - np.mean(xdata[PeriodSelection])) / stats.sem(xdata[PeriodSelection])
+        mean, variance, count = rollingWindowStatistics(xdata, tdata, 12*3600)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            normPower = (xdata - mean) / (np.sqrt(variance * count / (count - 1)) / np.sqrt(count))
     else:
         normPower = xdata
     return normPower
@@ -213,6 +334,9 @@ def queryChronicLFPs(user, patientUniqueID, TherapyHistory, authority):
     if not authority["Permission"]:
         return LFPTrends
 
+    # Research access is limited to the authorized time range, only partitions within the range are loaded.
+    AuthorizedTimeRange = Database.getAuthorizedTimeRange(authority)
+
     availableDevices = Database.getPerceptDevices(user, patientUniqueID, authority)
     
     ClinicianAnnotationsDjango = models.CustomAnnotations.objects.filter(patient_deidentified_id=patientUniqueID, event_type="Chronic Event").all()
@@ -224,7 +348,7 @@ def queryChronicLFPs(user, patientUniqueID, TherapyHistory, authority):
         for hemisphere in ["HemisphereLocationDef.Left","HemisphereLocationDef.Right"]:
             recording = models.NeuralActivityRecording.objects.filter(device_deidentified_id=device.deidentified_id, recording_type="ChronicLFPs", recording_info__Hemisphere=hemisphere).first()
             if not recording == None:
-                ChronicLFPs = Database.loadSourceDataPointer(recording.recording_datapointer)
+                ChronicLFPs = loadChronicLFPs(recording, AuthorizedTimeRange)
                 if device.device_name == "":
                     LFPTrends.append({"Device": str(device.deidentified_id) if not (user.is_admin or user.is_clinician) else device.getDeviceSerialNumber(key), "DeviceLocation": device.device_location})
                 else:
@@ -235,10 +359,9 @@ def queryChronicLFPs(user, patientUniqueID, TherapyHistory, authority):
                         LFPTrends[-1]["Hemisphere"] = lead["TargetLocation"]
                         LFPTrends[-1]["CustomName"] = lead["CustomName"]
 
-                LFPTimestamps = ChronicLFPs["DateTime"]
+                LFPTimestamps = getChronicTimestamp(ChronicLFPs).astype(float)
                 LFPPowers = ChronicLFPs["LFP"]
                 StimulationAmplitude = ChronicLFPs["Amplitude"]
-                LFPTimestamps = np.array([time.timestamp() for time in LFPTimestamps])
                 LFPTrends[-1]["Timestamp"] = list()
                 LFPTrends[-1]["Power"] = list()
                 #LFPTrends[-1]["NormPower"] = list()
@@ -321,19 +444,8 @@ def normalizeCircadianPower(Power, Timestamp):
     if len(Power) < 3: 
         return stats.zscore(Power) 
     
-    normPower = np.zeros(Power.shape)
-    for i in range(len(Power)):
-        refPower = 0
-        PeriodSelection = rangeSelection(Timestamp, [Timestamp[i]-12*3600, Timestamp[i]+12*3600])
-        while np.sum(PeriodSelection) < 3:
-            refPower += 1
-            PeriodSelection = rangeSelection(Timestamp, [Timestamp[i]-12*refPower*3600, Timestamp[i]+12*refPower*3600])
-            
-        #normPower[i] = (Power[i] - np.mean(Power[PeriodSelection])) / stats.sem(Power[PeriodSelection])
-        normPower[i] = (Power[i] - np.mean(Power[PeriodSelection])) / np.std(Power[PeriodSelection])
-        #normPower[i] = Power[i]
-    
-    return normPower
+    mean, variance, _ = rollingWindowStatistics(Power, Timestamp, 12*3600, minimumCount=3)
+    return (Power - mean) / np.sqrt(variance)
 
 def processChronicLFPs(LFPTrends, timezoneOffset=0, normalizeCircadian=False):
     """ Process Chronic LFPs based on Therapy History.
@@ -411,6 +523,14 @@ def processChronicLFPs(LFPTrends, timezoneOffset=0, normalizeCircadian=False):
                     LFPTrends[i]["EventLockedPower"][-1]["EventName"].extend(LFPTrends[i]["EventName"][j])
                     LFPTrends[i]["EventLockedPower"][-1]["Timestamp"].extend(LFPTrends[i]["EventTime"][j])
 
+            CacheKey = (ChronicAggregation.getDataVersion(LFPTrends[i]["CircadianPowers"][-1]["Power"], LFPTrends[i]["CircadianPowers"][-1]["Timestamp"], 
+                                                          LFPTrends[i]["EventLockedPower"][-1]["EventName"], LFPTrends[i]["EventLockedPower"][-1]["Timestamp"]),
+                        therapy, timezoneOffset, bool(normalizeCircadian), "Percept", ChronicAggregation.AGGREGATION_VERSION)
+            CachedResult = ChronicAggregation.getCachedAggregation(CacheKey)
+            if CachedResult:
+                LFPTrends[i]["CircadianPowers"][-1], LFPTrends[i]["EventLockedPower"][-1] = CachedResult
+                continue
+
             LFPTrends[i]["CircadianPowers"][-1]["Power"] = np.array(LFPTrends[i]["CircadianPowers"][-1]["Power"])
             LFPTrends[i]["CircadianPowers"][-1]["Timestamp"] = np.array(LFPTrends[i]["CircadianPowers"][-1]["Timestamp"])
             if normalizeCircadian:
@@ -418,25 +538,13 @@ def processChronicLFPs(LFPTrends, timezoneOffset=0, normalizeCircadian=False):
                 LFPTrends[i]["CircadianPowers"][-1]["Normalized"] = True
 
             # Event Locked Power
-            EventToInclude = list()
-            LFPTrends[i]["EventLockedPower"][-1]["TimeArray"] = np.arange(37)*600 - 180*60
-            EventLockedPower = np.zeros((len(LFPTrends[i]["EventLockedPower"][-1]["EventName"]),len(LFPTrends[i]["EventLockedPower"][-1]["TimeArray"])))
-            
-            for iEvent in range(len(LFPTrends[i]["EventLockedPower"][-1]["EventName"])):
-                print(LFPTrends[i]["EventLockedPower"][-1]["EventName"][iEvent])
-                dataSelected = rangeSelection(LFPTrends[i]["CircadianPowers"][-1]["Timestamp"], [LFPTrends[i]["EventLockedPower"][-1]["Timestamp"][iEvent]+LFPTrends[i]["EventLockedPower"][-1]["TimeArray"][0], LFPTrends[i]["EventLockedPower"][-1]["Timestamp"][iEvent]+LFPTrends[i]["EventLockedPower"][-1]["TimeArray"][-1]])
-                PowerTrend = LFPTrends[i]["CircadianPowers"][-1]["Power"][dataSelected]
-                Timestamp = LFPTrends[i]["CircadianPowers"][-1]["Timestamp"][dataSelected]
-                if len(Timestamp) >= 35:
-                    index = np.argsort(Timestamp)
-                    EventLockedPower[iEvent,:] = np.interp(LFPTrends[i]["EventLockedPower"][-1]["TimeArray"]+LFPTrends[i]["EventLockedPower"][-1]["Timestamp"][iEvent], Timestamp[index], PowerTrend[index])
-                    EventToInclude.append(iEvent)
-            EventToInclude = np.array(EventToInclude)
+            LFPTrends[i]["EventLockedPower"][-1]["TimeArray"] = ChronicAggregation.EVENT_LOCKED_TIME_ARRAY.copy()
+            EventLockedPower, EventToInclude = ChronicAggregation.eventLockedAggregation(LFPTrends[i]["CircadianPowers"][-1]["Power"], LFPTrends[i]["CircadianPowers"][-1]["Timestamp"], 
+                                                                                         LFPTrends[i]["EventLockedPower"][-1]["Timestamp"], minimumCount=35)
 
             if not len(EventToInclude) == 0:
                 LFPTrends[i]["EventLockedPower"][-1]["PowerChart"] = list()
                 LFPTrends[i]["EventLockedPower"][-1]["EventName"] = np.array(LFPTrends[i]["EventLockedPower"][-1]["EventName"])[EventToInclude]
-                EventLockedPower = EventLockedPower[EventToInclude,:]
                 for name in np.unique(LFPTrends[i]["EventLockedPower"][-1]["EventName"]):
                     SelectedEvent = LFPTrends[i]["EventLockedPower"][-1]["EventName"] == name
                     LFPTrends[i]["EventLockedPower"][-1]["PowerChart"].append({"EventName": name + f" (n={np.sum(SelectedEvent)})",
@@ -448,31 +556,23 @@ def processChronicLFPs(LFPTrends, timezoneOffset=0, normalizeCircadian=False):
                 del(LFPTrends[i]["EventLockedPower"][-1]["Timestamp"])
                 LFPTrends[i]["EventLockedPower"][-1]["TimeArray"] = LFPTrends[i]["EventLockedPower"][-1]["TimeArray"] / 60
 
-            LFPTrends[i]["CircadianPowers"][-1]["Timestamp"] = (np.array(LFPTrends[i]["CircadianPowers"][-1]["Timestamp"])-timezoneOffset) % (24*60*60)
+            LFPTrends[i]["CircadianPowers"][-1]["Timestamp"] = (LFPTrends[i]["CircadianPowers"][-1]["Timestamp"]-timezoneOffset) % (24*60*60)
 
             # Calculate Average Power/Std Power
-            LFPTrends[i]["CircadianPowers"][-1]["AverageTimestamp"] = np.arange(24*12)*300
-            LFPTrends[i]["CircadianPowers"][-1]["AveragePower"] = np.zeros(LFPTrends[i]["CircadianPowers"][-1]["AverageTimestamp"].shape)
-            LFPTrends[i]["CircadianPowers"][-1]["StdErrPower"] = np.zeros(LFPTrends[i]["CircadianPowers"][-1]["AverageTimestamp"].shape)
-            for t in range(len(LFPTrends[i]["CircadianPowers"][-1]["AverageTimestamp"])):
-                timeSelection = rangeSelection(LFPTrends[i]["CircadianPowers"][-1]["Timestamp"],[LFPTrends[i]["CircadianPowers"][-1]["AverageTimestamp"][t]-20*60, LFPTrends[i]["CircadianPowers"][-1]["AverageTimestamp"][t]+20*60])
-                if np.any(timeSelection):
-                    LFPTrends[i]["CircadianPowers"][-1]["AveragePower"][t] = np.median(LFPTrends[i]["CircadianPowers"][-1]["Power"][timeSelection])
-                    LFPTrends[i]["CircadianPowers"][-1]["StdErrPower"][t] = SPU.stderr(LFPTrends[i]["CircadianPowers"][-1]["Power"][timeSelection])*2
-                else:
-                    LFPTrends[i]["CircadianPowers"][-1]["AveragePower"][t] = 0
-                    LFPTrends[i]["CircadianPowers"][-1]["StdErrPower"][t] = 0
+            AverageTimestamp, AveragePower, StdErrPower = ChronicAggregation.circadianAggregation(LFPTrends[i]["CircadianPowers"][-1]["Power"], LFPTrends[i]["CircadianPowers"][-1]["Timestamp"])
 
-            LFPTrends[i]["CircadianPowers"][-1]["Power"] = LFPTrends[i]["CircadianPowers"][-1]["Power"][::1].tolist()
+            LFPTrends[i]["CircadianPowers"][-1]["Power"] = LFPTrends[i]["CircadianPowers"][-1]["Power"].tolist()
             LFPTrends[i]["CircadianPowers"][-1]["Timestamp"] = (LFPTrends[i]["CircadianPowers"][-1]["Timestamp"] + timezoneOffset).tolist()
-            LFPTrends[i]["CircadianPowers"][-1]["AveragePower"] = LFPTrends[i]["CircadianPowers"][-1]["AveragePower"].tolist()
-            LFPTrends[i]["CircadianPowers"][-1]["StdErrPower"] = LFPTrends[i]["CircadianPowers"][-1]["StdErrPower"].tolist()
-            LFPTrends[i]["CircadianPowers"][-1]["AverageTimestamp"] = (LFPTrends[i]["CircadianPowers"][-1]["AverageTimestamp"] + timezoneOffset).tolist()
+            LFPTrends[i]["CircadianPowers"][-1]["AveragePower"] = AveragePower.tolist()
+            LFPTrends[i]["CircadianPowers"][-1]["StdErrPower"] = StdErrPower.tolist()
+            LFPTrends[i]["CircadianPowers"][-1]["AverageTimestamp"] = (AverageTimestamp + timezoneOffset).tolist()
             
             if len(LFPTrends[i]["CircadianPowers"][-1]["Power"]) > 0:
                 LFPTrends[i]["CircadianPowers"][-1]["PowerRange"] = [np.percentile(LFPTrends[i]["CircadianPowers"][-1]["Power"],5),np.percentile(LFPTrends[i]["CircadianPowers"][-1]["Power"],95)]
             else:
                 LFPTrends[i]["CircadianPowers"][-1]["PowerRange"] = [0,0]
+
+            ChronicAggregation.setCachedAggregation(CacheKey, (LFPTrends[i]["CircadianPowers"][-1], LFPTrends[i]["EventLockedPower"][-1]))
     return LFPTrends
 
 def processCircadianPower(LFPTrends, therapyInfo, timezoneOffset=0):
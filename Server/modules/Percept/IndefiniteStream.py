@@ -22,6 +22,7 @@ import os, sys, pathlib
 RESOURCES = str(pathlib.Path(__file__).parent.parent.resolve())
 sys.path.append(os.environ.get("PYTHON_UTILITY"))
 
+import json
 import numpy as np
 from datetime import datetime
 import pytz
@@ -32,8 +33,10 @@ from decoder import Percept
 from utility import SignalProcessingUtility as SPU
 from utility.PythonUtility import *
 
+from django.db import transaction
+
 from Backend import models
-from modules import Database
+from modules import Database, LevelOfDetail
 
 key = os.environ.get('ENCRYPTION_KEY')
 
@@ -55,6 +58,13 @@ def saveMontageStreams(deviceID, streamList, sourceFile):
         StreamDates.append(datetime.fromtimestamp(stream["FirstPacketDateTime"], tz=pytz.utc))
     UniqueSessionDates = np.unique(StreamDates)
 
+    # Existing recordings are queried once and matched in memory.
+    ExistingRecordings = set()
+    for recording in models.NeuralActivityRecording.objects.filter(device_deidentified_id=deviceID, recording_type="IndefiniteStream", recording_date__in=list(UniqueSessionDates)).all():
+        if recording.recording_info and "Channel" in recording.recording_info.keys():
+            ExistingRecordings.add((recording.recording_date, json.dumps(recording.recording_info["Channel"])))
+
+    NewRecordings = []
     for date in UniqueSessionDates:
         Recording = dict()
         Recording["SamplingRate"] = streamList[0]["SamplingRate"]
@@ -93,14 +103,18 @@ def saveMontageStreams(deviceID, streamList, sourceFile):
         Recording["Duration"] = Recording["Data"].shape[0] / Recording["SamplingRate"]
         recording_info = {"Channel": Recording["ChannelNames"]}
 
-        if not models.NeuralActivityRecording.objects.filter(device_deidentified_id=deviceID, recording_type="IndefiniteStream", recording_date=date, recording_info=recording_info).exists():
+        if not (date, json.dumps(recording_info["Channel"])) in ExistingRecordings:
             recording = models.NeuralActivityRecording(device_deidentified_id=deviceID, recording_date=date, source_file=sourceFile,
                                   recording_type="IndefiniteStream", recording_info=recording_info)
             filename = Database.saveSourceFiles(Recording, "IndefiniteStream", "Combined", recording.recording_id, recording.device_deidentified_id)
             recording.recording_datapointer = filename
-            recording.recording_duration = Recording["Duration"]
-            recording.save()
+            Database.updateRecordingCatalog(recording, Recording)
+            ExistingRecordings.add((date, json.dumps(recording_info["Channel"])))
+            NewRecordings.append(recording)
             NewRecordingFound = True
+
+    with transaction.atomic():
+        models.NeuralActivityRecording.objects.bulk_create(NewRecordings)
     return NewRecordingFound
 
 def processMontageStreams(stream, method="spectrogram"):
@@ -177,7 +191,7 @@ def queryMontageDataOverview(user, patientUniqueID, authority):
             BrainSenseData.append(data)
     return BrainSenseData
 
-def queryMontageData(user, devices, timestamps, authority):
+def queryMontageData(user, devices, timestamps, authority, viewport=None):
     """ Query available Indefinite Streaming data from specific patient requested
 
     Query all data (which can be multiple recordings from the same day if data interruption exist) based on the 
@@ -188,14 +202,17 @@ def queryMontageData(user, devices, timestamps, authority):
       devices (list): Deidentified neurostimulator device IDs as referenced in SQL Database. 
       timestamps (list): Unix timestamps at which the recordings are collected.
       authority: User permission structure indicating the type of access the user has.
+      viewport: Optional viewport dictionary (see LevelOfDetail.parseViewport function). 
+        If provided, time-domain data is decimated with min/max pyramid and returned with "StreamTime".
 
     Returns:
       List of Indefinite Streaming data accessible.
     """
 
     BrainSenseData = list()
+    Devices = Database.getDevicesByID(devices)
     for i in range(len(devices)):
-        device = models.PerceptDevice.objects.filter(deidentified_id=devices[i]).first()
+        device = Devices.get(str(devices[i]))
 
         if not device == None:
             leads = device.device_lead_configurations
@@ -204,15 +221,29 @@ def queryMontageData(user, devices, timestamps, authority):
                 if not recording.recording_id in authority["Permission"] and authority["Level"] == 2:
                     continue
 
-                stream = Database.loadSourceDataPointer(recording.recording_datapointer)
+                # Once the decimation pyramid of the entire recording exists, only samples within the viewport are loaded from disk.
+                Pyramid = None
+                SampleOffset = 0
+                if viewport:
+                    Pyramid = Database.loadDerivedProduct(recording.recording_datapointer, {"Type": "DecimationPyramid"}, LevelOfDetail.PYRAMID_VERSION)
+                if not Pyramid == None:
+                    stream = Database.loadSourceDataRange(recording.recording_datapointer, timeRange=[viewport["Start"], viewport["End"]])
+                    SampleOffset = stream["SampleOffset"]
+                else:
+                    stream = Database.loadSourceDataPointer(recording.recording_datapointer)
 
                 # Skip this because this recording doesn't have enough data
                 if stream["Duration"] < 1:
                     continue 
 
                 if not "Spectrums" in stream.keys():
+                    if not Pyramid == None:
+                        stream = Database.loadSourceDataPointer(recording.recording_datapointer)
+                        Pyramid = None
+                        SampleOffset = 0
                     stream = processMontageStreams(stream)
-                    Database.saveSourceFiles(stream,"IndefiniteStream","Combined",recording.recording_id, recording.device_deidentified_id)
+                    recording.recording_datapointer = Database.saveSourceFiles(stream,"IndefiniteStream","Combined",recording.recording_id, recording.device_deidentified_id)
+                    recording.save()
 
                 data = dict()
                 data["Timestamp"] = stream["StartTime"]
@@ -227,8 +258,20 @@ def queryMontageData(user, devices, timestamps, authority):
                             data["ChannelNames"].append(lead["TargetLocation"] + f" E{contacts[0]:02}-E{contacts[1]:02}")
 
                 data["Stream"] = []
-                for j in range(len(stream["ChannelNames"])):
-                    data["Stream"].append(stream["Data"][:,j].tolist())
+                if viewport:
+                    if Pyramid == None:
+                        Pyramid = [LevelOfDetail.buildDecimationPyramid(stream["Data"][:,j]) for j in range(len(stream["ChannelNames"]))]
+                        Database.saveDerivedProduct(Pyramid, recording.recording_datapointer, {"Type": "DecimationPyramid"}, LevelOfDetail.PYRAMID_VERSION)
+
+                    data["Viewport"] = viewport
+                    data["StreamTime"] = []
+                    for j in range(len(stream["ChannelNames"])):
+                        Time, Values = LevelOfDetail.queryViewport(stream["Data"][:,j], stream["SamplingRate"], viewport, pyramid=Pyramid[j], offset=SampleOffset)
+                        data["Stream"].append(Values)
+                        data["StreamTime"].append(Time)
+                else:
+                    for j in range(len(stream["ChannelNames"])):
+                        data["Stream"].append(stream["Data"][:,j])
                 data["Spectrums"] = stream["Spectrums"]
                 BrainSenseData.append(data)
     return BrainSenseData
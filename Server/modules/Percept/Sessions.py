@@ -28,9 +28,13 @@ import pickle, joblib
 import dateutil, pytz
 import numpy as np
 import pandas as pd
-from cryptography.fernet import Fernet
-import hashlib
+from cryptography.fernet import Fernet, InvalidToken
+from cryptography.hazmat.primitives import hashes, hmac, padding
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+import base64, hashlib
 import shutil
+import json, re
+import ijson
 
 from Backend import models
 from modules import Database
@@ -40,6 +44,15 @@ from decoder import Percept
 DATABASE_PATH = os.environ.get('DATASERVER_PATH')
 key = os.environ.get('ENCRYPTION_KEY')
 
+# Top-level JSON sections that are parsed and saved one at a time instead of loaded with the session.
+STREAMING_SECTIONS = ["IndefiniteStreaming", "BrainSenseTimeDomain", "BrainSenseLfp"]
+
+# Number of base64 characters of encrypted cache files decoded at a time (multiple of 4).
+DECRYPTION_CHUNK_SIZE = 1024 * 1024
+
+# Strings (group 1, group 2 set if the string is an object key) and brackets of JSON, preceded by any other characters.
+JSON_TOKEN_PATTERN = re.compile(rb'[^"\[\]{}]*(?:("[^"\\]*(?:\\.[^"\\]*)*")(\s*:)?|[\[\]{}])')
+
 def retrievePatientInformation(PatientInformation, Institute, lookupTable=None, encoder=None):
     if not encoder:
         encoder = Fernet(key)
@@ -97,18 +110,282 @@ def saveCacheJSON(filename, rawBytes):
     with open(DATABASE_PATH + "cache" + os.path.sep + filename, "wb+") as file:
         file.write(secureEncoder.encrypt(rawBytes))
 
+def decryptCacheJSON(filename):
+    """ Decrypt cached session JSON in chunks
+
+    Cache files are a single Fernet token (see ``saveCacheJSON``). The token is decoded, authenticated and decrypted 
+    in chunks of ``DECRYPTION_CHUNK_SIZE`` into one preallocated buffer, so neither the encoded file nor the ciphertext 
+    is held in memory alongside the decrypted bytes. The buffer is only returned once the token is authenticated.
+
+    Args:
+      filename: filename of the encrypted session JSON in cache folder.
+
+    Returns:
+      Decrypted session JSON bytes (bytearray).
+    """
+
+    keyBytes = base64.urlsafe_b64decode(key)
+    signature = hmac.HMAC(keyBytes[:16], hashes.SHA256())
+
+    with open(DATABASE_PATH + "cache" + os.path.sep + filename, "rb") as file:
+        encodedSize = file.seek(0, os.SEEK_END)
+        file.seek(max(encodedSize-2, 0))
+        tokenSize = encodedSize // 4 * 3 - file.read().count(b"=")
+        file.seek(0)
+
+        header = base64.urlsafe_b64decode(file.read(36))
+        if tokenSize < 73 or not header[0] == 0x80:
+            raise InvalidToken
+        signature.update(header[:25])
+        decryptor = Cipher(algorithms.AES(keyBytes[16:]), modes.CBC(header[9:25])).decryptor()
+
+        # The last 32 bytes of the token are the signature, they are held back until the end of file.
+        rawBytes = bytearray(tokenSize - 57)
+        position = 0
+        pending = header[25:]
+        while True:
+            chunk = file.read(DECRYPTION_CHUNK_SIZE)
+            if len(chunk) > 0:
+                pending += base64.urlsafe_b64decode(chunk)
+            if len(pending) > 32:
+                ciphertext = memoryview(pending)[:-32]
+                signature.update(ciphertext)
+                decrypted = decryptor.update(ciphertext)
+                ciphertext.release()
+                rawBytes[position:position+len(decrypted)] = decrypted
+                position += len(decrypted)
+                pending = pending[-32:]
+            if len(chunk) == 0:
+                break
+
+    try:
+        signature.verify(pending)
+    except Exception:
+        raise InvalidToken
+    decrypted = decryptor.finalize()
+    rawBytes[position:position+len(decrypted)] = decrypted
+    position += len(decrypted)
+
+    unpadder = padding.PKCS7(algorithms.AES.block_size).unpadder()
+    try:
+        unpadder.update(rawBytes[position-16:position])
+        unpadder.finalize()
+    except ValueError:
+        raise InvalidToken
+    del rawBytes[position-rawBytes[position-1]:]
+    return rawBytes
+
+class SectionReader:
+    """ File-like reader over a byte range of the decrypted session JSON.
+
+    Sections are read through a memoryview, so parsing a section does not copy the session bytes.
+    """
+
+    def __init__(self, rawBytes, start, end):
+        self.view = memoryview(rawBytes)[start:end]
+        self.position = 0
+
+    def read(self, size=-1):
+        if size < 0:
+            size = len(self.view) - self.position
+        data = bytes(self.view[self.position:self.position+size])
+        self.position += len(data)
+        return data
+
+def findSectionRanges(rawBytes):
+    """ Locate top-level sections of session JSON
+
+    Only strings and brackets are matched, everything in between (mostly numeric time-domain data) is skipped by the 
+    regular expression, so sections are located without being built.
+
+    Args:
+      rawBytes: decrypted session JSON bytes.
+
+    Returns:
+      Dictionary of [start, end] byte offsets of each top-level value, keyed by section name.
+    """
+
+    Sections = dict()
+    currentKey = None
+    depth = 0
+    for match in JSON_TOKEN_PATTERN.finditer(rawBytes):
+        if match.lastindex == None:
+            if rawBytes[match.end()-1] in b"[{":
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    if currentKey:
+                        Sections[currentKey][1] = match.end()-1
+                    break
+        elif match.lastindex == 2 and depth == 1:
+            if currentKey:
+                Sections[currentKey][1] = rawBytes.rindex(b",", Sections[currentKey][0], match.start(1))
+            currentKey = json.loads(match.group(1))
+            Sections[currentKey] = [match.end(), None]
+    return Sections
+
+def loadSessionSkeleton(rawBytes):
+    """ Parse session JSON without streaming sections
+
+    All top-level sections except ``STREAMING_SECTIONS`` are built into a dictionary. Streaming sections are only located,
+    they are parsed from their byte range when saved (see ``iterateStreamingSection``).
+
+    Args:
+      rawBytes: decrypted session JSON bytes.
+
+    Returns:
+      Tuple of session JSON without streaming sections, and dictionary of [start, end] byte offsets of streaming sections.
+    """
+
+    JSON = dict()
+    SectionRanges = dict()
+    Sections = findSectionRanges(rawBytes)
+    for section in Sections.keys():
+        if section in STREAMING_SECTIONS:
+            SectionRanges[section] = Sections[section]
+        else:
+            JSON[section] = json.loads(rawBytes[Sections[section][0]:Sections[section][1]])
+    return JSON, SectionRanges
+
+def iterateStreamingSection(rawBytes, SectionRanges, section, prefix="item"):
+    """ Parse a streaming section one item at a time from its byte range.
+
+    Args:
+      rawBytes: decrypted session JSON bytes.
+      SectionRanges: byte offsets of streaming sections (from ``loadSessionSkeleton``).
+      section: streaming section name.
+      prefix: ijson prefix within the section. Default to each item of the section.
+
+    Returns:
+      Generator of section items. Empty if the section does not exist in the session.
+    """
+
+    if not section in SectionRanges.keys():
+        return
+    yield from ijson.items(SectionReader(rawBytes, SectionRanges[section][0], SectionRanges[section][1]), prefix, use_float=True)
+
+def getStreamingContext(JSON):
+    """ Session JSON passed to the decoder along with streaming sections.
+
+    Built once per session. Survey and chronic recordings are left out so that they are not decoded again 
+    with every streaming section.
+
+    Args:
+      JSON: session JSON without streaming sections (from ``loadSessionSkeleton``).
+
+    Returns:
+      Session JSON without streaming sections, surveys, chronic LFPs and events.
+    """
+
+    StreamingJSON = {section: JSON[section] for section in JSON.keys() if not section in ["LFPMontage", "LfpMontageTimeDomain"]}
+    if "DiagnosticData" in StreamingJSON.keys():
+        StreamingJSON["DiagnosticData"] = {key: JSON["DiagnosticData"][key] for key in JSON["DiagnosticData"].keys() if not key in ["LFPTrendLogs", "LfpFrequencySnapshotEvents"]}
+    return StreamingJSON
+
+def extractStreamingSection(StreamingJSON, sections):
+    """ Decode streaming sections of session JSON
+
+    Args:
+      StreamingJSON: session context (from ``getStreamingContext``).
+      sections: dictionary of section name to list of section items.
+
+    Returns:
+      Decoded Percept data structure containing only the requested streaming sections.
+    """
+
+    SessionJSON = dict(StreamingJSON)
+    for section in sections.keys():
+        if len(sections[section]) > 0:
+            SessionJSON[section] = sections[section]
+    return Percept.extractPerceptJSON(SessionJSON)
+
+def iterateMontageStreams(StreamingJSON, rawBytes, SectionRanges):
+    """ Decode Indefinite Streaming section one recording at a time.
+
+    Streams are parsed one item at a time and yielded as soon as all channels sharing the same ``FirstPacketDateTime`` are found.
+    Only streams of incomplete recordings are held in memory.
+
+    Args:
+      StreamingJSON: session context (from ``getStreamingContext``).
+      rawBytes: decrypted session JSON bytes.
+      SectionRanges: byte offsets of streaming sections (from ``loadSessionSkeleton``).
+
+    Returns:
+      Generator of decoded Percept data structures, each containing Indefinite Streams of a single recording.
+    """
+
+    MontageStreamCount = dict()
+    for FirstPacketDateTime in iterateStreamingSection(rawBytes, SectionRanges, "IndefiniteStreaming", prefix="item.FirstPacketDateTime"):
+        if not FirstPacketDateTime in MontageStreamCount.keys():
+            MontageStreamCount[FirstPacketDateTime] = 0
+        MontageStreamCount[FirstPacketDateTime] += 1
+
+    StreamGroups = dict()
+    for stream in iterateStreamingSection(rawBytes, SectionRanges, "IndefiniteStreaming"):
+        if not stream["FirstPacketDateTime"] in StreamGroups.keys():
+            StreamGroups[stream["FirstPacketDateTime"]] = []
+        StreamGroups[stream["FirstPacketDateTime"]].append(stream)
+        if len(StreamGroups[stream["FirstPacketDateTime"]]) == MontageStreamCount[stream["FirstPacketDateTime"]]:
+            yield extractStreamingSection(StreamingJSON, {"IndefiniteStreaming": StreamGroups.pop(stream["FirstPacketDateTime"])})
+
+def iterateRealtimeStreams(StreamingJSON, rawBytes, SectionRanges):
+    """ Parse and decode BrainSense streams one recording at a time.
+
+    TimeDomain and Lfp items of a recording share the same FirstPacketDateTime, a recording is decoded as soon as 
+    all of its items in both sections have been parsed. Both sections are read side by side, so only the items of
+    recordings that are not complete yet are held.
+
+    Args:
+      StreamingJSON: session context (from ``getStreamingContext``).
+      rawBytes: decrypted session JSON bytes.
+      SectionRanges: byte offsets of streaming sections (from ``loadSessionSkeleton``).
+
+    Returns:
+      Generator of decoded Percept data structures, each containing the BrainSense streams of a single recording.
+    """
+
+    RemainingItems = dict()
+    for section in ["BrainSenseTimeDomain", "BrainSenseLfp"]:
+        for FirstPacketDateTime in iterateStreamingSection(rawBytes, SectionRanges, section, prefix="item.FirstPacketDateTime"):
+            if not FirstPacketDateTime in RemainingItems.keys():
+                RemainingItems[FirstPacketDateTime] = 0
+            RemainingItems[FirstPacketDateTime] += 1
+
+    StreamGroups = dict()
+    Sections = {section: iterateStreamingSection(rawBytes, SectionRanges, section) for section in ["BrainSenseTimeDomain", "BrainSenseLfp"]}
+    while len(Sections) > 0:
+        for section in list(Sections.keys()):
+            stream = next(Sections[section], None)
+            if stream == None:
+                del Sections[section]
+                continue
+
+            if not stream["FirstPacketDateTime"] in StreamGroups.keys():
+                StreamGroups[stream["FirstPacketDateTime"]] = {"BrainSenseTimeDomain": [], "BrainSenseLfp": []}
+            StreamGroups[stream["FirstPacketDateTime"]][section].append(stream)
+            RemainingItems[stream["FirstPacketDateTime"]] -= 1
+            if RemainingItems[stream["FirstPacketDateTime"]] == 0:
+                yield extractStreamingSection(StreamingJSON, StreamGroups.pop(stream["FirstPacketDateTime"]))
+
 def processPerceptJSON(user, filename, device_deidentified_id="", lookupTable=None, process=True):
     secureEncoder = Fernet(key)
     
-    try:
-        JSON = Percept.decodeEncryptedJSON(DATABASE_PATH + "cache" + os.path.sep + filename, key)
-    except:
-        return "JSON Format Error: " + filename, None, None
-
     if not process:
+        try:
+            JSON = Percept.decodeEncryptedJSON(DATABASE_PATH + "cache" + os.path.sep + filename, key)
+        except:
+            return "JSON Format Error: " + filename, None, None
         os.remove(DATABASE_PATH + "cache" + os.path.sep + filename)
         return "Success", None, JSON
 
+    # Streaming sections are not part of JSON, they are parsed from their byte range in rawBytes when saved.
+    try:
+        rawBytes = decryptCacheJSON(filename)
+        JSON, SectionRanges = loadSessionSkeleton(rawBytes)
+    except:
+        return "JSON Format Error: " + filename, None, None
+
     if JSON["DeviceInformation"]["Final"]["NeurostimulatorSerialNumber"] != "" and not "█" in JSON["DeviceInformation"]["Final"]["NeurostimulatorSerialNumber"]:
         DeviceSerialNumber = secureEncoder.encrypt(JSON["DeviceInformation"]["Final"]["NeurostimulatorSerialNumber"].encode("utf-8")).decode("utf-8")
         deviceHashfield = hashlib.sha256(JSON["DeviceInformation"]["Final"]["NeurostimulatorSerialNumber"].encode("utf-8")).hexdigest()
@@ -125,7 +402,24 @@ def processPerceptJSON(user, filename, device_deidentified_id="", lookupTable=No
         print(Data["ProcessFailure"])
         shutil.copyfile(DATABASE_PATH + "cache" + os.path.sep + filename, DATABASE_PATH + "cache" + os.path.sep + "Failed_" + filename)
         return "Process Error: " + filename, None, None
-        
+
+    # Session files of the same device are processed by one worker at a time (device creation, therapy, events and partitioned recordings deduplication).
+    if (user.is_admin or user.is_clinician):
+        LockKey = "PerceptDevice:Clinic:" + user.institute + ":" + deviceHashfield
+    elif lookupTable:
+        LockKey = "PerceptDevice:Research:" + user.email + ":" + deviceHashfield
+    else:
+        LockKey = "PerceptDevice:" + str(device_deidentified_id)
+
+    Database.acquireProcessingLock(LockKey)
+    try:
+        return savePerceptSession(user, filename, JSON, Data, rawBytes, SectionRanges, DeviceSerialNumber, deviceHashfield, device_deidentified_id=device_deidentified_id, lookupTable=lookupTable)
+    finally:
+        Database.releaseProcessingLock(LockKey)
+
+def savePerceptSession(user, filename, JSON, Data, rawBytes, SectionRanges, DeviceSerialNumber, deviceHashfield, device_deidentified_id="", lookupTable=None):
+    secureEncoder = Fernet(key)
+
     SessionDate = datetime.fromtimestamp(Percept.estimateSessionDateTime(JSON),tz=pytz.utc)
     if (user.is_admin or user.is_clinician):
         deviceID = models.PerceptDevice.objects.filter(device_identifier_hashfield=deviceHashfield, authority_level="Clinic", authority_user=user.institute).first()
@@ -140,11 +434,16 @@ def processPerceptJSON(user, filename, device_deidentified_id="", lookupTable=No
     if deviceID == None:
         PatientInformation = JSON["PatientInformation"]["Final"]
         
-        patient, isNewPatient = retrievePatientInformation(PatientInformation, user.institute, lookupTable=lookupTable, encoder=secureEncoder)
-        if isNewPatient:
-            newPatient = patient
-            patient.institute = user.institute
-            patient.save()
+        # Patients and their device lists are shared by session files of different devices processed by concurrent workers
+        Database.acquireProcessingLock("Patient:" + user.institute)
+        try:
+            patient, isNewPatient = retrievePatientInformation(PatientInformation, user.institute, lookupTable=lookupTable, encoder=secureEncoder)
+            if isNewPatient:
+                newPatient = patient
+                patient.institute = user.institute
+                patient.save()
+        finally:
+            Database.releaseProcessingLock("Patient:" + user.institute)
 
         DeviceInformation = JSON["DeviceInformation"]["Final"]
         DeviceType = DeviceInformation["Neurostimulator"]
@@ -201,7 +500,12 @@ def processPerceptJSON(user, filename, device_deidentified_id="", lookupTable=No
         deviceID.device_identifier_hashfield=deviceHashfield
         deviceID.save()
 
-        patient.addDevice(str(deviceID.deidentified_id))
+        Database.acquireProcessingLock("Patient:" + user.institute)
+        try:
+            patient.refresh_from_db(fields=["device_deidentified_id"])
+            patient.addDevice(str(deviceID.deidentified_id))
+        finally:
+            Database.releaseProcessingLock("Patient:" + user.institute)
     else:
         patient = models.Patient.objects.filter(deidentified_id=deviceID.patient_deidentified_id).first()
 
@@ -308,14 +612,39 @@ def processPerceptJSON(user, filename, device_deidentified_id="", lookupTable=No
             NewDataFound = True
 
     # Process Montage Streams
-    if "IndefiniteStream" in Data.keys():
-        if IndefiniteStream.saveMontageStreams(deviceID.deidentified_id, Data["IndefiniteStream"], sessionUUID):
-            NewDataFound = True
-
-    # Process Realtime Streams
-    if "StreamingTD" in Data.keys() and "StreamingPower" in Data.keys():
-        if BrainSenseStream.saveRealtimeStreams(deviceID.deidentified_id, Data["StreamingTD"], Data["StreamingPower"], sessionUUID):
+    StreamingJSON = getStreamingContext(JSON)
+    for StreamData in iterateMontageStreams(StreamingJSON, rawBytes, SectionRanges):
+        if "ProcessFailure" in StreamData.keys():
+            print(StreamData["ProcessFailure"])
+            shutil.copyfile(DATABASE_PATH + "cache" + os.path.sep + filename, DATABASE_PATH + "cache" + os.path.sep + "Failed_" + filename)
+            return "Process Error: " + filename, None, None
+        
+        if "IndefiniteStream" in StreamData.keys():
+            if IndefiniteStream.saveMontageStreams(deviceID.deidentified_id, StreamData["IndefiniteStream"], sessionUUID):
+                NewDataFound = True
+        del StreamData
+
+    # Process Realtime Streams. TimeDomain and Power streams are paired and merged across recordings by saveRealtimeStreams, 
+    # recordings are decoded one at a time and only their decoded arrays are kept until saved together.
+    StreamingTD = list()
+    StreamingPower = list()
+    for StreamData in iterateRealtimeStreams(StreamingJSON, rawBytes, SectionRanges):
+        if "ProcessFailure" in StreamData.keys():
+            print(StreamData["ProcessFailure"])
+            shutil.copyfile(DATABASE_PATH + "cache" + os.path.sep + filename, DATABASE_PATH + "cache" + os.path.sep + "Failed_" + filename)
+            return "Process Error: " + filename, None, None
+        
+        if "StreamingTD" in StreamData.keys():
+            StreamingTD.extend(StreamData["StreamingTD"])
+        if "StreamingPower" in StreamData.keys():
+            StreamingPower.extend(StreamData["StreamingPower"])
+        del StreamData
+    del StreamingJSON, rawBytes
+
+    if len(StreamingTD) > 0 and len(StreamingPower) > 0:
+        if BrainSenseStream.saveRealtimeStreams(deviceID.deidentified_id, StreamingTD, StreamingPower, sessionUUID):
             NewDataFound = True
+    del StreamingTD, StreamingPower
 
     # Stiore Chronic LFPs
     if "LFPTrends" in Data.keys():
@@ -334,8 +663,9 @@ def processPerceptJSON(user, filename, device_deidentified_id="", lookupTable=No
 
     if NewDataFound:
         os.rename(DATABASE_PATH + "cache" + os.path.sep + filename, DATABASE_PATH + session.session_file_path)
+        # Only last_change is updated, device list of the patient may be changed by concurrent workers
         patient.last_change = datetime.now(tz=pytz.utc)
-        patient.save()
+        models.Patient.objects.filter(deidentified_id=patient.deidentified_id).update(last_change=patient.last_change)
         session.save()
     else:
         os.remove(DATABASE_PATH + "cache" + os.path.sep + filename)
@@ -520,10 +850,7 @@ def queryAvailableSessionFiles(user, patient_id, authority):
 def deleteDevice(device_id):
     recordings = models.NeuralActivityRecording.objects.filter(device_deidentified_id=device_id).all()
     for recording in recordings:
-        try:
-            os.remove(DATABASE_PATH + "recordings" + os.path.sep + recording.recording_datapointer)
-        except:
-            pass
+        Database.deleteSourceDataPointer(recording.recording_datapointer)
     recordings.delete()
 
     Sessions = models.PerceptSession.objects.filter(device_deidentified_id=device_id).all()
@@ -546,10 +873,7 @@ def deleteSession(session_id):
     models.PatientCustomEvents.objects.filter(source_file=str(session_id)).delete()
     recordings = models.NeuralActivityRecording.objects.filter(source_file=str(session_id)).all()
     for recording in recordings:
-        try:
-            os.remove(DATABASE_PATH + "recordings" + os.path.sep + recording.recording_datapointer)
-        except:
-            pass
+        Database.deleteSourceDataPointer(recording.recording_datapointer)
     recordings.delete()
     session = models.PerceptSession.objects.filter(deidentified_id=session_id).first()
     models.ImpedanceHistory.objects.filter(session_date=session.session_date).delete()
@@ -559,6 +883,31 @@ def deleteSession(session_id):
         pass
     session.delete()
 
+def deleteSessionFiles(SessionFiles):
+    """ Remove multiple sessions and all records extracted from them.
+
+    Same as ``deleteSession`` for each session, with one query per table for all sessions.
+
+    Args:
+      SessionFiles: list of PerceptSession objects.
+    """
+
+    SessionIDs = [str(sessionFile.deidentified_id) for sessionFile in SessionFiles]
+    models.TherapyHistory.objects.filter(source_file__in=SessionIDs).delete()
+    models.TherapyChangeLog.objects.filter(source_file__in=SessionIDs).delete()
+    models.PatientCustomEvents.objects.filter(source_file__in=SessionIDs).delete()
+    recordings = models.NeuralActivityRecording.objects.filter(source_file__in=SessionIDs).all()
+    for recording in recordings:
+        Database.deleteSourceDataPointer(recording.recording_datapointer)
+    recordings.delete()
+    models.ImpedanceHistory.objects.filter(session_date__in=[sessionFile.session_date for sessionFile in SessionFiles]).delete()
+    for sessionFile in SessionFiles:
+        try:
+            os.remove(DATABASE_PATH + sessionFile.session_file_path)
+        except:
+            pass
+    models.PerceptSession.objects.filter(deidentified_id__in=SessionIDs).delete()
+
 def deleteSessions(user, patient_id, session_ids, authority):
     availableDevices = Database.getPerceptDevices(user, patient_id, authority)
     for i in range(len(session_ids)):
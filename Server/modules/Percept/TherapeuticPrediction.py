@@ -26,6 +26,9 @@ import json
 import uuid
 import numpy as np
 import copy
+import hashlib
+import threading
+from collections import OrderedDict
 from shutil import copyfile, rmtree
 from datetime import datetime, date, timedelta
 import dateutil, pytz
@@ -40,13 +43,69 @@ from utility import SignalProcessingUtility as SPU
 from utility.PythonUtility import *
 
 from Backend import models
-from modules import Database
+from modules import Database, CurveFitting, RealtimeStream
 from modules.Percept import BrainSenseStream
 
 import os, pathlib
 RESOURCES = str(pathlib.Path(__file__).parent.resolve())
 key = os.environ.get('ENCRYPTION_KEY')
 
+FEATURE_VERSION = 1
+PREDICTION_MODEL_VERSION = 1
+FEATURE_CACHE_SIZE = int(os.environ.get('PREDICTION_FEATURE_CACHE_SIZE', 128))
+FeatureCache = OrderedDict()
+FeatureCacheLock = threading.Lock()
+
+def getFeatureCacheKey(stream, channel, featureType, centerFrequency, recordingId):
+    """ Cache key of prediction features for a recording channel.
+
+    The key contains a content digest of the channel spectrogram and stimulation series, 
+    so features are recomputed whenever the processed recording changes (i.e., different cardiac filter or spectrogram method).
+
+    Args:
+      stream: processed BrainSense streaming data structure.
+      channel: BrainSense channel name.
+      featureType: name of the feature set ("PredictionFeatures" or "FullPredictionFeatures").
+      centerFrequency: requested center frequency (0 for automatic selection).
+      recordingId: unique recording ID. Features are not cached if None.
+
+    Returns:
+      Cache key tuple, or None if the features should not be cached.
+    """
+
+    if recordingId == None:
+        return None
+
+    digest = hashlib.sha1()
+    for series in stream["PowerDomain"]["Stimulation"]:
+        if channel == series["Name"]:
+            digest.update(np.ascontiguousarray(series["Time"], dtype=float).tobytes())
+            digest.update(np.ascontiguousarray(series["Amplitude"], dtype=float).tobytes())
+    digest.update(str(stream["TimeDomain"]["StartTime"] - stream["PowerDomain"]["StartTime"]).encode("utf-8"))
+    for i in range(len(stream["TimeDomain"]["ChannelNames"])):
+        if stream["TimeDomain"]["ChannelNames"][i] == channel:
+            for key in ["Time", "Frequency", "Power", "Missing"]:
+                digest.update(np.ascontiguousarray(stream["TimeDomain"]["Spectrogram"][i][key]).tobytes())
+    return (str(recordingId), channel, featureType, float(centerFrequency), digest.hexdigest(), FEATURE_VERSION)
+
+def getCachedFeatures(cacheKey):
+    if cacheKey == None:
+        return None
+    with FeatureCacheLock:
+        if not cacheKey in FeatureCache.keys():
+            return None
+        FeatureCache.move_to_end(cacheKey)
+        return copy.deepcopy(FeatureCache[cacheKey])
+
+def setCachedFeatures(cacheKey, features):
+    if cacheKey == None or FEATURE_CACHE_SIZE <= 0:
+        return
+    with FeatureCacheLock:
+        FeatureCache[cacheKey] = copy.deepcopy(features)
+        FeatureCache.move_to_end(cacheKey)
+        while len(FeatureCache) > FEATURE_CACHE_SIZE:
+            FeatureCache.popitem(last=False)
+
 def processSpectrogram(stream, channel):
     for series in stream["PowerDomain"]["Stimulation"]:
         if channel == series["Name"]:
@@ -59,16 +118,16 @@ def processSpectrogram(stream, channel):
             stream["TimeDomain"]["Spectrogram"][i]["ConstantStimulation"] = np.ones(stream["TimeDomain"]["Spectrogram"][i]["Time"].shape, dtype=bool)
             stream["TimeDomain"]["Spectrogram"][i]["logPower"] = 10*np.log10(stream["TimeDomain"]["Spectrogram"][i]["Power"])
             stream["TimeDomain"]["Spectrogram"][i]["ConstantStimulation"][np.isinf(stream["TimeDomain"]["Spectrogram"][i]["logPower"][0,:])] = False
-            for t in StimulationSeries["Time"]:
-                stream["TimeDomain"]["Spectrogram"][i]["ConstantStimulation"][rangeSelection(stream["TimeDomain"]["Spectrogram"][i]["Time"], [t-3, t+3])] = False
-                
-            stream["TimeDomain"]["Spectrogram"][i]["Stimulation"] = np.zeros(stream["TimeDomain"]["Spectrogram"][i]["Time"].shape)
-            for t in range(len(stream["TimeDomain"]["Spectrogram"][i]["Time"])):
-                Stim = np.where(StimulationSeries["Time"] < stream["TimeDomain"]["Spectrogram"][i]["Time"][t])[0]
-                if len(Stim) == 0:
-                    stream["TimeDomain"]["Spectrogram"][i]["Stimulation"][t] = StimulationSeries["Amplitude"][0]
-                else:
-                    stream["TimeDomain"]["Spectrogram"][i]["Stimulation"][t] = StimulationSeries["Amplitude"][Stim[-1]]
+
+            # Exclude bins within 3 seconds of any stimulation change (change times are sorted).
+            ChangeIndex = np.searchsorted(StimulationSeries["Time"], stream["TimeDomain"]["Spectrogram"][i]["Time"] - 3, side="left")
+            NearChange = ChangeIndex < len(StimulationSeries["Time"])
+            NearChange[NearChange] = StimulationSeries["Time"][ChangeIndex[NearChange]] <= stream["TimeDomain"]["Spectrogram"][i]["Time"][NearChange] + 3
+            stream["TimeDomain"]["Spectrogram"][i]["ConstantStimulation"][NearChange] = False
+            
+            # Step-function amplitude: last change strictly before each bin, first amplitude before the first change.
+            StimulationIndex = np.searchsorted(StimulationSeries["Time"], stream["TimeDomain"]["Spectrogram"][i]["Time"], side="left") - 1
+            stream["TimeDomain"]["Spectrogram"][i]["Stimulation"] = np.asarray(StimulationSeries["Amplitude"], dtype=float)[np.maximum(StimulationIndex, 0)]
                     
     return stream
 
@@ -76,17 +135,19 @@ def extractFrequencyOfInterest(stream, channel):
     for i in range(len(stream["TimeDomain"]["ChannelNames"])):
         if stream["TimeDomain"]["ChannelNames"][i] == channel:
             if len(np.unique(stream["TimeDomain"]["Spectrogram"][i]["Stimulation"][stream["TimeDomain"]["Spectrogram"][i]["ConstantStimulation"]])) > 2:
-                ModulationIndex = np.zeros(stream["TimeDomain"]["Spectrogram"][i]["Frequency"].shape)
-                for f in range(len(stream["TimeDomain"]["Spectrogram"][i]["Frequency"])):
-                    ModulationIndex[f] = np.var(stream["TimeDomain"]["Spectrogram"][i]["logPower"][f,:][stream["TimeDomain"]["Spectrogram"][i]["ConstantStimulation"]])
+                ModulationIndex = np.var(stream["TimeDomain"]["Spectrogram"][i]["logPower"][:,stream["TimeDomain"]["Spectrogram"][i]["ConstantStimulation"]], axis=1)
                 
                 TargetFrequency = rangeSelection(stream["TimeDomain"]["Spectrogram"][i]["Frequency"], [5,50])
                 maxModulation = np.max(ModulationIndex[TargetFrequency])
                 SelectedData = np.bitwise_and(stream["TimeDomain"]["Spectrogram"][i]["ConstantStimulation"], stream["TimeDomain"]["Spectrogram"][i]["Missing"] == 0)
                 
-                CorrelationIndex = np.zeros(stream["TimeDomain"]["Spectrogram"][i]["Frequency"].shape)
-                for f in range(len(stream["TimeDomain"]["Spectrogram"][i]["Frequency"])):
-                    CorrelationIndex[f], _ = stats.pearsonr(stream["TimeDomain"]["Spectrogram"][i]["Stimulation"][SelectedData], stream["TimeDomain"]["Spectrogram"][i]["Power"][f,:][SelectedData])
+                # Pearson correlation between stimulation amplitude and power of every frequency as a single matrix reduction.
+                Amplitude = stream["TimeDomain"]["Spectrogram"][i]["Stimulation"][SelectedData]
+                Amplitude = Amplitude - np.mean(Amplitude)
+                Power = stream["TimeDomain"]["Spectrogram"][i]["Power"][:,SelectedData]
+                Power = Power - np.mean(Power, axis=1, keepdims=True)
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    CorrelationIndex = np.clip((Power @ Amplitude) / (np.linalg.norm(Power, axis=1) * np.linalg.norm(Amplitude)), -1, 1)
                 
                 CorrelationIndex = np.power(CorrelationIndex,2)
                 maxCorrelation = np.max(CorrelationIndex[TargetFrequency])
@@ -103,7 +164,19 @@ def extractFrequencyOfInterest(stream, channel):
 def powerDecay(x, a, b, c):
     return a * np.power(1/b, x) + c
 
-def extractModelParameters(stream, channel, centerFrequency):
+def extractDecayCurve(stream, channel, centerFrequency):
+    """ Brain power around the center frequency at each stimulation amplitude during constant stimulation.
+
+    Args:
+      stream: BrainSense streaming data structure processed by ``processSpectrogram``.
+      channel: BrainSense channel name.
+      centerFrequency: center frequency (Hz) of the +/- 3Hz power band.
+
+    Returns:
+      Dictionary with "StimulationAmplitude" and "BrainPower" of every spectrogram bin, 
+      "UniqueAmplitude" (sorted) and "MedianPower" at each unique amplitude.
+    """
+
     for i in range(len(stream["TimeDomain"]["ChannelNames"])):
         if stream["TimeDomain"]["ChannelNames"][i] == channel:
             break
@@ -117,15 +190,42 @@ def extractModelParameters(stream, channel, centerFrequency):
     simplifiedYData = []
     for k in range(len(uniqueAmplitude)):
         simplifiedYData.append(np.median(BrainPower[StimulationAmplitude==uniqueAmplitude[k]]))
+    return {"StimulationAmplitude": StimulationAmplitude, "BrainPower": BrainPower, "UniqueAmplitude": uniqueAmplitude, "MedianPower": simplifiedYData}
+
+def fitDecayCurves(curves):
+    """ Fit ``powerDecay`` to all curves with at least 4 amplitude levels in a single batch.
+
+    Args:
+      curves: list of decay curves from ``extractDecayCurve``.
+
+    Returns:
+      List aligned with curves. Each item is None (not fitted) or a dictionary with "Parameters" (a, b, c) 
+      and convergence diagnostics (see ``CurveFitting.fitPowerDecayBatch``).
+    """
+
+    Selected = [i for i in range(len(curves)) if len(curves[i]["UniqueAmplitude"]) >= 4]
+    Fit = CurveFitting.fitPowerDecayBatch([curves[i]["UniqueAmplitude"] for i in Selected], [curves[i]["MedianPower"] for i in Selected])
+
+    Results = [None for i in range(len(curves))]
+    for j in range(len(Selected)):
+        Results[Selected[j]] = {"Parameters": Fit["Parameters"][j].tolist(), "Converged": bool(Fit["Converged"][j]), "Iterations": int(Fit["Iterations"][j]),
+                                "ResidualSumSquares": float(Fit["ResidualSumSquares"][j]), "RSquared": float(Fit["RSquared"][j])}
+    return Results
+
+def extractModelParameters(stream, channel, centerFrequency, curve=None, fit=None):
+    if curve == None:
+        curve = extractDecayCurve(stream, channel, centerFrequency)
+        fit = fitDecayCurves([curve])[0]
+
+    StimulationAmplitude = curve["StimulationAmplitude"]
+    BrainPower = curve["BrainPower"]
+    uniqueAmplitude = curve["UniqueAmplitude"]
+    simplifiedYData = curve["MedianPower"]
     
+    # Parameters that left the finite range (diverging decay rate) fall back to polynomial model.
     xdata = np.linspace(np.min(StimulationAmplitude), np.max(StimulationAmplitude), 100)
-    if len(uniqueAmplitude) >= 4:
-        try:
-            popt, pcov = optimize.curve_fit(powerDecay, uniqueAmplitude, simplifiedYData, maxfev=5000)
-            modeled_signal = powerDecay(xdata, *popt)
-        except:
-            coe = np.polyfit(StimulationAmplitude, BrainPower, 4)
-            modeled_signal = np.polyval(coe, xdata)
+    if fit and np.all(np.isfinite(fit["Parameters"])):
+        modeled_signal = powerDecay(xdata, *fit["Parameters"])
     else:
         coe = np.polyfit(StimulationAmplitude, BrainPower, 4)
         modeled_signal = np.polyval(coe, xdata)
@@ -157,10 +257,15 @@ def extractModelParameters(stream, channel, centerFrequency):
         "ChangesInPower": np.percentile(modeled_signal, 85) - np.percentile(modeled_signal, 15),
         "FinalPower": np.percentile(modeled_signal, 5)}, xdata[modeled_signal <= threshold][0], [xdata[0], xdata[-1]], modeled_signal.tolist()
 
-def extractFullPredictionFeatures(BrainSenseData, HemisphereInfo):
+def extractFullPredictionFeatures(BrainSenseData, HemisphereInfo, recordingId=None):
     for channel in BrainSenseData["TimeDomain"]["ChannelNames"]:
         contacts, hemisphere = Percept.reformatChannelName(channel)
         if HemisphereInfo.startswith(hemisphere):
+            CacheKey = getFeatureCacheKey(BrainSenseData, channel, "FullPredictionFeatures", 0, recordingId)
+            FullFeatures = getCachedFeatures(CacheKey)
+            if not FullFeatures is None:
+                return FullFeatures
+
             BrainSenseData = processSpectrogram(BrainSenseData, channel)
 
             for i in range(len(BrainSenseData["TimeDomain"]["ChannelNames"])):
@@ -171,57 +276,165 @@ def extractFullPredictionFeatures(BrainSenseData, HemisphereInfo):
             StimulationAmplitude = BrainSenseData["TimeDomain"]["Spectrogram"][i]["Stimulation"][constantStimulation]
             uniqueAmplitude = sorted(np.unique(StimulationAmplitude))
             
-            FullFeatures = np.zeros((len(BrainSenseData["TimeDomain"]["Spectrogram"][i]["Frequency"])+1, len(uniqueAmplitude)))
-            for j in range(len(BrainSenseData["TimeDomain"]["Spectrogram"][i]["Frequency"])):
-                freq = BrainSenseData["TimeDomain"]["Spectrogram"][i]["Frequency"][j]
-                FrequencyOfInterest = rangeSelection(BrainSenseData["TimeDomain"]["Spectrogram"][i]["Frequency"], [freq - 3, freq + 3])
-                BrainPower = np.mean(BrainSenseData["TimeDomain"]["Spectrogram"][i]["Power"][:,constantStimulation][FrequencyOfInterest], axis=0)
-
-                simplifiedYData = []
-                for k in range(len(uniqueAmplitude)):
-                    simplifiedYData.append(np.median(BrainPower[StimulationAmplitude==uniqueAmplitude[k]]))
-                
-                FullFeatures[j,:] = np.array(simplifiedYData)
+            # Mean power within +/- 3Hz of every frequency from cumulative sums along the frequency axis (frequencies are sorted).
+            Frequency = BrainSenseData["TimeDomain"]["Spectrogram"][i]["Frequency"]
+            Power = BrainSenseData["TimeDomain"]["Spectrogram"][i]["Power"][:,constantStimulation]
+            CumulativePower = np.concatenate((np.zeros((1,Power.shape[1])), np.cumsum(Power, axis=0)), axis=0)
+            StartIndex = np.searchsorted(Frequency, Frequency - 3, side="left")
+            EndIndex = np.searchsorted(Frequency, Frequency + 3, side="right")
+            BrainPower = (CumulativePower[EndIndex] - CumulativePower[StartIndex]) / (EndIndex - StartIndex).reshape(-1,1)
+
+            FullFeatures = np.zeros((len(Frequency)+1, len(uniqueAmplitude)))
+            for k in range(len(uniqueAmplitude)):
+                FullFeatures[:-1,k] = np.median(BrainPower[:,StimulationAmplitude==uniqueAmplitude[k]], axis=1)
             FullFeatures[-1,:] = np.array(uniqueAmplitude)
+            setCachedFeatures(CacheKey, FullFeatures)
             return FullFeatures
 
     return None
 
-def extractPredictionFeatures(BrainSenseData, HemisphereInfo, centerFrequency=0):
+def getPredictionChannel(BrainSenseData, HemisphereInfo):
     for channel in BrainSenseData["TimeDomain"]["ChannelNames"]:
         contacts, hemisphere = Percept.reformatChannelName(channel)
         if HemisphereInfo.startswith(hemisphere):
-            BrainSenseData = processSpectrogram(BrainSenseData, channel)
+            return channel
+    return None
 
-            if centerFrequency == 0:
-                centerFrequency, goodnessOfFit = extractFrequencyOfInterest(BrainSenseData, channel)
-            else:
-                pass
-            
-            if centerFrequency > 0:
-                Features, PredictedAmplitude, AmplitudeRange, ModeledSignal = extractModelParameters(BrainSenseData, channel, centerFrequency)
-                if Features["ChangesDirection"] > 0:
-                    Features = { "OptimalFrequency": -1, "ChangesDirection": 1, "FittedEffect": 0, "ChangesInPower": 0, "FinalPower": 0 }
-                    PredictedAmplitude = 0
-                    AmplitudeRange = [0,0]
-                    ModeledSignal = np.zeros(100).tolist()
-            else:
+def extractPredictionFeaturesBatch(requests):
+    """ Extract therapeutic prediction features of many recording hemispheres with a single batch curve fit.
+
+    Args:
+      requests: list of dictionaries with "Data" (BrainSense streaming data structure including PowerDomain stimulation series), 
+        "Hemisphere", optional "CenterFrequency" (0 for automatic selection) and optional "RecordingID" (used for caching).
+
+    Returns:
+      List of feature dictionaries aligned with requests. Empty dictionary if no channel matches the hemisphere.
+    """
+
+    Results = [None for i in range(len(requests))]
+    Pending = list()
+    for i in range(len(requests)):
+        BrainSenseData = requests[i]["Data"]
+        channel = getPredictionChannel(BrainSenseData, requests[i]["Hemisphere"])
+        if channel == None:
+            Results[i] = dict()
+            continue
+
+        centerFrequency = requests[i].get("CenterFrequency", 0)
+        CacheKey = getFeatureCacheKey(BrainSenseData, channel, "PredictionFeatures", centerFrequency, requests[i].get("RecordingID"))
+        Results[i] = getCachedFeatures(CacheKey)
+        if not Results[i] is None:
+            continue
+
+        BrainSenseData = processSpectrogram(BrainSenseData, channel)
+        if centerFrequency == 0:
+            centerFrequency, goodnessOfFit = extractFrequencyOfInterest(BrainSenseData, channel)
+        
+        Curve = None
+        if centerFrequency > 0:
+            Curve = extractDecayCurve(BrainSenseData, channel, centerFrequency)
+        Pending.append({"Index": i, "Data": BrainSenseData, "Channel": channel, "CenterFrequency": centerFrequency, "Curve": Curve, "CacheKey": CacheKey})
+
+    Fits = fitDecayCurves([item["Curve"] for item in Pending if item["Curve"]])
+    for item in Pending:
+        centerFrequency = item["CenterFrequency"]
+        Fit = None
+        if centerFrequency > 0:
+            Fit = Fits.pop(0)
+            Features, PredictedAmplitude, AmplitudeRange, ModeledSignal = extractModelParameters(item["Data"], item["Channel"], centerFrequency, curve=item["Curve"], fit=Fit)
+            if Features["ChangesDirection"] > 0:
                 Features = { "OptimalFrequency": -1, "ChangesDirection": 1, "FittedEffect": 0, "ChangesInPower": 0, "FinalPower": 0 }
                 PredictedAmplitude = 0
                 AmplitudeRange = [0,0]
                 ModeledSignal = np.zeros(100).tolist()
-            
-            if "Features" in Features.keys():
-                Features["Score"] = applyPredictionModel(Features["Features"])
-            else:
-                Features["Score"] = 0
-            Features["CenterFrequency"] = centerFrequency
-            Features["PredictedAmplitude"] = PredictedAmplitude
-            Features["AmplitudeRange"] = AmplitudeRange
-            Features["ModeledSignal"] = ModeledSignal
-            return Features
-
-    return dict()
+        else:
+            Features = { "OptimalFrequency": -1, "ChangesDirection": 1, "FittedEffect": 0, "ChangesInPower": 0, "FinalPower": 0 }
+            PredictedAmplitude = 0
+            AmplitudeRange = [0,0]
+            ModeledSignal = np.zeros(100).tolist()
+        
+        if "Features" in Features.keys():
+            Features["Score"] = applyPredictionModel(Features["Features"])
+        else:
+            Features["Score"] = 0
+        Features["CenterFrequency"] = centerFrequency
+        Features["PredictedAmplitude"] = PredictedAmplitude
+        Features["AmplitudeRange"] = AmplitudeRange
+        Features["ModeledSignal"] = ModeledSignal
+        if Fit:
+            Features["FitDiagnostics"] = Fit
+        setCachedFeatures(item["CacheKey"], Features)
+        Results[item["Index"]] = Features
+
+    return Results
+
+def extractPredictionFeatures(BrainSenseData, HemisphereInfo, centerFrequency=0, recordingId=None):
+    return extractPredictionFeaturesBatch([{"Data": BrainSenseData, "Hemisphere": HemisphereInfo, "CenterFrequency": centerFrequency, "RecordingID": recordingId}])[0]
+
+def precomputePredictionModels(analysisIds, cardiacFilter=False):
+    """ Precompute ``PredictionModel`` rows of BrainSense streaming recordings.
+
+    Called from the processing queue after ingest so that prediction models are available without fitting in request handlers.
+    All hemispheres of all recordings are fitted in a single batch. Existing rows are replaced.
+
+    Args:
+      analysisIds: list of CombinedRecordingAnalysis deidentified IDs (as used by ``QueryPredictionModel``).
+      cardiacFilter: Boolean indicator if cardiac filter is applied before spectrogram (see BrainSenseStream.processRealtimeStreams function).
+
+    Returns:
+      Number of saved prediction models.
+    """
+
+    Requests = list()
+    for analysis in models.CombinedRecordingAnalysis.objects.filter(deidentified_id__in=analysisIds).all():
+        if not "BrainSenseRecording" in analysis.recording_type:
+            continue
+
+        try:
+            BrainSenseData, RecordingID = BrainSenseStream.queryRealtimeStreamRecording(analysis, cardiacFilter=cardiacFilter, refresh=False)
+        except Exception as e:
+            print(f"Prediction Model {analysis.deidentified_id}: {e}")
+            continue
+
+        BrainSenseData["PowerDomain"]["Stimulation"] = RealtimeStream.processRealtimeStreamStimulationAmplitude(BrainSenseData["PowerDomain"])
+        for stimulationSide in BrainSenseData["PowerDomain"]["Stimulation"]:
+            if len(np.unique(stimulationSide["Amplitude"])) > 3:
+                Requests.append({"Data": BrainSenseData, "Hemisphere": stimulationSide["Hemisphere"], "RecordingID": RecordingID, "Channel": stimulationSide["Name"]})
+
+    FeatureList = extractPredictionFeaturesBatch(Requests)
+    for i in range(len(Requests)):
+        savePredictionModel(Requests[i]["RecordingID"], Requests[i]["Channel"], FeatureList[i], cardiacFilter)
+    return len(Requests)
+
+def savePredictionModel(recordingId, channel, Features, cardiacFilter):
+    """ Save prediction model of a recording channel as ``PredictionModel`` row.
+
+    The cardiac filter setting and ``PREDICTION_MODEL_VERSION`` are stored with the model so that 
+    stale models are refitted instead of reused (see isPredictionModelCurrent function).
+
+    Args:
+      recordingId: CombinedRecordingAnalysis deidentified ID.
+      channel: stimulation channel name.
+      Features: prediction features dictionary (see extractPredictionFeatures function).
+      cardiacFilter: Boolean indicator if cardiac filter was applied before spectrogram.
+    """
+
+    Features["CardiacFilter"] = cardiacFilter
+    Features["ModelVersion"] = PREDICTION_MODEL_VERSION
+    models.PredictionModel.objects.update_or_create(recording_id=recordingId, recording_channel=channel, defaults={"model_details": Features})
+
+def isPredictionModelCurrent(modelDetails, cardiacFilter):
+    """ Check if a stored prediction model can be reused.
+
+    Args:
+      modelDetails: ``model_details`` of a PredictionModel row.
+      cardiacFilter: Boolean indicator if cardiac filter is requested.
+
+    Returns:
+      True if the model was fitted with the same cardiac filter setting by the current model version.
+    """
+
+    return modelDetails.get("CardiacFilter") == cardiacFilter and modelDetails.get("ModelVersion") == PREDICTION_MODEL_VERSION
 
 def applyPredictionModel(RecordingFeatures):
     #Features = np.array([RecordingFeatures[key] for key in RecordingFeatures.keys()])
@@ -40,7 +40,7 @@ from utility import SignalProcessingUtility as SPU
 from utility.PythonUtility import *
 
 from Backend import models
-from modules import Database
+from modules import Database, MissingLabel, LevelOfDetail
 from modules.Percept import BrainSenseStream
 from modules.Summit import StreamingData
 
@@ -112,7 +112,7 @@ def processRealtimeStreams(stream, cardiacFilter=False):
 
         # Wavelet Computation
         stream["TimeDomain"]["Wavelet"].append(SPU.waveletTimeFrequency(stream["TimeDomain"]["Filtered"][i], freq=np.arange(0.5,100.5,0.5), ma=int(stream["TimeDomain"]["SamplingRate"]/2), fs=stream["TimeDomain"]["SamplingRate"]))
-        stream["TimeDomain"]["Wavelet"][i]["Missing"] = stream["TimeDomain"]["Missing"][:,i][::int(stream["TimeDomain"]["SamplingRate"]/2)]
+        stream["TimeDomain"]["Wavelet"][i]["Missing"] = MissingLabel.decimateMissingLabel(stream["TimeDomain"]["Missing"][:,i], int(stream["TimeDomain"]["SamplingRate"]/2))
         stream["TimeDomain"]["Wavelet"][i]["Power"] = stream["TimeDomain"]["Wavelet"][i]["Power"][:,::int(stream["TimeDomain"]["SamplingRate"]/2)]
         stream["TimeDomain"]["Wavelet"][i]["Time"] = stream["TimeDomain"]["Wavelet"][i]["Time"][::int(stream["TimeDomain"]["SamplingRate"]/2)]
         stream["TimeDomain"]["Wavelet"][i]["Type"] = "Wavelet"
@@ -124,10 +124,7 @@ def processRealtimeStreams(stream, cardiacFilter=False):
         stream["TimeDomain"]["Spectrogram"][i]["Time"] += 0 # TODO Check later
         
         TimeArray = np.arange(len(stream["TimeDomain"]["Filtered"][i])) / stream["TimeDomain"]["SamplingRate"]
-        stream["TimeDomain"]["Spectrogram"][i]["Missing"] = np.zeros(stream["TimeDomain"]["Spectrogram"][i]["Time"].shape, dtype=bool)
-        for j in range(len(stream["TimeDomain"]["Spectrogram"][i]["Missing"])):
-            if np.any(stream["TimeDomain"]["Missing"][rangeSelection(TimeArray, [stream["TimeDomain"]["Spectrogram"][i]["Time"][j]-2, stream["TimeDomain"]["Spectrogram"][i]["Time"][j]+2]), i]):
-                stream["TimeDomain"]["Spectrogram"][i]["Missing"][j] = True
+        stream["TimeDomain"]["Spectrogram"][i]["Missing"] = MissingLabel.windowMissingLabel(stream["TimeDomain"]["Missing"][:,i], TimeArray, stream["TimeDomain"]["Spectrogram"][i]["Time"]-2, stream["TimeDomain"]["Spectrogram"][i]["Time"]+2)
         del(stream["TimeDomain"]["Spectrogram"][i]["logPower"])
 
     return stream
@@ -218,6 +215,10 @@ def queryRealtimeStreamOverview(user, patientUniqueID, authority):
             if len(allAnalysis) > 0:
                 leads = device.device_lead_configurations
 
+            CatalogRecordings = dict()
+            for recording in models.NeuralActivityRecording.objects.filter(device_deidentified_id=device.deidentified_id, recording_type__in=["BrainSenseStreamTimeDomain", "BrainSenseStreamPowerDomain"]).all():
+                CatalogRecordings[str(recording.recording_id)] = recording
+
             for analysis in allAnalysis:
                 for recordingId in analysis.recording_list:
                     if not recordingId in authority["Permission"] and authority["Level"] == 2:
@@ -242,7 +243,7 @@ def queryRealtimeStreamOverview(user, patientUniqueID, authority):
                 data["Channels"] = list()
                 data["ContactTypes"] = list()
 
-                allRecordings = models.NeuralActivityRecording.objects.filter(recording_id__in=analysis.recording_list)
+                allRecordings = [CatalogRecordings[recordingId] for recordingId in analysis.recording_list if recordingId in CatalogRecordings.keys()]
                 for recording in allRecordings:
                     if recording.recording_type == "BrainSenseStreamPowerDomain":
                         PowerRecording = recording
@@ -253,15 +254,16 @@ def queryRealtimeStreamOverview(user, patientUniqueID, authority):
                     analysis.delete()
                     continue 
 
-                RawData = Database.loadSourceDataPointer(PowerRecording.recording_datapointer)
-                if not "Therapy" in PowerRecording.recording_info:
-                    PowerRecording.recording_info["Therapy"] = RawData["Descriptor"]["Therapy"]
+                # Overview is served from recording catalog. Recordings missing from the catalog (not yet backfilled) are catalogued once here.
+                if not "Therapy" in PowerRecording.recording_info or PowerRecording.recording_size == 0:
+                    RawData = Database.loadSourceDataPointer(PowerRecording.recording_datapointer)
+                    Database.updateRecordingCatalog(PowerRecording, RawData)
                     PowerRecording.save()
                 
                 data["Therapy"] = PowerRecording.recording_info["Therapy"]
-                data["Duration"] = RawData["Duration"]
+                data["Duration"] = PowerRecording.recording_duration
 
-                if RawData["Duration"] < 5:
+                if data["Duration"] < 5:
                     continue
                 
                 Channels = TimeRecording.recording_info["Channel"]
@@ -354,15 +356,15 @@ def queryMultipleSegmentComparison(user, recordingIds, authority):
         if str(recording.device_deidentified_id) in authority["Devices"]:
             BrainSenseData = Database.loadSourceDataPointer(recording.recording_datapointer)
 
-            if len(recording.recording_info["Channel"]) == 2:
-                info = "Bilateral"
-            else:
-                info = "Unilateral"
-
+            # Spectrogram is stored as derived product, the raw recording is left untouched.
             if not "Spectrogram" in BrainSenseData.keys():
-                BrainSenseData = processRealtimeStreams(BrainSenseData)
-                Database.saveSourceFiles(BrainSenseData, recording.recording_type, info, recording.recording_id, recording.device_deidentified_id)
-                recording.save()
+                ProcessingParameters = BrainSenseStream.getProcessingParameters()
+                DerivedProduct = Database.loadDerivedProduct(recording.recording_datapointer, ProcessingParameters, BrainSenseStream.PROCESSING_VERSION)
+                if DerivedProduct == None:
+                    BrainSenseData = processRealtimeStreams(BrainSenseData)
+                    DerivedProduct = {"Spectrogram": BrainSenseData["Spectrogram"]}
+                    Database.saveDerivedProduct(DerivedProduct, recording.recording_datapointer, ProcessingParameters, BrainSenseStream.PROCESSING_VERSION)
+                BrainSenseData.update(DerivedProduct)
             
             BrainSenseData["Stimulation"] = processRealtimeStreamStimulationAmplitude(BrainSenseData)
             for StimulationSeries in BrainSenseData["Stimulation"]:
@@ -436,20 +438,39 @@ def mergeRealtimeStreamData(recordings):
     else:
         info = "Unilateral"
         
-    Database.saveSourceFiles(CombinedData, recordings[0].recording_type, info, recordings[0].recording_id, recordings[0].device_deidentified_id)
+    recordings[0].recording_datapointer = Database.saveSourceFiles(CombinedData, recordings[0].recording_type, info, recordings[0].recording_id, recordings[0].device_deidentified_id)
     recordings[0].recording_duration = CombinedData["Time"][-1]
     recordings[0].save()
 
     for i in range(1, len(recordings)):
-        try:
-            os.remove(DATABASE_PATH + "recordings" + os.path.sep + recordings[i].recording_datapointer)
-        except:
-            pass
+        Database.deleteSourceDataPointer(recordings[i].recording_datapointer)
         recordings[i].delete()
     
     return True
 
-def processRealtimeStreamRenderingData(stream, options=dict(), centerFrequencies=[0,0], stimulationReference="Ipsilateral"):
+def processRealtimeStreamViewport(stream, viewport):
+    """ Extract BrainSense Streaming time-series needed to render a viewport.
+
+    Raw and filtered signals are decimated with the min/max decimation pyramid (see LevelOfDetail module) 
+    so that the response size depends on the viewport width instead of the recording length.
+
+    Args:
+      stream: processed BrainSense TimeDomain structure (see processRealtimeStreams function)
+      viewport: viewport dictionary with "Start", "End" (seconds relative to recording start) and "Width" (pixels).
+
+    Returns:
+      List of per-channel dictionaries with "RawData", "Filtered" and "Time".
+    """
+
+    Pyramid = stream["TimeDomain"]["Pyramid"] if "Pyramid" in stream["TimeDomain"].keys() else None
+    Streams = list()
+    for counter in range(len(stream["TimeDomain"]["ChannelNames"])):
+        Time, RawData = LevelOfDetail.queryViewport(stream["TimeDomain"]["Data"][:,counter], stream["TimeDomain"]["SamplingRate"], viewport, pyramid=Pyramid["Data"][counter] if Pyramid else None)
+        _, Filtered = LevelOfDetail.queryViewport(stream["TimeDomain"]["Filtered"][counter], stream["TimeDomain"]["SamplingRate"], viewport, pyramid=Pyramid["Filtered"][counter] if Pyramid else None)
+        Streams.append({"RawData": RawData, "Filtered": Filtered, "Time": Time})
+    return Streams
+
+def processRealtimeStreamRenderingData(stream, options=dict(), centerFrequencies=[0,0], stimulationReference="Ipsilateral", viewport=None):
     """ Process BrainSense Streaming Data to be used for Plotly rendering.
 
     This function takes the processRealtimeStreams BrainSense Stream object and further process it for frontend rendering system.
@@ -462,6 +483,8 @@ def processRealtimeStreamRenderingData(stream, options=dict(), centerFrequencies
       stream: processed BrainSense TimeDomain structure (see processRealtimeStreams function)
       options: Signal processing module configurations. 
       centerFrequencies: The center frequencies (Left and Right hemisphere) used to obtain Power-band box plot.
+      viewport: Optional viewport dictionary (see processRealtimeStreamViewport function). If provided, only the time-series 
+        samples needed to render the viewport are returned instead of the full-resolution signals.
 
     Returns:
       Returns processed data object with content sufficient for React.js to render Plotly graphs.
@@ -503,11 +526,16 @@ def processRealtimeStreamRenderingData(stream, options=dict(), centerFrequencies
                     data["Stimulation"][i]["LegendName"] = lead["TargetLocation"] + " " + data["Stimulation"][i]["LegendName"]
         
     data["Stream"] = list()
+    if viewport:
+        data["Viewport"] = viewport
+        data["Stream"] = processRealtimeStreamViewport(stream, viewport)
+
     for counter in range(len(data["Channels"])):
-        data["Stream"].append(dict())
-        data["Stream"][counter]["RawData"] = stream["TimeDomain"]["Data"][:,counter]
-        data["Stream"][counter]["Filtered"] = stream["TimeDomain"]["Filtered"][counter]
-        data["Stream"][counter]["Time"] = np.arange(len(data["Stream"][counter]["RawData"]))/stream["TimeDomain"]["SamplingRate"]
+        if not viewport:
+            data["Stream"].append(dict())
+            data["Stream"][counter]["RawData"] = stream["TimeDomain"]["Data"][:,counter]
+            data["Stream"][counter]["Filtered"] = stream["TimeDomain"]["Filtered"][counter]
+            data["Stream"][counter]["Time"] = np.arange(len(data["Stream"][counter]["RawData"]))/stream["TimeDomain"]["SamplingRate"]
 
         if options["SpectrogramMethod"]["value"] == "Spectrogram":
             data["Stream"][counter]["Spectrogram"] = copy.deepcopy(stream["TimeDomain"]["Spectrogram"][counter])
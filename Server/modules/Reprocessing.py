@@ -0,0 +1,443 @@
+""""""
+"""
+=========================================================
+* UF BRAVO Platform
+=========================================================
+
+* Copyright 2023 by Jackson Cagle, Fixel Institute
+* The source code is made available under a Creative Common NonCommercial ShareAlike License (CC BY-NC-SA 4.0) (https://creativecommons.org/licenses/by-nc-sa/4.0/)
+
+ =========================================================
+
+* The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+"""
+"""
+Batch Reprocessing Module
+===================================================
+Re-decode stored Percept session files and refresh derived database records (therapy history, session info, impedance)
+after a decoder fix, used by ``manage.py Reprocess`` and ``manage.py Refresh``. Legacy database migrations 
+(``manage.py MigrateFromV1`` and ``MigrateFromV2.1``) queue every stored session for full decoding with ``queueSessionDecoding``.
+
+Sessions are sharded by device so that all sessions of a device are processed serially by the same worker
+(device records such as lead configurations are updated without cross-worker races), and shards are distributed
+over a pool of forked worker processes, largest first. The outcome of every session is written to the
+``ReprocessingCheckpoint`` table, so an interrupted job resumes with the sessions that are not completed yet.
+
+@author: Jackson Cagle, University of Florida
+@email: jackson.cagle@neurology.ufl.edu
+"""
+
+import os
+import time
+import shutil
+import queue
+import multiprocessing
+from datetime import datetime
+import pytz
+
+from django.db import connections, transaction
+from django.utils import timezone
+
+from Backend import models
+from modules.Percept import Sessions
+from decoder import Percept
+
+DATABASE_PATH = os.environ.get('DATASERVER_PATH')
+key = os.environ.get('ENCRYPTION_KEY')
+
+REPROCESSING_WORKERS = int(os.environ.get('REPROCESSING_WORKERS', 1))
+REPROCESSING_PROGRESS_INTERVAL = float(os.environ.get('REPROCESSING_PROGRESS_INTERVAL', 10))
+
+ProgressQueue = None
+
+def extractLeadConfigurations(JSON):
+    LeadConfigurations = []
+    LeadInformation = JSON["LeadConfiguration"]["Final"]
+    for lead in LeadInformation:
+        LeadConfiguration = dict()
+        LeadConfiguration["TargetLocation"] = lead["Hemisphere"].replace("HemisphereLocationDef.","") + " "
+        if lead["LeadLocation"] == "LeadLocationDef.Vim":
+            LeadConfiguration["TargetLocation"] += "VIM"
+        elif lead["LeadLocation"] == "LeadLocationDef.Stn":
+            LeadConfiguration["TargetLocation"] += "STN"
+        elif lead["LeadLocation"] == "LeadLocationDef.Gpi":
+            LeadConfiguration["TargetLocation"] += "GPi"
+        else:
+            LeadConfiguration["TargetLocation"] += lead["LeadLocation"].replace("LeadLocationDef.","")
+
+        if lead["ElectrodeNumber"] == "InsPort.ZERO_THREE":
+            LeadConfiguration["ElectrodeNumber"] = "E00-E03"
+        elif lead["ElectrodeNumber"] == "InsPort.ZERO_SEVEN":
+            LeadConfiguration["ElectrodeNumber"] = "E00-E07"
+        elif lead["ElectrodeNumber"] == "InsPort.EIGHT_ELEVEN":
+            LeadConfiguration["ElectrodeNumber"] = "E08-E11"
+        elif lead["ElectrodeNumber"] == "InsPort.EIGHT_FIFTEEN":
+            LeadConfiguration["ElectrodeNumber"] = "E08-E15"
+        if lead["Model"] == "LeadModelDef.LEAD_B33015":
+            LeadConfiguration["ElectrodeType"] = "SenSight B33015"
+        elif lead["Model"] == "LeadModelDef.LEAD_B33005":
+            LeadConfiguration["ElectrodeType"] = "SenSight B33005"
+        elif lead["Model"] == "LeadModelDef.LEAD_3387":
+            LeadConfiguration["ElectrodeType"] = "Medtronic 3387"
+        elif lead["Model"] == "LeadModelDef.LEAD_3389":
+            LeadConfiguration["ElectrodeType"] = "Medtronic 3389"
+        elif lead["Model"] == "LeadModelDef.LEAD_OTHER":
+            LeadConfiguration["ElectrodeType"] = "Unknown Lead"
+        else:
+            LeadConfiguration["ElectrodeType"] = lead["Model"]
+
+        LeadConfigurations.append(LeadConfiguration)
+    return LeadConfigurations
+
+def refreshTherapyHistory(sessionFile, JSON):
+    """ Replace therapy details of all therapy history records extracted from the session with the re-decoded settings.
+
+    Args:
+      sessionFile: PerceptSession object.
+      JSON: decoded session JSON.
+    """
+
+    TherapySettings = Percept.extractTherapySettings(JSON)
+
+    # Last matching group wins, same as assigning in order of the decoded settings.
+    PastTherapy = dict()
+    for newTherapy in TherapySettings["TherapyHistory"]:
+        TherapyDate = datetime.fromisoformat(newTherapy["DateTime"].replace("Z","+00:00"))
+        for group in newTherapy["Therapy"]:
+            PastTherapy[(TherapyDate, group["GroupId"])] = group
+    PreviousGroups = {group["GroupId"]: group for group in TherapySettings["PreviousGroups"]}
+    StimulationGroups = {group["GroupId"]: group for group in TherapySettings["StimulationGroups"]}
+
+    UpdatedTherapy = list()
+    for therapy in models.TherapyHistory.objects.filter(source_file=str(sessionFile.deidentified_id)).all():
+        newTherapy = None
+        if therapy.therapy_type == "Past Therapy":
+            newTherapy = PastTherapy.get((therapy.therapy_date, therapy.group_id))
+        elif therapy.therapy_type == "Pre-visit Therapy":
+            newTherapy = PreviousGroups.get(therapy.group_id)
+        elif therapy.therapy_type == "Post-visit Therapy":
+            newTherapy = StimulationGroups.get(therapy.group_id)
+
+        if not newTherapy == None:
+            therapy.therapy_details = newTherapy
+            UpdatedTherapy.append(therapy)
+
+    if len(UpdatedTherapy) > 0:
+        models.TherapyHistory.objects.bulk_update(UpdatedTherapy, ["therapy_details"])
+
+def refreshSessionInfo(sessionFile, JSON):
+    """ Refresh session date and device lead configurations from the re-decoded session.
+
+    Args:
+      sessionFile: PerceptSession object.
+      JSON: decoded session JSON.
+    """
+
+    LeadConfigurations = extractLeadConfigurations(JSON)
+
+    sessionFile.session_date = datetime.fromtimestamp(Percept.estimateSessionDateTime(JSON),tz=pytz.utc)
+    sessionFile.save()
+
+    deviceObj = models.PerceptDevice.objects.filter(deidentified_id=sessionFile.device_deidentified_id).first()
+    if len(deviceObj.device_lead_configurations) < len(LeadConfigurations):
+        deviceObj.device_lead_configurations = LeadConfigurations
+        deviceObj.save()
+
+def refreshImpedance(sessionFile, JSON):
+    """ Add impedance records of the re-decoded session that are not in database yet.
+
+    Args:
+      sessionFile: PerceptSession object.
+      JSON: decoded session JSON.
+    """
+
+    Data = Percept.extractPatientInformation(JSON)
+    if "Impedance" in Data.keys():
+        for impedanceData in Data["Impedance"]:
+            if not models.ImpedanceHistory.objects.filter(impedance_record=impedanceData, device_deidentified_id=sessionFile.device_deidentified_id, session_date=sessionFile.session_date).exists():
+                models.ImpedanceHistory(impedance_record=impedanceData, device_deidentified_id=sessionFile.device_deidentified_id, session_date=sessionFile.session_date).save()
+
+REPROCESSING_TASKS = {
+    "TherapyHistory": refreshTherapyHistory,
+    "Sessions": refreshSessionInfo,
+    "Impedance": refreshImpedance,
+}
+
+def reprocessSession(task, sessionFile):
+    """ Decode a stored session file and run the reprocessing task on it.
+
+    Args:
+      task: name of reprocessing task (see REPROCESSING_TASKS).
+      sessionFile: PerceptSession object.
+
+    Returns:
+      Tuple (state, message). State is "Complete" or "Failed".
+    """
+
+    if task == "Sessions" and not sessionFile.session_file_path.startswith("sessions/"):
+        sessionFile.session_file_path = "sessions/" + sessionFile.session_file_path.split(os.path.sep)[-1]
+
+    try:
+        JSON = Percept.decodeEncryptedJSON(DATABASE_PATH + sessionFile.session_file_path, key)
+    except Exception as e:
+        print(sessionFile.session_file_path)
+        return "Failed", f"Decode Error: {e}"
+
+    try:
+        REPROCESSING_TASKS[task](sessionFile, JSON)
+    except Exception as e:
+        print(sessionFile.session_file_path, e)
+        return "Failed", str(e)
+    return "Complete", ""
+
+def queryPendingSessions(task, deviceID="All", jobName=None):
+    """ Sessions to be reprocessed, sharded by device.
+
+    Args:
+      task: name of reprocessing task (see REPROCESSING_TASKS).
+      deviceID: deidentified device ID, or "All" for every device.
+      jobName: checkpoint job name. Sessions already completed in this job are excluded. None disables checkpoints.
+
+    Returns:
+      Tuple (Shards, CompletedCount). Shards is a list of (device ID, list of session IDs) ordered from largest shard.
+    """
+
+    if deviceID == "All":
+        SessionFiles = models.PerceptSession.objects.all()
+    else:
+        SessionFiles = models.PerceptSession.objects.filter(device_deidentified_id=deviceID).all()
+
+    Completed = set()
+    if not jobName == None:
+        Completed = set(models.ReprocessingCheckpoint.objects.filter(job_name=jobName, task=task, state="Complete").values_list("item_id", flat=True))
+
+    Shards = dict()
+    for sessionID, sessionDevice in SessionFiles.order_by("session_date").values_list("deidentified_id", "device_deidentified_id"):
+        if sessionID in Completed:
+            continue
+        if not sessionDevice in Shards.keys():
+            Shards[sessionDevice] = list()
+        Shards[sessionDevice].append(sessionID)
+
+    return sorted(Shards.items(), key=lambda shard: len(shard[1]), reverse=True), len(Completed)
+
+def processShard(task, jobName, shard, reportProgress=None):
+    """ Reprocess all sessions of one device serially and record checkpoints.
+
+    Args:
+      task: name of reprocessing task (see REPROCESSING_TASKS).
+      jobName: checkpoint job name, None disables checkpoints.
+      shard: tuple of (device ID, list of session IDs).
+      reportProgress: optional function called with the state of each processed session.
+
+    Returns:
+      List of (session ID, state) tuples.
+    """
+
+    deviceID, SessionIDs = shard
+    Results = list()
+    SessionFiles = {sessionFile.deidentified_id: sessionFile for sessionFile in models.PerceptSession.objects.filter(deidentified_id__in=SessionIDs).all()}
+    for sessionID in SessionIDs:
+        startTime = time.time()
+        if sessionID in SessionFiles.keys():
+            state, message = reprocessSession(task, SessionFiles[sessionID])
+        else:
+            state, message = "Failed", "Session Removed"
+
+        if not jobName == None:
+            models.ReprocessingCheckpoint.objects.update_or_create(job_name=jobName, item_id=sessionID, defaults={
+                "task": task, "device_deidentified_id": deviceID, "state": state, "message": message,
+                "duration": time.time() - startTime, "completed_at": timezone.now(),
+            })
+
+        Results.append((sessionID, state))
+        if not reportProgress == None:
+            reportProgress(state)
+    return Results
+
+def initializeShardWorker(progressQueue):
+    global ProgressQueue
+    ProgressQueue = progressQueue
+
+def executeShard(arguments):
+    return processShard(*arguments, reportProgress=ProgressQueue.put)
+
+def formatDuration(seconds):
+    seconds = int(seconds)
+    return f"{seconds // 3600}:{(seconds % 3600) // 60:02d}:{seconds % 60:02d}"
+
+class ReprocessingProgress:
+    """ Processed/failed counters with rate and ETA, printed at most every REPROCESSING_PROGRESS_INTERVAL seconds.
+    """
+
+    def __init__(self, total):
+        self.total = total
+        self.processed = 0
+        self.failed = 0
+        self.startTime = time.time()
+        self.lastReport = 0
+
+    def update(self, state):
+        self.processed += 1
+        if not state == "Complete":
+            self.failed += 1
+        if time.time() - self.lastReport >= REPROCESSING_PROGRESS_INTERVAL or self.processed == self.total:
+            self.report()
+
+    def report(self):
+        self.lastReport = time.time()
+        elapsed = self.lastReport - self.startTime
+        rate = self.processed / elapsed if elapsed > 0 else 0
+        eta = formatDuration((self.total - self.processed) / rate) if rate > 0 else "--:--:--"
+        print(f"{datetime.now()} {self.processed}/{self.total} sessions ({self.failed} failed), {rate:.2f} sessions/s, elapsed {formatDuration(elapsed)}, ETA {eta}")
+
+def runReprocessing(task, deviceID="All", workers=REPROCESSING_WORKERS, jobName=None, dryRun=False):
+    """ Reprocess stored session files with device sharding, checkpoints and progress report.
+
+    Args:
+      task: name of reprocessing task (see REPROCESSING_TASKS).
+      deviceID: deidentified device ID, or "All" for every device.
+      workers: number of worker processes. 1 processes all shards in the current process.
+      jobName: checkpoint job name. Sessions completed in a previous run of the same job are skipped. None disables checkpoints.
+      dryRun: only report the shards that would be processed.
+
+    Returns:
+      Dictionary with "Total", "Skipped", "Complete" and "Failed" session counts.
+    """
+
+    if not task in REPROCESSING_TASKS.keys():
+        raise ValueError(f"Unknown reprocessing task {task}, available tasks: {', '.join(REPROCESSING_TASKS.keys())}")
+
+    Shards, CompletedCount = queryPendingSessions(task, deviceID, jobName)
+    Summary = {"Total": sum([len(shard[1]) for shard in Shards]), "Skipped": CompletedCount, "Complete": 0, "Failed": 0}
+    workers = max(1, min(workers, len(Shards)))
+    print(f"{task}: {Summary['Total']} sessions in {len(Shards)} devices to process, {CompletedCount} already completed" + (f" in job {jobName}" if jobName else "") + f", {workers} workers")
+
+    if dryRun:
+        for deviceID, SessionIDs in Shards:
+            print(f"  {deviceID}: {len(SessionIDs)} sessions")
+        return Summary
+
+    progress = ReprocessingProgress(Summary["Total"])
+    Tasks = [(task, jobName, shard) for shard in Shards]
+    if workers == 1:
+        Results = list()
+        for arguments in Tasks:
+            Results.extend(processShard(*arguments, reportProgress=progress.update))
+
+    else:
+        context = multiprocessing.get_context("fork")
+        progressQueue = context.Queue()
+
+        # Forked workers must not share the parent database connection
+        connections.close_all()
+        with context.Pool(workers, initializer=initializeShardWorker, initargs=(progressQueue,)) as pool:
+            pending = pool.map_async(executeShard, Tasks, chunksize=1)
+            while not pending.ready():
+                try:
+                    progress.update(progressQueue.get(timeout=1))
+                except queue.Empty:
+                    pass
+            Results = [result for shardResults in pending.get() for result in shardResults]
+
+            # Drain progress messages still in transit from the workers
+            while progress.processed < len(Results):
+                try:
+                    progress.update(progressQueue.get(timeout=1))
+                except queue.Empty:
+                    break
+
+    for sessionID, state in Results:
+        Summary[state] += 1
+    if progress.processed < Summary["Total"]:
+        progress.report()
+    return Summary
+
+def queryOwnedSessions():
+    """ Stored sessions sharded by device, with the user that owns them.
+
+    Ownership is the same as walking users, their patients, devices and sessions in order: sessions of a device belong 
+    to the first clinician of the device institute, or to the researcher of a research device. Each table is queried once.
+
+    Returns:
+      List of (owner, device ID, list of PerceptSession objects) tuples.
+    """
+
+    Owners = dict()
+    for user in models.PlatformUser.objects.all():
+        if user.is_admin or user.is_clinician:
+            Authority = ("Clinic", user.institute)
+        else:
+            Authority = ("Research", user.email)
+        if not Authority in Owners.keys():
+            Owners[Authority] = user
+
+    Scopes = set([Authority[1] for Authority in Owners.keys()])
+    PatientInstitutes = dict(models.Patient.objects.filter(institute__in=Scopes).values_list("deidentified_id", "institute"))
+
+    DeviceOwners = dict()
+    for deviceID, patientID, authorityLevel, authorityUser in models.PerceptDevice.objects.filter(patient_deidentified_id__in=PatientInstitutes.keys()).values_list("deidentified_id", "patient_deidentified_id", "authority_level", "authority_user"):
+        if (authorityLevel, authorityUser) in Owners.keys() and PatientInstitutes[patientID] == authorityUser:
+            DeviceOwners[deviceID] = Owners[(authorityLevel, authorityUser)]
+
+    Shards = {deviceID: list() for deviceID in DeviceOwners.keys()}
+    for sessionFile in models.PerceptSession.objects.filter(device_deidentified_id__in=DeviceOwners.keys()).all():
+        Shards[sessionFile.device_deidentified_id].append(sessionFile)
+    return [(DeviceOwners[deviceID], deviceID, Shards[deviceID]) for deviceID in Shards.keys() if len(Shards[deviceID]) > 0]
+
+def queueSessionDecoding(jobName=None):
+    """ Queue every stored session for decoding by its owner, and remove the session with its extracted records.
+
+    Session files are copied to cache before removal, the processing queue extracts all data again with current decoders.
+    Sessions are processed device by device with bulk queries, and the outcome of every session is written to the 
+    ``ReprocessingCheckpoint`` table, so an interrupted migration resumes with the sessions that are not queued yet.
+
+    Args:
+      jobName: checkpoint job name. None disables checkpoints.
+
+    Returns:
+      Dictionary with "Total", "Skipped", "Complete" and "Failed" session counts.
+    """
+
+    Completed = set()
+    if not jobName == None:
+        Completed = set(models.ReprocessingCheckpoint.objects.filter(job_name=jobName, task="Requeue", state="Complete").values_list("item_id", flat=True))
+
+    Shards = queryOwnedSessions()
+    Summary = {"Total": sum([len(shard[2]) for shard in Shards]), "Skipped": 0, "Complete": 0, "Failed": 0}
+    progress = ReprocessingProgress(Summary["Total"])
+    for owner, deviceID, SessionFiles in Shards:
+        QueueItems = list()
+        QueuedSessions = list()
+        Checkpoints = list()
+        for sessionFile in SessionFiles:
+            if sessionFile.deidentified_id in Completed:
+                Summary["Skipped"] += 1
+                progress.update("Complete")
+                continue
+
+            state, message = "Complete", ""
+            try:
+                shutil.copyfile(DATABASE_PATH + sessionFile.session_file_path, (DATABASE_PATH + sessionFile.session_file_path).replace("/sessions/","/cache/"))
+                QueueItems.append(models.ProcessingQueue(owner=owner.unique_user_id, type="decodeJSON", state="InProgress", descriptor={
+                    "filename": sessionFile.session_file_path.split("/")[-1],
+                    "device_deidentified_id": str(deviceID),
+                }))
+                QueuedSessions.append(sessionFile)
+            except Exception as e:
+                print(e)
+                state, message = "Failed", str(e)
+
+            Summary[state] += 1
+            Checkpoints.append(models.ReprocessingCheckpoint(job_name=jobName, task="Requeue", device_deidentified_id=deviceID, item_id=sessionFile.deidentified_id, state=state, message=message))
+            progress.update(state)
+
+        # Queue items, session removal and checkpoints of a device are committed together
+        with transaction.atomic():
+            models.ProcessingQueue.objects.bulk_create(QueueItems)
+            Sessions.deleteSessionFiles(QueuedSessions)
+            if not jobName == None:
+                models.ReprocessingCheckpoint.objects.filter(job_name=jobName, item_id__in=[checkpoint.item_id for checkpoint in Checkpoints]).delete()
+                models.ReprocessingCheckpoint.objects.bulk_create(Checkpoints)
+
+    return Summary
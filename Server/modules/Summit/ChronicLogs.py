@@ -40,7 +40,7 @@ from utility import SignalProcessingUtility as SPU
 from utility.PythonUtility import *
 
 from Backend import models
-from modules import Database
+from modules import Database, ChronicAggregation
 
 key = os.environ.get('ENCRYPTION_KEY')
 
@@ -66,43 +66,30 @@ def saveChronicLogs(deviceID, ChronicLogs, sourceFile):
     
     NewRecordingFound = False
     recording_info = {"Hemisphere": "AllHemisphere"}
-    if not models.NeuralActivityRecording.objects.filter(device_deidentified_id=deviceID, recording_type="SummitChronicLogs", recording_info__Hemisphere=recording_info["Hemisphere"]).exists():
-        sortedIndex = np.argsort(ChronicLogTimestamp,axis=0).flatten()
-        ChronicLogTimestamp = ChronicLogTimestamp[sortedIndex]
-        ChronicLogState = ChronicLogState[sortedIndex]
-        
+    recording = models.NeuralActivityRecording.objects.filter(device_deidentified_id=deviceID, recording_type="SummitChronicLogs", recording_info__Hemisphere=recording_info["Hemisphere"]).first()
+    if recording == None:
         recording = models.NeuralActivityRecording(device_deidentified_id=deviceID, recording_type="SummitChronicLogs", recording_info=recording_info)
-        filename = Database.saveSourceFiles({
-            "ChronicLogs": {
-                "DateTime": ChronicLogTimestamp,
-                "State": ChronicLogState,
-            }
-        }, "SummitChronicLogs", "SummitRCS", recording.recording_id, recording.device_deidentified_id)
+
+    # Chronic logs stored as a single file are converted to partitioned storage on first update.
+    LegacyDataPointer = None
+    if recording.recording_datapointer and not recording.recording_datapointer.endswith(Database.PARTITIONED_RECORDING_EXTENSION):
+        LegacyDataPointer = recording.recording_datapointer
+        Database.savePartitionedRecording(Database.loadSourceDataPointer(LegacyDataPointer), "SummitChronicLogs", "SummitRCS", recording.recording_id, recording.device_deidentified_id, "DateTime", group="ChronicLogs")
+
+    filename, NewSamples = Database.savePartitionedRecording({
+        "ChronicLogs": {
+            "DateTime": ChronicLogTimestamp,
+            "State": ChronicLogState,
+        }
+    }, "SummitChronicLogs", "SummitRCS", recording.recording_id, recording.device_deidentified_id, "DateTime", group="ChronicLogs")
+    NewRecordingFound = NewSamples > 0 or not recording.recording_datapointer
+
+    if not recording.recording_datapointer == filename:
         recording.recording_datapointer = filename
         recording.save()
-        NewRecordingFound = True
-    else:
-        recording = models.NeuralActivityRecording.objects.filter(device_deidentified_id=deviceID, recording_type="SummitChronicLogs", recording_info__Hemisphere=recording_info["Hemisphere"]).first()
-        ChronicData = Database.loadSourceDataPointer(recording.recording_datapointer)
-
-        Common = set(ChronicLogTimestamp) & set(ChronicData["ChronicLogs"]["DateTime"])
-
-        toInclude = np.zeros(len(ChronicLogTimestamp), dtype=bool)
-        IndexToInclude = list()
-        for i in range(len(ChronicLogTimestamp)):
-            if not ChronicLogTimestamp[i] in Common:
-                toInclude[i] = True
-
-        if np.any(toInclude):
-            ChronicData["ChronicLogs"]["DateTime"] = np.concatenate((ChronicData["ChronicLogs"]["DateTime"], ChronicLogTimestamp[toInclude]),axis=0)
-            ChronicData["ChronicLogs"]["State"] = np.concatenate((ChronicData["ChronicLogs"]["State"], ChronicLogState[toInclude]),axis=0)
-            
-            sortedIndex = np.argsort(ChronicData["ChronicLogs"]["DateTime"],axis=0).flatten()
-            ChronicData["ChronicLogs"]["DateTime"] = ChronicData["ChronicLogs"]["DateTime"][sortedIndex]
-            ChronicData["ChronicLogs"]["State"] = ChronicData["ChronicLogs"]["State"][sortedIndex]
-            filename = Database.saveSourceFiles(ChronicData, "SummitChronicLogs", "SummitRCS", recording.recording_id, recording.device_deidentified_id)
-            
-            NewRecordingFound = True
+
+    if LegacyDataPointer:
+        Database.deleteSourceDataPointer(LegacyDataPointer)
 
     return NewRecordingFound
 
@@ -186,6 +173,9 @@ def queryChronicLFPs(user, patientUniqueID, TherapyHistory, authority):
     if not authority["Permission"]:
         return LFPTrends
     
+    # Research access is limited to the authorized time range, only partitions within the range are loaded.
+    AuthorizedTimeRange = Database.getAuthorizedTimeRange(authority)
+
     availableDevices = Database.getPerceptDevices(user, patientUniqueID, authority)
     PowerBandIndex = []
 
@@ -193,7 +183,10 @@ def queryChronicLFPs(user, patientUniqueID, TherapyHistory, authority):
         leads = device.device_lead_configurations
         recording = models.NeuralActivityRecording.objects.filter(device_deidentified_id=device.deidentified_id, recording_type="SummitChronicLogs", recording_info__Hemisphere="AllHemisphere").first()
         if not recording == None:
-            ChronicLFPs = Database.loadSourceDataPointer(recording.recording_datapointer)
+            if recording.recording_datapointer.endswith(Database.PARTITIONED_RECORDING_EXTENSION):
+                ChronicLFPs = Database.loadPartitionedRecording(recording.recording_datapointer, AuthorizedTimeRange)
+            else:
+                ChronicLFPs = Database.loadSourceDataPointer(recording.recording_datapointer)
             
             if not "IncludedRecordings" in ChronicLFPs.keys():
                 ChronicLFPs["IncludedRecordings"] = []
@@ -201,7 +194,11 @@ def queryChronicLFPs(user, patientUniqueID, TherapyHistory, authority):
     
             ChronicLFPs, Updated = processPowerBand(device, ChronicLFPs)
             if Updated:
-                Database.saveSourceFiles(ChronicLFPs, "SummitChronicLogs", "SummitRCS", recording.recording_id, recording.device_deidentified_id)
+                if recording.recording_datapointer.endswith(Database.PARTITIONED_RECORDING_EXTENSION):
+                    Database.savePartitionedExtra(recording.recording_datapointer, {key: ChronicLFPs[key] for key in ["IncludedRecordings", "PowerBand"]})
+                else:
+                    recording.recording_datapointer = Database.saveSourceFiles(ChronicLFPs, "SummitChronicLogs", "SummitRCS", recording.recording_id, recording.device_deidentified_id)
+                    recording.save()
 
             ChronicLFPChannels = ChronicLFPs["PowerBand"].keys()
             for Channel in ChronicLFPChannels:
@@ -394,27 +391,25 @@ def processChronicLFPs(LFPTrends, timezoneOffset=0):
                     LFPTrends[i]["EventLockedPower"][-1]["EventName"].extend(LFPTrends[i]["EventName"][j])
                     LFPTrends[i]["EventLockedPower"][-1]["Timestamp"].extend(LFPTrends[i]["EventTime"][j])
 
+            CacheKey = (ChronicAggregation.getDataVersion(LFPTrends[i]["CircadianPowers"][-1]["Power"], LFPTrends[i]["CircadianPowers"][-1]["Timestamp"], 
+                                                          LFPTrends[i]["EventLockedPower"][-1]["EventName"], LFPTrends[i]["EventLockedPower"][-1]["Timestamp"]),
+                        therapy, timezoneOffset, "Summit", ChronicAggregation.AGGREGATION_VERSION)
+            CachedResult = ChronicAggregation.getCachedAggregation(CacheKey)
+            if CachedResult:
+                LFPTrends[i]["CircadianPowers"][-1], LFPTrends[i]["EventLockedPower"][-1] = CachedResult
+                continue
+
             LFPTrends[i]["CircadianPowers"][-1]["Power"] = np.array(LFPTrends[i]["CircadianPowers"][-1]["Power"])
             LFPTrends[i]["CircadianPowers"][-1]["Timestamp"] = np.array(LFPTrends[i]["CircadianPowers"][-1]["Timestamp"])
 
             # Event Locked Power
-            EventToInclude = list()
-            LFPTrends[i]["EventLockedPower"][-1]["TimeArray"] = np.arange(37)*600 - 180*60
-            EventLockedPower = np.zeros((len(LFPTrends[i]["EventLockedPower"][-1]["EventName"]),len(LFPTrends[i]["EventLockedPower"][-1]["TimeArray"])))
-            for iEvent in range(len(LFPTrends[i]["EventLockedPower"][-1]["EventName"])):
-                dataSelected = rangeSelection(LFPTrends[i]["CircadianPowers"][-1]["Timestamp"], [LFPTrends[i]["EventLockedPower"][-1]["Timestamp"][iEvent]+LFPTrends[i]["EventLockedPower"][-1]["TimeArray"][0], LFPTrends[i]["EventLockedPower"][-1]["Timestamp"][iEvent]+LFPTrends[i]["EventLockedPower"][-1]["TimeArray"][-1]])
-                PowerTrend = LFPTrends[i]["CircadianPowers"][-1]["Power"][dataSelected]
-                Timestamp = LFPTrends[i]["CircadianPowers"][-1]["Timestamp"][dataSelected]
-                if len(Timestamp) > 35:
-                    index = np.argsort(Timestamp)
-                    EventLockedPower[iEvent,:] = np.interp(LFPTrends[i]["EventLockedPower"][-1]["TimeArray"]+LFPTrends[i]["EventLockedPower"][-1]["Timestamp"][iEvent], Timestamp[index], PowerTrend[index])
-                    EventToInclude.append(iEvent)
-            EventToInclude = np.array(EventToInclude)
+            LFPTrends[i]["EventLockedPower"][-1]["TimeArray"] = ChronicAggregation.EVENT_LOCKED_TIME_ARRAY.copy()
+            EventLockedPower, EventToInclude = ChronicAggregation.eventLockedAggregation(LFPTrends[i]["CircadianPowers"][-1]["Power"], LFPTrends[i]["CircadianPowers"][-1]["Timestamp"], 
+                                                                                         LFPTrends[i]["EventLockedPower"][-1]["Timestamp"], minimumCount=36)
 
             if not len(EventToInclude) == 0:
                 LFPTrends[i]["EventLockedPower"][-1]["PowerChart"] = list()
                 LFPTrends[i]["EventLockedPower"][-1]["EventName"] = np.array(LFPTrends[i]["EventLockedPower"][-1]["EventName"])[EventToInclude]
-                EventLockedPower = EventLockedPower[EventToInclude,:]
                 for name in np.unique(LFPTrends[i]["EventLockedPower"][-1]["EventName"]):
                     SelectedEvent = LFPTrends[i]["EventLockedPower"][-1]["EventName"] == name
                     LFPTrends[i]["EventLockedPower"][-1]["PowerChart"].append({"EventName": name + f" (n={np.sum(SelectedEvent)})",
@@ -426,38 +421,24 @@ def processChronicLFPs(LFPTrends, timezoneOffset=0):
                 del(LFPTrends[i]["EventLockedPower"][-1]["Timestamp"])
                 LFPTrends[i]["EventLockedPower"][-1]["TimeArray"] = LFPTrends[i]["EventLockedPower"][-1]["TimeArray"] / 60
 
-            LFPTrends[i]["CircadianPowers"][-1]["Timestamp"] = (np.array(LFPTrends[i]["CircadianPowers"][-1]["Timestamp"])-timezoneOffset) % (24*60*60)
+            LFPTrends[i]["CircadianPowers"][-1]["Timestamp"] = (LFPTrends[i]["CircadianPowers"][-1]["Timestamp"]-timezoneOffset) % (24*60*60)
 
-            # Calculate Average Power/Std Power
-            LFPTrends[i]["CircadianPowers"][-1]["AverageTimestamp"] = np.arange(24*12)*300
-            LFPTrends[i]["CircadianPowers"][-1]["AveragePower"] = np.zeros(LFPTrends[i]["CircadianPowers"][-1]["AverageTimestamp"].shape)
-            LFPTrends[i]["CircadianPowers"][-1]["StdErrPower"] = np.zeros(LFPTrends[i]["CircadianPowers"][-1]["AverageTimestamp"].shape)
-            for t in range(len(LFPTrends[i]["CircadianPowers"][-1]["AverageTimestamp"])):
-                timeSelection = rangeSelection(LFPTrends[i]["CircadianPowers"][-1]["Timestamp"],[LFPTrends[i]["CircadianPowers"][-1]["AverageTimestamp"][t]-20*60, LFPTrends[i]["CircadianPowers"][-1]["AverageTimestamp"][t]+20*60])
-                PowerList = LFPTrends[i]["CircadianPowers"][-1]["Power"][timeSelection]
-                while True:
-                    PowerList = PowerList[np.abs(stats.zscore(PowerList)) < 3]
-                    if np.sum(np.abs(stats.zscore(PowerList)) < 3) == len(PowerList):
-                        break
-
-                if len(PowerList) > 0:
-                    LFPTrends[i]["CircadianPowers"][-1]["AveragePower"][t] = np.median(PowerList)
-                    LFPTrends[i]["CircadianPowers"][-1]["StdErrPower"][t] = SPU.stderr(PowerList)*2
-                else:
-                    LFPTrends[i]["CircadianPowers"][-1]["AveragePower"][t] = 0
-                    LFPTrends[i]["CircadianPowers"][-1]["StdErrPower"][t] = 0
+            # Calculate Average Power/Std Power with iterative outlier rejection (|z| < 3) within each bin
+            AverageTimestamp, AveragePower, StdErrPower = ChronicAggregation.circadianAggregation(LFPTrends[i]["CircadianPowers"][-1]["Power"], LFPTrends[i]["CircadianPowers"][-1]["Timestamp"], rejectOutliers=True)
 
-            LFPTrends[i]["CircadianPowers"][-1]["Power"] = LFPTrends[i]["CircadianPowers"][-1]["Power"][::1].tolist()
+            LFPTrends[i]["CircadianPowers"][-1]["Power"] = LFPTrends[i]["CircadianPowers"][-1]["Power"].tolist()
             LFPTrends[i]["CircadianPowers"][-1]["Timestamp"] = (LFPTrends[i]["CircadianPowers"][-1]["Timestamp"] + timezoneOffset).tolist()
-            LFPTrends[i]["CircadianPowers"][-1]["AveragePower"] = LFPTrends[i]["CircadianPowers"][-1]["AveragePower"].tolist()
-            LFPTrends[i]["CircadianPowers"][-1]["StdErrPower"] = LFPTrends[i]["CircadianPowers"][-1]["StdErrPower"].tolist()
-            LFPTrends[i]["CircadianPowers"][-1]["AverageTimestamp"] = (LFPTrends[i]["CircadianPowers"][-1]["AverageTimestamp"] + timezoneOffset).tolist()
+            LFPTrends[i]["CircadianPowers"][-1]["AveragePower"] = AveragePower.tolist()
+            LFPTrends[i]["CircadianPowers"][-1]["StdErrPower"] = StdErrPower.tolist()
+            LFPTrends[i]["CircadianPowers"][-1]["AverageTimestamp"] = (AverageTimestamp + timezoneOffset).tolist()
             
             if len(LFPTrends[i]["CircadianPowers"][-1]["Power"]) > 0:
                 LFPTrends[i]["CircadianPowers"][-1]["PowerRange"] = [np.percentile(LFPTrends[i]["CircadianPowers"][-1]["Power"],5),np.percentile(LFPTrends[i]["CircadianPowers"][-1]["Power"],95)]
             else:
                 LFPTrends[i]["CircadianPowers"][-1]["PowerRange"] = [0,0]
 
+            ChronicAggregation.setCachedAggregation(CacheKey, (LFPTrends[i]["CircadianPowers"][-1], LFPTrends[i]["EventLockedPower"][-1]))
+
     return LFPTrends
 
 def processCircadianPower(LFPTrends, therapyInfo, timezoneOffset=0):
@@ -164,10 +164,7 @@ def queryAvailableSessionFiles(user, patient_id, authority):
 def deleteDevice(device_id):
     recordings = models.NeuralActivityRecording.objects.filter(device_deidentified_id=device_id).all()
     for recording in recordings:
-        try:
-            os.remove(DATABASE_PATH + "recordings" + os.path.sep + recording.recording_datapointer)
-        except:
-            pass
+        Database.deleteSourceDataPointer(recording.recording_datapointer)
     recordings.delete()
 
     Sessions = models.PerceptSession.objects.filter(device_deidentified_id=device_id).all()
@@ -190,10 +187,7 @@ def deleteSessions(session_id):
     models.PatientCustomEvents.objects.filter(source_file=str(session_id)).delete()
     recordings = models.NeuralActivityRecording.objects.filter(source_file=str(session_id)).all()
     for recording in recordings:
-        try:
-            os.remove(DATABASE_PATH + "recordings" + os.path.sep + recording.recording_datapointer)
-        except:
-            pass
+        Database.deleteSourceDataPointer(recording.recording_datapointer)
     recordings.delete()
     session = models.PerceptSession.objects.filter(deidentified_id=session_id).first()
     models.ImpedanceHistory.objects.filter(session_date=session.session_date).delete()
@@ -40,11 +40,15 @@ from utility import SignalProcessingUtility as SPU
 from utility.PythonUtility import *
 
 from Backend import models
-from modules import Database
+from modules import Database, CardiacFilter, MissingLabel, LevelOfDetail
 
 DATABASE_PATH = os.environ.get('DATASERVER_PATH')
 key = os.environ.get('ENCRYPTION_KEY')
 
+# Version identifier of processRealtimeStreams output. Increment when the processing algorithm changes 
+# so that previously stored derived products are no longer used. 
+PROCESSING_VERSION = 2
+
 def saveRealtimeStreams(deviceID, Data, sourceFile):
     """ Save BrainSense Streaming Data in Database Storage
 
@@ -227,6 +231,27 @@ def savePowerStreams(deviceID, StreamingSession, sourceFile):
             recording.save()
             RecordingModel.append(recording)
 
+def getProcessingParameters(cardiacFilter=False):
+    """ Processing parameters used by processRealtimeStreams
+
+    The parameters identify the derived product (filtered data, wavelet and spectrogram) of a streaming recording 
+    in the derived product store (see Database.getDerivedProductPointer function).
+
+    Args:
+      cardiacFilter: Boolean indicating if cardiac filter is applied.
+
+    Returns:
+      Dictionary of processing parameters.
+    """
+
+    return {
+        "CardiacFilter": cardiacFilter,
+        "CardiacFilterMethod": "Template" if cardiacFilter else "None",
+        "SpectrogramWindow": 1.0,
+        "SpectrogramOverlap": 0.5,
+        "WaveletMovingAverage": 0.5,
+    }
+
 def processRealtimeStreams(stream, cardiacFilter=False):
     """ Process BrainSense Streaming Data 
 
@@ -255,44 +280,11 @@ def processRealtimeStreams(stream, cardiacFilter=False):
         stream["TimeDomain"]["Filtered"].append(signal.filtfilt(b, a, stream["TimeDomain"]["Data"][:,i]*1000))
 
         if cardiacFilter:
-            # Cardiac Filter
-            posPeaks,_ = signal.find_peaks(stream["TimeDomain"]["Filtered"][i], prominence=[10,200], distance=stream["TimeDomain"]["SamplingRate"]*0.5)
-            PosCardiacVariability = np.std(np.diff(posPeaks))
-            negPeaks,_ = signal.find_peaks(-stream["TimeDomain"]["Filtered"][i], prominence=[10,200], distance=stream["TimeDomain"]["SamplingRate"]*0.5)
-            NegCardiacVariability = np.std(np.diff(negPeaks))
-
-            if PosCardiacVariability < NegCardiacVariability:
-                peaks = posPeaks
-            else:
-                peaks = negPeaks
-            CardiacRate = int(np.mean(np.diff(peaks)))
-
-            PrePeak = int(CardiacRate*0.25)
-            PostPeak = int(CardiacRate*0.65)
-            EKGMatrix = np.zeros((len(peaks)-2,PrePeak+PostPeak))
-            for j in range(1,len(peaks)-1):
-                if peaks[j]+PostPeak < len(stream["TimeDomain"]["Filtered"][i]) and peaks[j]-PrePeak > 0:
-                    EKGMatrix[j-1,:] = stream["TimeDomain"]["Filtered"][i][peaks[j]-PrePeak:peaks[j]+PostPeak]
-
-            EKGTemplate = np.mean(EKGMatrix,axis=0)
-            EKGTemplate = EKGTemplate / (np.max(EKGTemplate)-np.min(EKGTemplate))
-
-            def EKGTemplateFunc(xdata, amplitude, offset):
-                return EKGTemplate * amplitude + offset
-
-            for j in range(len(peaks)):
-                if peaks[j]-PrePeak < 0:
-                    pass
-                elif peaks[j]+PostPeak >= len(stream["TimeDomain"]["Filtered"][i]) :
-                    pass
-                else:
-                    sliceSelection = np.arange(peaks[j]-PrePeak,peaks[j]+PostPeak)
-                    params, covmat = optimize.curve_fit(EKGTemplateFunc, sliceSelection, stream["TimeDomain"]["Filtered"][i][sliceSelection])
-                    stream["TimeDomain"]["Filtered"][i][sliceSelection] = stream["TimeDomain"]["Filtered"][i][sliceSelection] - EKGTemplateFunc(sliceSelection, *params)
+            stream["TimeDomain"]["Filtered"][i] = CardiacFilter.fixedPeakTemplateFilter(stream["TimeDomain"]["Filtered"][i], stream["TimeDomain"]["SamplingRate"])
 
         # Wavelet Computation
         stream["TimeDomain"]["Wavelet"].append(SPU.waveletTimeFrequency(stream["TimeDomain"]["Filtered"][i], freq=np.arange(0.5,100.5,0.5), ma=int(stream["TimeDomain"]["SamplingRate"]/2), fs=stream["TimeDomain"]["SamplingRate"]))
-        stream["TimeDomain"]["Wavelet"][i]["Missing"] = stream["TimeDomain"]["Missing"][:,i][::int(stream["TimeDomain"]["SamplingRate"]/2)]
+        stream["TimeDomain"]["Wavelet"][i]["Missing"] = MissingLabel.decimateMissingLabel(stream["TimeDomain"]["Missing"][:,i], int(stream["TimeDomain"]["SamplingRate"]/2))
         stream["TimeDomain"]["Wavelet"][i]["Power"] = stream["TimeDomain"]["Wavelet"][i]["Power"][:,::int(stream["TimeDomain"]["SamplingRate"]/2)]
         stream["TimeDomain"]["Wavelet"][i]["Time"] = stream["TimeDomain"]["Wavelet"][i]["Time"][::int(stream["TimeDomain"]["SamplingRate"]/2)]
         stream["TimeDomain"]["Wavelet"][i]["Type"] = "Wavelet"
@@ -304,10 +296,7 @@ def processRealtimeStreams(stream, cardiacFilter=False):
         stream["TimeDomain"]["Spectrogram"][i]["Time"] += 0 # TODO Check later
         
         TimeArray = np.arange(len(stream["TimeDomain"]["Filtered"][i])) / stream["TimeDomain"]["SamplingRate"]
-        stream["TimeDomain"]["Spectrogram"][i]["Missing"] = np.zeros(stream["TimeDomain"]["Spectrogram"][i]["Time"].shape, dtype=bool)
-        for j in range(len(stream["TimeDomain"]["Spectrogram"][i]["Missing"])):
-            if np.any(stream["TimeDomain"]["Missing"][rangeSelection(TimeArray, [stream["TimeDomain"]["Spectrogram"][i]["Time"][j]-2, stream["TimeDomain"]["Spectrogram"][i]["Time"][j]+2]), i]):
-                stream["TimeDomain"]["Spectrogram"][i]["Missing"][j] = True
+        stream["TimeDomain"]["Spectrogram"][i]["Missing"] = MissingLabel.windowMissingLabel(stream["TimeDomain"]["Missing"][:,i], TimeArray, stream["TimeDomain"]["Spectrogram"][i]["Time"]-2, stream["TimeDomain"]["Spectrogram"][i]["Time"]+2)
         del(stream["TimeDomain"]["Spectrogram"][i]["logPower"])
 
     return stream
@@ -352,21 +341,24 @@ def queryRealtimeStreamRecording(analysis, cardiacFilter=False, refresh=False):
     BrainSenseData["TimeDomain"] = Database.loadSourceDataPointer(TimeRecording.recording_datapointer)
     BrainSenseData["PowerDomain"] = Database.loadSourceDataPointer(PowerRecording.recording_datapointer)
     
-    if not "CardiacFilter" in TimeRecording.recording_info:
-        TimeRecording.recording_info["CardiacFilter"] = cardiacFilter
-        TimeRecording.save()
-
-    if not "Spectrogram" in BrainSenseData["TimeDomain"].keys() or (refresh or not TimeRecording.recording_info["CardiacFilter"] == cardiacFilter):
-        TimeRecording.recording_info["CardiacFilter"] = cardiacFilter
+    ProcessingParameters = getProcessingParameters(cardiacFilter)
+    DerivedProduct = None
+    if not refresh:
+        DerivedProduct = Database.loadDerivedProduct(TimeRecording.recording_datapointer, ProcessingParameters, PROCESSING_VERSION)
+    
+    if DerivedProduct:
+        BrainSenseData["TimeDomain"].update(DerivedProduct)
+    else:
         BrainSenseData = processRealtimeStreams(BrainSenseData, cardiacFilter=cardiacFilter)
-        Database.saveSourceFiles(BrainSenseData["TimeDomain"], "SummitLfp", "Raw", TimeRecording.recording_id, TimeRecording.device_deidentified_id)
-        TimeRecording.save()
-        print("Refresh")
+        BrainSenseData["TimeDomain"]["Pyramid"] = LevelOfDetail.buildStreamPyramid(BrainSenseData["TimeDomain"])
+        Database.saveDerivedProduct({key: BrainSenseData["TimeDomain"][key] for key in ["Filtered", "Wavelet", "Spectrogram", "Pyramid"]}, 
+                                    TimeRecording.recording_datapointer, ProcessingParameters, PROCESSING_VERSION)
     
     BrainSenseData["Timestamp"] = analysis.analysis_date.timestamp()
     BrainSenseData["Info"]["Power"].update(PowerRecording.recording_info)
     BrainSenseData["Info"]["Time"].update(TimeRecording.recording_info)
     BrainSenseData["Info"]["Device"] = "Summit RC+S"
+    BrainSenseData["Info"]["CardiacFilter"] = cardiacFilter
 
     RecordingID = analysis.deidentified_id
     
@@ -399,15 +391,15 @@ def queryMultipleSegmentComparison(user, recordingIds, authority):
         if str(recording.device_deidentified_id) in authority["Devices"]:
             BrainSenseData = Database.loadSourceDataPointer(recording.recording_datapointer)
 
-            if len(recording.recording_info["Channel"]) == 2:
-                info = "Bilateral"
-            else:
-                info = "Unilateral"
-
+            # Spectrogram is stored as derived product, the raw recording is left untouched.
             if not "Spectrogram" in BrainSenseData.keys():
-                BrainSenseData = processRealtimeStreams(BrainSenseData)
-                Database.saveSourceFiles(BrainSenseData, recording.recording_type, info, recording.recording_id, recording.device_deidentified_id)
-                recording.save()
+                ProcessingParameters = getProcessingParameters()
+                DerivedProduct = Database.loadDerivedProduct(recording.recording_datapointer, ProcessingParameters, PROCESSING_VERSION)
+                if DerivedProduct == None:
+                    BrainSenseData = processRealtimeStreams(BrainSenseData)
+                    DerivedProduct = {"Spectrogram": BrainSenseData["Spectrogram"]}
+                    Database.saveDerivedProduct(DerivedProduct, recording.recording_datapointer, ProcessingParameters, PROCESSING_VERSION)
+                BrainSenseData.update(DerivedProduct)
             
             BrainSenseData["Stimulation"] = processRealtimeStreamStimulationAmplitude(BrainSenseData)
             for StimulationSeries in BrainSenseData["Stimulation"]:
@@ -481,15 +473,12 @@ def mergeRealtimeStreamData(recordings):
     else:
         info = "Unilateral"
         
-    Database.saveSourceFiles(CombinedData, recordings[0].recording_type, info, recordings[0].recording_id, recordings[0].device_deidentified_id)
+    recordings[0].recording_datapointer = Database.saveSourceFiles(CombinedData, recordings[0].recording_type, info, recordings[0].recording_id, recordings[0].device_deidentified_id)
     recordings[0].recording_duration = CombinedData["Time"][-1]
     recordings[0].save()
 
     for i in range(1, len(recordings)):
-        try:
-            os.remove(DATABASE_PATH + "recordings" + os.path.sep + recordings[i].recording_datapointer)
-        except:
-            pass
+        Database.deleteSourceDataPointer(recordings[i].recording_datapointer)
         recordings[i].delete()
     
     return True